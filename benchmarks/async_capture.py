@@ -0,0 +1,111 @@
+"""Throughput of the asyncio capture mode, driven by the local replay server
+
+Records generated markets, replays them over the exchange stream protocol with `ReplayServer` and
+captures them with `AsyncCapture` (one event loop, one writer thread). Reports the market changes
+captured per second and checks that every captured market is identical to its source.
+
+Usage:
+    python benchmarks/async_capture.py
+    python benchmarks/async_capture.py --streams 50 --markets-per-stream 20 --buffer-size 100
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from backtest_throughput import encode_packets, synthetic_market  # noqa: E402
+from stream.async_capture import AsyncCapture, AsyncCaptureConfig  # noqa: E402
+from stream.replay_server import ReplayServer  # noqa: E402
+from stream.session import SessionManager  # noqa: E402
+from stream.storage.data_location import DataLocation  # noqa: E402
+from stream.streaming import StreamConfig  # noqa: E402
+
+
+def record_markets(data_path: str, markets, num_packets: int) -> int:
+    data_location = DataLocation(data_path, [])
+    packet_count = 0
+    for event_id, market_id in markets:
+        os.makedirs(os.path.join(data_path, event_id), exist_ok=True)
+        packets = synthetic_market(market_id, num_runners=10, num_packets=num_packets)
+        lines = "".join(encode_packets(packets))
+        with open(os.path.join(data_path, event_id, f"{market_id}.txt"), "w") as f:
+            f.write(lines)
+        data_location.record_capture(event_id, market_id, f"{market_id}.txt", len(lines),
+                                     len(packets), packets[0][0], packets[-1][0])
+        packet_count += len(packets)
+    return packet_count
+
+
+async def capture(source: DataLocation, output: DataLocation, streams, markets, expected: int,
+                  buffer_size: int) -> float:
+    server = ReplayServer(source, markets)
+    await server.start()
+    # The replay server accepts any session
+    client = SimpleNamespace(session_expired=False, session_token="replay", app_key="replay",
+                             keep_alive=lambda: None)
+    config = AsyncCaptureConfig(host=server.host, port=server.port, ssl=False,
+                                buffer_size=buffer_size, metrics_interval_sec=5)
+    async_capture = AsyncCapture(config, streams, {"fields": ["EX_ALL_OFFERS"]}, output,
+                                 SessionManager(client))
+
+    start = time.perf_counter()
+    task = asyncio.create_task(async_capture.run())
+    while async_capture.metrics["changes"] < expected:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    seconds = time.perf_counter() - start
+    await server.stop()
+    return seconds
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure the asyncio capture throughput")
+    parser.add_argument("--streams", type=int, default=10, help="Number of stream subscriptions")
+    parser.add_argument("--markets-per-stream", type=int, default=5)
+    parser.add_argument("--packets", type=int, default=2000, help="Packets per market")
+    parser.add_argument("--buffer-size", type=int, default=5,
+                        help="Changes buffered per market before a write, every write updates the "
+                             "catalog")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as source_path, tempfile.TemporaryDirectory() as output_path:
+        events = {f"3200{idx:04d}": [f"1.2{idx:04d}{market:03d}"
+                                     for market in range(args.markets_per_stream)]
+                  for idx in range(args.streams)}
+        markets = [(event_id, market_id) for event_id, market_ids in events.items()
+                   for market_id in market_ids]
+        expected = record_markets(source_path, markets, args.packets)
+
+        output = DataLocation(output_path, [])
+        for event_id, market_ids in events.items():
+            output.catalog.add_event({"id": event_id},
+                                     [{"marketId": market_id} for market_id in market_ids])
+            os.makedirs(os.path.join(output_path, event_id), exist_ok=True)
+        streams = [StreamConfig(datetime.now(), f"stream-{event_id}", {"eventIds": [event_id]},
+                                {"eventIds": [event_id]}) for event_id in events]
+
+        source = DataLocation(source_path, [])
+        seconds = asyncio.run(capture(source, output, streams, markets, expected, args.buffer_size))
+
+        mismatched = [market_id for event_id, market_id in markets
+                      if list(source.iter_market(event_id, market_id))
+                      != list(output.iter_market(event_id, market_id))]
+        print(f"{len(streams)} stream(s), {len(markets)} market(s), {expected} changes")
+        print(f"    captured {expected / seconds:12,.0f} changes/s ({seconds:.2f}s)")
+        identical = len(markets) - len(mismatched)
+        print(f"    identical to the source: {identical}/{len(markets)} market(s)")
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
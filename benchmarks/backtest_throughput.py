@@ -0,0 +1,134 @@
+"""Packets per second of the backtest engine
+
+Replays generated markets (or recorded captures) through `Backtest` and reports:
+    - engine throughput on pre-decoded packets (books, trade tape, order matching and strategy
+      callbacks)
+    - end to end throughput from the capture files, including decoding the JSON lines
+    - parameter grid throughput over a process pool
+
+Usage:
+    python benchmarks/backtest_throughput.py                        # generated markets
+    python benchmarks/backtest_throughput.py --data data --markets <event_id>/<market_id> [...]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from backtest.broker import BACK  # noqa: E402
+from backtest.engine import Backtest, iter_merged_packets, run_parameter_grid  # noqa: E402
+from backtest.strategy import Strategy  # noqa: E402
+from stream.storage.capture import CaptureRecord, encode_record  # noqa: E402
+from stream.storage.data_location import DataLocation  # noqa: E402
+
+
+class BackFavourite(Strategy):
+    """Backs the favourite below `max_price` once per market, the orders exercise the broker"""
+
+    def __init__(self, **params) -> None:
+        super().__init__(**params)
+        self.placed = set()
+
+    def on_market_book(self, backtest, books):
+        if books.market_id in self.placed:
+            return
+        best = None
+        for runner_id, book in books.runners.items():
+            price = book.atb_ladder[0][0] if book.atb_ladder else None
+            if price is not None and (best is None or price < best[1]):
+                best = (runner_id, price)
+        if best is not None and best[1] <= self.params.get("max_price", 3.0):
+            backtest.place_order(books.market_id, best[0], BACK, best[1],
+                                 self.params.get("stake", 2.0))
+            self.placed.add(books.market_id)
+
+
+def synthetic_market(market_id: str, num_runners: int = 10,
+                     num_packets: int = 50000) -> List[Tuple[int, Dict]]:
+    """Generate the packets of a market with price, volume and traded ladder updates"""
+    rng = random.Random(market_id)
+    runner_ids = [50000000 + idx for idx in range(num_runners)]
+    traded = {runner_id: {} for runner_id in runner_ids}
+    definition = {"status": "OPEN", "inPlay": False,
+                  "runners": [{"id": runner_id, "status": "ACTIVE"} for runner_id in runner_ids]}
+    timestamp = 1676386800000
+    packets = [(timestamp, {"id": market_id, "img": True, "marketDefinition": definition,
+                            "rc": []})]
+    for _ in range(num_packets):
+        timestamp += rng.randint(5, 200)
+        runner_id = rng.choice(runner_ids)
+        price = round(rng.uniform(1.5, 10), 1)
+        runner_change = {"id": runner_id, "atb": [[price, round(rng.uniform(0, 100), 2)]],
+                         "atl": [[round(price + 0.1, 1), round(rng.uniform(0, 100), 2)]]}
+        if rng.random() < 0.3:
+            volume = traded[runner_id].get(price, 0) + rng.uniform(1, 50)
+            traded[runner_id][price] = round(volume, 2)
+            runner_change["trd"] = [[price, traded[runner_id][price]]]
+            runner_change["ltp"] = price
+        packets.append((timestamp, {"id": market_id, "rc": [runner_change]}))
+    settled = {"status": "CLOSED", "inPlay": True,
+               "runners": [{"id": runner_id, "status": "WINNER" if idx == 0 else "LOSER"}
+                           for idx, runner_id in enumerate(runner_ids)]}
+    packets.append((timestamp + 1000, {"id": market_id, "marketDefinition": settled}))
+    return packets
+
+
+def encode_packets(packets: List[Tuple[int, Dict]]) -> List[str]:
+    """Capture lines of generated packets, numbered from 1"""
+    return [encode_record(CaptureRecord(sequence, timestamp, None, None, packet))
+            for sequence, (timestamp, packet) in enumerate(packets, start=1)]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure backtest engine throughput")
+    parser.add_argument("--data", help="Data folder of recorded captures")
+    parser.add_argument("--markets", nargs="*", default=[],
+                        help="<event_id>/<market_id> of the markets to replay")
+    parser.add_argument("--workers", type=int, default=None, help="Processes of the parameter grid")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.data and args.markets:
+            data_path = args.data
+            markets = [tuple(market.split("/")) for market in args.markets]
+        else:
+            data_path, markets = tmp_dir, [("32000000", f"1.2100000{idx:02d}") for idx in range(4)]
+            data_location = DataLocation(data_path, [])
+            for event_id, market_id in markets:
+                os.makedirs(os.path.join(tmp_dir, event_id), exist_ok=True)
+                packets = synthetic_market(market_id)
+                lines = "".join(encode_packets(packets))
+                with open(os.path.join(tmp_dir, event_id, f"{market_id}.txt"), "w") as f:
+                    f.write(lines)
+                data_location.record_capture(event_id, market_id, f"{market_id}.txt", len(lines),
+                                             len(packets), packets[0][0], packets[-1][0])
+
+        data_location = DataLocation(data_path, [])
+        start = time.perf_counter()
+        packets = list(iter_merged_packets(data_location, markets))
+        decode_seconds = time.perf_counter() - start
+
+        result = Backtest(BackFavourite(), latency_ms=100).run(packets)
+        print(f"{len(markets)} market(s), {len(packets)} packets")
+        print(f"    decode + merge {len(packets) / decode_seconds:12,.0f} packets/s")
+        print(f"    engine         {result['packets_per_second']:12,.0f} packets/s "
+              f"({result['orders']} orders, {result['size_matched']:.2f} matched, "
+              f"profit {result['profit']:.2f})")
+
+        param_grid = {"max_price": [2.0, 3.0, 4.0, 5.0], "stake": [2.0, 5.0]}
+        start = time.perf_counter()
+        results = run_parameter_grid(data_path, markets, BackFavourite, param_grid, 100,
+                                     args.workers)
+        grid_seconds = time.perf_counter() - start
+        print(f"    grid           {len(results) * len(packets) / grid_seconds:12,.0f} packets/s "
+              f"({len(results)} backtests end to end, {grid_seconds:.2f}s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""Byte and parse time savings of dictionary encoded market definitions
+
+Re-encodes recorded market captures with `DefinitionEncoder` and compares them with the raw
+captures:
+    - capture size (the encoded size includes the `.defs` sidecar)
+    - time to decode every packet (the encoded time includes expanding the definitions)
+    - that the expanded packets are identical to the raw packets
+
+Usage:
+    python benchmarks/definition_encoding.py data/<event_id>/<market_id>.txt [...]
+    python benchmarks/definition_encoding.py --synthetic   # racing market with suspend/resume churn
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from stream.storage.capture import CaptureRecord, decode_record, encode_record  # noqa: E402
+from stream.storage.definition_codec import DefinitionDecoder, DefinitionEncoder  # noqa: E402
+
+REPEATS = 5
+
+
+def synthetic_racing_market(num_runners: int = 14, num_packets: int = 20000) -> List[str]:
+    """Generate capture lines of a horse race with frequent suspend/resume and non-runner definition
+    changes"""
+    random.seed(1)
+    definition = {
+        "bspMarket": True, "turnInPlayEnabled": True, "persistenceEnabled": True,
+        "marketBaseRate": 5.0, "eventId": "32000000", "eventTypeId": "7", "numberOfWinners": 1,
+        "bettingType": "ODDS", "marketType": "WIN", "marketTime": "2023-02-14T15:30:00.000Z",
+        "suspendTime": "2023-02-14T15:30:00.000Z", "bspReconciled": False, "complete": True,
+        "inPlay": False, "crossMatching": True, "runnersVoidable": False,
+        "numberOfActiveRunners": num_runners, "betDelay": 0, "status": "OPEN", "venue": "Kempton",
+        "countryCode": "GB", "discountAllowed": True, "timezone": "Europe/London",
+        "openDate": "2023-02-14T13:00:00Z", "version": 5000000000, "name": "2m Hcap Hrd",
+        "eventName": "Kempton 14th Feb",
+        "runners": [{"adjustmentFactor": round(random.uniform(1, 30), 2), "status": "ACTIVE",
+                     "sortPriority": idx + 1, "id": 40000000 + idx, "name": f"Runner {idx + 1}",
+                     "bsp": None} for idx in range(num_runners)],
+    }
+
+    lines, timestamp = [], 1676386800000
+    for idx in range(num_packets):
+        timestamp += random.randint(20, 400)
+        update = {"id": "1.210000000", "rc": [
+            {"id": 40000000 + random.randrange(num_runners),
+             "atb": [[round(random.uniform(2, 20), 1), 10.5]]}
+        ]}
+        if idx % 50 == 0:
+            definition = json.loads(json.dumps(definition))
+            definition["status"] = "SUSPENDED" if definition["status"] == "OPEN" else "OPEN"
+            definition["version"] += 1
+            if random.random() < 0.05:
+                runner = random.choice(definition["runners"])
+                runner["status"] = "REMOVED"
+            update["marketDefinition"] = definition
+        lines.append(encode_record(CaptureRecord(idx + 1, timestamp, None, None, update)))
+    return lines
+
+
+def measure(lines: List[str]) -> Tuple[int, int, float, float, bool]:
+    """Encode the capture lines and measure size and decode time of the raw and encoded captures
+
+    Returns:
+        Tuple[int, int, float, float, bool]: raw bytes, encoded bytes, raw decode seconds, encoded
+            decode seconds, whether the decoded packets match
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        defs_path = os.path.join(tmp_dir, "market.defs")
+        encoder = DefinitionEncoder(defs_path)
+        encoded_lines = []
+        for line in lines:
+            record = decode_record(line)
+            encoded = record._replace(update=encoder.encode(record.update))
+            encoded_lines.append(encode_record(encoded))
+        encoder.flush()
+
+        raw_bytes = sum(len(line.encode()) for line in lines)
+        encoded_bytes = (sum(len(line.encode()) for line in encoded_lines)
+                         + os.path.getsize(defs_path))
+
+        # Both captures are decoded the same way, best of REPEATS runs without garbage collection,
+        # which would otherwise charge the scans of the packets kept from the first loop to the
+        # second one
+        raw_seconds = encoded_seconds = float("inf")
+        gc.disable()
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            raw_packets: List[CaptureRecord] = []
+            for line in lines:
+                record = decode_record(line)
+                raw_packets.append(record._replace(update=record.update))
+            raw_seconds = min(raw_seconds, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            decoder = DefinitionDecoder(defs_path)
+            encoded_packets: List[CaptureRecord] = []
+            for line in encoded_lines:
+                record = decode_record(line)
+                encoded_packets.append(record._replace(update=decoder.decode(record.update)))
+            encoded_seconds = min(encoded_seconds, time.perf_counter() - start)
+        gc.enable()
+
+    return raw_bytes, encoded_bytes, raw_seconds, encoded_seconds, raw_packets == encoded_packets
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Measure dictionary encoding of market definitions")
+    parser.add_argument("captures", nargs="*", help="Raw .txt market captures")
+    parser.add_argument("--synthetic", action="store_true", help="Use a generated racing market")
+    args = parser.parse_args()
+
+    captures = {path: open(path).readlines() for path in args.captures}
+    if args.synthetic or not captures:
+        captures["synthetic racing market"] = synthetic_racing_market()
+
+    lossless = True
+    for name, lines in captures.items():
+        raw_bytes, encoded_bytes, raw_seconds, encoded_seconds, matches = measure(lines)
+        lossless = lossless and matches
+        print(f"{name}: {len(lines)} packets")
+        print(f"    size   {raw_bytes / 1e6:8.2f}MB -> {encoded_bytes / 1e6:8.2f}MB "
+              f"({100 * (1 - encoded_bytes / raw_bytes):.1f}% smaller)")
+        print(f"    decode {raw_seconds:8.3f}s  -> {encoded_seconds:8.3f}s  "
+              f"({100 * encoded_seconds / raw_seconds:.1f}% of raw time)")
+        print(f"    lossless {matches}")
+
+    return 0 if lossless else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""Time to open a market in the dashboard with the order book history cache
+
+Records generated markets, then measures the replay of a market's order book history (cache miss)
+against opening it from the memory-mapped cache entry with a new `HistoryCache`, as a new dashboard
+process would. Checks that the cached histories equal a direct replay with `MarketOrderBookHistory`
+and that the LRU eviction keeps the cache under its size limit.
+
+Usage:
+    python benchmarks/history_cache.py
+    python benchmarks/history_cache.py --markets 5 --packets 10000 --runners 12
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from backtest_throughput import encode_packets, synthetic_market  # noqa: E402
+from order_book.history_cache import HistoryCache, HistoryCacheConfig  # noqa: E402
+from order_book.order_book_history import MarketOrderBookHistory  # noqa: E402
+from stream.storage.data_location import DataLocation  # noqa: E402
+
+
+def record_market(data_location: DataLocation, event_id: str, market_id: str, num_runners: int,
+                  num_packets: int) -> list:
+    os.makedirs(os.path.join(data_location.data_path, event_id), exist_ok=True)
+    packets = synthetic_market(market_id, num_runners=num_runners, num_packets=num_packets)
+    lines = "".join(encode_packets(packets))
+    with open(os.path.join(data_location.data_path, event_id, f"{market_id}.txt"), "w") as f:
+        f.write(lines)
+    data_location.record_capture(event_id, market_id, f"{market_id}.txt", len(lines), len(packets),
+                                 packets[0][0], packets[-1][0])
+    return [50000000 + idx for idx in range(num_runners)]
+
+
+def matches_replay(data_location: DataLocation, history, event_id: str, market_id: str,
+                   runner_ids: list) -> bool:
+    replay = MarketOrderBookHistory(runner_ids)
+    for timestamp, packet in data_location.iter_market(event_id, market_id):
+        replay.update(timestamp, packet)
+    for runner_id in runner_ids:
+        expected = replay.get_runner_order_book(runner_id)
+        cached = history.get_runner_history(runner_id)
+        if (expected.timestamps != cached.timestamps.tolist()
+                or expected.ltp_history != cached.ltp.tolist()
+                or expected.tv_history != cached.tv.tolist()):
+            return False
+        for row, ladder in enumerate(expected.atl_price_history):
+            cached_ladder = cached.atl_price[row][~np.isnan(cached.atl_price[row])].tolist()
+            if ladder[:cached.atl_price.shape[1]] != cached_ladder:
+                return False
+    return True
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Measure the order book history cache of the dashboard")
+    parser.add_argument("--markets", type=int, default=3)
+    parser.add_argument("--packets", type=int, default=10000, help="Packets per market")
+    parser.add_argument("--runners", type=int, default=12, help="Runners per market")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_path:
+        data_location = DataLocation(data_path, [])
+        markets = [("32000000", f"1.2200000{idx:02d}") for idx in range(args.markets)]
+        runners = {market_id: record_market(data_location, event_id, market_id, args.runners,
+                                            args.packets)
+                   for event_id, market_id in markets}
+
+        replay_seconds, open_seconds, identical = [], [], 0
+        for event_id, market_id in markets:
+            start = time.perf_counter()
+            HistoryCache(data_location).get(event_id, market_id, runners[market_id])
+            replay_seconds.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            history = HistoryCache(data_location).get(event_id, market_id, runners[market_id])
+            for runner_id in runners[market_id]:
+                history.get_runner_history(runner_id).ltp.sum()
+            open_seconds.append(time.perf_counter() - start)
+            identical += matches_replay(data_location, history, event_id, market_id,
+                                        runners[market_id])
+
+        history_cache = HistoryCache(data_location)
+        total_bytes = sum(byte_size for _, byte_size, _ in history_cache.entries())
+        entry_mb = total_bytes / len(markets) / 1024 / 1024
+        history_cache.config = HistoryCacheConfig(max_mb=entry_mb * 1.5)
+        history_cache.evict()
+        remaining = len(history_cache.entries())
+
+        print(f"{len(markets)} market(s), {args.packets} packets and {args.runners} runners each, "
+              f"{entry_mb:.1f}MB per entry")
+        print(f"    replay (miss) {np.median(replay_seconds) * 1000:10.1f}ms median")
+        print(f"    open (hit)    {np.median(open_seconds) * 1000:10.1f}ms median")
+        print(f"    identical to a direct replay: {identical}/{len(markets)} market(s)")
+        print(f"    entries left after evicting to {entry_mb * 1.5:.1f}MB: {remaining}")
+    return 0 if identical == len(markets) and remaining == 1 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
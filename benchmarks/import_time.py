@@ -0,0 +1,113 @@
+"""Cold start import benchmark for each CLI mode
+
+Runs `python -X importtime` in a fresh interpreter for every mode of `src/main.py` and checks that:
+    - the total import time stays under the mode's target
+    - the parse/report modes do not pull in any of the streaming/plotting dependencies
+
+Usage:
+    python benchmarks/import_time.py [--repeat 5] [--scale 1.0]
+
+Exits with a non-zero status code if any mode breaks its budget.
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Modules imported by each mode of main.py (main itself is always imported first)
+MODES: Dict[str, List[str]] = {
+    "parse": ["stream.storage.data_location", "parse.parser"],
+    "report": ["stream.storage.data_location", "utils.report"],
+    "features": ["stream.storage.data_location", "utils.dataset"],
+    "stream": [
+        "stream.writer.stream_writer",
+        "stream.scheduler",
+        "stream.storage.data_location",
+        "utils.helper",
+    ],
+}
+
+# Import time budget per mode in milliseconds (best of --repeat runs)
+TARGETS_MS: Dict[str, float] = {
+    "parse": 150,
+    "report": 150,
+    "features": 150,
+    "stream": 1500,
+}
+
+# Heavy dependencies which must never be imported by the given mode
+FORBIDDEN: Dict[str, List[str]] = {
+    "parse": ["betfairlightweight", "pandas", "matplotlib", "tenacity", "dacite"],
+    "report": ["betfairlightweight", "pandas", "matplotlib", "tenacity", "dacite"],
+    "features": ["betfairlightweight", "pandas", "matplotlib", "tenacity", "dacite"],
+    "stream": ["pandas", "matplotlib"],
+}
+
+
+def measure_imports(modules: List[str]) -> Tuple[float, List[str]]:
+    """Import the modules in a fresh interpreter and parse the `-X importtime` output
+
+    Args:
+        modules (List[str]): Modules to import after main
+
+    Returns:
+        Tuple[float, List[str]]: Total import time in ms, list of top level packages imported
+    """
+    statement = "; ".join(f"import {module}" for module in ["main"] + modules)
+    env = dict(os.environ, PYTHONPATH=SRC_PATH)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=SRC_PATH, env=env, capture_output=True, text=True, check=True
+    )
+
+    total_us = 0
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        packages.add(name.strip().split(".")[0])
+        # Only count top level imports, nested imports are included in their parents cumulative time
+        if not name[1:].startswith(" "):
+            total_us += int(cumulative)
+
+    return total_us / 1000, sorted(packages)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure CLI cold start import time per mode")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of runs per mode, best run is reported")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiply all targets, e.g. for slow CI runners")
+    args = parser.parse_args()
+
+    failed = False
+    for mode, modules in MODES.items():
+        runs = [measure_imports(modules) for _ in range(args.repeat)]
+        best_ms = min(elapsed for elapsed, _ in runs)
+        packages = runs[0][1]
+        target_ms = TARGETS_MS[mode] * args.scale
+
+        status = "OK"
+        if best_ms > target_ms:
+            status = "SLOW"
+            failed = True
+
+        leaked = [package for package in FORBIDDEN[mode] if package in packages]
+        if leaked:
+            status = "LEAK"
+            failed = True
+
+        print(f"{mode:<8} {best_ms:8.1f}ms (target {target_ms:.0f}ms) {status}")
+        if leaked:
+            print(f"{'':<8} imports {', '.join(leaked)}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,26 +3,31 @@ import dotenv
 import plotly.graph_objs as go
 import pandas as pd
 import numpy as np
+import os
 from utils.helper import convert_timestamp_to_datetime
 from datetime import timedelta, time
+from time import sleep
 from utils.configure import load_config
 from stream.storage.data_location import DataLocation
 from order_book.order_book_history import MarketOrderBookHistory
+from order_book.history_cache import HistoryCache, HistoryCacheConfig, MarketHistory, RunnerHistory
+from order_book.resample import choose_resolution, lttb
+from stream.storage.tail import CaptureTailer
 
 # Load environment variables from .env file
 dotenv.load_dotenv()
-_, config = load_config()
+config = load_config()
 data_location = DataLocation(config["paths"]["data_dir"], [])
-events = data_location.load_json_data(file_name="eventLog.json")
+events = data_location.load_events()
 
 
-@st.cache
+@st.cache_data(max_entries=64)
 def get_event_info(event_id):
     event_info = data_location.load_event(event_id)
     return event_info["event"], event_info["markets"]
 
 
-@st.cache
+@st.cache_data(max_entries=8)
 def get_orderbook_data(event_id, market_id):
     orderbook_data = data_location.load_market(event_id, market_id)
     return orderbook_data
@@ -35,6 +40,13 @@ event_id = st.sidebar.selectbox("Events", list(events), format_func=lambda x: ev
 event, markets = get_event_info(event_id)
 market_idx = st.sidebar.selectbox("Markets", list(range(len(markets))), format_func=lambda x: markets[x]['marketName'])
 max_load_limit = st.sidebar.number_input("Max Load Limit", 0, 100000, 10000)
+window_minutes = st.sidebar.number_input("Last N Minutes (0 = from start)", 0, 24 * 60, 0)
+max_points = st.sidebar.number_input("Max Chart Points", 100, 20000, 2000)
+live = st.sidebar.checkbox("Live (follow the capture being recorded)")
+refresh_seconds = st.sidebar.number_input("Refresh Interval (s)", 1, 60, 2)
+
+# Windows up to this length are shown tick by tick, longer ones from the resolution pyramid
+TICK_WINDOW_MS = 5 * 60 * 1000
 
 st.title(f'{events[event_id]}')
 st.write("""
@@ -48,51 +60,206 @@ View game metrics over time, and compare between runners
 # TODO: Add start time and end time filter
 
 
-@st.cache
-def get_order_book_history(runner_ids, max_load_limit) -> MarketOrderBookHistory:
-    market_history = MarketOrderBookHistory(runner_ids)
+def get_market_time_range(market_id):
+    captures = data_location.catalog.get_capture_files(market_id=market_id)
+    first_timestamp = min([capture["first_timestamp"] for capture in captures
+                           if capture["first_timestamp"]],
+                          default=0)
+    last_timestamp = max([capture["last_timestamp"] or 0 for capture in captures], default=0)
+    return first_timestamp, last_timestamp
+
+
+def get_captures_key(event_id, market_id):
+    # Size and mtime of the capture files, changes when the capture grows
+    captures = (data_location.get_capture_files("txt", event_id, market_id)
+                + data_location.get_capture_files("json", event_id, market_id))
+    key = []
+    for path in captures:
+        try:
+            file_stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        key.append((path, file_stat.st_size, file_stat.st_mtime_ns))
+    return tuple(key)
+
+
+@st.cache_resource(max_entries=8)
+def get_market_pyramid(event_id, market_id, captures_key):
+    # `captures_key` invalidates the cached pyramid when the capture changes, see get_captures_key
+    return data_location.load_market_pyramid(event_id, market_id)
+
+
+@st.cache_resource
+def get_history_cache() -> HistoryCache:
+    # One cache per server process, the replayed histories are shared with other processes through
+    # the disk
+    history_cache = HistoryCache(data_location, HistoryCacheConfig.from_config(config))
+    if history_cache.config.prewarm:
+        history_cache.prewarm()
+    return history_cache
+
+
+def get_order_book_history(runner_ids, max_load_limit, window_minutes) -> MarketHistory:
     market_id = markets[market_idx]['marketId']
-    market_data = data_location.load_market(event_id, market_id)["mcm"]
-    counter = 0
+    _, last_timestamp = get_market_time_range(market_id)
+    start, end = None, None
+    if window_minutes > 0 and last_timestamp > 0:
+        # Only decode the requested window using the capture's sidecar index
+        start, end = last_timestamp - window_minutes * 60 * 1000, last_timestamp
+    return get_history_cache().get(event_id, market_id, runner_ids, start, end,
+                                   max_load_limit or None)
 
-    for timestamp, packet in market_data.items():
-        market_history.update(timestamp, packet)
 
-        counter += 1
-        if counter > max_load_limit:
-            print(f"Reached Limit: Processed {len(market_history)} packets")
-            break
-    return market_history
+def ladder(values):
+    # Book state of each row without the NaN padding
+    return [row[~np.isnan(row)].tolist() for row in values]
 
 
 def get_runner_data(runner_id, order_book_history):
-    runner_history = order_book_history.get_runner_order_book(runner_id)
+    runner_history: RunnerHistory = order_book_history.get_runner_history(runner_id)
+    if len(runner_history) == 0:
+        return pd.DataFrame(columns=["Volume", "ATL Price", "ATL Volume", "ATB Price", "ATB Volume",
+                                     "Close", "Total Volume"]), None, None
     game_start_time = convert_timestamp_to_datetime(runner_history.timestamps[0]).time()
     game_end_time = convert_timestamp_to_datetime(runner_history.timestamps[-1]).time()
     runner_timestamps = pd.to_datetime(runner_history.timestamps, unit='ms')
 
-    data = pd.DataFrame({"Volume": runner_history.delta_tv_history,
-                         "ATL Price": runner_history.atl_price_history,
-                         "ATL Volume": runner_history.atl_volume_history,
-                         "ATB Price": runner_history.atb_price_history,
-                         "ATB Volume": runner_history.atb_volume_history,
-                         "Close": runner_history.ltp_history,
-                         "Total Volume": runner_history.tv_history},
+    data = pd.DataFrame({"Volume": runner_history.delta_tv,
+                         "ATL Price": ladder(runner_history.atl_price),
+                         "ATL Volume": ladder(runner_history.atl_volume),
+                         "ATB Price": ladder(runner_history.atb_price),
+                         "ATB Volume": ladder(runner_history.atb_volume),
+                         "Close": runner_history.ltp,
+                         "Total Volume": runner_history.tv},
                         index=runner_timestamps)
     return data, game_start_time, game_end_time
 
 
+def get_live_market(event_id, market_id, runner_ids, window_minutes):
+    # The tailer and order book history survive reruns, so new packets are added to the existing
+    # history. A session follows one market at a time, the tailer of the previous one is closed
+    key = (event_id, market_id, tuple(runner_ids), window_minutes)
+    live_market = st.session_state.get("live")
+    if live_market is None or live_market[0] != key:
+        if live_market is not None:
+            live_market[1].close()
+        _, last_timestamp = get_market_time_range(market_id)
+        start_timestamp = None
+        if window_minutes > 0:
+            start_timestamp = last_timestamp - window_minutes * 60 * 1000
+        st.session_state["live"] = (key,
+                                    CaptureTailer(data_location, event_id, market_id, start_timestamp),
+                                    MarketOrderBookHistory(runner_ids))
+    return st.session_state["live"][1:]
+
+
+def get_live_rows(runner_id, order_book_history, start):
+    # Chart rows of the packets added to the history since `start`
+    runner_history = order_book_history.get_runner_order_book(runner_id)
+    return pd.DataFrame({"Close": runner_history.ltp_history[start:],
+                         "Volume": runner_history.delta_tv_history[start:],
+                         "Total Volume": runner_history.tv_history[start:]},
+                        index=pd.to_datetime(runner_history.timestamps[start:], unit='ms'))
+
+
+def run_live(event_id, market_id, runners, runner_tabs):
+    runner_ids = [runner['selectionId'] for runner in runners]
+    tailer, order_book_history = get_live_market(event_id, market_id, runner_ids, window_minutes)
+    for timestamp, packet in tailer.poll(max_load_limit or None):
+        order_book_history.update(timestamp, packet)
+
+    charts = {}
+    for runner_idx, runner_id in enumerate(runner_ids):
+        with runner_tabs[runner_idx]:
+            st.header(runners[runner_idx]['runnerName'])
+            data = get_live_rows(runner_id, order_book_history, 0)
+            st.subheader("Price")
+            price_chart = st.line_chart(data, y="Close")
+            st.subheader("Volume")
+            volume_chart = st.bar_chart(data, y="Volume")
+            st.subheader("Total Volume")
+            total_volume_chart = st.line_chart(data, y="Total Volume")
+            charts[runner_id] = (price_chart, volume_chart, total_volume_chart)
+
+    # Only the packets written since the last refresh are read and appended to the charts
+    while True:
+        rendered = len(order_book_history)
+        sleep(refresh_seconds)
+        for timestamp, packet in tailer.poll(max_load_limit or None):
+            order_book_history.update(timestamp, packet)
+        if len(order_book_history) == rendered:
+            continue
+        for runner_id, (price_chart, volume_chart, total_volume_chart) in charts.items():
+            rows = get_live_rows(runner_id, order_book_history, rendered)
+            price_chart.add_rows(rows[["Close"]])
+            volume_chart.add_rows(rows[["Volume"]])
+            total_volume_chart.add_rows(rows[["Total Volume"]])
+
+
+def get_runner_bars(runner_id, pyramid, resolution, start, end):
+    runner_levels = pyramid.get(runner_id)
+    if runner_levels is None:
+        return pd.DataFrame(columns=["Volume", "ATL Price", "ATL Volume", "ATB Price", "ATB Volume",
+                                     "Close", "Total Volume"])
+    bars = runner_levels[resolution].window(start, end)
+    return pd.DataFrame({"Volume": bars.volume,
+                         "ATL Price": ladder(bars.atl_price),
+                         "ATL Volume": ladder(bars.atl_volume),
+                         "ATB Price": ladder(bars.atb_price),
+                         "ATB Volume": ladder(bars.atb_volume),
+                         "Open": bars.open,
+                         "High": bars.high,
+                         "Low": bars.low,
+                         "Close": bars.close,
+                         "Total Volume": bars.total_volume},
+                        index=pd.to_datetime(bars.time, unit='ms'))
+
+
+def downsample_line(data, column):
+    # Keep the shape of long lines with at most max_points points
+    if len(data) <= max_points:
+        return data
+    indices = lttb(data.index.asi8, data[column].to_numpy(dtype=float), max_points)
+    return data.iloc[indices]
+
+
 runners = markets[market_idx]['runners']
 runner_tabs = st.tabs([runner['runnerName'] for runner in runners])
 runner_ids = [runner['selectionId'] for runner in runners]
 
-with st.spinner("Building Order Book History..."):
-    order_book_history = get_order_book_history(runner_ids, max_load_limit)
+market_id = markets[market_idx]['marketId']
+if live:
+    run_live(event_id, market_id, runners, runner_tabs)
+
+# Pick the resolution which fits the visible window, full resolution ticks are only loaded for
+# short windows
+first_timestamp, last_timestamp = get_market_time_range(market_id)
+window_start = first_timestamp
+if window_minutes > 0:
+    window_start = last_timestamp - window_minutes * 60 * 1000
+resolution = None
+if last_timestamp - window_start > TICK_WINDOW_MS:
+    resolution = choose_resolution(last_timestamp - window_start, max_points)
+    st.caption(f"Showing {resolution} bars, select a window of {TICK_WINDOW_MS // 60000} minutes "
+               "or less for ticks")
+    with st.spinner("Loading Resolution Pyramid..."):
+        pyramid = get_market_pyramid(event_id, market_id, get_captures_key(event_id, market_id))
+else:
+    with st.spinner("Building Order Book History..."):
+        order_book_history = get_order_book_history(runner_ids, max_load_limit, window_minutes)
 
 for runner_idx in range(len(runners)):
     with runner_tabs[runner_idx]:
         with st.spinner("Loading Runner Data..."):
-            data, game_start_time, game_end_time = get_runner_data(runner_ids[runner_idx], order_book_history)
+            if resolution is not None:
+                data = get_runner_bars(runner_ids[runner_idx], pyramid, resolution, window_start,
+                                       last_timestamp)
+            else:
+                data, game_start_time, game_end_time = get_runner_data(runner_ids[runner_idx],
+                                                                       order_book_history)
+        if len(data) == 0:
+            st.write("No updates recorded for this runner")
+            continue
 
         st.header(runners[runner_idx]['runnerName'])
         current_time = st.select_slider("View Order Book state at time", options=data.index,
@@ -106,8 +273,8 @@ for runner_idx in range(len(runners)):
         fig.update_layout(title="Order Book", xaxis_title="Price", yaxis_title="Volume")
         st.plotly_chart(fig, use_container_width=True)
         st.subheader("Price")
-        st.line_chart(data, y="Close")
+        st.line_chart(downsample_line(data, "Close"), y="Close")
         st.subheader("Volume")
         st.bar_chart(data, y="Volume")
         st.subheader("Total Volume")
-        st.line_chart(data, y="Total Volume")
+        st.line_chart(downsample_line(data, "Total Volume"), y="Total Volume")
@@ -0,0 +1,221 @@
+import heapq
+import itertools
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from order_book.runner_order_book import RunnerOrderBook
+
+BACK = "BACK"
+LAY = "LAY"
+
+
+@dataclass
+class Order:
+    """Simulated limit order"""
+    order_id: int
+    market_id: str
+    selection_id: int
+    side: str  # BACK or LAY
+    price: float
+    size: float
+    placed_time: int  # Time the strategy placed the order (ms)
+    active_time: int  # Time the order reaches the exchange, after the simulated latency (ms)
+    status: str = "PENDING"  # PENDING, EXECUTABLE, EXECUTION_COMPLETE or CANCELLED
+    size_matched: float = 0.0
+    matched_notional: float = 0.0
+    queue_ahead: float = 0.0  # Volume at the order's price which has to trade before it is matched
+    fills: List[Tuple[int, float, float]] = field(default_factory=list)  # (time, price, size)
+
+    @property
+    def size_remaining(self) -> float:
+        return self.size - self.size_matched
+
+    @property
+    def average_price_matched(self) -> Optional[float]:
+        return self.matched_notional / self.size_matched if self.size_matched > 0 else None
+
+    def fill(self, timestamp: int, price: float, size: float) -> None:
+        self.size_matched += size
+        self.matched_notional += price * size
+        self.fills.append((timestamp, price, size))
+        if self.size_remaining <= 1e-9:
+            self.status = "EXECUTION_COMPLETE"
+
+
+def _price_priority(order: Order) -> Tuple[str, float]:
+    """ Sort key of the resting orders matched by a print, the lowest back and highest lay prices
+    first, orders at the same price keep their time priority (stable sort) """
+    return order.side, order.price if order.side == BACK else -order.price
+
+
+class SimulatedBroker:
+    """Matches simulated orders against the recorded order books and trade tape
+
+    An order reaches the exchange `latency_ms` after it is placed. It is then matched against the
+    opposite side of the book at its price or better (back orders take the available to back prices
+    at or above their price, lay orders the available to lay prices at or below it), and the rest
+    waits in the queue. A resting order is matched by prints at a better price, and by prints at its
+    price once the volume queued ahead of it has traded.
+
+    The simulated orders share the recorded volume: the volume of a book level taken by an order is
+    not available to later orders until the level changes, and the size of a print is shared by the
+    resting orders of each side, best price first.
+    """
+
+    def __init__(self, latency_ms: int = 0) -> None:
+        self.latency_ms = latency_ms
+        self.orders: Dict[int, Order] = {}
+        self._pending: List[Tuple[int, int]] = []  # Heap of (active time, order ID)
+        self._resting: Dict[Tuple[str, int], List[Order]] = {}
+        # (market ID, selection ID, side) to the book levels matched by orders, price to (level
+        # size when matched, volume taken from it)
+        self._taken: Dict[Tuple[str, int, str], Dict[float, Tuple[float, float]]] = {}
+        self._order_ids = itertools.count(1)
+
+    def place_order(self, timestamp: int, market_id: str, selection_id: int, side: str,
+                    price: float, size: float) -> Order:
+        """ Place a limit order
+
+        Raises:
+            ValueError: If the side is not BACK or LAY or the size is not positive
+        """
+        if side not in (BACK, LAY):
+            raise ValueError(f"Invalid order side {side}")
+        if size <= 0:
+            raise ValueError(f"Invalid order size {size}")
+
+        order = Order(next(self._order_ids), market_id, selection_id, side, price, size, timestamp,
+                      timestamp + self.latency_ms)
+        self.orders[order.order_id] = order
+        heapq.heappush(self._pending, (order.active_time, order.order_id))
+        return order
+
+    def cancel_order(self, order_id: int) -> None:
+        """ Cancel the unmatched part of an order, cancellations are not delayed """
+        order = self.orders[order_id]
+        if order.status in ("PENDING", "EXECUTABLE"):
+            order.status = "CANCELLED"
+
+    def has_pending(self, timestamp: int) -> bool:
+        return len(self._pending) > 0 and self._pending[0][0] <= timestamp
+
+    def activate(self, timestamp: int, books: Dict[str, Dict[int, RunnerOrderBook]]) -> List[Order]:
+        """ Submit the orders which reached the exchange by `timestamp` to the current books
+
+        Args:
+            timestamp (int): Current time (ms)
+            books (Dict[str, Dict[int, RunnerOrderBook]]): Runner books of every market
+
+        Returns:
+            List[Order]: Orders which were (partially) matched against the book
+        """
+        matched = []
+        while self._pending and self._pending[0][0] <= timestamp:
+            _, order_id = heapq.heappop(self._pending)
+            order = self.orders[order_id]
+            if order.status == "CANCELLED":
+                continue
+            order.status = "EXECUTABLE"
+            book = books.get(order.market_id, {}).get(order.selection_id)
+            if book is not None:
+                self._match_book(order, book, timestamp)
+                if order.size_matched > 0:
+                    matched.append(order)
+            if order.status == "EXECUTABLE":
+                # Back orders wait on the lay side of the book and lay orders on the back side
+                if book is not None:
+                    queue_book = book.atl_book if order.side == BACK else book.atb_book
+                    order.queue_ahead = queue_book.get(order.price, 0.0)
+                self._resting.setdefault((order.market_id, order.selection_id), []).append(order)
+        return matched
+
+    def _match_book(self, order: Order, book: RunnerOrderBook, timestamp: int) -> None:
+        if order.side == BACK:
+            levels = sorted(((price, size) for price, size in book.atb_book.items()
+                             if price >= order.price),
+                            reverse=True)
+        else:
+            levels = sorted((price, size) for price, size in book.atl_book.items()
+                            if price <= order.price)
+        taken = self._taken.setdefault((order.market_id, order.selection_id, order.side), {})
+        for price, size in levels:
+            if order.status != "EXECUTABLE":
+                break
+            level_size, level_taken = taken.get(price, (size, 0.0))
+            if level_size != size:
+                # The level changed since it was matched, the recorded size is available again
+                level_taken = 0.0
+            available = size - level_taken
+            if available <= 0:
+                continue
+            fill_size = min(available, order.size_remaining)
+            order.fill(timestamp, price, fill_size)
+            taken[price] = (size, level_taken + fill_size)
+
+    def on_prints(self, market_id: str, prints: List[Tuple[int, int, float, float]]) -> List[Order]:
+        """ Match the resting orders of a market against new prints
+
+        Args:
+            market_id (str): Market ID
+            prints (List[Tuple[int, int, float, float]]): (timestamp, selection ID, price, size)
+                prints
+
+        Returns:
+            List[Order]: Orders which were (partially) matched
+        """
+        matched = []
+        for timestamp, selection_id, price, size in prints:
+            resting = self._resting.get((market_id, selection_id))
+            if not resting:
+                continue
+            # Size of the print already matched by the orders of each side
+            taken = {BACK: 0.0, LAY: 0.0}
+            for order in sorted(resting, key=_price_priority):
+                if order.status != "EXECUTABLE":
+                    continue
+                through = price > order.price if order.side == BACK else price < order.price
+                if through:
+                    available = size - taken[order.side]
+                elif price == order.price:
+                    available = min(size - order.queue_ahead, size - taken[order.side])
+                    order.queue_ahead = max(order.queue_ahead - size, 0.0)
+                else:
+                    continue
+                if available <= 1e-9:
+                    continue
+                fill_size = min(available, order.size_remaining)
+                order.fill(timestamp, order.price, fill_size)
+                taken[order.side] += fill_size
+                matched.append(order)
+            self._resting[(market_id, selection_id)] = [order for order in resting
+                                                        if order.status == "EXECUTABLE"]
+        return matched
+
+    def settle(self, definitions: Dict[str, Optional[Dict]]) -> Dict[str, float]:
+        """ Profit and loss of the matched orders of every market from the runner statuses of its
+        last definition
+
+        Winning backs earn `size * (price - 1)` and losing backs lose their size (the reverse for
+        lays), orders on removed runners are void. Markets without a settled definition are not
+        included.
+
+        Args:
+            definitions (Dict[str, Optional[Dict]]): Last market definition of every market
+
+        Returns:
+            Dict[str, float]: Profit and loss per market
+        """
+        profit = {}
+        for order in self.orders.values():
+            definition = definitions.get(order.market_id)
+            if not definition or order.size_matched == 0:
+                continue
+            statuses = {runner["id"]: runner.get("status")
+                        for runner in definition.get("runners", [])}
+            status = statuses.get(order.selection_id)
+            if status not in ("WINNER", "LOSER"):
+                continue
+            win = (order.matched_notional - order.size_matched)
+            order_profit = win if status == "WINNER" else -order.size_matched
+            profit[order.market_id] = profit.get(order.market_id, 0.0) + \
+                (order_profit if order.side == BACK else -order_profit)
+        return profit
@@ -0,0 +1,47 @@
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
+from order_book.market_order_books import MarketOrderBooks
+
+if TYPE_CHECKING:
+    from backtest.broker import Order
+    from backtest.engine import Backtest
+
+
+class Strategy:
+    """Base class of backtest strategies, override the callbacks needed
+
+    Callbacks receive the running `Backtest`, whose `place_order`/`cancel_order` methods simulate
+    orders. The books passed to the callbacks are the live state of the replay and must not be
+    modified.
+    """
+
+    def __init__(self, **params: Any) -> None:
+        """ Initialise the strategy
+
+        Args:
+            **params: Strategy parameters, e.g. one combination of a parameter grid
+        """
+        self.params = params
+
+    def on_start(self, backtest: "Backtest") -> None:
+        pass
+
+    def on_market_book(self, backtest: "Backtest", books: MarketOrderBooks) -> None:
+        """ Called after every packet of a market with the updated books of the market """
+        pass
+
+    def on_prints(self, backtest: "Backtest", market_id: str,
+                  prints: List[Tuple[int, int, float, float]]) -> None:
+        """ Called with the (timestamp, selection ID, price, size) prints of a packet """
+        pass
+
+    def on_fill(self, backtest: "Backtest", order: "Order") -> None:
+        """ Called when a simulated order is (partially) matched """
+        pass
+
+    def on_finish(self, backtest: "Backtest") -> Dict[str, Any]:
+        """ Called once every packet has been replayed
+
+        Returns:
+            Dict[str, Any]: Extra values to add to the backtest result
+        """
+        return {}
@@ -1,38 +1,62 @@
 import logging
 import sys
-from stream.writer.stream_writer import MarketStreamHandler
-from stream.scheduler import Scheduler
-from utils.configure import load_config, get_streams
-from utils.helper import get_stream_market_data_filter, get_stream_market_filter, get_market_filter
-from stream.storage.data_location import DataLocation
-from parse.parser import MarketDataParser
-from utils import cli
-from utils.report import generate_all_events_report
-from utils.helper import get_events
+from typing import TYPE_CHECKING
+from utils.configure import load_config
+from utils import cli, profiling
 import dotenv
 
+# Mode specific modules (betfairlightweight, pandas, tenacity, dacite, ...) are imported inside the
+# run_* functions, so each mode only pays the import cost of what it uses. See
+# benchmarks/import_time.py.
+if TYPE_CHECKING:
+    from stream.scheduler import Scheduler
+
 THREAD_WAIT_SEC = 5
 BUFFER_SIZE = 5
 
 
-def confirm_markets(scheduler: Scheduler) -> bool:
+def confirm_markets(scheduler: "Scheduler") -> bool:
     scheduler.display()
 
     answer = input("Is this correct? [y/n]")
     return answer.lower() == "y"
 
 
-def run_stream(config, trading, force_run_flag=False):
+def run_stream(config, force_run_flag=False):
+    from stream.writer.stream_writer import MarketStreamHandler
+    from stream.fanout import FanOutConfig, FanOutServer
+    from stream.shared_books import SharedBookConfig, SharedBookWriter
+    from stream.bar_stage import BarConfig, BarStage
+    from stream.scheduler import Scheduler
+    from stream.session import SessionManager
+    from stream.checkpoint import CheckpointConfig, StreamCheckpoint
+    from stream.conflation import ConflationConfig, ConflationController
+    from stream.storage.data_location import DataLocation
+    from stream.storage.segments import SegmentCompressor, SegmentPolicy
+    from utils.configure import create_api_client, get_streams
+    from utils.helper import get_stream_market_data_filter, get_events
+
     logging.info("Successfully loaded config")
-    trading.login()
-    logging.info("Logged in to BetFair Account")
+    trading = create_api_client()
+    # Single login shared by the streams, kept alive in the background
+    session = SessionManager(trading)
+    session.login()
 
     # Create stream filters for markets and data
     # stream_market_filter = get_stream_market_filter(config)
     stream_market_data_filter = get_stream_market_data_filter(config)
     stream_schedule_config = get_streams(config)
 
-    scheduler = Scheduler(stream_schedule_config, trading, stream_market_data_filter)
+    # Optional checkpoint of the stream clocks, streams running before a restart resume without full
+    # images
+    checkpoint = None
+    checkpoint_config = CheckpointConfig.from_config(config)
+    if checkpoint_config is not None:
+        checkpoint = StreamCheckpoint(config["paths"]["data_dir"], checkpoint_config)
+
+    conflation_config = ConflationConfig.from_config(config)
+    scheduler = Scheduler(stream_schedule_config, trading, stream_market_data_filter,
+                          conflation_config.conflate_ms, checkpoint=checkpoint, session=session)
 
     # Check w/ user if input provided is valid
     if not force_run_flag and not confirm_markets(scheduler):
@@ -49,58 +73,233 @@ def run_stream(config, trading, force_run_flag=False):
     data_location = DataLocation(config["paths"]["data_dir"], events)
     data_location.create()
 
-    market_stream_handler = MarketStreamHandler('local', max_sleep_time=THREAD_WAIT_SEC)
+    # Optional local server and shared memory region publishing the live order books to other
+    # processes, and live OHLCV bars
+    stages = []
+    fanout_server = None
+    fanout_config = FanOutConfig.from_config(config)
+    if fanout_config is not None:
+        fanout_server = FanOutServer(fanout_config)
+        fanout_server.start()
+        stages.append(fanout_server)
+    shared_book_config = SharedBookConfig.from_config(config)
+    if shared_book_config is not None:
+        stages.append(SharedBookWriter(shared_book_config))
+    bar_config = BarConfig.from_config(config)
+    if bar_config is not None:
+        stages.append(BarStage(bar_config, data_location, fanout_server))
+
+    market_stream_handler = MarketStreamHandler('local', max_sleep_time=THREAD_WAIT_SEC,
+                                                stages=stages, checkpoint=checkpoint)
+
+    # Optional adaptive conflation, the least important streams are conflated while the writer falls
+    # behind
+    conflation_controller = None
+    if conflation_config.adaptive:
+        conflation_controller = ConflationController(conflation_config, scheduler,
+                                                     lambda: market_stream_handler.lag_seconds,
+                                                     data_location.catalog)
+
+    capture_config = config.get("capture", {})
+
+    # Optional segmented capture layout, sealed segments are compressed in the background
+    segment_policy = SegmentPolicy.from_config(config)
+    segment_compressor = None
+    if segment_policy is not None and segment_policy.compression is not None:
+        segment_compressor = SegmentCompressor(segment_policy.compression)
+        segment_compressor.start()
 
     try:
+        session.start()
         scheduler.start()
+        if conflation_controller is not None:
+            conflation_controller.start()
         market_stream_handler.process_packets(
             scheduler.output_queue,
             max_buffer_size=BUFFER_SIZE,
-            data_location=data_location
+            data_location=data_location,
+            segment_policy=segment_policy,
+            segment_compressor=segment_compressor,
+            index_interval=capture_config.get("index_interval", 100),
+            encode_definitions=capture_config.get("encode_definitions", False),
         )
     except KeyboardInterrupt:
         logging.info("Stopping stream scheduler...")
+        if conflation_controller is not None:
+            conflation_controller.stop()
         market_stream_handler.write()
         logging.info("Writen buffers on stream handler")
+        # Stages publishing to other stages (e.g. bars to the fan-out server) are closed first
+        for stage in reversed(stages):
+            stage.close()
+        if segment_compressor is not None:
+            segment_compressor.stop()
+            logging.info("Compressed sealed segments")
         scheduler.stop()
+        session.stop()
         logging.info("Stopped streams")
         trading.logout()
         logging.info("Logged out of BetFair Account")
 
 
+def run_stream_async(config, force_run_flag=False):
+    import asyncio
+    from stream.async_capture import AsyncCapture, AsyncCaptureConfig
+    from stream.conflation import ConflationConfig
+    from stream.scheduler import Scheduler
+    from stream.session import SessionManager
+    from stream.storage.data_location import DataLocation
+    from stream.storage.segments import SegmentCompressor, SegmentPolicy
+    from utils.configure import create_api_client, get_streams
+    from utils.helper import get_stream_market_data_filter, get_events
+
+    logging.info("Successfully loaded config")
+    trading = create_api_client()
+    session = SessionManager(trading)
+    session.login()
+
+    stream_market_data_filter = get_stream_market_data_filter(config)
+    stream_schedule_config = get_streams(config)
+    # The scheduler is only used to display the streams, the asyncio capture schedules them on its
+    # event loop
+    scheduler = Scheduler(stream_schedule_config, trading, stream_market_data_filter)
+    if not force_run_flag and not confirm_markets(scheduler):
+        trading.logout()
+        logging.info("Logged out of BetFair Account")
+        logging.info("Exiting...")
+        return
+
+    events = []
+    for stream_config in scheduler.stream_schedule:
+        events += (get_events(trading, event_filter=stream_config.market_filter))
+
+    data_location = DataLocation(config["paths"]["data_dir"], events)
+    data_location.create()
+
+    capture_config = config.get("capture", {})
+    segment_policy = SegmentPolicy.from_config(config)
+    segment_compressor = None
+    if segment_policy is not None and segment_policy.compression is not None:
+        segment_compressor = SegmentCompressor(segment_policy.compression)
+        segment_compressor.start()
+
+    capture = AsyncCapture(
+        AsyncCaptureConfig.from_config(config),
+        stream_schedule_config,
+        stream_market_data_filter,
+        data_location,
+        session,
+        ConflationConfig.from_config(config).conflate_ms,
+        segment_policy=segment_policy,
+        segment_compressor=segment_compressor,
+        index_interval=capture_config.get("index_interval", 100),
+        encode_definitions=capture_config.get("encode_definitions", False),
+    )
+    try:
+        asyncio.run(capture.run())
+    except KeyboardInterrupt:
+        # The capture writes its buffers when its task is cancelled
+        logging.info("Stopped asyncio capture")
+        if segment_compressor is not None:
+            segment_compressor.stop()
+            logging.info("Compressed sealed segments")
+        trading.logout()
+        logging.info("Logged out of BetFair Account")
+
+
 def run_parser(config):
+    from stream.storage.data_location import DataLocation
+    from parse.parser import MarketDataParser
+
     logging.info("Running parser...")
     data_location = DataLocation(config["paths"]["data_dir"], [])
     data_parser = MarketDataParser(data_location)
     data_parser.parse_all(delete_flag=True)
 
 
-def run_report(config):
+def run_maintenance(config):
+    from stream.storage.data_location import DataLocation
+    from stream.storage.segments import SegmentPolicy
+    from stream.storage.retention import apply_retention
+
+    segment_policy = SegmentPolicy.from_config(config)
+    if segment_policy is None:
+        logging.info("No storage policy configured, skipping maintenance")
+        return
+
+    logging.info("Running storage maintenance...")
+    data_location = DataLocation(config["paths"]["data_dir"], [])
+    apply_retention(data_location, segment_policy)
+
+
+def run_report(config, workers=None):
+    from stream.storage.data_location import DataLocation
+    from utils.report import write_all_events_report
+
     logging.info("Running report...")
     data_location = DataLocation(config["paths"]["data_dir"], [])
-    report = generate_all_events_report(data_location)
-#   save report in data_location
-    data_location.save_json_data(report, file_name="report.json")
+    # Streams the report to report.json in data_location
+    write_all_events_report(data_location, file_name="report.json", workers=workers)
+
+
+def run_features(config, workers=None):
+    from stream.storage.data_location import DataLocation
+    from utils.dataset import FeatureConfig, build_feature_dataset
+
+    logging.info("Building feature dataset...")
+    data_location = DataLocation(config["paths"]["data_dir"], [])
+    build_feature_dataset(data_location, FeatureConfig.from_config(config), workers=workers)
+
+
+def run_merge(config, source_paths, workers=None):
+    from stream.storage.data_location import DataLocation
+    from stream.storage.merge import merge_recordings
+
+    logging.info("Merging listener recordings...")
+    data_location = DataLocation(config["paths"]["data_dir"], [])
+    # Writes merge_report.json with the duplicates dropped and gaps closed to data_location
+    merge_recordings(source_paths, data_location, workers=workers)
 
 
 if __name__ == "__main__":
     sys.path.append(".")  # Adds higher directory to python modules path.
-    parse_flag = cli.handle_cli_args().parse
-    report_flag = cli.handle_cli_args().report
-    force_run_flag = cli.handle_cli_args().force
+    cli_args = cli.handle_cli_args()
+    parse_flag = cli_args.parse
+    report_flag = cli_args.report
+    force_run_flag = cli_args.force
+    maintain_flag = cli_args.maintain
+    features_flag = cli_args.features
+    merge_sources = cli_args.merge
 
     # Load environment variables from .env file
     dotenv.load_dotenv()
-    # Load config and create API Client
-    trading_client, app_config = load_config()
+    # Load config, the API client is only created when streaming
+    app_config = load_config()
+    # Profiling hooks are installed when the mode modules are imported, inside the run_* functions
+    # below
+    if cli_args.profile:
+        profiling.enable(cli_args.profile)
 
-    if parse_flag or report_flag:
+    if parse_flag or report_flag or maintain_flag or features_flag or merge_sources:
+        # Merge the recordings of redundant listeners first, so the other modes see the merged
+        # captures
+        if merge_sources:
+            run_merge(app_config, merge_sources, cli_args.workers)
+        # Expire/compact capture segments if --maintain flag is set
+        if maintain_flag:
+            run_maintenance(app_config)
         # Run parser if --parse flag is set
         if parse_flag:
             run_parser(app_config)
         # Run report if --report flag is set
         if report_flag:
-            run_report(app_config)
+            run_report(app_config, cli_args.workers)
+        # Build the feature dataset if --features flag is set
+        if features_flag:
+            run_features(app_config, cli_args.workers)
+    elif cli_args.asyncio:
+        logging.info("Running asyncio stream...")
+        run_stream_async(app_config, force_run_flag)
     else:
         logging.info("Running stream...")
-        run_stream(app_config, trading_client, force_run_flag)
+        run_stream(app_config, force_run_flag)
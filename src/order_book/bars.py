@@ -0,0 +1,214 @@
+import re
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from order_book.runner_order_book import RunnerOrderBook
+from order_book.trade_tape import traded_deltas
+
+INTERVAL_UNITS_MS = {"s": 1000, "m": 60 * 1000, "h": 60 * 60 * 1000}
+
+
+def parse_interval(interval: str) -> int:
+    """ Length of a bar interval such as `1s`, `10s`, `1m` or `1h` in milliseconds
+
+    Raises:
+        ValueError: If the interval is not a number followed by s, m or h
+    """
+    match = re.fullmatch(r"(\d+)([smh])", interval)
+    if match is None:
+        raise ValueError(f"Invalid bar interval {interval}")
+    return int(match.group(1)) * INTERVAL_UNITS_MS[match.group(2)]
+
+
+@dataclass
+class Bar:
+    """OHLCV bar of a runner"""
+    market_id: str
+    selection_id: int
+    interval: str
+    start: int  # Bucket start (ms)
+    open: Optional[float]  # OHLC of the last traded price, None if the runner has not traded yet
+    high: Optional[float]
+    low: Optional[float]
+    close: Optional[float]
+    volume: float  # Volume traded in the bar
+    vwap: Optional[float]  # Volume weighted average traded price, None if nothing traded in the bar
+    best_back: Optional[float]  # Best prices available when the bar closed
+    best_lay: Optional[float]
+    updates: int  # Number of runner changes in the bar
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+class _OpenBar:
+    """Running aggregates of the current bar of a runner for one interval"""
+    __slots__ = ("start", "open", "high", "low", "close", "volume", "notional", "updates")
+
+    def __init__(self, start: int, ltp: Optional[float]) -> None:
+        self.start = start
+        self.open = self.high = self.low = self.close = ltp
+        self.volume = 0.0
+        self.notional = 0.0
+        self.updates = 0
+
+
+class _RunnerBars:
+    def __init__(self, selection_id: int, intervals: int) -> None:
+        self.book = RunnerOrderBook(selection_id)
+        self.bars: List[Optional[_OpenBar]] = [None] * intervals
+
+
+class BarBuilder:
+    """Builds OHLCV bars of every runner for several intervals at once from market change messages
+
+    Each runner change updates the open bar of every interval in constant time. A bar is completed
+    once a packet of its market is published after the end of the bar, or when the builder is
+    flushed. The same builder is used for live market books (see BarStage) and for replayed captures
+    (see build_market_bars).
+    """
+
+    def __init__(self, intervals: List[str] = None, on_bar: Callable[[Bar], None] = None) -> None:
+        """ Initialise the bar builder
+
+        Args:
+            intervals (List[str], optional): Bar intervals, e.g. `["1s", "1m"]`. Defaults to 1s, 10s
+                and 1m.
+            on_bar (Callable[[Bar], None], optional): Called with every completed bar
+        """
+        self.intervals = intervals or ["1s", "10s", "1m"]
+        self.intervals_ms = [parse_interval(interval) for interval in self.intervals]
+        self.on_bar = on_bar
+        self.runners: Dict[str, Dict[int, _RunnerBars]] = {}
+        self._market_buckets: Dict[str, List[Optional[int]]] = {}
+
+    def update(self, market_id: str, publish_time: int, update: Dict) -> List[Bar]:
+        """ Update the bars with a market change message
+
+        Args:
+            market_id (str): Market ID
+            publish_time (int): Publish time in milliseconds
+            update (Dict): Market change message
+
+        Returns:
+            List[Bar]: Bars completed by this update
+        """
+        completed = []
+        market_runners = self.runners.setdefault(market_id, {})
+        buckets = self._market_buckets.setdefault(market_id, [None] * len(self.intervals))
+        for idx, interval_ms in enumerate(self.intervals_ms):
+            bucket = publish_time - publish_time % interval_ms
+            if buckets[idx] is None or bucket > buckets[idx]:
+                # Happens once per interval, so closing the bars of every runner is amortised over
+                # their updates
+                for runner in market_runners.values():
+                    if runner.bars[idx] is not None:
+                        completed.append(self._close(market_id, runner, idx))
+                buckets[idx] = bucket
+
+        image = bool(update.get("img"))
+        for runner_change in update.get("rc", []):
+            runner = market_runners.get(runner_change["id"])
+            if runner is None:
+                runner = _RunnerBars(runner_change["id"], len(self.intervals))
+                market_runners[runner_change["id"]] = runner
+            self._update_runner(runner, publish_time, buckets, runner_change, image)
+
+        if self.on_bar is not None:
+            for bar in completed:
+                self.on_bar(bar)
+        return completed
+
+    def _update_runner(self, runner: _RunnerBars, publish_time: int, buckets: List[int],
+                       runner_change: Dict, image: bool) -> None:
+        # Volume traded at each price since the last update, from the cumulative traded ladder. The
+        # volume of an image was mostly traded before the capture started, see `traded_deltas`.
+        trd = runner_change.get("trd")
+        volume, notional = 0.0, 0.0
+        for price, size in traded_deltas(runner.book.trd_book, trd or [], image):
+            volume += size
+            notional += price * size
+
+        runner.book.apply(publish_time, runner_change)
+        if not trd and not image:
+            # Captures without the traded ladder only have the total volume
+            volume = runner.book.delta_tv
+            notional = volume * runner.book.ltp
+        ltp = runner.book.ltp or None
+
+        for idx, bucket in enumerate(buckets):
+            bar = runner.bars[idx]
+            if bar is None:
+                bar = runner.bars[idx] = _OpenBar(bucket, ltp)
+            if ltp is not None:
+                if bar.open is None:
+                    bar.open = bar.high = bar.low = ltp
+                bar.high = max(bar.high, ltp)
+                bar.low = min(bar.low, ltp)
+                bar.close = ltp
+            bar.volume += volume
+            bar.notional += notional
+            bar.updates += 1
+
+    def _close(self, market_id: str, runner: _RunnerBars, idx: int) -> Bar:
+        bar = runner.bars[idx]
+        runner.bars[idx] = None
+        book = runner.book
+        return Bar(
+            market_id=market_id,
+            selection_id=book.runner_id,
+            interval=self.intervals[idx],
+            start=bar.start,
+            open=bar.open,
+            high=bar.high,
+            low=bar.low,
+            close=bar.close,
+            volume=bar.volume,
+            vwap=bar.notional / bar.volume if bar.volume > 0 else None,
+            best_back=max(book.atb_book) if book.atb_book else None,
+            best_lay=min(book.atl_book) if book.atl_book else None,
+            updates=bar.updates,
+        )
+
+    def flush(self, market_id: str = None) -> List[Bar]:
+        """ Complete the open bars, e.g. when a market closes or a replay ends
+
+        Args:
+            market_id (str, optional): Only complete the bars of this market. Defaults to all
+                markets.
+
+        Returns:
+            List[Bar]: Completed bars
+        """
+        completed = []
+        for bars_market_id, market_runners in self.runners.items():
+            if market_id is not None and bars_market_id != market_id:
+                continue
+            for runner in market_runners.values():
+                for idx, bar in enumerate(runner.bars):
+                    if bar is not None:
+                        completed.append(self._close(bars_market_id, runner, idx))
+
+        if self.on_bar is not None:
+            for bar in completed:
+                self.on_bar(bar)
+        return completed
+
+
+def build_market_bars(market_id: str, packets: Iterable[Tuple[int, Dict]],
+                      intervals: List[str] = None) -> List[Bar]:
+    """Builds the bars of a recorded market
+
+    Args:
+        market_id (str): Market ID
+        packets (Iterable[Tuple[int, Dict]]): Publish time in milliseconds and market change
+            message, e.g. `DataLocation.iter_market`
+        intervals (List[str], optional): Bar intervals, see BarBuilder
+
+    Returns:
+        List[Bar]: Completed bars, in completion order
+    """
+    builder = BarBuilder(intervals)
+    bars = []
+    for publish_time, packet in packets:
+        bars += builder.update(market_id, int(publish_time), packet)
+    return bars + builder.flush()
@@ -0,0 +1,159 @@
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from order_book.resample import BOOK_DEPTH, Bars, build_runner_bars
+
+DEFAULT_RETURN_LAGS = (1, 5, 30)
+
+
+def feature_columns(depth: int, return_lags: Sequence[int]) -> List[str]:
+    """ Names of the columns of `build_market_features`, in order """
+    columns = ["time", "selection_id", "in_play", "time_to_off"]
+    for side in ("back", "lay"):
+        columns += [f"{side}_price_{level}" for level in range(1, depth + 1)]
+        columns += [f"{side}_size_{level}" for level in range(1, depth + 1)]
+    columns += ["ltp", "traded_volume", "total_volume"]
+    columns += [f"ltp_return_{lag}" for lag in return_lags]
+    columns += [f"traded_volume_{lag}" for lag in return_lags]
+    return columns
+
+
+def _parse_market_time(market_time: Optional[str]) -> float:
+    """ Market start time of a market definition in milliseconds, NaN if unknown """
+    if not market_time:
+        return np.nan
+    return datetime.fromisoformat(market_time.replace("Z", "+00:00")).timestamp() * 1000
+
+
+def _ffill(values: np.ndarray) -> np.ndarray:
+    """ Forward fill the NaN values of a 1D array """
+    index = np.where(np.isnan(values), 0, np.arange(len(values)))
+    np.maximum.accumulate(index, out=index)
+    return values[index]
+
+
+def _lag(values: np.ndarray, lag: int) -> np.ndarray:
+    lagged = np.full_like(values, np.nan)
+    if lag < len(values):
+        lagged[lag:] = values[:len(values) - lag]
+    return lagged
+
+
+def _best_first(prices: np.ndarray, volumes: np.ndarray, depth: int,
+                descending: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """Top `depth` levels of bucketed ladders, best price first
+
+    The ladders of `Bars` are sorted by ascending price and padded with NaN, so the best back prices
+    are the last levels of each row.
+    """
+    depth = min(depth, BOOK_DEPTH)
+    if not descending:
+        return prices[:, :depth], volumes[:, :depth]
+    counts = np.count_nonzero(~np.isnan(prices), axis=1)
+    columns = counts[:, None] - 1 - np.arange(depth)[None, :]
+    valid = columns >= 0
+    columns = np.where(valid, columns, 0)
+    return (np.where(valid, np.take_along_axis(prices, columns, axis=1), np.nan),
+            np.where(valid, np.take_along_axis(volumes, columns, axis=1), np.nan))
+
+
+def _runner_features(bars: Bars, grid: np.ndarray, depth: int,
+                     return_lags: Sequence[int]) -> Dict[str, np.ndarray]:
+    """ Features of a runner on a regular time grid, the last bucket at or before each grid time is
+    carried forward """
+    index = np.searchsorted(bars.time, grid, side="right") - 1
+    seen = index >= 0
+    index = np.maximum(index, 0)
+    in_bucket = seen & (bars.time[index] == grid)
+
+    features = {}
+    for side, prices, volumes in (("back", bars.atb_price, bars.atb_volume),
+                                  ("lay", bars.atl_price, bars.atl_volume)):
+        prices, volumes = _best_first(prices, volumes, depth, descending=side == "back")
+        for level in range(prices.shape[1]):
+            features[f"{side}_price_{level + 1}"] = np.where(seen, prices[index, level], np.nan)
+            features[f"{side}_size_{level + 1}"] = np.where(seen, volumes[index, level], np.nan)
+        for level in range(prices.shape[1], depth):
+            features[f"{side}_price_{level + 1}"] = np.full(len(grid), np.nan)
+            features[f"{side}_size_{level + 1}"] = np.full(len(grid), np.nan)
+
+    ltp = np.where(seen, _ffill(bars.close)[index], np.nan)
+    total_volume = np.where(seen, bars.total_volume[index], 0.0)
+    features["ltp"] = ltp
+    features["traded_volume"] = np.where(in_bucket, bars.volume[index], 0.0)
+    features["total_volume"] = total_volume
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for lag in return_lags:
+            features[f"ltp_return_{lag}"] = np.log(ltp / _lag(ltp, lag))
+    for lag in return_lags:
+        features[f"traded_volume_{lag}"] = total_volume - _lag(total_volume, lag)
+    return features
+
+
+def build_market_features(packets: Iterable[Tuple[int, Dict]], interval_ms: int = 1000,
+                          depth: int = 3, return_lags: Sequence[int] = DEFAULT_RETURN_LAGS,
+                          max_time_to_off_ms: int = None) -> Dict[str, np.ndarray]:
+    """Fixed interval feature rows of every runner of a market
+
+    The packets are bucketed in one pass (see `build_runner_bars`), then the features of each runner
+    are computed with NumPy on a regular grid from the first to the last bucket of the market. Each
+    row holds the state at the end of its interval:
+        - top `depth` back/lay prices and sizes, best first (NaN when the level is empty)
+        - last traded price, its log returns over `return_lags` intervals
+        - volume traded in the interval and over `return_lags` intervals, total traded volume
+        - in play flag and seconds to the scheduled off time of the latest market definition
+
+    Args:
+        packets (Iterable[Tuple[int, Dict]]): Publish time in milliseconds and market change message
+        interval_ms (int, optional): Row interval (ms). Defaults to 1000.
+        depth (int, optional): Number of ladder levels per side, at most BOOK_DEPTH. Defaults to 3.
+        return_lags (Sequence[int], optional): Lags (in intervals) of the returns and traded volumes
+        max_time_to_off_ms (int, optional): Only keep rows at most this long before the off, all
+            rows if None
+
+    Returns:
+        Dict[str, np.ndarray]: Columns named by `feature_columns`, rows grouped by runner in time
+            order
+    """
+    definitions: List[Tuple[int, bool, float]] = []
+
+    def record_definitions() -> Iterator[Tuple[int, Dict]]:
+        for timestamp, packet in packets:
+            definition = packet.get("marketDefinition")
+            if definition is not None:
+                definitions.append((int(timestamp), bool(definition.get("inPlay")),
+                                    _parse_market_time(definition.get("marketTime"))))
+            yield timestamp, packet
+
+    all_runner_bars = build_runner_bars(record_definitions(), interval_ms)
+    runner_bars = {runner_id: bars for runner_id, bars in all_runner_bars.items() if len(bars) > 0}
+    columns = feature_columns(depth, return_lags)
+    if not runner_bars:
+        return {column: np.array([], dtype=np.int64 if column in ("time", "selection_id") else
+                                 bool if column == "in_play" else np.float64) for column in columns}
+
+    start = min(int(bars.time[0]) for bars in runner_bars.values())
+    end = max(int(bars.time[-1]) for bars in runner_bars.values())
+    definition_times = np.array([timestamp for timestamp, _, _ in definitions], dtype=np.int64)
+    if max_time_to_off_ms is not None and definitions and not np.isnan(definitions[-1][2]):
+        window_start = int(definitions[-1][2]) - max_time_to_off_ms
+        start = max(start, window_start - window_start % interval_ms)
+    grid = np.arange(start, end + 1, interval_ms, dtype=np.int64)
+
+    # Market state as of the end of each interval
+    index = np.searchsorted(definition_times, grid + interval_ms - 1, side="right") - 1
+    definition_index = np.maximum(index, 0)
+    in_play = np.array([in_play for _, in_play, _ in definitions] or [False], dtype=bool)
+    in_play = in_play[definition_index] & (index >= 0)
+    market_time = np.array([market_time for _, _, market_time in definitions] or [np.nan])
+    market_time = market_time[definition_index]
+    time_to_off = np.where(index >= 0, (market_time - grid) / 1000, np.nan)
+
+    rows: Dict[str, List[np.ndarray]] = {column: [] for column in columns}
+    for runner_id, bars in runner_bars.items():
+        features = _runner_features(bars, grid, depth, return_lags)
+        features.update(time=grid, selection_id=np.full(len(grid), runner_id, dtype=np.int64),
+                        in_play=in_play, time_to_off=time_to_off)
+        for column in columns:
+            rows[column].append(features[column])
+    return {column: np.concatenate(values) for column, values in rows.items()}
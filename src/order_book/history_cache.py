@@ -0,0 +1,327 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass, fields
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from order_book.order_book_history import MarketOrderBookHistory
+from order_book.resample import BOOK_DEPTH
+from stream.storage.data_location import DataLocation
+
+# Bumped when the columns of an entry change, older entries are then never matched and age out of
+# the cache
+FORMAT_VERSION = 1
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+@dataclass
+class HistoryCacheConfig:
+    """Options of the order book history cache of the dashboard"""
+    directory: str = "history_cache"  # Relative to the data folder
+    max_mb: float = 1024  # Least recently used entries are evicted above this size
+    depth: int = BOOK_DEPTH  # Ladder levels per side kept for every update
+    prewarm: bool = False  # Build the histories of the latest day's markets in the background
+    # Packets replayed by the pre-warm, the dashboard's default limit
+    prewarm_max_records: Optional[int] = 10000
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "HistoryCacheConfig":
+        """ Create the options from the `history_cache` section of the app config, defaults if there
+        is none
+
+        Args:
+            config (Dict): App config
+        """
+        history_cache = config.get("history_cache") or {}
+        return cls(**{key: value for key, value in history_cache.items()
+                      if key in cls.__dataclass_fields__})
+
+
+@dataclass
+class RunnerHistory:
+    """Order book of a runner after every replayed packet, the arrays are read-only views of the
+    cache entry"""
+    runner_id: int
+    timestamps: np.ndarray  # Publish time (ms)
+    ltp: np.ndarray
+    tv: np.ndarray
+    delta_tv: np.ndarray
+    atb_price: np.ndarray  # (updates, depth) sorted by price and padded with NaN, best prices last
+    atb_volume: np.ndarray
+    atl_price: np.ndarray  # (updates, depth) sorted by price and padded with NaN, best prices first
+    atl_volume: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+
+# Columns of an entry, shaped (runners, updates) or (runners, updates, depth), next to timestamps
+# and runner_ids
+RUNNER_COLUMNS = [field.name for field in fields(RunnerHistory)
+                  if field.name not in ("runner_id", "timestamps")]
+
+
+class MarketHistory:
+    """Replayed order book histories of the runners of a market"""
+
+    def __init__(self, columns: Dict[str, np.ndarray]) -> None:
+        self.columns = columns
+        self._runner_index = {int(runner_id): idx
+                              for idx, runner_id in enumerate(columns["runner_ids"])}
+
+    @classmethod
+    def from_order_book_history(cls, history: MarketOrderBookHistory,
+                                depth: int = BOOK_DEPTH) -> "MarketHistory":
+        """ Columns of a replayed `MarketOrderBookHistory`, ladders are cut to the `depth` best
+        levels """
+        runners = list(history.runners.values())
+        num_updates = len(history)
+        columns = {
+            "runner_ids": np.array([runner.runner_id for runner in runners], dtype=np.int64),
+            "timestamps": np.array(runners[0].timestamps if runners else [], dtype=np.int64),
+        }
+        for name, attribute in (("ltp", "ltp_history"), ("tv", "tv_history"),
+                                ("delta_tv", "delta_tv_history")):
+            columns[name] = np.array([getattr(runner, attribute) for runner in runners],
+                                     dtype=np.float64)
+            columns[name] = columns[name].reshape(len(runners), num_updates)
+        for side, best_last in (("atb", True), ("atl", False)):
+            prices = np.full((len(runners), num_updates, depth), np.nan)
+            volumes = np.full((len(runners), num_updates, depth), np.nan)
+            for idx, runner in enumerate(runners):
+                price_history = getattr(runner, f"{side}_price_history")
+                volume_history = getattr(runner, f"{side}_volume_history")
+                ladders = zip(price_history, volume_history)
+                for update, (ladder_prices, ladder_volumes) in enumerate(ladders):
+                    levels = slice(-depth, None) if best_last else slice(None, depth)
+                    ladder_prices, ladder_volumes = ladder_prices[levels], ladder_volumes[levels]
+                    prices[idx, update, :len(ladder_prices)] = ladder_prices
+                    volumes[idx, update, :len(ladder_volumes)] = ladder_volumes
+            columns[f"{side}_price"], columns[f"{side}_volume"] = prices, volumes
+        return cls(columns)
+
+    @property
+    def runner_ids(self) -> List[int]:
+        return list(self._runner_index)
+
+    def __len__(self) -> int:
+        return len(self.columns["timestamps"])
+
+    def get_runner_history(self, runner_id: int) -> RunnerHistory:
+        idx = self._runner_index[runner_id]
+        return RunnerHistory(runner_id, self.columns["timestamps"],
+                             **{name: self.columns[name][idx] for name in RUNNER_COLUMNS})
+
+
+class HistoryCache:
+    """Persistent cache of the order book histories replayed for the dashboard
+
+    Every entry is the replay of a market for one set of replay parameters (runners, publish time
+    window and maximum number of packets), keyed with the identity (path, size, packet count) of the
+    market's capture files, so a capture which grows or is parsed gets a new entry. The entries of
+    its previous files can never be matched again, they are removed when the new one is written, so
+    a market followed while it is captured keeps one entry per set of parameters. Entries are
+    folders of uncompressed `.npy` columns opened memory-mapped, so any process (every Streamlit
+    session or server) reads them without replaying the packets or copying the arrays. The least
+    recently used entries are evicted once the cache is larger than `max_mb`.
+    """
+
+    def __init__(self, data_location: DataLocation, config: HistoryCacheConfig = None) -> None:
+        """ Initialise the cache
+
+        Args:
+            data_location (DataLocation): Data location of the captures, the cache folder is inside
+                its data path
+            config (HistoryCacheConfig, optional): Cache options, defaults if None
+        """
+        self.data_location = data_location
+        self.config = config or HistoryCacheConfig()
+        self.cache_path = os.path.join(data_location.data_path, self.config.directory)
+        os.makedirs(self.cache_path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def cache_key(self, event_id: str, market_id: str, runner_ids: List[int], start: int = None,
+                  end: int = None, max_records: int = None) -> str:
+        """ Key of the replay of a market with the given parameters, see `get`
+
+        The key is `{market_id}-{capture files hash}-{parameters hash}`.
+        """
+        capture_files = self.data_location.catalog.get_capture_files(event_id=event_id,
+                                                                     market_id=market_id)
+        captures = [(capture["path"], capture["byte_size"], capture["packet_count"])
+                    for capture in capture_files]
+        identity = json.dumps([FORMAT_VERSION, event_id, market_id, captures])
+        parameters = json.dumps([list(runner_ids), start, end, max_records, self.config.depth])
+        return (f"{market_id}-{hashlib.sha1(identity.encode()).hexdigest()[:10]}"
+                f"-{hashlib.sha1(parameters.encode()).hexdigest()[:20]}")
+
+    def get(self, event_id: str, market_id: str, runner_ids: List[int], start: int = None,
+            end: int = None, max_records: int = None) -> MarketHistory:
+        """ Order book histories of the runners of a market, replayed from its records or read from
+        the cache
+
+        Args:
+            event_id (str): Event ID
+            market_id (str): Market ID
+            runner_ids (List[int]): Selection IDs of the runners
+            start (int, optional): Only replay the packets published from this time (ms)
+            end (int, optional): Only replay the packets published up to this time (ms)
+            max_records (int, optional): Maximum number of packets replayed
+
+        Returns:
+            MarketHistory: Runner histories, memory-mapped from the cache entry
+        """
+        key = self.cache_key(event_id, market_id, runner_ids, start, end, max_records)
+        entry_path = os.path.join(self.cache_path, key)
+        if os.path.isdir(entry_path):
+            try:
+                history = self._load(entry_path)
+                self.hits += 1
+                return history
+            except (OSError, ValueError) as e:
+                # Evicted by another process while it was opened, or damaged
+                logging.warning(f"Could not read history cache entry {entry_path}, "
+                                f"replaying the market : {e}")
+                shutil.rmtree(entry_path, ignore_errors=True)
+
+        self.misses += 1
+        started = time.perf_counter()
+        history = MarketOrderBookHistory(runner_ids)
+        records = self.data_location.iter_market_records(event_id, market_id, start, end)
+        for count, record in enumerate(records, start=1):
+            history.update(record.publish_time, record.update)
+            if max_records is not None and count >= max_records:
+                break
+        self._save(entry_path, MarketHistory.from_order_book_history(history, self.config.depth))
+        logging.info(f"Replayed {len(history)} packet(s) of {market_id} into the history cache in "
+                     f"{time.perf_counter() - started:.2f}s")
+        self.remove_superseded(key)
+        self.evict(keep=entry_path)
+        return self._load(entry_path)
+
+    def _load(self, entry_path: str) -> MarketHistory:
+        columns = {name: np.load(os.path.join(entry_path, f"{name}.npy"), mmap_mode="r")
+                   for name in ["runner_ids", "timestamps"] + RUNNER_COLUMNS}
+        # The modification time of an entry is its last use, for the LRU eviction
+        os.utime(entry_path)
+        return MarketHistory(columns)
+
+    def _save(self, entry_path: str, history: MarketHistory) -> None:
+        """ Write the columns of an entry to a temporary folder first, so readers never see a
+        partial entry """
+        tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, column in history.columns.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(column))
+        try:
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Written concurrently by another session
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def entries(self) -> List[Tuple[str, int, float]]:
+        """ Entries of the cache as (path, bytes, last use), least recently used first """
+        entries = []
+        for name in os.listdir(self.cache_path):
+            entry_path = os.path.join(self.cache_path, name)
+            if name.endswith(".tmp") or not os.path.isdir(entry_path):
+                continue
+            try:
+                byte_size = sum(entry.stat().st_size for entry in os.scandir(entry_path))
+                entries.append((entry_path, byte_size, os.path.getmtime(entry_path)))
+            except FileNotFoundError:
+                continue
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def remove_superseded(self, key: str) -> int:
+        """ Remove the entries of the market of `key` replayed from other capture files, e.g. before
+        the capture grew
+
+        Args:
+            key (str): Key of an entry replayed from the current capture files, see `cache_key`
+
+        Returns:
+            int: Number of entries removed
+        """
+        market_id, captures_hash, _ = key.split("-")
+        with self._lock:
+            removed = 0
+            for entry_path, _, _ in self.entries():
+                name_market_id, _, name = os.path.basename(entry_path).partition("-")
+                if name_market_id == market_id and not name.startswith(f"{captures_hash}-"):
+                    # Readers which already mapped the columns keep reading them
+                    shutil.rmtree(entry_path, ignore_errors=True)
+                    removed += 1
+            return removed
+
+    def evict(self, keep: str = None) -> int:
+        """ Remove the least recently used entries until the cache fits in `max_mb`
+
+        Args:
+            keep (str, optional): Entry which is never removed, e.g. the one just written
+
+        Returns:
+            int: Number of entries removed
+        """
+        with self._lock:
+            entries = self.entries()
+            total = sum(byte_size for _, byte_size, _ in entries)
+            max_bytes = self.config.max_mb * 1024 * 1024
+            removed = 0
+            for entry_path, byte_size, _ in entries:
+                if total <= max_bytes:
+                    break
+                if entry_path == keep:
+                    continue
+                # Readers which already mapped the columns keep reading them
+                shutil.rmtree(entry_path, ignore_errors=True)
+                total -= byte_size
+                removed += 1
+            if removed:
+                entries_label = "entry" if removed == 1 else "entries"
+                logging.info(f"Evicted {removed} history cache {entries_label}")
+            return removed
+
+    def latest_markets(self) -> List[Tuple[str, str, List[int]]]:
+        """ (event ID, market ID, runner IDs) of the markets captured in the day before the latest
+        capture """
+        captures = self.data_location.catalog.get_capture_files()
+        last_timestamp = max((capture["last_timestamp"] or 0 for capture in captures), default=0)
+        market_ids = {(capture["event_id"], capture["market_id"]) for capture in captures
+                      if (capture["last_timestamp"] or 0) > last_timestamp - DAY_MS}
+        markets = []
+        for event_id in sorted({event_id for event_id, _ in market_ids}):
+            for market in self.data_location.catalog.get_markets(event_id=event_id):
+                if (event_id, market["marketId"]) in market_ids:
+                    runner_ids = [runner["selectionId"] for runner in market.get("runners", [])]
+                    markets.append((event_id, market["marketId"], runner_ids))
+        return markets
+
+    def prewarm(self) -> threading.Thread:
+        """ Build the histories and resolution pyramids of the latest day's markets in a background
+        thread, with the dashboard's default parameters (all runners, whole market,
+        `prewarm_max_records` packets)
+
+        Returns:
+            threading.Thread: Pre-warm thread, already started
+        """
+        thread = threading.Thread(target=self._prewarm, daemon=True, name="HistoryCachePrewarm")
+        thread.start()
+        return thread
+
+    def _prewarm(self) -> None:
+        markets = self.latest_markets()
+        logging.info(f"Pre-warming the history cache with {len(markets)} market(s)")
+        for event_id, market_id, runner_ids in markets:
+            try:
+                self.get(event_id, market_id, runner_ids,
+                         max_records=self.config.prewarm_max_records)
+                self.data_location.load_market_pyramid(event_id, market_id)
+            except Exception as e:
+                logging.error(f"Error pre-warming the history of market {market_id} : {e}")
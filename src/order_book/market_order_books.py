@@ -0,0 +1,43 @@
+from typing import Dict, Optional
+from order_book.runner_order_book import RunnerOrderBook
+
+
+class MarketOrderBooks:
+    """Current order book of every runner of a market, built from the market change messages"""
+
+    def __init__(self, market_id: str) -> None:
+        self.market_id = market_id
+        self.publish_time: Optional[int] = None
+        self.definition: Optional[Dict] = None
+        self.runners: Dict[int, RunnerOrderBook] = {}
+
+    @property
+    def is_closed(self) -> bool:
+        return self.definition is not None and self.definition.get("status") == "CLOSED"
+
+    def update(self, publish_time: int, update: Dict) -> None:
+        self.publish_time = publish_time
+        if update.get("img"):
+            # Full image, the market is sent again from scratch
+            self.runners = {}
+        if "marketDefinition" in update:
+            self.definition = update["marketDefinition"]
+        for runner_change in update.get("rc", []):
+            runner_book = self.runners.get(runner_change["id"])
+            if runner_book is None:
+                runner_book = RunnerOrderBook(runner_change["id"])
+                self.runners[runner_change["id"]] = runner_book
+            runner_book.apply(publish_time, runner_change)
+
+    def snapshot(self) -> Dict:
+        return {
+            "type": "snapshot",
+            "market_id": self.market_id,
+            "pt": self.publish_time,
+            "marketDefinition": self.definition,
+            "runners": {
+                str(runner_id): {"ltp": book.ltp, "tv": book.tv, "atb": book.atb_ladder,
+                                 "atl": book.atl_ladder}
+                for runner_id, book in self.runners.items()
+            },
+        }
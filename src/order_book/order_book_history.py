@@ -1,5 +1,6 @@
 from typing import Dict, List
 from order_book.runner_order_book import RunnerOrderBook
+from order_book.trade_tape import TradeTape, traded_deltas
 
 
 class RunnerOrderBookHistory:
@@ -15,10 +16,16 @@ class RunnerOrderBookHistory:
         self.atb_volume_history = []
         self.atl_price_history = []
         self.atl_volume_history = []
-        self.trd_history = []
+        # Individual trades, derived from the cumulative traded ladder
+        self.trade_tape = TradeTape()
         self.curOrderBook = RunnerOrderBook(runner_id)
 
     def update(self, timestamp: str, packet: dict):
+        for runner in packet.get('rc', []):
+            if runner['id'] == self.runner_id and 'trd' in runner:
+                for price, size in traded_deltas(self.curOrderBook.trd_book, runner['trd'],
+                                                 packet.get('img', False)):
+                    self.trade_tape.append(int(timestamp), self.runner_id, price, size)
         self.curOrderBook.update(timestamp, packet)
         self.timestamps.append(timestamp)
         self.ltp_history.append(self.curOrderBook.ltp)
@@ -31,8 +38,6 @@ class RunnerOrderBookHistory:
         self.atb_volume_history.append([volume for _, volume in self.curOrderBook.atb_ladder])
         self.atl_volume_history.append([volume for _, volume in self.curOrderBook.atl_ladder])
 
-        self.trd_history.append(self.curOrderBook.trd_ladder)
-
 
 class MarketOrderBookHistory:
     """Maintains the order book state for a market"""
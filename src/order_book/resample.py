@@ -0,0 +1,254 @@
+import os
+from dataclasses import dataclass, fields
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from order_book.runner_order_book import RunnerOrderBook
+from order_book.trade_tape import traded_deltas
+
+# Resolution levels of the pyramid, finest first
+RESOLUTIONS_MS = {"1s": 1000, "10s": 10 * 1000, "1m": 60 * 1000}
+
+# Number of price levels kept per side of the last book state of a bucket
+BOOK_DEPTH = 10
+
+
+@dataclass
+class Bars:
+    """Bucketed series of a runner at one resolution, buckets without updates are omitted"""
+    time: np.ndarray  # Bucket start (ms)
+    open: np.ndarray  # OHLC of the last traded price, NaN before the first trade
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray  # Traded volume in the bucket
+    total_volume: np.ndarray  # Total traded volume at the end of the bucket
+    atb_price: np.ndarray  # Last book state of the bucket, (buckets, BOOK_DEPTH) padded with NaN
+    atb_volume: np.ndarray
+    atl_price: np.ndarray
+    atl_volume: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def window(self, start: int, end: int) -> "Bars":
+        """ Buckets starting in [start, end] """
+        lower = np.searchsorted(self.time, start, side="left")
+        upper = np.searchsorted(self.time, end, side="right")
+        return Bars(**{field.name: getattr(self, field.name)[lower:upper]
+                       for field in fields(self)})
+
+
+def _ladder(ladder: List[List[float]], best_first: bool) -> Tuple[List[float], List[float]]:
+    """ Top BOOK_DEPTH levels of a ladder sorted by price, padded with NaN """
+    levels = ladder[-BOOK_DEPTH:] if best_first else ladder[:BOOK_DEPTH]
+    prices = [price for price, _ in levels] + [np.nan] * (BOOK_DEPTH - len(levels))
+    volumes = [volume for _, volume in levels] + [np.nan] * (BOOK_DEPTH - len(levels))
+    return prices, volumes
+
+
+class _RunnerBarBuilder:
+    """Aggregates the updates of a runner into buckets of the finest resolution"""
+
+    def __init__(self, runner_id: int, resolution_ms: int) -> None:
+        self.book = RunnerOrderBook(runner_id)
+        self.resolution_ms = resolution_ms
+        self.rows: List[tuple] = []
+        self._bucket: Optional[int] = None
+        self._ohlc: List[float] = []
+        self._volume = 0.0
+
+    def update(self, timestamp: int, runner_change: Dict, image: bool = False) -> None:
+        bucket = timestamp - timestamp % self.resolution_ms
+        if bucket != self._bucket:
+            self._close_bucket()
+            self._bucket, self._ohlc, self._volume = bucket, [], 0.0
+
+        # Volume traded since the last update, from the cumulative traded ladder. The volume of an
+        # image was mostly traded before the capture started, see `traded_deltas`.
+        trd = runner_change.get("trd")
+        volume = sum(size for _, size in traded_deltas(self.book.trd_book, trd or [], image))
+        self.book.apply(timestamp, runner_change)
+        if not trd and not image:
+            # Captures without the traded ladder only have the total volume
+            volume = self.book.delta_tv
+        self._volume += volume
+        if self.book.ltp:
+            ltp = self.book.ltp
+            if self._ohlc:
+                self._ohlc = [self._ohlc[0], max(self._ohlc[1], ltp), min(self._ohlc[2], ltp), ltp]
+            else:
+                self._ohlc = [ltp] * 4
+
+    def _close_bucket(self) -> None:
+        if self._bucket is None:
+            return
+        # The back ladder is sorted by price so its best prices are last, see
+        # RunnerOrderBook.atb_ladder
+        atb_price, atb_volume = _ladder(self.book.atb_ladder, best_first=True)
+        atl_price, atl_volume = _ladder(self.book.atl_ladder, best_first=False)
+        self.rows.append((self._bucket, *(self._ohlc or [np.nan] * 4), self._volume, self.book.tv,
+                          atb_price, atb_volume, atl_price, atl_volume))
+
+    def build(self) -> Bars:
+        self._close_bucket()
+        self._bucket = None
+        columns = list(zip(*self.rows)) if self.rows else [[] for _ in fields(Bars)]
+        scalar_count = len(fields(Bars)) - 4
+        return Bars(
+            np.array(columns[0], dtype=np.int64),
+            *(np.array(column, dtype=np.float64) for column in columns[1:scalar_count]),
+            *(np.array(column, dtype=np.float64).reshape(-1, BOOK_DEPTH)
+              for column in columns[scalar_count:]),
+        )
+
+
+def downsample_bars(bars: Bars, resolution_ms: int) -> Bars:
+    """Aggregates bars into a coarser resolution
+
+    Args:
+        bars (Bars): Bars of a finer resolution
+        resolution_ms (int): Coarser resolution, a multiple of the resolution of `bars`
+
+    Returns:
+        Bars: Aggregated bars
+    """
+    if len(bars) == 0:
+        return bars
+
+    buckets = bars.time - bars.time % resolution_ms
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(buckets)] - 1
+    with np.errstate(invalid="ignore"):
+        return Bars(
+            time=buckets[starts],
+            open=bars.open[starts],
+            high=np.fmax.reduceat(bars.high, starts),
+            low=np.fmin.reduceat(bars.low, starts),
+            close=bars.close[ends],
+            volume=np.add.reduceat(bars.volume, starts),
+            total_volume=bars.total_volume[ends],
+            atb_price=bars.atb_price[ends],
+            atb_volume=bars.atb_volume[ends],
+            atl_price=bars.atl_price[ends],
+            atl_volume=bars.atl_volume[ends],
+        )
+
+
+def build_runner_bars(packets: Iterable[Tuple[int, Dict]], resolution_ms: int) -> Dict[int, Bars]:
+    """Buckets the updates of every runner of a market in one pass over its packets
+
+    Args:
+        packets (Iterable[Tuple[int, Dict]]): Publish time in milliseconds and market change message
+        resolution_ms (int): Bucket length (ms)
+
+    Returns:
+        Dict[int, Bars]: Runner ID to bars
+    """
+    builders: Dict[int, _RunnerBarBuilder] = {}
+    for timestamp, packet in packets:
+        image = bool(packet.get("img"))
+        for runner_change in packet.get("rc", []):
+            builder = builders.get(runner_change["id"])
+            if builder is None:
+                builder = _RunnerBarBuilder(runner_change["id"], resolution_ms)
+                builders[runner_change["id"]] = builder
+            builder.update(int(timestamp), runner_change, image)
+    return {runner_id: builder.build() for runner_id, builder in builders.items()}
+
+
+def build_market_pyramid(packets: Iterable[Tuple[int, Dict]]) -> Dict[int, Dict[str, Bars]]:
+    """Builds the resolution pyramid of every runner of a market in one pass over its packets
+
+    Args:
+        packets (Iterable[Tuple[int, Dict]]): Publish time in milliseconds and market change message
+
+    Returns:
+        Dict[int, Dict[str, Bars]]: Runner ID to resolution label (see RESOLUTIONS_MS) to bars
+    """
+    labels = list(RESOLUTIONS_MS)
+    pyramid = {}
+    for runner_id, bars in build_runner_bars(packets, RESOLUTIONS_MS[labels[0]]).items():
+        levels = {labels[0]: bars}
+        for finer, label in zip(labels, labels[1:]):
+            levels[label] = downsample_bars(levels[finer], RESOLUTIONS_MS[label])
+        pyramid[runner_id] = levels
+    return pyramid
+
+
+def save_pyramid(path: str, pyramid: Dict[int, Dict[str, Bars]]) -> None:
+    """ Save a resolution pyramid as an uncompressed `.npz` file, written to a temporary file
+    first """
+    arrays = {f"{runner_id}/{label}/{field.name}": getattr(bars, field.name)
+              for runner_id, levels in pyramid.items()
+              for label, bars in levels.items()
+              for field in fields(Bars)}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_pyramid(path: str) -> Dict[int, Dict[str, Bars]]:
+    """ Load a resolution pyramid saved with `save_pyramid` """
+    with np.load(path) as data:
+        columns: Dict[int, Dict[str, Dict[str, np.ndarray]]] = {}
+        for key in data.files:
+            runner_id, label, name = key.split("/")
+            columns.setdefault(int(runner_id), {}).setdefault(label, {})[name] = data[key]
+    return {runner_id: {label: Bars(**level) for label, level in levels.items()}
+            for runner_id, levels in columns.items()}
+
+
+def choose_resolution(window_ms: int, max_points: int) -> str:
+    """Finest resolution which shows a time window in at most `max_points` buckets, the
+    coarsest otherwise
+
+    Args:
+        window_ms (int): Visible time window (ms)
+        max_points (int): Maximum number of buckets to display
+
+    Returns:
+        str: Resolution label, see RESOLUTIONS_MS
+    """
+    for label, resolution_ms in RESOLUTIONS_MS.items():
+        if window_ms / resolution_ms <= max_points:
+            return label
+    return list(RESOLUTIONS_MS)[-1]
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets downsampling of a line
+
+    Args:
+        x (np.ndarray): Sorted x values
+        y (np.ndarray): y values, NaN points are never selected unless the whole bucket is NaN
+        threshold (int): Number of points to keep
+
+    Returns:
+        np.ndarray: Indices of the points to keep, including the first and last points
+    """
+    length = len(x)
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    missing = np.isnan(y)
+    # NaN points still take part in the averages of the next buckets as the mean of the line
+    filled = np.where(missing, np.nanmean(y) if not missing.all() else 0.0, y)
+    edges = np.linspace(1, length - 1, threshold - 1).astype(np.int64)
+
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, length - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else length
+        # Average point of the next bucket is the third vertex of the triangle
+        next_x, next_y = x[next_start:next_end].mean(), filled[next_start:next_end].mean()
+        areas = np.abs((x[previous] - next_x) * (filled[start:end] - filled[previous])
+                       - (x[previous] - x[start:end]) * (next_y - filled[previous]))
+        areas[missing[start:end]] = -1.0
+        previous = start + int(np.argmax(areas))
+        indices[bucket + 1] = previous
+    return indices
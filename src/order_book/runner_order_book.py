@@ -1,5 +1,5 @@
-from matplotlib import pyplot as plt
 from typing import List, Tuple
+from utils.profiling import profiled
 
 
 class RunnerOrderBook:
@@ -33,17 +33,17 @@ class RunnerOrderBook:
         trd_ladder = sorted(list(self.trd_book))
         return trd_ladder
 
-    def _update_book(self, book: dict, delta_book: dict) -> None:
-        if len(delta_book) > 0:
-            if len(book) == 0:
-                book = book.update({price: volume for price, volume in delta_book})
+    @staticmethod
+    def _update_book(book: dict, delta_book: list) -> None:
+        if not book:
+            book.update(delta_book)
+            return
+        for price, volume in delta_book:
+            if volume == 0 and price in book:
+                # Remove price from book
+                del book[price]
             else:
-                for price, volume in delta_book:
-                    if volume == 0 and price in book.keys():
-                        # Remove price from book
-                        del book[price]
-                    else:
-                        book[price] = volume
+                book[price] = volume
 
     def update(self, timestamp: str, packet: dict) -> None:
         """Update the order book state for a runner
@@ -54,23 +54,38 @@ class RunnerOrderBook:
         """
         if 'rc' in packet:
             self.timestamp = timestamp
-            runner = [runner for runner in packet['rc'] if runner['id'] == self.runner_id]
-            # print([runner['id'] for runner in packet['rc']])
+            for runner in packet['rc']:
+                if runner['id'] == self.runner_id:
+                    self.apply(timestamp, runner)
+                    break
 
-            if len(runner) > 0:
-                runner = runner[0]
-                atb = runner.get('atb', [])
-                atl = runner.get('atl', [])
-                trd = runner.get('trd', [])
+    @profiled("order_book.runner_update")
+    def apply(self, timestamp: str, runner_change: dict) -> None:
+        """Update the order book state with a runner change of this runner, without looking it up
+        in a packet
 
-                self.ltp = runner.get('ltp', self.ltp)
-                new_tv = runner.get('tv', self.tv)
-                self.delta_tv = max(new_tv - self.tv, 0)
-                self.tv = new_tv
-
-                self._update_book(self.atb_book, atb)
-                self._update_book(self.atl_book, atl)
-                self._update_book(self.trd_book, trd)
+        Args:
+            timestamp (str): Timestamp of the update
+            runner_change (dict): Runner change (`rc` entry) of this runner
+        """
+        self.timestamp = timestamp
+        self.ltp = runner_change.get('ltp', self.ltp)
+        new_tv = runner_change.get('tv')
+        if new_tv is None:
+            self.delta_tv = 0
+        else:
+            self.delta_tv = max(new_tv - self.tv, 0)
+            self.tv = new_tv
+
+        atb = runner_change.get('atb')
+        if atb:
+            self._update_book(self.atb_book, atb)
+        atl = runner_change.get('atl')
+        if atl:
+            self._update_book(self.atl_book, atl)
+        trd = runner_change.get('trd')
+        if trd:
+            self._update_book(self.trd_book, trd)
 
     def view(self, limit=0):
         """ View the current status of the order book for a runner
@@ -78,6 +93,8 @@ class RunnerOrderBook:
         Args:
             limit (int, optional): Limit the number of prices to display. Defaults to all.
         """
+        from matplotlib import pyplot as plt
+
         backs = self.atb_book
         lays = self.atl_book
 
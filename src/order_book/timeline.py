@@ -0,0 +1,252 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from order_book.market_order_books import MarketOrderBooks
+from order_book.runner_order_book import RunnerOrderBook
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# State of each runner carried forward by the timeline, each market also has an `in_play`
+# column (1.0/0.0)
+RUNNER_FIELDS = ("ltp", "tv", "back", "back_size", "lay", "lay_size")
+
+DEFAULT_CHUNK_ROWS = 10_000
+
+
+def runner_column(market_id: str, selection_id: int, field: str) -> str:
+    return f"{market_id}/{selection_id}/{field}"
+
+
+def market_column(market_id: str, field: str) -> str:
+    return f"{market_id}/{field}"
+
+
+def _best_price(book: Dict[float, float], changes: Optional[List[List[float]]],
+                best: Optional[float], back: bool) -> Optional[float]:
+    """Best price of one side of a runner book after `changes` were applied to it
+
+    The book is only scanned when the previous best level was removed (or is unknown), otherwise the
+    best price is updated from the changed levels.
+
+    Args:
+        book (Dict[float, float]): Price to volume of the side, after the changes
+        changes (Optional[List[List[float]]]): [price, volume] levels of the runner change
+        best (Optional[float]): Best price before the changes, None if unknown
+        back (bool): Back side (best is the highest price), lay side otherwise
+
+    Returns:
+        Optional[float]: Best price, None if the side is empty
+    """
+    if best is not None and changes:
+        for price, volume in changes:
+            if volume > 0:
+                if price > best if back else price < best:
+                    best = price
+            elif price == best:
+                best = None
+                break
+    if best is None or best not in book:
+        prices = [price for price, volume in book.items() if volume > 0]
+        best = (max(prices) if back else min(prices)) if prices else None
+    return best
+
+
+@dataclass
+class TimelineChunk:
+    """Consecutive rows of an as-of joined timeline
+
+    Row i holds the latest state of every column after the packet published at `time[i]` in market
+    `market_id[i]`. Columns are added as runners appear, so later chunks can have more columns than
+    earlier ones.
+    """
+    time: np.ndarray  # Publish time (ms)
+    market_id: np.ndarray  # Market of the packet of each row
+    columns: List[str]  # `{market_id}/{selection_id}/{field}` and `{market_id}/{field}`
+    values: np.ndarray  # (rows, columns)
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def column(self, name: str) -> np.ndarray:
+        return self.values[:, self.columns.index(name)]
+
+    def to_frame(self) -> "pd.DataFrame":
+        """ DataFrame of the chunk indexed by publish time, chunks can be joined with
+        `pd.concat` """
+        import pandas as pd
+        frame = pd.DataFrame(self.values, columns=self.columns,
+                             index=pd.to_datetime(self.time, unit="ms", utc=True))
+        frame.insert(0, "market_id", self.market_id)
+        return frame
+
+
+class EventTimeline:
+    """Builds an as-of joined timeline of several markets from their packets merged in publish time
+    order
+
+    Only the changes of each packet are recorded (row, column, value), the dense rows are
+    materialised and forward filled with NumPy once a chunk is full. The cost is linear in the
+    number of packets and memory is bounded by the chunk size.
+    """
+
+    def __init__(self, runner_fields: Sequence[str] = RUNNER_FIELDS,
+                 chunk_rows: int = DEFAULT_CHUNK_ROWS) -> None:
+        """ Initialise the timeline
+
+        Args:
+            runner_fields (Sequence[str], optional): Runner state columns, a subset of RUNNER_FIELDS
+            chunk_rows (int, optional): Rows per chunk
+
+        Raises:
+            ValueError: If a field is unknown
+        """
+        unknown = set(runner_fields) - set(RUNNER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown timeline fields {sorted(unknown)}")
+        self.runner_fields = list(runner_fields)
+        self.chunk_rows = chunk_rows
+        self.books: Dict[str, MarketOrderBooks] = {}
+        self.columns: List[str] = []
+        self._column_index: Dict[str, int] = {}
+        self._runner_columns: Dict[Tuple[str, int], List[int]] = {}
+        # Best back and lay price of each runner
+        self._best: Dict[Tuple[str, int], Tuple[Optional[float], Optional[float]]] = {}
+        self._carry = np.empty(0)  # State of every column before the current chunk
+        self._times: List[int] = []
+        self._markets: List[str] = []
+        self._change_rows: List[int] = []
+        self._change_columns: List[int] = []
+        self._change_values: List[float] = []
+
+    def _columns(self, names: List[str]) -> List[int]:
+        indices = []
+        for name in names:
+            index = self._column_index.get(name)
+            if index is None:
+                index = self._column_index[name] = len(self.columns)
+                self.columns.append(name)
+            indices.append(index)
+        return indices
+
+    def _set(self, row: int, columns: List[int], values: List[float]) -> None:
+        self._change_rows.extend([row] * len(columns))
+        self._change_columns.extend(columns)
+        self._change_values.extend(values)
+
+    def update(self, publish_time: int, market_id: str, packet: Dict) -> None:
+        """ Apply a packet, adding a row to the timeline
+
+        Args:
+            publish_time (int): Publish time in milliseconds
+            market_id (str): Market ID
+            packet (Dict): Market change message
+        """
+        books = self.books.get(market_id)
+        if books is None:
+            books = self.books[market_id] = MarketOrderBooks(market_id)
+        previous_runners = books.runners if packet.get("img") else {}
+        books.update(publish_time, packet)
+        for selection_id in previous_runners:
+            self._best.pop((market_id, selection_id), None)
+
+        row = len(self._times)
+        self._times.append(publish_time)
+        self._markets.append(market_id)
+
+        if "marketDefinition" in packet:
+            self._set(row, self._columns([market_column(market_id, "in_play")]),
+                      [1.0 if packet["marketDefinition"].get("inPlay") else 0.0])
+        # Runners missing from a full image have no state any more
+        for selection_id in previous_runners.keys() - books.runners.keys():
+            self._set(row, self._get_runner_columns(market_id, selection_id),
+                      [np.nan] * len(self.runner_fields))
+        for runner_change in packet.get("rc", []):
+            selection_id = runner_change["id"]
+            self._set(row, self._get_runner_columns(market_id, selection_id),
+                      self._runner_state(market_id, books.runners[selection_id], runner_change))
+
+    def _get_runner_columns(self, market_id: str, selection_id: int) -> List[int]:
+        columns = self._runner_columns.get((market_id, selection_id))
+        if columns is None:
+            columns = self._runner_columns[(market_id, selection_id)] = self._columns(
+                [runner_column(market_id, selection_id, field) for field in self.runner_fields])
+        return columns
+
+    def _runner_state(self, market_id: str, book: RunnerOrderBook,
+                      runner_change: Dict) -> List[float]:
+        back, lay = self._best.get((market_id, book.runner_id), (None, None))
+        back = _best_price(book.atb_book, runner_change.get("atb"), back, back=True)
+        lay = _best_price(book.atl_book, runner_change.get("atl"), lay, back=False)
+        self._best[(market_id, book.runner_id)] = (back, lay)
+        state = {
+            "ltp": book.ltp or np.nan,
+            "tv": book.tv,
+            "back": np.nan if back is None else back,
+            "back_size": np.nan if back is None else book.atb_book[back],
+            "lay": np.nan if lay is None else lay,
+            "lay_size": np.nan if lay is None else book.atl_book[lay],
+        }
+        return [state[field] for field in self.runner_fields]
+
+    def __len__(self) -> int:
+        """ Number of rows added since the last flush """
+        return len(self._times)
+
+    def is_full(self) -> bool:
+        return len(self._times) >= self.chunk_rows
+
+    def flush(self) -> TimelineChunk:
+        """ Materialise the rows added since the last flush """
+        row_count, column_count = len(self._times), len(self.columns)
+        carry = np.full(column_count, np.nan)
+        carry[:len(self._carry)] = self._carry
+
+        values = np.full((row_count, column_count), np.nan)
+        rows = np.array(self._change_rows, dtype=np.int64)
+        columns = np.array(self._change_columns, dtype=np.int64)
+        changes = np.array(self._change_values, dtype=np.float64)
+        # A column can change several times in a packet, the last change wins
+        cells = rows * column_count + columns
+        _, last = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - last
+        values[rows[last], columns[last]] = changes[last]
+        changed = np.zeros((row_count, column_count), dtype=bool)
+        changed[rows[last], columns[last]] = True
+
+        # Forward fill: each cell takes the value of the last change at or before its row, the carry
+        # otherwise
+        source = np.where(changed, np.arange(row_count, dtype=np.int32)[:, None], np.int32(-1))
+        np.maximum.accumulate(source, axis=0, out=source)
+        filled = values[np.maximum(source, 0), np.arange(column_count)[None, :]]
+        filled = np.where(source >= 0, filled, carry[None, :])
+
+        chunk = TimelineChunk(np.array(self._times, dtype=np.int64), np.array(self._markets),
+                              list(self.columns), filled)
+        self._carry = filled[-1] if row_count else carry
+        self._times, self._markets = [], []
+        self._change_rows, self._change_columns, self._change_values = [], [], []
+        return chunk
+
+
+def build_event_timeline(packets: Iterable[Tuple[int, str, Dict]],
+                         runner_fields: Sequence[str] = RUNNER_FIELDS,
+                         chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Iterator[TimelineChunk]:
+    """Streams the as-of joined timeline of merged market packets in chunks
+
+    Args:
+        packets (Iterable[Tuple[int, str, Dict]]): Publish time, market ID and market change message
+            in publish time order, e.g. `DataLocation.iter_event`
+        runner_fields (Sequence[str], optional): Runner state columns, a subset of RUNNER_FIELDS
+        chunk_rows (int, optional): Rows per chunk
+
+    Yields:
+        TimelineChunk: Up to `chunk_rows` rows
+    """
+    timeline = EventTimeline(runner_fields, chunk_rows)
+    for publish_time, market_id, packet in packets:
+        timeline.update(publish_time, market_id, packet)
+        if timeline.is_full():
+            yield timeline.flush()
+    if len(timeline) > 0:
+        yield timeline.flush()
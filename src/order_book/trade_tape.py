@@ -0,0 +1,164 @@
+from array import array
+from typing import TYPE_CHECKING, Dict, Iterable, List, Tuple
+
+if TYPE_CHECKING:
+    import numpy as np
+
+TAPE_COLUMNS = ["timestamp", "selection_id", "price", "size"]
+
+
+def traded_deltas(traded_book: Dict[float, float], trd: List[List[float]],
+                  image: bool = False) -> List[Tuple[float, float]]:
+    """Volume traded at each price since the previous update, from the cumulative traded ladder of a
+    runner change
+
+    Args:
+        traded_book (Dict[float, float]): Cumulative traded volume per price before the update, it
+            is not modified
+        trd (List[List[float]]): `trd` levels of the runner change, [price, cumulative volume]
+        image (bool, optional): The change is part of a full image (`img`), volume at prices which
+            are not in the book yet was traded before the capture started and is not a print
+
+    Returns:
+        List[Tuple[float, float]]: Traded (price, size), decreases of the cumulative volume are
+            ignored
+    """
+    deltas = []
+    for price, volume in trd:
+        previous = traded_book.get(price)
+        if previous is None and image:
+            continue
+        size = volume - (previous or 0)
+        if size > 0:
+            deltas.append((price, size))
+    return deltas
+
+
+class TradeTape:
+    """Columnar tape of the trades (prints) of one or more runners"""
+
+    def __init__(self) -> None:
+        self.timestamps = array("q")
+        self.selection_ids = array("q")
+        self.prices = array("d")
+        self.sizes = array("d")
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def append(self, timestamp: int, selection_id: int, price: float, size: float) -> None:
+        self.timestamps.append(timestamp)
+        self.selection_ids.append(selection_id)
+        self.prices.append(price)
+        self.sizes.append(size)
+
+    def to_columns(self) -> Dict[str, "np.ndarray"]:
+        """ NumPy arrays of the tape, the arrays share the memory of the tape """
+        import numpy as np
+        return {
+            "timestamp": np.frombuffer(self.timestamps, dtype=np.int64),
+            "selection_id": np.frombuffer(self.selection_ids, dtype=np.int64),
+            "price": np.frombuffer(self.prices, dtype=np.float64),
+            "size": np.frombuffer(self.sizes, dtype=np.float64),
+        }
+
+
+class TradeTapeBuilder:
+    """Derives the trade tape of a market incrementally from its market change messages"""
+
+    def __init__(self, keep_tape: bool = True) -> None:
+        """ Initialise the builder
+
+        Args:
+            keep_tape (bool, optional): Keep the prints in `tape`, otherwise they are only returned
+                by `update`
+        """
+        self.traded_books: Dict[int, Dict[float, float]] = {}
+        self.tape = TradeTape() if keep_tape else None
+
+    def update(self, publish_time: int, update: Dict) -> List[Tuple[int, int, float, float]]:
+        """ Add the prints of a market change message to the tape
+
+        Args:
+            publish_time (int): Publish time in milliseconds
+            update (Dict): Market change message
+
+        Returns:
+            List[Tuple[int, int, float, float]]: New (timestamp, selection ID, price, size) prints
+        """
+        prints = []
+        image = bool(update.get("img"))
+        for runner_change in update.get("rc", []):
+            trd = runner_change.get("trd")
+            if not trd:
+                continue
+            traded_book = self.traded_books.setdefault(runner_change["id"], {})
+            for price, size in traded_deltas(traded_book, trd, image):
+                if self.tape is not None:
+                    self.tape.append(publish_time, runner_change["id"], price, size)
+                prints.append((publish_time, runner_change["id"], price, size))
+            traded_book.update((price, volume) for price, volume in trd)
+        return prints
+
+
+def extract_trade_tape(packets: Iterable[Tuple[int, Dict]]) -> Dict[str, "np.ndarray"]:
+    """Vectorized trade tape of a recorded market
+
+    The `trd` levels of the capture are collected into flat columns in one pass and the cumulative
+    volumes are differenced per (runner, price) with NumPy, which gives the same prints as
+    `TradeTapeBuilder`.
+
+    Args:
+        packets (Iterable[Tuple[int, Dict]]): Publish time in milliseconds and market change
+            message, e.g. `DataLocation.iter_market`
+
+    Returns:
+        Dict[str, np.ndarray]: `timestamp`, `selection_id`, `price` and `size` columns in publish
+            order
+    """
+    import numpy as np
+
+    timestamps, selection_ids, images = array("q"), array("q"), array("b")
+    prices, volumes = array("d"), array("d")
+    for publish_time, packet in packets:
+        image = 1 if packet.get("img") else 0
+        for runner_change in packet.get("rc", []):
+            for price, volume in runner_change.get("trd", ()):
+                timestamps.append(int(publish_time))
+                selection_ids.append(runner_change["id"])
+                images.append(image)
+                prices.append(price)
+                volumes.append(volume)
+
+    timestamp = np.frombuffer(timestamps, dtype=np.int64)
+    selection_id = np.frombuffer(selection_ids, dtype=np.int64)
+    price = np.frombuffer(prices, dtype=np.float64)
+    volume = np.frombuffer(volumes, dtype=np.float64)
+    if len(timestamp) == 0:
+        return {column: np.array([], dtype=np.float64 if column in ("price", "size") else np.int64)
+                for column in TAPE_COLUMNS}
+
+    # Group the levels by (runner, price), in publish order within each group
+    order = np.lexsort((np.arange(len(timestamp)), price, selection_id))
+    grouped_volume = volume[order]
+    grouped_selection_id, grouped_price = selection_id[order], price[order]
+    first = np.r_[True, (grouped_selection_id[1:] != grouped_selection_id[:-1])
+                  | (grouped_price[1:] != grouped_price[:-1])]
+
+    size = np.empty_like(grouped_volume)
+    size[1:] = grouped_volume[1:] - grouped_volume[:-1]
+    size[first] = grouped_volume[first]
+    # Volume first seen in an image was traded before the capture started
+    size[first & (np.frombuffer(images, dtype=np.int8)[order] == 1)] = 0
+    # The cumulative volume only decreases on corrections, those levels are not prints but become
+    # the new base
+    size = np.maximum(size, 0)
+    rows = np.sort(order[size > 0])
+    sizes = np.empty(len(timestamp))
+    sizes[order] = size
+    return {
+        "timestamp": timestamp[rows],
+        "selection_id": selection_id[rows],
+        "price": price[rows],
+        "size": sizes[rows],
+    }
@@ -2,7 +2,11 @@ import json
 import os
 import logging
 from stream.storage.data_location import DataLocation
+from stream.storage.segments import index_file_name, iter_segment_lines
+from stream.storage.capture import iter_records, record_to_dict
+from stream.storage.definition_codec import DefinitionDecoder
 from typing import Dict, List
+from utils.profiling import profiled, span
 
 
 class MarketDataParser:
@@ -13,28 +17,61 @@ class MarketDataParser:
             data_location (DataLocation): Data location object, with data path and event list
         """
         self.data_location = data_location
-        self.file_paths = data_location.get_files_in_folder()
+        self.market_captures = data_location.get_market_captures("txt")
+
+    @property
+    def file_paths(self) -> List[str]:
+        return [file_path for file_paths in self.market_captures.values()
+                for file_path in file_paths]
 
     def parse_all(self, delete_flag: bool = False) -> None:
-        """ Parse all files in the data folder
+        """ Parse the captures of all markets in the data folder, segmented captures are merged into
+        one file and the resolution pyramid of each market is precomputed
 
         Args:
             delete_flag (bool): Flag to delete the .txt files after parsing
         """
-        for file_path in self.file_paths:
-            logging.info(f"Parsing file {file_path}")
-            parsed_file_data = self.parse_file(file_path)
-            new_file_path = self._replace_extension(file_path, "json")
+        # Imported here so numpy is only loaded when parsing
+        from order_book.resample import build_market_pyramid
+
+        for (event_id, market_id), file_paths in self.market_captures.items():
+            logging.info(f"Parsing market {market_id} from {len(file_paths)} file(s)")
+            defs_path = self.data_location.get_definitions_path(event_id, market_id)
+            parsed_file_data = self.parse_files(file_paths, defs_path)
+            new_file_path = os.path.join(self.data_location.data_path, event_id,
+                                         f"{market_id}.json")
 
             # Write to file to json
-            with open(new_file_path, "w") as file:
+            with span("parser.write_json"), open(new_file_path, "w") as file:
                 file.write(json.dumps(parsed_file_data, indent=4))
             logging.info(f"Created new file {new_file_path}")
 
-            # Remove .txt file
-            logging.info(f"Removing file {file_path}")
+            # Precompute the downsampled series used by the dashboard
+            with span("parser.pyramid"):
+                self.data_location.save_market_pyramid(event_id, market_id, build_market_pyramid(
+                    (record["pt"], record["mc"]) for record in parsed_file_data["records"]
+                ))
+
+            # Record the parsed file in the catalog, replacing the .txt entries if they are deleted
+            self.data_location.catalog.replace_captures(
+                [self.data_location.relative_path(file_path) for file_path in file_paths],
+                self.data_location.relative_path(new_file_path),
+                byte_size=os.path.getsize(new_file_path),
+                keep_old=not delete_flag
+            )
+
+            # Remove .txt files
             if delete_flag:
-                os.remove(file_path)
+                for file_path in file_paths:
+                    logging.info(f"Removing file {file_path}")
+                    os.remove(file_path)
+                    # The sidecar index only applies to the .txt capture
+                    index_path = index_file_name(file_path)
+                    if os.path.exists(index_path):
+                        os.remove(index_path)
+                # Market definitions are expanded in the parsed file
+                if os.path.exists(defs_path):
+                    os.remove(defs_path)
 
     def parse_file(self, file_path: str) -> Dict[str, Dict]:
         """ Parse a file into a dictionary
@@ -43,14 +80,32 @@ class MarketDataParser:
             file_path (str): File path to parse
 
         Returns:
-            Dict[str, List]: Dictionary of parsed file
+            Dict[str, List]: Records of the file under "records"
+        """
+        return self.parse_files([file_path])
+
+    @profiled("parser.parse_file")
+    def parse_files(self, file_paths: List[str], defs_path: str = None) -> Dict[str, Dict]:
+        """ Parse the (possibly compressed) segments of a market capture into a dictionary
+
+        Every record is kept, in write order, including packets sharing a publish time.
+
+        Args:
+            file_paths (List[str]): Segment paths to parse
+            defs_path (str, optional): Market definitions sidecar, references to it are expanded if
+                it exists
+
+        Returns:
+            Dict[str, List]: Records of the segments under "records", see stream.storage.capture
         """
-        with open(file_path, "r") as file:
-            market_data = {}
-            for line in file:
-                market_data.update(json.loads(line))
+        decoder = DefinitionDecoder(defs_path) if defs_path and os.path.exists(defs_path) else None
+        records = []
+        for record in iter_records(iter_segment_lines(file_paths)):
+            if decoder:
+                record = record._replace(update=decoder.decode(record.update))
+            records.append(record_to_dict(record))
 
-        res = {"mcm": market_data}
+        res = {"records": records}
         return res
 
     def _replace_extension(self, file_path: str, new_extension) -> str:
@@ -0,0 +1,329 @@
+import ssl
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+from stream.session import SessionManager
+from stream.storage.data_location import DataLocation
+from stream.streaming import StreamConfig
+from stream.writer.stream_writer import MarketFileBuffer
+
+# Largest message line read from the stream, subscription images can be several MB
+STREAM_LINE_LIMIT = 16 * 1024 * 1024
+
+
+@dataclass
+class AsyncCaptureConfig:
+    """Options of the asyncio capture mode"""
+    host: str = "stream-api.betfair.com"
+    port: int = 443
+    ssl: bool = True
+    # Market changes waiting for the writer before the connections stop reading
+    queue_size: int = 10000
+    buffer_size: int = 5  # Market changes buffered per market before they are written
+    # Buffers are written at most this long after their first change
+    max_buffer_age_sec: float = 10.0
+    flush_interval_sec: float = 1.0
+    metrics_interval_sec: float = 60.0
+    keep_alive_interval_sec: float = 30 * 60
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "AsyncCaptureConfig":
+        """ Create the options from the `async_capture` section of the app config, defaults if there
+        is none
+
+        Args:
+            config (Dict): App config
+        """
+        async_capture = config.get("async_capture") or {}
+        return cls(**{key: value for key, value in async_capture.items()
+                      if key in cls.__dataclass_fields__})
+
+
+class MarketChange:
+    """Change of a market received by the asyncio capture, written like the market books of the
+    threaded capture"""
+    __slots__ = ("market_id", "publish_time_epoch", "streaming_update", "receive_time", "clk")
+
+    def __init__(self, market_id: str, publish_time_epoch: int, streaming_update: Dict,
+                 receive_time: int = None, clk: str = None) -> None:
+        self.market_id = market_id
+        self.publish_time_epoch = publish_time_epoch
+        self.streaming_update = streaming_update
+        self.receive_time = receive_time  # Milliseconds since the epoch
+        self.clk = clk  # Clock of the message of the change
+
+    @property
+    def publish_time(self) -> datetime:
+        return datetime.fromtimestamp(self.publish_time_epoch / 1000, tz=timezone.utc)
+
+
+class StreamProtocolError(Exception):
+    """Failure status or unexpected end of a stream connection"""
+
+
+class AsyncMarketStream:
+    """Market subscription of the asyncio capture, one connection handled by a task of the event
+    loop
+
+    The connection is re-established with an exponential back-off on errors, resuming the
+    subscription from the last clocks so no change is missed. Changes are put on the capture queue,
+    a full queue stops the reads so the backlog stays bounded and the exchange stream is slowed down
+    instead.
+    """
+
+    def __init__(self, stream_config: StreamConfig, market_data_filter: Dict,
+                 conflate_ms: Optional[int] = None, unique_id: int = 1) -> None:
+        self.stream_config = stream_config
+        self.stream_name = stream_config.stream_name
+        self.market_data_filter = market_data_filter
+        self.conflate_ms = conflate_ms
+        self.unique_id = unique_id
+        self.initial_clk: Optional[str] = None
+        self.clk: Optional[str] = None
+        self.start_time: Optional[float] = None
+        self.time_to_first_packet: Optional[float] = None
+        self.change_count = 0
+        self.connection_count = 0
+
+    async def run(self, config: AsyncCaptureConfig, get_session: Callable, app_key: str,
+                  output_queue: asyncio.Queue) -> None:
+        """ Connect and subscribe, reconnecting on errors until cancelled
+
+        Args:
+            config (AsyncCaptureConfig): Endpoint of the stream
+            get_session (Callable): Coroutine function returning a valid session token, given the
+                stale token of a lost connection (or None)
+            app_key (str): Application key
+            output_queue (asyncio.Queue): Queue of the `MarketChange`s
+        """
+        self.start_time = time.monotonic()
+        session_token, backoff = None, 2
+        while True:
+            change_count = self.change_count
+            try:
+                session_token = await get_session(session_token)
+                await self._connect(config, session_token, app_key, output_queue)
+            except (OSError, ValueError, StreamProtocolError, asyncio.IncompleteReadError) as e:
+                # The back-off restarts once a connection delivered data
+                backoff = 2 if self.change_count > change_count else backoff
+                logging.error(f"Stream {self.stream_name} disconnected, "
+                              f"reconnecting in {backoff}s : {e}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 20)
+
+    async def _connect(self, config: AsyncCaptureConfig, session_token: str, app_key: str,
+                       output_queue: asyncio.Queue) -> None:
+        ssl_context = ssl.create_default_context() if config.ssl else None
+        reader, writer = await asyncio.open_connection(config.host, config.port, ssl=ssl_context,
+                                                       limit=STREAM_LINE_LIMIT)
+        self.connection_count += 1
+        try:
+            await self._read_message(reader)  # Connection message
+            await self._request(writer, {"op": "authentication", "appKey": app_key,
+                                         "session": session_token})
+            self._check_status(await self._read_message(reader))
+            await self._request(writer, {
+                "op": "marketSubscription",
+                "marketFilter": self.stream_config.stream_market_filter,
+                "marketDataFilter": self.market_data_filter,
+                "conflateMs": self.conflate_ms,
+                "initialClk": self.initial_clk,  # supplying these two values allows a reconnect
+                "clk": self.clk,
+            })
+            while True:
+                message = await self._read_message(reader)
+                operation = message.get("op")
+                if operation == "status":
+                    self._check_status(message)
+                elif operation == "mcm":
+                    await self._on_change_message(message, output_queue)
+        finally:
+            writer.close()
+
+    async def _request(self, writer: asyncio.StreamWriter, message: Dict) -> None:
+        self.unique_id += 1
+        message["id"] = self.unique_id
+        writer.write(json.dumps(message).encode() + b"\r\n")
+        await writer.drain()
+
+    async def _read_message(self, reader: asyncio.StreamReader) -> Dict:
+        line = await reader.readline()
+        if not line:
+            raise StreamProtocolError("Connection closed by the server")
+        return json.loads(line)
+
+    @staticmethod
+    def _check_status(message: Dict) -> None:
+        if message.get("statusCode") == "FAILURE":
+            raise StreamProtocolError(f"{message.get('errorCode')}: {message.get('errorMessage')}")
+
+    async def _on_change_message(self, message: Dict, output_queue: asyncio.Queue) -> None:
+        if message.get("initialClk"):
+            self.initial_clk = message["initialClk"]
+        if message.get("clk"):
+            self.clk = message["clk"]
+        changes = message.get("mc")
+        if not changes:
+            return  # Heartbeat
+        if self.time_to_first_packet is None:
+            self.time_to_first_packet = time.monotonic() - self.start_time
+            logging.info(f"First packet of {self.stream_name} {self.time_to_first_packet:.2f}s "
+                         "after its start")
+
+        publish_time, receive_time = message["pt"], int(time.time() * 1000)
+        for change in changes:
+            # Waits while the queue is full, which stops the reads of the connection
+            await output_queue.put(MarketChange(change["id"], publish_time, change, receive_time,
+                                                self.clk))
+        self.change_count += len(changes)
+
+
+class AsyncCapture:
+    """Capture pipeline running on one asyncio event loop
+
+    Stream connections, start time timers, buffer flushing and metrics are tasks of the loop,
+    connected by a bounded `asyncio.Queue`. Thousands of subscriptions or idle timers cost no
+    threads. Capture files are written by the `MarketFileBuffer`s in a single writer thread, the
+    consumer waits for each write so a slow disk slows down the reads of the connections instead of
+    growing the backlog.
+    """
+
+    def __init__(self, config: AsyncCaptureConfig, stream_schedule: List[StreamConfig],
+                 market_data_filter: Dict, data_location: DataLocation, session: SessionManager,
+                 conflate_ms: Optional[int] = None, **buffer_kwargs) -> None:
+        """ Initialise the capture
+
+        Args:
+            config (AsyncCaptureConfig): Capture options
+            stream_schedule (List[StreamConfig]): Streams, each starts at its start time
+            market_data_filter (Dict): Streaming market data filter
+            data_location (DataLocation): Data location of the captures, the markets must be in its
+                catalog
+            session (SessionManager): Session of the API client, logged in and kept alive from the
+                event loop
+            conflate_ms (int, optional): Conflation of the subscriptions
+            **buffer_kwargs: Options of the `MarketFileBuffer`s (segment_policy, index_interval,
+                ...)
+        """
+        self.config = config
+        self.data_location = data_location
+        self.session = session
+        self.buffer_kwargs = buffer_kwargs
+        self.streams = [AsyncMarketStream(stream_config, market_data_filter, conflate_ms)
+                        for stream_config in sorted(stream_schedule,
+                                                    key=lambda stream: stream.start_time)]
+        self.metrics = {"changes": 0, "writes": 0, "queue_depth": 0, "changes_per_second": 0.0}
+        self.queue: Optional[asyncio.Queue] = None
+        self._pending: Dict[str, List[MarketChange]] = {}
+        self._pending_since: Dict[str, float] = {}
+        self._file_buffers: Dict[str, Optional[MarketFileBuffer]] = {}
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="capture-writer")
+        self._tasks: List[asyncio.Task] = []
+
+    async def run(self) -> None:
+        """ Run the capture until cancelled, the buffered changes are written on the way out """
+        self.queue = asyncio.Queue(self.config.queue_size)
+        self._tasks = [asyncio.create_task(self._run_stream(stream)) for stream in self.streams]
+        self._tasks += [asyncio.create_task(self._flush_stale_buffers()),
+                        asyncio.create_task(self._log_metrics()),
+                        asyncio.create_task(self._keep_alive())]
+        try:
+            await self._consume()
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self.flush()
+            self._executor.shutdown()
+
+    async def _session(self, stale_token: Optional[str]) -> str:
+        # The HTTP login/keep alive requests block, they run in the default executor
+        return await asyncio.get_running_loop().run_in_executor(None, self.session.ensure_session,
+                                                                stale_token)
+
+    async def _keep_alive(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.keep_alive_interval_sec)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.session.keep_alive)
+            except Exception as e:
+                logging.error(f"Error keeping the session alive : {e}")
+
+    async def _run_stream(self, stream: AsyncMarketStream) -> None:
+        delay = (stream.stream_config.start_time - datetime.now()).total_seconds()
+        if delay > 0:
+            logging.info(f"Waiting for {stream.stream_name} to start @ "
+                         f"{stream.stream_config.start_time}")
+            await asyncio.sleep(delay)
+        logging.info(f"Starting {stream.stream_name}")
+        await stream.run(self.config, self._session, self.session.client.app_key, self.queue)
+
+    async def _consume(self) -> None:
+        while True:
+            change = await self.queue.get()
+            self.metrics["changes"] += 1
+            pending = self._pending.get(change.market_id)
+            if pending is None:
+                pending = self._pending[change.market_id] = []
+                self._pending_since[change.market_id] = time.monotonic()
+            pending.append(change)
+            if len(pending) > self.config.buffer_size:
+                await self._write(change.market_id)
+
+    async def _write(self, market_id: str) -> None:
+        changes = self._pending.pop(market_id, None)
+        self._pending_since.pop(market_id, None)
+        if changes:
+            # Batches are written in order by the single writer thread
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write_changes,
+                                                             market_id, changes)
+            self.metrics["writes"] += 1
+
+    def _write_changes(self, market_id: str, changes: List[MarketChange]) -> None:
+        """ Append changes to the capture of a market, in the writer thread """
+        if market_id not in self._file_buffers:
+            try:
+                self._file_buffers[market_id] = MarketFileBuffer(market_id, self.data_location,
+                                                                 max_size=self.config.buffer_size,
+                                                                 **self.buffer_kwargs)
+            except KeyError as e:
+                logging.error(f"Not capturing market {market_id} : {e}")
+                self._file_buffers[market_id] = None
+        file_buffer = self._file_buffers[market_id]
+        if file_buffer is not None:
+            file_buffer.buffer = changes
+            file_buffer.write()
+
+    async def flush(self) -> None:
+        """ Write every buffered change """
+        for market_id in list(self._pending):
+            await self._write(market_id)
+
+    async def _flush_stale_buffers(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.flush_interval_sec)
+            now = time.monotonic()
+            for market_id, since in list(self._pending_since.items()):
+                if now - since >= self.config.max_buffer_age_sec:
+                    await self._write(market_id)
+
+    async def _log_metrics(self) -> None:
+        last_changes, last_time = 0, time.monotonic()
+        while True:
+            await asyncio.sleep(self.config.metrics_interval_sec)
+            now = time.monotonic()
+            self.metrics["queue_depth"] = self.queue.qsize()
+            changes = self.metrics["changes"] - last_changes
+            self.metrics["changes_per_second"] = changes / (now - last_time)
+            last_changes, last_time = self.metrics["changes"], now
+            started = [stream.time_to_first_packet for stream in self.streams
+                       if stream.time_to_first_packet]
+            logging.info(f"Capture: {self.metrics['changes_per_second']:.0f} change(s)/s, "
+                         f"queue depth {self.metrics['queue_depth']}, {self.metrics['writes']} "
+                         f"write(s), "
+                         f"{len(started)}/{len(self.streams)} stream(s) receiving")
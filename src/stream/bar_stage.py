@@ -0,0 +1,123 @@
+import os
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, List, Optional
+from order_book.bars import Bar, BarBuilder, parse_interval
+from stream.storage.data_location import DataLocation
+from stream.writer.stream_writer import PipelineStage
+
+if TYPE_CHECKING:
+    from betfairlightweight.resources import MarketBook
+    from stream.fanout import FanOutServer
+
+
+@dataclass
+class BarConfig:
+    """Options of the live bar building stage"""
+    intervals: List[str] = field(default_factory=lambda: ["1s", "10s", "1m"])
+    store: bool = True
+    publish: bool = True
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Optional["BarConfig"]:
+        """ Create the options from the `bars` section of the app config, None if disabled
+
+        Args:
+            config (Dict): App config
+
+        Raises:
+            ValueError: If an interval is invalid
+        """
+        bars = config.get("bars")
+        if not bars or not bars.get("enabled", True):
+            return None
+
+        bar_config = cls(
+            intervals=bars.get("intervals", cls().intervals),
+            store=bars.get("store", True),
+            publish=bars.get("publish", True),
+        )
+        for interval in bar_config.intervals:
+            parse_interval(interval)
+        return bar_config
+
+
+def bars_file_name(market_id: str) -> str:
+    return f"{market_id}.bars.jsonl"
+
+
+def load_market_bars(data_location: DataLocation, event: str, market: str,
+                     interval: str = None) -> List[Dict]:
+    """Loads the bars stored by the live bar stage
+
+    Args:
+        data_location (DataLocation): DataLocation instance
+        event (str): Event ID
+        market (str): Market ID
+        interval (str, optional): Only return the bars of this interval
+
+    Returns:
+        List[Dict]: Bars, see order_book.bars.Bar
+    """
+    file_path = os.path.join(data_location.data_path, event, bars_file_name(market))
+    if not os.path.exists(file_path):
+        return []
+    with open(file_path) as file:
+        bars = [json.loads(line) for line in file if line.endswith("\n")]
+    return [bar for bar in bars if interval is None or bar["interval"] == interval]
+
+
+class BarStage(PipelineStage):
+    """Builds OHLCV bars from the live market books, completed bars are appended to
+    `{market_id}.bars.jsonl` next to the capture and/or published to the fan-out subscribers as
+    `{"type": "bar", ...}` messages
+    """
+
+    def __init__(self, config: BarConfig, data_location: DataLocation = None,
+                 fanout_server: "FanOutServer" = None) -> None:
+        """ Initialise the bar stage
+
+        Args:
+            config (BarConfig): Bar options
+            data_location (DataLocation, optional): Data location to store the bars in, required if
+                `store` is set
+            fanout_server (FanOutServer, optional): Fan-out server to publish the bars to
+        """
+        self.config = config
+        self.builder = BarBuilder(config.intervals)
+        self.data_location = data_location if config.store else None
+        self.fanout_server = fanout_server if config.publish else None
+
+    def process(self, market_book: "MarketBook") -> None:
+        bars = self.builder.update(market_book.market_id, market_book.publish_time_epoch,
+                                   market_book.streaming_update)
+        self._emit(bars)
+
+    def _emit(self, bars: List[Bar]) -> None:
+        if len(bars) == 0:
+            return
+
+        if self.fanout_server is not None:
+            for bar in bars:
+                self.fanout_server.broadcast(bar.market_id, {"type": "bar", **bar.to_dict()})
+
+        if self.data_location is not None:
+            market_bars: Dict[str, List[Bar]] = {}
+            for bar in bars:
+                market_bars.setdefault(bar.market_id, []).append(bar)
+            for market_id, bars_to_write in market_bars.items():
+                try:
+                    event_id = self.data_location.get_market_event_id(market_id)
+                except KeyError:
+                    logging.warning(f"Not storing the bars of market {market_id} which has no "
+                                    "event folder")
+                    continue
+                file_path = os.path.join(self.data_location.data_path, event_id,
+                                         bars_file_name(market_id))
+                with open(file_path, "a") as file:
+                    file.writelines(json.dumps(bar.to_dict()) + "\n" for bar in bars_to_write)
+
+    def close(self) -> None:
+        """ Complete the open bars """
+        self._emit(self.builder.flush())
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Optional, Tuple
+from stream.storage.segments import COMPRESSION_EXTENSIONS
+
+
+@dataclass
+class CheckpointConfig:
+    """Options of the stream checkpoint"""
+    file_name: str = "checkpoint.json"  # Relative to the data folder
+    # Minimum time between two checkpoint writes, the last state is written on exit
+    min_interval_sec: float = 1.0
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Optional["CheckpointConfig"]:
+        """ Create the options from the `checkpoint` section of the app config, None if checkpoints
+        are disabled
+
+        Args:
+            config (Dict): App config
+        """
+        checkpoint = config.get("checkpoint")
+        if not checkpoint or not checkpoint.get("enabled", True):
+            return None
+
+        return cls(
+            file_name=checkpoint.get("file_name", cls.file_name),
+            min_interval_sec=checkpoint.get("min_interval_sec", cls.min_interval_sec),
+        )
+
+
+@dataclass
+class StreamPosition:
+    """Clock of a stream after a change message, queued behind the market books of the message"""
+    stream_name: str
+    initial_clk: Optional[str]
+    clk: Optional[str]
+    # Markets of the stream, only set when they changed
+    market_ids: Optional[Tuple[str, ...]] = None
+    # Subscription the clocks were issued for, see `subscription_key`. It differs from the
+    # subscription the stream was started with once its conflation is changed under load
+    subscription: Optional[str] = None
+
+
+def subscription_key(market_filter: Dict, market_data_filter: Dict,
+                     conflate_ms: Optional[int]) -> str:
+    """ Canonical form of a subscription, a clock can only resume the subscription it was issued
+    for """
+    return json.dumps({"market_filter": market_filter, "market_data_filter": market_data_filter,
+                       "conflate_ms": conflate_ms}, sort_keys=True, default=str)
+
+
+class StreamCheckpoint:
+    """Durable resume state of the streams, in a JSON file replaced atomically
+
+    The clock of a stream is only checkpointed once every market book queued before it has been
+    written to its capture file, so resuming from the checkpoint cannot skip packets. Books flushed
+    after the checkpointed clock are sent again on resume, the deltas hold absolute values (ladder
+    levels, traded volumes, ...) so replaying them on top of the capture does not change the order
+    books.
+
+    The file holds, per stream, the clocks, the subscription they were issued for and the subscribed
+    markets, and per market the capture file and byte offset written at the time of the checkpoint.
+    """
+
+    def __init__(self, data_path: str, config: CheckpointConfig) -> None:
+        self.data_path = data_path
+        self.config = config
+        self.file_path = os.path.join(data_path, config.file_name)
+        self.streams: Dict[str, Dict] = {}
+        self.writers: Dict[str, Dict] = {}
+        self._pending: Dict[str, Deque[Tuple[int, StreamPosition]]] = {}
+        self._last_write = 0.0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        """ Load the checkpoint file, a missing or unreadable file starts from an empty
+        checkpoint """
+        if not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path, "r") as file:
+                checkpoint = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.error(f"Ignoring unreadable stream checkpoint {self.file_path} : {e}")
+            return
+        self.streams = checkpoint.get("streams", {})
+        self.writers = checkpoint.get("writers", {})
+
+    def resume_position(self, stream_name: str, subscription: str) -> Optional[Dict]:
+        """Checkpointed state of a stream if it can be resumed
+
+        A stream is resumed if it was checkpointed with the same subscription, and the capture files
+        of its markets still hold everything written up to the checkpoint.
+
+        Args:
+            stream_name (str): Stream name
+            subscription (str): Current subscription, see `subscription_key`
+
+        Returns:
+            Optional[Dict]: `initial_clk`, `clk` and `market_ids` of the stream, None to subscribe
+                with full images
+        """
+        stream = self.streams.get(stream_name)
+        if stream is None or not stream.get("clk"):
+            return None
+        if stream.get("subscription") != subscription:
+            logging.info(f"Subscription of {stream_name} changed since the checkpoint, "
+                         "subscribing with full images")
+            return None
+        for market_id in stream.get("market_ids", []):
+            writer = self.writers.get(market_id)
+            if writer is not None and not self._capture_intact(writer["path"], writer["offset"]):
+                logging.warning(f"Capture {writer['path']} is missing data written before the "
+                                f"checkpoint, subscribing {stream_name} with full images")
+                return None
+        return dict(stream)
+
+    def _capture_intact(self, path: str, offset: int) -> bool:
+        file_path = os.path.join(self.data_path, path)
+        if os.path.exists(file_path):
+            return os.path.getsize(file_path) >= offset
+        # Sealed segments are compressed in the background
+        return any(os.path.exists(file_path + extension)
+                   for extension in COMPRESSION_EXTENSIONS.values())
+
+    def start_stream(self, stream_name: str, subscription: str) -> None:
+        """ Record the subscription of a stream being started, its previous clocks are kept until
+        replaced """
+        with self._lock:
+            stream = self.streams.setdefault(stream_name, {})
+            if stream.get("subscription") != subscription:
+                stream.clear()
+            stream["subscription"] = subscription
+
+    def add_position(self, sequence: int, position: StreamPosition) -> None:
+        """ Queue the clock of a stream, it is checkpointed once the books before `sequence` are
+        written """
+        self._pending.setdefault(position.stream_name, deque()).append((sequence, position))
+
+    def update(self, flushed: int, writers: Dict[str, Tuple[str, int]],
+               force: bool = False) -> None:
+        """Checkpoint the clocks of the books written to disk
+
+        Args:
+            flushed (int): Sequence number of the oldest book not written yet, every book before it
+                is on disk
+            writers (Dict[str, Tuple[str, int]]): Capture file (relative to the data folder) and
+                byte offset per market
+            force (bool, optional): Write the checkpoint even if the last write was less than
+                `min_interval_sec` ago
+        """
+        with self._lock:
+            for stream_name, pending in self._pending.items():
+                while pending and pending[0][0] <= flushed:
+                    _, position = pending.popleft()
+                    stream = self.streams.setdefault(stream_name, {})
+                    stream.update(initial_clk=position.initial_clk, clk=position.clk,
+                                  updated=int(time.time() * 1000))
+                    if position.market_ids is not None:
+                        stream["market_ids"] = sorted(position.market_ids)
+                    if position.subscription is not None:
+                        stream["subscription"] = position.subscription
+                    self._dirty = True
+
+            too_soon = time.time() - self._last_write < self.config.min_interval_sec
+            if not self._dirty or (not force and too_soon):
+                return
+            self.writers.update({market_id: {"path": path, "offset": offset}
+                                 for market_id, (path, offset) in writers.items()})
+            self._write()
+
+    def _write(self) -> None:
+        """ Write the checkpoint to a temporary file and rename it over the previous checkpoint """
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"streams": self.streams, "writers": self.writers}, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.file_path)
+        self._last_write = time.time()
+        self._dirty = False
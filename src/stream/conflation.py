@@ -0,0 +1,158 @@
+import time
+import logging
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set
+from stream.storage.catalog import Catalog
+
+if TYPE_CHECKING:
+    from stream.scheduler import Scheduler
+    from stream.streaming import Streaming
+
+# Bounds of the conflateMs of a market subscription
+MAX_CONFLATE_MS = 120000
+
+
+@dataclass
+class ConflationConfig:
+    """Conflation of the streams, and thresholds of the adaptive conflation"""
+    # Conflation of the streams at full resolution, None for every change
+    conflate_ms: Optional[int] = None
+    adaptive: bool = False
+    degraded_conflate_ms: int = 1000  # Conflation of a degraded stream
+    high_queue_depth: int = 5000  # Degrade a stream when this many messages wait for the writer
+    low_queue_depth: int = 500  # ... and restore one when the backlog is back under this
+    high_lag_sec: float = 5.0  # Degrade a stream when the books written are this old
+    low_lag_sec: float = 1.0
+    check_interval_sec: float = 5.0
+    hold_sec: float = 30.0  # Minimum time between two conflation changes
+    # Streams with a priority up to this can be degraded, lowest priority first
+    max_priority: int = 0
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "ConflationConfig":
+        """ Create the options from the `conflation` section of the app config, defaults if there is
+        none
+
+        Args:
+            config (Dict): App config
+
+        Raises:
+            ValueError: If a conflation is out of bounds or the thresholds are inverted
+        """
+        conflation = config.get("conflation") or {}
+        conflation_config = cls(**{key: value for key, value in conflation.items()
+                                   if key in cls.__dataclass_fields__})
+        for conflate_ms in (conflation_config.conflate_ms, conflation_config.degraded_conflate_ms):
+            if conflate_ms is not None and not 0 <= conflate_ms <= MAX_CONFLATE_MS:
+                raise ValueError(f"Invalid conflation {conflate_ms}ms, "
+                                 f"must be between 0 and {MAX_CONFLATE_MS}")
+        if (conflation_config.low_queue_depth > conflation_config.high_queue_depth
+                or conflation_config.low_lag_sec > conflation_config.high_lag_sec):
+            raise ValueError("The low conflation thresholds must not be above the high thresholds")
+        return conflation_config
+
+
+class ConflationController(threading.Thread):
+    """Raises the conflation of the less important streams while the writer falls behind
+
+    Every `check_interval_sec` the backlog of the capture (messages waiting in the output queue and
+    age of the books being written) is compared to the thresholds. Under load, the lowest priority
+    stream at full resolution is re-subscribed with `degraded_conflate_ms`. Once the backlog has
+    cleared, the highest priority degraded stream is returned to full resolution. One stream changes
+    at a time and at most once every `hold_sec`, so the capture degrades gradually. Re-subscriptions
+    resume from the stream clocks, so no change is missed, only conflated.
+
+    The windows during which a market was captured at a lower resolution are recorded in the
+    catalog, see `Catalog.get_conflation_windows`.
+    """
+
+    def __init__(self, config: ConflationConfig, scheduler: "Scheduler",
+                 lag_seconds: Callable[[], float], catalog: Catalog) -> None:
+        """ Initialise the controller
+
+        Args:
+            config (ConflationConfig): Conflation options
+            scheduler (Scheduler): Scheduler of the streams
+            lag_seconds (Callable[[], float]): Age of the books being written, e.g.
+                `MarketStreamHandler.lag_seconds`
+            catalog (Catalog): Catalog recording the conflation windows
+        """
+        threading.Thread.__init__(self, daemon=True, name=self.__class__.__name__)
+        self.config = config
+        self.scheduler = scheduler
+        self.lag_seconds = lag_seconds
+        self.catalog = catalog
+        self.degraded: List["Streaming"] = []
+        self._recorded_markets: Dict[int, Set[str]] = {}
+        self._last_change = 0.0
+        self._stop_event = threading.Event()
+        # Windows left open by a previous run end when it stopped, the streams restart at full
+        # resolution
+        self.catalog.close_conflation_windows(None, _now_ms())
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.config.check_interval_sec):
+            try:
+                self.check()
+            except Exception as e:
+                logging.error(f"Error in conflation controller : {e}")
+
+    def check(self) -> None:
+        """ Degrade or restore one stream according to the current backlog """
+        queue_depth = self.scheduler.output_queue.qsize()
+        lag = self.lag_seconds()
+        self._record_new_markets()
+        if time.time() - self._last_change < self.config.hold_sec:
+            return
+
+        if queue_depth >= self.config.high_queue_depth or lag >= self.config.high_lag_sec:
+            candidates = [stream for stream in self.scheduler.active_streams
+                          if stream.priority <= self.config.max_priority
+                          and stream not in self.degraded]
+            if candidates:
+                stream = min(candidates, key=lambda candidate: candidate.priority)
+                logging.warning(f"Capture backlog of {queue_depth} message(s) and {lag:.1f}s, "
+                                f"conflating {stream.stream_name} to "
+                                f"{self.config.degraded_conflate_ms}ms")
+                self._set_conflation(stream, self.config.degraded_conflate_ms)
+                self.degraded.append(stream)
+        elif (self.degraded and queue_depth <= self.config.low_queue_depth
+              and lag <= self.config.low_lag_sec):
+            stream = max(self.degraded, key=lambda degraded: degraded.priority)
+            logging.info(f"Capture backlog cleared, restoring {stream.stream_name} "
+                         "to full resolution")
+            self._set_conflation(stream, self.config.conflate_ms)
+            self.degraded.remove(stream)
+
+    def _set_conflation(self, stream: "Streaming", conflate_ms: Optional[int]) -> None:
+        stream.set_conflation(conflate_ms)
+        self._last_change = time.time()
+        market_ids = stream.market_ids
+        if conflate_ms == self.config.conflate_ms:
+            self.catalog.close_conflation_windows(market_ids, _now_ms())
+            self._recorded_markets.pop(id(stream), None)
+        else:
+            self.catalog.open_conflation_windows(market_ids, stream.stream_name, conflate_ms,
+                                                 _now_ms())
+            self._recorded_markets[id(stream)] = set(market_ids)
+
+    def _record_new_markets(self) -> None:
+        """ Open the windows of markets added to a degraded stream since it was degraded """
+        for stream in self.degraded:
+            recorded = self._recorded_markets.setdefault(id(stream), set())
+            new_markets = [market_id for market_id in stream.market_ids
+                           if market_id not in recorded]
+            if new_markets:
+                self.catalog.open_conflation_windows(new_markets, stream.stream_name,
+                                                     stream.conflate_ms, _now_ms())
+                recorded.update(new_markets)
+
+    def stop(self) -> None:
+        """ Stop the controller and close the open windows, the capture stops with it """
+        self._stop_event.set()
+        self.catalog.close_conflation_windows(None, _now_ms())
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
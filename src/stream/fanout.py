@@ -0,0 +1,327 @@
+import os
+import json
+import socket
+import logging
+import selectors
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Set
+from order_book.market_order_books import MarketOrderBooks
+from stream.writer.stream_writer import PipelineStage
+
+if TYPE_CHECKING:
+    from betfairlightweight.resources import MarketBook
+
+
+@dataclass
+class FanOutConfig:
+    """Options of the local fan-out server publishing live order books to other processes"""
+    socket_path: str = "/tmp/betfair-listener.sock"
+    max_pending: int = 1000
+    max_buffer_bytes: int = 4 * 1024 * 1024
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Optional["FanOutConfig"]:
+        """ Create the options from the `fanout` section of the app config, None if the server is
+        disabled
+
+        Args:
+            config (Dict): App config
+        """
+        fanout = config.get("fanout")
+        if not fanout or not fanout.get("enabled", True):
+            return None
+
+        return cls(
+            socket_path=fanout.get("socket_path", cls.socket_path),
+            max_pending=fanout.get("max_pending", cls.max_pending),
+            max_buffer_bytes=int(fanout.get("max_buffer_mb", cls.max_buffer_bytes / 1024 / 1024)
+                                 * 1024 * 1024),
+        )
+
+
+class _Subscriber:
+    """Connection state of a subscriber, its pending messages are bounded and conflated into
+    snapshots"""
+
+    def __init__(self, connection: socket.socket) -> None:
+        self.connection = connection
+        self.market_ids: Optional[Set[str]] = set()  # None subscribes to all markets
+        self.pending: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self.pending_count = 0
+        # Markets to send as a snapshot instead of their pending deltas
+        self.stale: Set[str] = set()
+        self.out = bytearray()
+        self.read_buffer = b""
+        self.conflations = 0
+
+    def wants(self, market_id: str) -> bool:
+        return self.market_ids is None or market_id in self.market_ids
+
+
+class FanOutServer(PipelineStage, threading.Thread):
+    """Publishes the live order books of the stream to local subscribers over a Unix socket
+
+    Subscribers send newline delimited JSON requests, `{"op": "subscribe", "market_ids": [...]}`
+    (omit `market_ids` for all markets), and receive a snapshot of each subscribed market followed
+    by its deltas (the market change messages with their publish time `pt`), one JSON message per
+    line.
+
+    Publishing never blocks the capture: messages are queued per subscriber and sent by the server
+    thread. When a subscriber falls more than `max_pending` messages behind, its pending deltas are
+    conflated into one snapshot per market, other messages (e.g. bars) are kept. No more messages
+    are serialized for a subscriber while `max_buffer_bytes` are waiting to be sent. The order book
+    of a market is dropped once it is closed.
+    """
+
+    def __init__(self, config: FanOutConfig) -> None:
+        threading.Thread.__init__(self, daemon=True, name=self.__class__.__name__)
+        self.config = config
+        self.books: Dict[str, MarketOrderBooks] = {}
+        self.subscribers: Dict[int, _Subscriber] = {}
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self._running = True
+
+        if os.path.exists(config.socket_path):
+            os.remove(config.socket_path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(config.socket_path)
+        self._server.listen()
+        self._server.setblocking(False)
+
+    def process(self, market_book: "MarketBook") -> None:
+        """ Update the order book of the market and queue the delta for its subscribers """
+        update = market_book.streaming_update
+        publish_time = market_book.publish_time_epoch
+        with self._lock:
+            books = self.books.get(market_book.market_id)
+            if books is None:
+                books = self.books[market_book.market_id] = MarketOrderBooks(market_book.market_id)
+            books.update(publish_time, update)
+
+            self._queue(market_book.market_id,
+                        {"type": "delta", "market_id": market_book.market_id, "pt": publish_time,
+                         **update})
+            if books.is_closed:
+                self._close_market(books)
+        self._wake()
+
+    def _close_market(self, books: MarketOrderBooks) -> None:
+        """ Drop the order book of a closed market, subscribers waiting for its snapshot get the
+        final snapshot queued """
+        for subscriber in self.subscribers.values():
+            if books.market_id in subscriber.stale:
+                subscriber.stale.discard(books.market_id)
+                subscriber.pending.setdefault(books.market_id, []).insert(0, books.snapshot())
+                subscriber.pending_count += 1
+        del self.books[books.market_id]
+
+    def broadcast(self, market_id: str, message: Dict) -> None:
+        """ Publish a message derived from a market (e.g. a completed bar) to the subscribers of the
+        market
+
+        Args:
+            market_id (str): Market ID
+            message (Dict): JSON serializable message, its `type` tells subscribers how to handle it
+        """
+        with self._lock:
+            self._queue(market_id, message)
+        self._wake()
+
+    def _queue(self, market_id: str, message: Dict) -> None:
+        is_delta = message.get("type") == "delta"
+        for subscriber in self.subscribers.values():
+            if not subscriber.wants(market_id):
+                continue
+            if is_delta and market_id in subscriber.stale:
+                # Part of the snapshot sent instead of the deltas
+                continue
+            subscriber.pending.setdefault(market_id, []).append(message)
+            subscriber.pending_count += 1
+            if subscriber.pending_count > self.config.max_pending:
+                self._conflate(subscriber)
+
+    def _conflate(self, subscriber: _Subscriber) -> None:
+        """ Replace the pending deltas of a slow subscriber with a snapshot of each market at send
+        time, the other messages are kept up to `max_pending` """
+        kept = 0
+        for market_id in list(subscriber.pending):
+            messages = [message for message in subscriber.pending[market_id]
+                        if message.get("type") != "delta"]
+            if len(messages) < len(subscriber.pending[market_id]):
+                subscriber.stale.add(market_id)
+            if messages:
+                subscriber.pending[market_id] = messages
+                kept += len(messages)
+            else:
+                del subscriber.pending[market_id]
+        # Drop the oldest markets' messages when the subscriber is too far behind to keep them all
+        while kept > self.config.max_pending:
+            _, messages = subscriber.pending.popitem(last=False)
+            kept -= len(messages)
+        subscriber.pending_count = kept
+        subscriber.conflations += 1
+        if subscriber.conflations == 1 or subscriber.conflations % 100 == 0:
+            logging.warning("Fan-out subscriber is falling behind, "
+                            f"conflated {subscriber.conflations} time(s)")
+
+    def _wake(self) -> None:
+        try:
+            self._wake_writer.send(b"\0")
+        except BlockingIOError:
+            # The server thread has already been woken up
+            pass
+
+    def run(self) -> None:
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._selector.register(self._wake_reader, selectors.EVENT_READ)
+        logging.info(f"Fan-out server listening on {self.config.socket_path}")
+        while self._running:
+            for key, events in self._selector.select(timeout=1):
+                if key.fileobj is self._server:
+                    self._accept()
+                elif key.fileobj is self._wake_reader:
+                    self._drain_wake()
+                else:
+                    subscriber = self.subscribers.get(key.fileobj.fileno())
+                    if subscriber is None:
+                        continue
+                    if events & selectors.EVENT_READ:
+                        self._read(subscriber)
+                    connected = subscriber.connection.fileno() in self.subscribers
+                    if events & selectors.EVENT_WRITE and connected:
+                        self._send(subscriber)
+            # Serialize the queued messages of subscribers which are not waiting on a full socket
+            # buffer
+            for subscriber in list(self.subscribers.values()):
+                if len(subscriber.out) == 0 and (subscriber.pending_count or subscriber.stale):
+                    self._send(subscriber)
+
+    def _accept(self) -> None:
+        connection, _ = self._server.accept()
+        connection.setblocking(False)
+        with self._lock:
+            self.subscribers[connection.fileno()] = _Subscriber(connection)
+        self._selector.register(connection, selectors.EVENT_READ)
+        logging.info(f"Fan-out subscriber connected ({len(self.subscribers)} connected)")
+
+    def _drain_wake(self) -> None:
+        try:
+            while self._wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _disconnect(self, subscriber: _Subscriber) -> None:
+        with self._lock:
+            self.subscribers.pop(subscriber.connection.fileno(), None)
+        self._selector.unregister(subscriber.connection)
+        subscriber.connection.close()
+        logging.info(f"Fan-out subscriber disconnected ({len(self.subscribers)} connected)")
+
+    def _read(self, subscriber: _Subscriber) -> None:
+        try:
+            data = subscriber.connection.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._disconnect(subscriber)
+            return
+
+        lines = (subscriber.read_buffer + data).split(b"\n")
+        subscriber.read_buffer = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Ignoring invalid fan-out request {line[:100]!r}")
+                continue
+            if request.get("op") == "subscribe":
+                self._subscribe(subscriber, request.get("market_ids"))
+
+    def _subscribe(self, subscriber: _Subscriber, market_ids: Optional[List[str]]) -> None:
+        """ Change the market filter of a subscriber, newly subscribed markets start with a
+        snapshot """
+        with self._lock:
+            previous = subscriber.market_ids
+            subscriber.market_ids = None if market_ids is None else set(market_ids)
+            for market_id in self.books:
+                newly_subscribed = previous is not None and market_id not in previous
+                if subscriber.wants(market_id) and newly_subscribed:
+                    subscriber.stale.add(market_id)
+            for market_id in list(subscriber.pending):
+                if not subscriber.wants(market_id):
+                    subscriber.pending_count -= len(subscriber.pending.pop(market_id))
+            subscriber.stale = {market_id for market_id in subscriber.stale
+                                if subscriber.wants(market_id)}
+        self._send(subscriber)
+
+    def _serialize(self, subscriber: _Subscriber) -> None:
+        """ Move the queued messages of a subscriber to its output buffer, stale markets are sent as
+        a snapshot """
+        with self._lock:
+            # The deltas of stale markets are not queued, the snapshot contains them
+            messages = [self.books[market_id].snapshot() for market_id in subscriber.stale
+                        if market_id in self.books]
+            subscriber.stale = set()
+            for deltas in subscriber.pending.values():
+                messages += deltas
+            subscriber.pending.clear()
+            subscriber.pending_count = 0
+        subscriber.out += b"".join(json.dumps(message).encode() + b"\n" for message in messages)
+
+    def _send(self, subscriber: _Subscriber) -> None:
+        if len(subscriber.out) < self.config.max_buffer_bytes:
+            self._serialize(subscriber)
+        try:
+            sent = subscriber.connection.send(subscriber.out) if subscriber.out else 0
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._disconnect(subscriber)
+            return
+        del subscriber.out[:sent]
+
+        # Wait for the socket to be writable while data is left to send
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if subscriber.out else 0)
+        self._selector.modify(subscriber.connection, events)
+
+    def close(self) -> None:
+        """ Stop the server and disconnect all subscribers """
+        self._running = False
+        self._wake()
+        if self.is_alive():
+            self.join(timeout=5)
+        for subscriber in list(self.subscribers.values()):
+            subscriber.connection.close()
+        self._server.close()
+        if os.path.exists(self.config.socket_path):
+            os.remove(self.config.socket_path)
+
+
+def subscribe(socket_path: str, market_ids: List[str] = None) -> Iterator[Dict]:
+    """Subscribe to the order books published by a running fan-out server
+
+    Args:
+        socket_path (str): Unix socket path of the fan-out server
+        market_ids (List[str], optional): Markets to subscribe to, defaults to all markets
+
+    Yields:
+        Dict: Snapshot and delta messages, see FanOutServer
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        request = {"op": "subscribe", "market_ids": market_ids}
+        connection.sendall(json.dumps(request).encode() + b"\n")
+        with connection.makefile("rb") as stream:
+            for line in stream:
+                yield json.loads(line)
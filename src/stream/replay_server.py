@@ -0,0 +1,125 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+from stream.storage.data_location import DataLocation
+
+# Largest message line read from a client
+STREAM_LINE_LIMIT = 16 * 1024 * 1024
+
+
+class ReplayServer:
+    """Local server replaying recorded markets over the Betfair exchange stream protocol
+
+    Clients connect over plain TCP and receive the CRLF delimited JSON messages of the exchange
+    stream: a connection message, a status per authentication request (any session is accepted) and,
+    per market subscription, the recorded market changes of the subscribed markets merged in publish
+    time order as `mcm` messages. The clock of each message is its packet sequence number, so a
+    subscription with `clk` resumes the replay after that packet (`RESUB_DELTA`) like the exchange
+    does. Used to drive the capture pipeline in tests and benchmarks.
+    """
+
+    def __init__(self, data_location: DataLocation, markets: List[Tuple[str, str]] = None,
+                 speed: float = None, host: str = "127.0.0.1", port: int = 0) -> None:
+        """ Initialise the server
+
+        Args:
+            data_location (DataLocation): Data location of the recorded markets
+            markets (List[Tuple[str, str]], optional): (event ID, market ID) of the markets served,
+                every captured market if None
+            speed (float, optional): Replay speed relative to the recorded publish times, as fast as
+                possible if None
+            host (str, optional): Listening address
+            port (int, optional): Listening port, any free port if 0
+        """
+        self.data_location = data_location
+        if markets is None:
+            markets = sorted(data_location.get_market_captures())
+        self.markets = markets
+        self.speed = speed
+        self.host = host
+        self.port = port
+        self.connection_count = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port,
+                                                  limit=STREAM_LINE_LIMIT)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"Replaying {len(self.markets)} market(s) on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def _select(self, market_filter: Dict) -> List[Tuple[str, str]]:
+        """ Markets of the replay matching the market IDs and event IDs of a subscription filter """
+        market_ids = set(market_filter.get("marketIds") or [])
+        event_ids = set(market_filter.get("eventIds") or [])
+        return [(event_id, market_id) for event_id, market_id in self.markets
+                if (not market_ids or market_id in market_ids)
+                and (not event_ids or event_id in event_ids)]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connection_count += 1
+        connection_id = f"replay-{self.connection_count}"
+        replay: Optional[asyncio.Task] = None
+        try:
+            await _send(writer, {"op": "connection", "connectionId": connection_id})
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                operation = request.get("op")
+                if operation == "marketSubscription":
+                    if replay is not None:
+                        replay.cancel()
+                    await _send(writer, _status(request))
+                    replay = asyncio.create_task(self._replay(writer, request))
+                else:
+                    # Authentication and heartbeat requests always succeed
+                    await _send(writer, _status(request))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if replay is not None:
+                replay.cancel()
+            writer.close()
+
+    async def _replay(self, writer: asyncio.StreamWriter, request: Dict) -> None:
+        """ Send the recorded changes of the subscribed markets, from the packet after `clk` if
+        given """
+        unique_id = request.get("id")
+        resume_after = 0
+        if request.get("initialClk") and request.get("clk"):
+            resume_after = int(request["clk"])
+        markets = self._select(request.get("marketFilter") or {})
+        first_timestamp, started = None, time.monotonic()
+        packets = self.data_location.iter_markets(markets)
+        for sequence, (timestamp, _, packet) in enumerate(packets, start=1):
+            if sequence <= resume_after:
+                continue
+            if self.speed is not None:
+                first_timestamp = timestamp if first_timestamp is None else first_timestamp
+                elapsed = time.monotonic() - started
+                delay = (timestamp - first_timestamp) / 1000 / self.speed - elapsed
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            message = {"op": "mcm", "id": unique_id, "clk": str(sequence), "pt": timestamp,
+                       "mc": [packet]}
+            if sequence == resume_after + 1:
+                message.update(ct="RESUB_DELTA" if resume_after else "SUB_IMAGE", initialClk="0")
+            await _send(writer, message)
+
+
+def _status(request: Dict) -> Dict:
+    return {"op": "status", "id": request.get("id"), "statusCode": "SUCCESS",
+            "connectionClosed": False}
+
+
+async def _send(writer: asyncio.StreamWriter, message: Dict) -> None:
+    writer.write(json.dumps(message, separators=(",", ":")).encode() + b"\r\n")
+    await writer.drain()
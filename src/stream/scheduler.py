@@ -2,27 +2,34 @@ import logging
 import time
 import threading
 import queue
-import pandas as pd
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
 from datetime import datetime
 from betfairlightweight import StreamListener, APIClient
 from random import randint
+from stream.checkpoint import StreamCheckpoint, subscription_key
+from stream.session import SessionManager
 from stream.streaming import Streaming, StreamConfig
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 
 def _get_streaming_unique_id() -> int:
     return randint(0, 10000)
 
 
 class Scheduler(threading.Thread):
-    def __init__(self, stream_schedule: List[StreamConfig], client: APIClient, market_data_filter: Dict,
-                 conflate_ms: int = None):
+    def __init__(self, stream_schedule: List[StreamConfig], client: APIClient,
+                 market_data_filter: Dict, conflate_ms: int = None,
+                 checkpoint: StreamCheckpoint = None, session: SessionManager = None):
         threading.Thread.__init__(self, daemon=True, name=self.__class__.__name__)
         self.stream_schedule = sorted(stream_schedule, key=lambda stream: stream.start_time)
         self.client = client
         self.active_streams = []
         self.market_data_filter = market_data_filter
         self.conflate_ms = conflate_ms
+        self.checkpoint = checkpoint
+        self.session = session
         self.output_queue = queue.Queue()
 
     def display(self) -> None:
@@ -47,7 +54,9 @@ class Scheduler(threading.Thread):
             market for market in current_stream.listener.stream._caches.values() if not market.closed
         ]) > 0
 
-    def _get_stream_events_df(self, stream_config: StreamConfig) -> pd.DataFrame:
+    def _get_stream_events_df(self, stream_config: StreamConfig) -> "pd.DataFrame":
+        import pandas as pd
+
         events = self.client.betting.list_events(
             filter=stream_config.market_filter
         )
@@ -63,35 +72,77 @@ class Scheduler(threading.Thread):
 
         return events_df
 
+    def _resume_position(self, stream_config: StreamConfig) -> Optional[Dict]:
+        """ Checkpointed clocks of a stream which was running before a restart, None if it starts
+        afresh """
+        if self.checkpoint is None:
+            return None
+        subscription = subscription_key(stream_config.stream_market_filter, self.market_data_filter,
+                                        self.conflate_ms)
+        resume = self.checkpoint.resume_position(stream_config.stream_name, subscription)
+        self.checkpoint.start_stream(stream_config.stream_name, subscription)
+        return resume
+
+    def _start_stream(self, stream_config: StreamConfig, resume: Optional[Dict]) -> None:
+        """ Start the thread of a stream, it logs in (through the shared session), connects and
+        subscribes """
+        streaming_unique_id = stream_config.streaming_unique_id
+        if resume is not None:
+            market_count = len(resume.get('market_ids', []))
+            logging.info(f"Resuming {stream_config.stream_name} on {market_count} market(s) "
+                         f"from the checkpoint")
+        logging.info(f"Starting {stream_config.stream_name} | ID: {streaming_unique_id}")
+        stream = Streaming(
+            self.client,
+            stream_config.stream_market_filter,
+            self.market_data_filter,
+            self.conflate_ms,
+            streaming_unique_id,
+            self.output_queue,
+            stream_name=stream_config.stream_name,
+            resume=resume,
+            checkpoint=self.checkpoint is not None,
+            priority=stream_config.priority,
+            session=self.session,
+        )
+
+        stream.start()
+        self.active_streams.append(stream)
+        stream_config.is_running = True
+
+    def _log_start_up(self) -> None:
+        """ Log the time to first packet of the streams once every stream has received data """
+        times = sorted(stream.time_to_first_packet for stream in self.active_streams)
+        logging.info(f"Time to first packet of {len(times)} stream(s): median "
+                     f"{times[len(times) // 2]:.2f}s, max {times[-1]:.2f}s")
+
     def run(self) -> None:
         logging.info("Starting Scheduler...")
         logging.info(f"Scheduled Streams[{len(self.stream_schedule)}]: ")
 
-        for idx in range(len(self.stream_schedule)):
-            current_stream = self.stream_schedule[idx]
+        # Streams checkpointed before a restart are resumed straight away, whatever their start time
+        resumes = {id(stream): self._resume_position(stream) for stream in self.stream_schedule}
+        pending = [stream for stream in self.stream_schedule if not stream.is_running]
 
-            if current_stream.is_running:
+        while pending:
+            current_time = datetime.now()
+            due = [stream for stream in pending
+                   if resumes[id(stream)] is not None or stream.start_time <= current_time]
+            if not due:
+                start_time = min(stream.start_time for stream in pending)
+                stream_names = [stream.stream_name for stream in pending
+                                if stream.start_time == start_time]
+                logging.info(f"Waiting for {', '.join(stream_names)} to start @ {start_time}")
+                time.sleep(max((start_time - current_time).total_seconds(), 0))
                 continue
 
-            current_time = datetime.now()
-            if current_time < current_stream.start_time:
-                logging.info(f"Waiting for {current_stream.stream_name} to start @ {current_stream.start_time}")
-                time.sleep((current_stream.start_time - current_time).total_seconds())
-
-            logging.info(f"Starting {current_stream.stream_name} | ID: {current_stream.streaming_unique_id}")
-            stream = Streaming(
-                self.client,
-                current_stream.stream_market_filter,
-                self.market_data_filter,
-                self.conflate_ms,
-                current_stream.streaming_unique_id,
-                self.output_queue,
-            )
-
-            stream.start()
-            self.active_streams.append(stream)
-            current_stream.is_running = True
+            # The streams due connect and subscribe in parallel, each in its own thread
+            for stream_config in due:
+                self._start_stream(stream_config, resumes[id(stream_config)])
+            logging.info(f"Started {len(due)} stream(s)")
+            pending = [stream for stream in pending if not stream.is_running]
 
+        start_up_logged = False
         while len(self.active_streams) > 0:
             # Check if any streams have ended every 90 seconds, and update the active streams list
             _active_streams = []
@@ -103,6 +154,10 @@ class Scheduler(threading.Thread):
                 _active_streams.append(stream)
 
             self.active_streams = _active_streams
+            if not start_up_logged and all(stream.time_to_first_packet is not None
+                                           for stream in self.active_streams):
+                self._log_start_up()
+                start_up_logged = True
             time.sleep(90)
 
     def stop(self) -> None:
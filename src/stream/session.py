@@ -0,0 +1,89 @@
+import time
+import logging
+import threading
+from typing import Optional
+import betfairlightweight
+
+# Betfair sessions expire after hours of inactivity, a keep alive every 30 minutes keeps them open
+KEEP_ALIVE_INTERVAL_SEC = 30 * 60
+# A session validated this recently is not validated again when a stream reconnects
+VALIDATION_INTERVAL_SEC = 60
+
+
+class SessionManager(threading.Thread):
+    """Logs in once and keeps the session of the API client alive for every stream
+
+    Streams read the session token of the shared client when they connect. A stream reconnecting
+    after an error passes the token it used, the session is then validated with a keep alive and
+    only renewed by a new login if it is no longer valid. Streams failing together share one
+    validation/login, so reconnecting dozens of streams does not hit the login throttling.
+    """
+
+    def __init__(self, client: betfairlightweight.APIClient,
+                 keep_alive_interval_sec: float = KEEP_ALIVE_INTERVAL_SEC):
+        """ Initialise the session manager
+
+        Args:
+            client (betfairlightweight.APIClient): API client shared by the streams
+            keep_alive_interval_sec (float, optional): Time between two keep alive requests
+        """
+        threading.Thread.__init__(self, daemon=True, name=self.__class__.__name__)
+        self.client = client
+        self.keep_alive_interval_sec = keep_alive_interval_sec
+        self.login_count = 0
+        self._lock = threading.Lock()
+        self._validated_at = 0.0
+        self._stop_event = threading.Event()
+
+    def login(self) -> None:
+        with self._lock:
+            self._login()
+
+    def _login(self) -> None:
+        self.client.login()
+        self.login_count += 1
+        self._validated_at = time.monotonic()
+        logging.info("Logged in to BetFair Account")
+
+    def ensure_session(self, stale_token: Optional[str] = None) -> str:
+        """Returns a valid session token, logging in only if needed
+
+        Args:
+            stale_token (str, optional): Token used by a stream which lost its connection, validated
+                if it is still the current token
+
+        Returns:
+            str: Session token
+        """
+        with self._lock:
+            if self.client.session_expired:
+                self._login()
+            elif (stale_token is not None and stale_token == self.client.session_token
+                  and time.monotonic() - self._validated_at > VALIDATION_INTERVAL_SEC):
+                self._keep_alive()
+            return self.client.session_token
+
+    def keep_alive(self) -> None:
+        with self._lock:
+            self._keep_alive()
+
+    def _keep_alive(self) -> None:
+        """ Extend the session, or log in again if it is no longer valid """
+        try:
+            self.client.keep_alive()
+            self._validated_at = time.monotonic()
+            logging.debug("Session kept alive")
+        except betfairlightweight.BetfairError as e:
+            logging.warning(f"Session keep alive failed, logging in again : {e}")
+            self._login()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.keep_alive_interval_sec):
+            try:
+                self.keep_alive()
+            except Exception as e:
+                # The next stream to connect logs in again
+                logging.error(f"Error keeping the session alive : {e}")
+
+    def stop(self) -> None:
+        self._stop_event.set()
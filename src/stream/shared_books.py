@@ -0,0 +1,327 @@
+import time
+import struct
+import logging
+from collections import namedtuple
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from order_book.market_order_books import MarketOrderBooks
+from stream.writer.stream_writer import PipelineStage
+
+if TYPE_CHECKING:
+    from betfairlightweight.resources import MarketBook
+
+MAGIC = b"BFLBOOK1"
+
+# magic, depth, max slots, allocated slots, generation (changes when a slot is assigned or freed)
+HEADER = struct.Struct("<8sIIII")
+# market id, selection id
+INDEX_ENTRY = struct.Struct("<16sq")
+# sequence, publish time, ltp, tv, back levels, lay levels
+SLOT_HEADER = struct.Struct("<QqddII")
+SEQUENCE = struct.Struct("<Q")
+
+RunnerBookSnapshot = namedtuple("RunnerBookSnapshot", ["publish_time", "ltp", "tv", "atb", "atl"])
+
+
+@dataclass
+class SharedBookConfig:
+    """Options of the shared memory region holding the live order books"""
+    name: str = "betfair-listener-books"
+    max_slots: int = 4096
+    depth: int = 10
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Optional["SharedBookConfig"]:
+        """ Create the options from the `shared_books` section of the app config, None if disabled
+
+        Args:
+            config (Dict): App config
+        """
+        shared_books = config.get("shared_books")
+        if not shared_books or not shared_books.get("enabled", True):
+            return None
+
+        return cls(
+            name=shared_books.get("name", cls.name),
+            max_slots=shared_books.get("max_slots", cls.max_slots),
+            depth=shared_books.get("depth", cls.depth),
+        )
+
+
+class _Layout:
+    """Offsets of the shared memory region: header, slot index, then one fixed size record per
+    runner
+
+    Each record and its index entry are protected by a seqlock, the writer makes its sequence odd
+    while they are written and even again once they are complete, so readers retry when the
+    sequence is odd or changed while they copied the record.
+    """
+
+    def __init__(self, depth: int, max_slots: int) -> None:
+        self.depth = depth
+        self.max_slots = max_slots
+        self.ladder = struct.Struct(f"<{4 * depth}d")
+        self.slot_size = SLOT_HEADER.size + self.ladder.size
+        self.index_offset = HEADER.size
+        self.slots_offset = self.index_offset + max_slots * INDEX_ENTRY.size
+
+    @property
+    def size(self) -> int:
+        return self.slots_offset + self.max_slots * self.slot_size
+
+    def index_entry_offset(self, slot: int) -> int:
+        return self.index_offset + slot * INDEX_ENTRY.size
+
+    def slot_offset(self, slot: int) -> int:
+        return self.slots_offset + slot * self.slot_size
+
+
+def _untrack(shm: shared_memory.SharedMemory) -> None:
+    """ Stop the resource tracker from unlinking a region this process only attached to """
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+class SharedBookWriter(PipelineStage):
+    """Publishes the top of the order book of every runner into a shared memory region
+
+    Same host processes read a consistent book with `SharedBookReader` without any copy through a
+    socket or serialisation. A slot is allocated per (market, selection) the first time the runner
+    is updated, the slots of a market are freed and reused by other runners once it is closed.
+    """
+
+    def __init__(self, config: SharedBookConfig) -> None:
+        self.config = config
+        self.layout = _Layout(config.depth, config.max_slots)
+        try:
+            # Remove a region left behind by a previous run
+            stale = shared_memory.SharedMemory(name=config.name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self.shm = shared_memory.SharedMemory(name=config.name, create=True, size=self.layout.size)
+        self.buf = self.shm.buf
+        self.slots: Dict[Tuple[str, int], int] = {}
+        self.free_slots: List[int] = []
+        self.books: Dict[str, MarketOrderBooks] = {}
+        self._slot_count = 0
+        self._generation = 0
+        self._full = False
+        self._write_header()
+        logging.info(f"Publishing order books to shared memory {config.name} "
+                     f"({self.layout.size} bytes)")
+
+    def _write_header(self) -> None:
+        HEADER.pack_into(self.buf, 0, MAGIC, self.layout.depth, self.layout.max_slots,
+                         self._slot_count, self._generation)
+
+    def _allocate(self, market_id: str, selection_id: int) -> Optional[int]:
+        """ Take a free slot for a runner, its index entry is written with its first record """
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        elif self._slot_count < self.layout.max_slots:
+            slot = self._slot_count
+            self._slot_count += 1
+        else:
+            if not self._full:
+                logging.warning("Shared memory order books are full "
+                                f"({self.layout.max_slots} runners)")
+                self._full = True
+            return None
+        self.slots[(market_id, selection_id)] = slot
+        return slot
+
+    def _release_market(self, market_id: str) -> None:
+        """ Free the slots of a closed market, readers no longer find its runners """
+        del self.books[market_id]
+        for key in [key for key in self.slots if key[0] == market_id]:
+            slot = self.slots.pop(key)
+            offset = self.layout.slot_offset(slot)
+            sequence = SEQUENCE.unpack_from(self.buf, offset)[0]
+            SEQUENCE.pack_into(self.buf, offset, sequence + 1)
+            INDEX_ENTRY.pack_into(self.buf, self.layout.index_entry_offset(slot), b"", 0)
+            SEQUENCE.pack_into(self.buf, offset, sequence + 2)
+            self.free_slots.append(slot)
+        self._full = False
+        self._generation += 1
+        self._write_header()
+
+    def process(self, market_book: "MarketBook") -> None:
+        update = market_book.streaming_update
+        books = self.books.get(market_book.market_id)
+        if books is None:
+            books = self.books[market_book.market_id] = MarketOrderBooks(market_book.market_id)
+        books.update(market_book.publish_time_epoch, update)
+
+        if update.get("img"):
+            runner_ids = books.runners
+        else:
+            runner_ids = [runner["id"] for runner in update.get("rc", [])]
+        allocated = False
+        for runner_id in runner_ids:
+            slot = self.slots.get((market_book.market_id, runner_id))
+            index_entry = None
+            if slot is None:
+                slot = self._allocate(market_book.market_id, runner_id)
+                if slot is None:
+                    continue
+                index_entry = (market_book.market_id.encode(), runner_id)
+                allocated = True
+            self._write_slot(slot, books.publish_time, books.runners[runner_id], index_entry)
+        if allocated:
+            # Publish the slot count last, readers only look up slots whose index entry is complete
+            self._generation += 1
+            self._write_header()
+
+        if books.is_closed:
+            self._release_market(market_book.market_id)
+
+    def _write_slot(self, slot: int, publish_time: int, book,
+                    index_entry: Tuple[bytes, int] = None) -> None:
+        depth = self.layout.depth
+        atb = book.atb_ladder[::-1][:depth]  # Best (highest) back price first
+        atl = book.atl_ladder[:depth]
+        ladder = [0.0] * (4 * depth)
+        for level, (price, size) in enumerate(atb):
+            ladder[level], ladder[depth + level] = price, size
+        for level, (price, size) in enumerate(atl):
+            ladder[2 * depth + level], ladder[3 * depth + level] = price, size
+
+        offset = self.layout.slot_offset(slot)
+        sequence = SEQUENCE.unpack_from(self.buf, offset)[0]
+        SEQUENCE.pack_into(self.buf, offset, sequence + 1)
+        if index_entry is not None:
+            INDEX_ENTRY.pack_into(self.buf, self.layout.index_entry_offset(slot), *index_entry)
+        SLOT_HEADER.pack_into(self.buf, offset, sequence + 1, publish_time, book.ltp, book.tv,
+                              len(atb), len(atl))
+        self.layout.ladder.pack_into(self.buf, offset + SLOT_HEADER.size, *ladder)
+        SEQUENCE.pack_into(self.buf, offset, sequence + 2)
+
+    def close(self) -> None:
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedBookReader:
+    """Reads the order books published by a `SharedBookWriter` running in another process"""
+
+    def __init__(self, name: str = SharedBookConfig.name, max_retries: int = 1000) -> None:
+        """ Attach to the shared memory region
+
+        Args:
+            name (str, optional): Name of the shared memory region
+            max_retries (int, optional): Number of attempts to read a record which is being written
+
+        Raises:
+            FileNotFoundError: If no writer has created the region
+            ValueError: If the region was not created by a `SharedBookWriter`
+        """
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attached regions are always tracked
+            self.shm = shared_memory.SharedMemory(name=name)
+            _untrack(self.shm)
+        self.buf = self.shm.buf
+        magic, depth, max_slots, _, _ = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Shared memory {name} does not contain order books")
+        self.layout = _Layout(depth, max_slots)
+        self.max_retries = max_retries
+        self.slots: Dict[Tuple[str, int], int] = {}
+        self._generation: Optional[int] = None
+
+    def _refresh_slots(self) -> None:
+        """ Rebuild the slot lookup when the writer assigned or freed slots since the last
+        refresh """
+        _, _, _, slot_count, generation = HEADER.unpack_from(self.buf, 0)
+        if generation == self._generation:
+            return
+        slots = {}
+        for slot in range(slot_count):
+            key = self._read_entry(slot)
+            if key is not None:
+                slots[key] = slot
+        self.slots, self._generation = slots, generation
+
+    def _read_entry(self, slot: int) -> Optional[Tuple[str, int]]:
+        """ Read the (market ID, selection ID) of a slot, None if it is free """
+        offset = self.layout.slot_offset(slot)
+        for attempt in range(self.max_retries):
+            if attempt > 0:
+                time.sleep(0)
+            sequence = SEQUENCE.unpack_from(self.buf, offset)[0]
+            if sequence % 2:
+                continue
+            entry = INDEX_ENTRY.unpack_from(self.buf, self.layout.index_entry_offset(slot))
+            if SEQUENCE.unpack_from(self.buf, offset)[0] == sequence:
+                market_id, selection_id = entry
+                return (market_id.rstrip(b"\0").decode(), selection_id) if market_id else None
+        raise TimeoutError(f"Order book slot {slot} is being written")
+
+    def runners(self) -> List[Tuple[str, int]]:
+        """ Returns the (market ID, selection ID) of every published runner """
+        self._refresh_slots()
+        return list(self.slots)
+
+    def read(self, market_id: str, selection_id: int) -> Optional[RunnerBookSnapshot]:
+        """ Read a consistent copy of the book of a runner
+
+        Args:
+            market_id (str): Market ID
+            selection_id (int): Selection ID
+
+        Returns:
+            RunnerBookSnapshot: Publish time, LTP, TV and the back (best first) and lay ladders as
+                [price, size] levels, None if the runner has not been published or its market was
+                closed
+
+        Raises:
+            TimeoutError: If the record is still being written after `max_retries` attempts
+        """
+        key = (market_id, selection_id)
+        slot = self.slots.get(key)
+        if slot is None:
+            self._refresh_slots()
+            slot = self.slots.get(key)
+            if slot is None:
+                return None
+
+        depth = self.layout.depth
+        index_entry = INDEX_ENTRY.pack(market_id.encode(), selection_id)
+        for attempt in range(self.max_retries):
+            if attempt > 0:
+                # Let the writer finish the record, it may have been preempted half way through
+                time.sleep(0)
+            offset = self.layout.slot_offset(slot)
+            entry_offset = self.layout.index_entry_offset(slot)
+            sequence = SEQUENCE.unpack_from(self.buf, offset)[0]
+            if sequence % 2:
+                continue
+            header = SLOT_HEADER.unpack_from(self.buf, offset)
+            _, publish_time, ltp, tv, atb_count, atl_count = header
+            ladder = self.layout.ladder.unpack_from(self.buf, offset + SLOT_HEADER.size)
+            entry = bytes(self.buf[entry_offset:entry_offset + INDEX_ENTRY.size])
+            if SEQUENCE.unpack_from(self.buf, offset)[0] != sequence:
+                continue
+            if entry != index_entry:
+                # The slot was freed when the market closed, and may now hold another runner
+                self._refresh_slots()
+                slot = self.slots.get(key)
+                if slot is None:
+                    return None
+                continue
+            atb = [[ladder[level], ladder[depth + level]] for level in range(atb_count)]
+            atl = [[ladder[2 * depth + level], ladder[3 * depth + level]]
+                   for level in range(atl_count)]
+            return RunnerBookSnapshot(publish_time, ltp, tv, atb, atl)
+        raise TimeoutError(f"Order book of {market_id}/{selection_id} is being written")
+
+    def close(self) -> None:
+        self.buf = None
+        self.shm.close()
@@ -0,0 +1,90 @@
+import json
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
+
+
+class CaptureRecord(NamedTuple):
+    """Packet of a market capture
+
+    Records are numbered per market from 1, in write order, so packets sharing a publish time are
+    all kept and keep their order. Records written before records were numbered have no sequence
+    number.
+    """
+    sequence: Optional[int]
+    publish_time: int  # Milliseconds since the epoch
+    # Milliseconds since the epoch, when the listener received the packet
+    receive_time: Optional[int]
+    clk: Optional[str]  # Clock of the stream message of the packet
+    update: Dict  # Market change message
+
+
+def record_to_dict(record: CaptureRecord) -> Dict:
+    """ JSON object of a record, as written in captures and parsed market files """
+    return {"seq": record.sequence, "pt": record.publish_time, "rt": record.receive_time,
+            "clk": record.clk, "mc": record.update}
+
+
+def record_from_dict(data: Dict) -> CaptureRecord:
+    """ Record of a JSON object, objects written before records were numbered (`{publish_time:
+    update}`) are converted too, without sequence number, receive time and clock
+
+    Args:
+        data (Dict): JSON object of the record
+
+    Returns:
+        CaptureRecord: Record
+    """
+    if "mc" in data:
+        return CaptureRecord(data["seq"], data["pt"], data.get("rt"), data.get("clk"), data["mc"])
+    (timestamp, update), = data.items()
+    return CaptureRecord(None, int(timestamp), None, None, update)
+
+
+def encode_record(record: CaptureRecord) -> str:
+    """ Encode a capture record as a capture file line
+
+    Args:
+        record (CaptureRecord): Record to encode
+
+    Returns:
+        str: Line including the trailing new line
+    """
+    return json.dumps(record_to_dict(record)) + '\n'
+
+
+def decode_record(line: str) -> CaptureRecord:
+    """ Decode a capture file line into a record, see `record_from_dict` """
+    return record_from_dict(json.loads(line))
+
+
+def decode_line(line: str) -> Tuple[int, Dict]:
+    """ Decode a capture file line into its publish time and market change message """
+    record = decode_record(line)
+    return record.publish_time, record.update
+
+
+def iter_records(lines: Iterator[str]) -> Iterator[CaptureRecord]:
+    """ Decode the lines of a capture, lines written before records were numbered have no sequence
+    number
+
+    Args:
+        lines (Iterator[str]): Capture file lines, across all segments of the capture
+
+    Yields:
+        CaptureRecord: Records in write order
+    """
+    for line in lines:
+        if line.strip():
+            yield decode_record(line)
+
+
+def iter_capture_file(file_path: str) -> Iterator[CaptureRecord]:
+    """ Stream the records of a capture file without loading the whole file
+
+    Args:
+        file_path (str): Path to the .txt capture file
+
+    Yields:
+        CaptureRecord: Records in write order
+    """
+    with open(file_path, "r") as file:
+        yield from iter_records(file)
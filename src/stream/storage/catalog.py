@@ -0,0 +1,463 @@
+import os
+import re
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from stream.storage.capture import decode_record, record_from_dict
+
+
+class Catalog:
+    """SQLite catalog of the events, markets, runners and capture files stored in a data location
+
+    The catalog replaces the eventLog.json/eventIndex.json files, it is updated incrementally (by
+    `DataLocation.create` and the stream writer) so lookups by event, market, date or runner never
+    need to crawl the data folder. Capture file paths are stored relative to the data folder.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            event_id TEXT PRIMARY KEY,
+            name TEXT,
+            open_date TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS markets (
+            market_id TEXT PRIMARY KEY,
+            event_id TEXT NOT NULL REFERENCES events(event_id),
+            market_name TEXT,
+            market_type TEXT,
+            market_time TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS markets_event_id ON markets(event_id);
+        CREATE INDEX IF NOT EXISTS markets_market_time ON markets(market_time);
+        CREATE TABLE IF NOT EXISTS runners (
+            market_id TEXT NOT NULL REFERENCES markets(market_id),
+            selection_id INTEGER NOT NULL,
+            runner_name TEXT,
+            PRIMARY KEY (market_id, selection_id)
+        );
+        CREATE INDEX IF NOT EXISTS runners_selection_id ON runners(selection_id);
+        CREATE TABLE IF NOT EXISTS capture_files (
+            path TEXT PRIMARY KEY,
+            event_id TEXT NOT NULL,
+            market_id TEXT NOT NULL,
+            file_format TEXT NOT NULL,
+            byte_size INTEGER NOT NULL DEFAULT 0,
+            packet_count INTEGER NOT NULL DEFAULT 0,
+            first_timestamp INTEGER,
+            last_timestamp INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS capture_files_event_id ON capture_files(event_id);
+        CREATE INDEX IF NOT EXISTS capture_files_market_id ON capture_files(market_id);
+        CREATE TABLE IF NOT EXISTS market_stats (
+            market_id TEXT PRIMARY KEY,
+            event_id TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS market_stats_event_id ON market_stats(event_id);
+        CREATE TABLE IF NOT EXISTS conflation_windows (
+            market_id TEXT NOT NULL,
+            stream_name TEXT NOT NULL,
+            conflate_ms INTEGER NOT NULL,
+            start_time INTEGER NOT NULL,
+            end_time INTEGER,
+            PRIMARY KEY (market_id, start_time)
+        );
+        CREATE TABLE IF NOT EXISTS report_cache (
+            market_id TEXT PRIMARY KEY,
+            cache_key TEXT NOT NULL,
+            report TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_path: str) -> None:
+        """ Open (or create) the catalog database
+
+        Args:
+            db_path (str): Path to the SQLite database file
+        """
+        self.db_path = db_path
+        # The catalog is shared between the stream writer, scheduler and streamlit threads
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        # Writes on the capture path append to the write-ahead log, fsynced at checkpoints instead
+        # of every commit
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._transaction_depth = 0
+        with self.transaction():
+            self._connection.executescript(self.SCHEMA)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """ Commit the writes made in the block in a single transaction, blocks can be nested
+
+        Example:
+            with catalog.transaction():
+                catalog.record_capture(...)
+                catalog.save_market_stats(...)
+        """
+        with self._lock:
+            if self._transaction_depth > 0:
+                self._transaction_depth += 1
+                try:
+                    yield
+                finally:
+                    self._transaction_depth -= 1
+                return
+
+            self._transaction_depth = 1
+            try:
+                with self._connection:
+                    yield
+            finally:
+                self._transaction_depth = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def is_empty(self) -> bool:
+        return self._fetch_one("SELECT COUNT(*) AS count FROM events")["count"] == 0
+
+    def add_event(self, event: Dict[str, Any], markets: List[Dict[str, Any]]) -> None:
+        """ Insert or update an event and its markets/runners
+
+        Args:
+            event (Dict[str, Any]): Event object from the Betfair API
+            markets (List[Dict[str, Any]]): Market catalogues from the Betfair API
+        """
+        with self.transaction():
+            self._connection.execute(
+                "INSERT INTO events (event_id, name, open_date, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(event_id) DO UPDATE SET name = excluded.name, "
+                "open_date = excluded.open_date, "
+                "data = excluded.data",
+                (event["id"], event.get("name"), event.get("openDate"), json.dumps(event))
+            )
+            for market in markets:
+                description = market.get("description", {})
+                market_time = market.get("marketStartTime", description.get("marketTime"))
+                self._connection.execute(
+                    "INSERT INTO markets (market_id, event_id, market_name, market_type, "
+                    "market_time, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(market_id) DO UPDATE SET event_id = excluded.event_id, "
+                    "market_name = excluded.market_name, market_type = excluded.market_type, "
+                    "market_time = excluded.market_time, data = excluded.data",
+                    (market["marketId"], event["id"], market.get("marketName"),
+                     description.get("marketType"), market_time, json.dumps(market))
+                )
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO runners (market_id, selection_id, runner_name) "
+                    "VALUES (?, ?, ?)",
+                    [(market["marketId"], runner["selectionId"], runner.get("runnerName"))
+                     for runner in market.get("runners", [])]
+                )
+
+    def get_events(self) -> Dict[str, str]:
+        """ Returns a mapping of event ID to event name """
+        rows = self._fetch_all("SELECT event_id, name FROM events ORDER BY event_id")
+        return {row["event_id"]: row["name"] for row in rows}
+
+    def get_event(self, event_id: str) -> Dict[str, Any]:
+        """ Returns the event and its markets, in the same format as the legacy eventIndex.json
+
+        Raises:
+            KeyError: If the event is not in the catalog
+        """
+        row = self._fetch_one("SELECT data FROM events WHERE event_id = ?", (event_id,))
+        if row is None:
+            raise KeyError(f"Event {event_id} not found in catalog")
+        return {"event": json.loads(row["data"]), "markets": self.get_markets(event_id=event_id)}
+
+    def get_markets(self, event_id: str = None, date: datetime = None,
+                    selection_id: int = None) -> List[Dict]:
+        """ Returns market catalogues filtered by event, market start date and/or runner
+
+        Args:
+            event_id (str, optional): Event ID
+            date (datetime, optional): Market start date (UTC)
+            selection_id (int, optional): Runner selection ID
+
+        Returns:
+            List[Dict]: Market catalogues ordered by start time
+        """
+        query = "SELECT markets.data FROM markets"
+        conditions, params = [], []
+        if selection_id is not None:
+            query += " JOIN runners ON runners.market_id = markets.market_id"
+            conditions.append("runners.selection_id = ?")
+            params.append(selection_id)
+        if event_id is not None:
+            conditions.append("markets.event_id = ?")
+            params.append(event_id)
+        if date is not None:
+            start = datetime(date.year, date.month, date.day)
+            conditions.append("markets.market_time >= ? AND markets.market_time < ?")
+            params += [start.strftime("%Y-%m-%d"), (start + timedelta(days=1)).strftime("%Y-%m-%d")]
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY markets.market_time, markets.market_id"
+
+        return [json.loads(row["data"]) for row in self._fetch_all(query, params)]
+
+    def get_market_event_id(self, market_id: str) -> Optional[str]:
+        row = self._fetch_one("SELECT event_id FROM markets WHERE market_id = ?", (market_id,))
+        return row["event_id"] if row else None
+
+    def record_capture(self, path: str, event_id: str, market_id: str, byte_size: int,
+                       packet_count: int, first_timestamp: Optional[int],
+                       last_timestamp: Optional[int]) -> None:
+        """ Record data appended to a capture file, the sizes and counts are added to the existing
+        totals
+
+        Args:
+            path (str): Path of the capture file relative to the data folder
+            event_id (str): Event ID
+            market_id (str): Market ID
+            byte_size (int): Number of bytes appended
+            packet_count (int): Number of packets appended
+            first_timestamp (int, optional): First publish time (ms) appended
+            last_timestamp (int, optional): Last publish time (ms) appended
+        """
+        with self.transaction():
+            self._connection.execute(
+                "INSERT INTO capture_files "
+                "(path, event_id, market_id, file_format, byte_size, packet_count, "
+                "first_timestamp, last_timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET "
+                "byte_size = byte_size + excluded.byte_size, "
+                "packet_count = packet_count + excluded.packet_count, "
+                "first_timestamp = COALESCE(MIN(first_timestamp, excluded.first_timestamp), "
+                "first_timestamp, excluded.first_timestamp), "
+                "last_timestamp = COALESCE(MAX(last_timestamp, excluded.last_timestamp), "
+                "last_timestamp, excluded.last_timestamp)",
+                (path, event_id, market_id, _file_format(path), byte_size, packet_count,
+                 first_timestamp, last_timestamp)
+            )
+
+    def replace_captures(self, paths: List[str], new_path: str, byte_size: int,
+                         keep_old: bool = False) -> None:
+        """ Record capture files converted/merged into a new file (e.g. parsed .txt segments to
+        .json, compressed or compacted segments), the statistics of the existing files are combined
+
+        Args:
+            paths (List[str]): Relative paths of the existing capture files, all of the same market
+            new_path (str): Relative path of the new file
+            byte_size (int): Size of the new file in bytes
+            keep_old (bool): Keep the entries of the existing files
+        """
+        placeholders = ", ".join("?" for _ in paths)
+        with self.transaction():
+            self._connection.execute(
+                "INSERT OR REPLACE INTO capture_files "
+                "(path, event_id, market_id, file_format, byte_size, packet_count, "
+                "first_timestamp, last_timestamp) "
+                "SELECT ?, event_id, market_id, ?, ?, SUM(packet_count), MIN(first_timestamp), "
+                "MAX(last_timestamp) "
+                f"FROM capture_files WHERE path IN ({placeholders}) GROUP BY event_id, market_id",
+                [new_path, _file_format(new_path), byte_size] + list(paths)
+            )
+            if not keep_old:
+                self._connection.execute(
+                    f"DELETE FROM capture_files WHERE path IN ({placeholders}) AND path != ?",
+                    list(paths) + [new_path]
+                )
+
+    def remove_capture(self, path: str) -> None:
+        with self.transaction():
+            self._connection.execute("DELETE FROM capture_files WHERE path = ?", (path,))
+
+    def get_capture_files(self, event_id: str = None, market_id: str = None,
+                          file_format: str = None) -> List[Dict[str, Any]]:
+        """ Returns the capture files filtered by event, market and/or format
+
+        Args:
+            event_id (str, optional): Event ID
+            market_id (str, optional): Market ID
+            file_format (str, optional): File extension without the dot (txt, json)
+
+        Returns:
+            List[Dict[str, Any]]: Capture file records ordered by path
+        """
+        conditions, params = [], []
+        for column, value in (("event_id", event_id), ("market_id", market_id),
+                              ("file_format", file_format)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+
+        query = "SELECT * FROM capture_files"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY path"
+
+        return [dict(row) for row in self._fetch_all(query, params)]
+
+    def save_market_stats(self, event_id: str, market_id: str, stats: Dict[str, Any]) -> None:
+        """ Insert or replace the running statistics of a market capture
+
+        Args:
+            event_id (str): Event ID
+            market_id (str): Market ID
+            stats (Dict[str, Any]): Serialised `MarketStats`
+        """
+        with self.transaction():
+            self._connection.execute(
+                "INSERT OR REPLACE INTO market_stats (market_id, event_id, data) VALUES (?, ?, ?)",
+                (market_id, event_id, json.dumps(stats))
+            )
+
+    def get_market_stats(self, market_id: str) -> Optional[Dict[str, Any]]:
+        row = self._fetch_one("SELECT data FROM market_stats WHERE market_id = ?", (market_id,))
+        return json.loads(row["data"]) if row else None
+
+    def get_event_market_stats(self, event_id: str) -> Dict[str, Dict[str, Any]]:
+        """ Returns the statistics of every market of an event, keyed by market ID """
+        rows = self._fetch_all("SELECT market_id, data FROM market_stats WHERE event_id = ?",
+                               (event_id,))
+        return {row["market_id"]: json.loads(row["data"]) for row in rows}
+
+    def open_conflation_windows(self, market_ids: List[str], stream_name: str, conflate_ms: int,
+                                start_time: int) -> None:
+        """ Record that the markets are captured at a lower resolution from `start_time` (ms) until
+        closed
+
+        Args:
+            market_ids (List[str]): Market IDs
+            stream_name (str): Name of the stream subscribed to the markets
+            conflate_ms (int): Conflation of the stream
+            start_time (int): Start of the window (ms)
+        """
+        self.close_conflation_windows(market_ids, start_time)
+        with self.transaction():
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO conflation_windows "
+                "(market_id, stream_name, conflate_ms, start_time) "
+                "VALUES (?, ?, ?, ?)",
+                [(market_id, stream_name, conflate_ms, start_time) for market_id in market_ids]
+            )
+
+    def close_conflation_windows(self, market_ids: Optional[List[str]], end_time: int) -> None:
+        """ Close the open conflation windows of the markets at `end_time` (ms), of every market if
+        None """
+        query = "UPDATE conflation_windows SET end_time = ? WHERE end_time IS NULL"
+        params = [end_time]
+        if market_ids is not None:
+            query += f" AND market_id IN ({', '.join('?' for _ in market_ids)})"
+            params += list(market_ids)
+        with self.transaction():
+            self._connection.execute(query, params)
+
+    def get_conflation_windows(self, market_id: str) -> List[Dict[str, Any]]:
+        """ Returns the conflation windows of a market in time order, `end_time` is None while a
+        window is open """
+        return [dict(row) for row in self._fetch_all(
+            "SELECT * FROM conflation_windows WHERE market_id = ? ORDER BY start_time", (market_id,)
+        )]
+
+    def get_cached_report(self, market_id: str, cache_key: str) -> Optional[Dict[str, Any]]:
+        """ Returns the cached report of a market if it was generated from the same capture files
+        (cache key) """
+        row = self._fetch_one("SELECT cache_key, report FROM report_cache WHERE market_id = ?",
+                              (market_id,))
+        if row is None or row["cache_key"] != cache_key:
+            return None
+        return json.loads(row["report"])
+
+    def save_cached_report(self, market_id: str, cache_key: str, report: Dict[str, Any]) -> None:
+        with self.transaction():
+            self._connection.execute(
+                "INSERT OR REPLACE INTO report_cache (market_id, cache_key, report) "
+                "VALUES (?, ?, ?)",
+                (market_id, cache_key, json.dumps(report))
+            )
+
+    def import_legacy(self, data_path: str) -> None:
+        """ One-off migration of eventLog.json/eventIndex.json and existing capture files into the
+        catalog
+
+        Args:
+            data_path (str): Root data folder
+        """
+        event_log_path = os.path.join(data_path, "eventLog.json")
+        if not os.path.exists(event_log_path):
+            return
+
+        logging.info("Importing legacy event log into catalog")
+        with open(event_log_path, "r") as file:
+            event_log = json.load(file)
+
+        for event_id, event_name in event_log.items():
+            event_index_path = os.path.join(data_path, event_id, "eventIndex.json")
+            if os.path.exists(event_index_path):
+                with open(event_index_path, "r") as file:
+                    event_index = json.load(file)
+                self.add_event(event_index["event"], event_index.get("markets", []))
+            else:
+                self.add_event({"id": event_id, "name": event_name}, [])
+
+            event_path = os.path.join(data_path, event_id)
+            if not os.path.isdir(event_path):
+                logging.warning(f"Event folder {event_path} of the legacy event log is missing")
+                continue
+            for file_name in sorted(os.listdir(event_path)):
+                market_id, _, extension = file_name.rpartition(".")
+                if extension not in ("txt", "json") or file_name == "eventIndex.json":
+                    continue
+                # Segments are named {market_id}.{sequence}.txt
+                market_id = re.sub(r"\.\d{5}$", "", market_id)
+                path = os.path.join(event_id, file_name)
+                file_path = os.path.join(data_path, path)
+                self.record_capture(path, event_id, market_id, os.path.getsize(file_path),
+                                    *_scan_capture(file_path))
+
+    def _fetch_one(self, query: str, params=()) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self._connection.execute(query, params).fetchone()
+
+    def _fetch_all(self, query: str, params=()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._connection.execute(query, params).fetchall()
+
+
+def _scan_capture(file_path: str) -> Tuple[int, Optional[int], Optional[int]]:
+    """ Packet count and first/last publish time of a capture file written before the catalog, so
+    imported captures have the same statistics as the ones recorded while streaming """
+    if file_path.endswith(".json"):
+        with open(file_path, "r") as file:
+            market_data = json.load(file)
+        if "records" in market_data:
+            timestamps = [record_from_dict(data).publish_time for data in market_data["records"]]
+        else:
+            timestamps = [int(timestamp) for timestamp in market_data.get("mcm", {})]
+    else:
+        timestamps = []
+        with open(file_path, "r") as file:
+            for line in file:
+                try:
+                    timestamps.append(decode_record(line).publish_time)
+                except ValueError:
+                    # Blank or partially written line
+                    continue
+
+    if not timestamps:
+        return 0, None, None
+    return len(timestamps), min(timestamps), max(timestamps)
+
+
+def _file_format(path: str) -> str:
+    """ Returns the extension of a capture file, ignoring the compression extension of sealed
+    segments """
+    for extension in (".gz", ".zst"):
+        if path.endswith(extension):
+            path = path[:-len(extension)]
+    return path.rsplit(".", 1)[-1]
@@ -1,9 +1,21 @@
 import os
-import glob
-from typing import List, Dict, Union, Any
+import mmap
+import heapq
+from typing import List, Dict, Union, Any, Iterator, Optional, Tuple
 import logging
 import json
 from abc import ABC, abstractmethod
+from stream.storage.catalog import Catalog
+from stream.storage.capture import CaptureRecord, iter_records, record_from_dict
+from stream.storage.offset_index import OffsetIndex
+from stream.storage.definition_codec import DefinitionDecoder, definitions_file_name
+from stream.storage.segments import (
+    index_file_name,
+    is_compressed,
+    open_segment,
+    segment_sequence,
+    sort_segments,
+)
 
 
 class AbstractDataStorage(ABC):
@@ -13,7 +25,7 @@ class AbstractDataStorage(ABC):
         pass
 
     @abstractmethod
-    def load_events(self) -> List[Dict]:
+    def load_events(self) -> Dict[str, str]:
         pass
 
     @abstractmethod
@@ -21,13 +33,15 @@ class AbstractDataStorage(ABC):
         pass
 
     @abstractmethod
-    def load_market(self, event_id: str, market_id: str) -> Dict:
+    def load_market(self, event_id: str, market_id: str) -> List[CaptureRecord]:
         pass
 
 
 class DataLocation(AbstractDataStorage):
     """Class to handle the creation of data folders and files"""
 
+    CATALOG_FILE_NAME = "catalog.db"
+
     def __init__(self, data_path: str, events: List[Dict]):
         self.data_path = data_path
         self.events = events
@@ -37,10 +51,15 @@ class DataLocation(AbstractDataStorage):
                 market_event_mapping[market["marketId"]] = event["event"]["id"]
         self.market_event_mapping = market_event_mapping
 
+        if not os.path.exists(data_path):
+            os.makedirs(data_path)
+        self.catalog = Catalog(os.path.join(data_path, self.CATALOG_FILE_NAME))
+        if self.catalog.is_empty():
+            self.catalog.import_legacy(data_path)
+
     def create(self):
-        """ Create data folders and files """
+        """ Create data folders and register the events/markets in the catalog """
         self._create_event_folders()
-        self._create_main_event_log()
 
         for event in self.events:
             self._create_event_index(event)
@@ -50,56 +69,14 @@ class DataLocation(AbstractDataStorage):
         for event in self.events:
             self._create_folder(event["event"]["id"])
 
-    def _create_main_event_log(self):
-        """ Check if event log exists if so load and append missing events, else create new """
-
-        logging.info("Creating main event log")
-        file_name = "eventLog.json"
-        event_log = {}
-
-        if self.check_file_exists("", file_name):
-            # Load file and append missing events
-            with open(os.path.join(self.data_path, file_name), "r") as file:
-                event_log = json.load(file)
-            for event in self.events:
-                if event["event"]["id"] not in event_log.keys():
-                    event_log[event["event"]["id"]] = event["event"]["name"]
-        else:
-            event_log = {event["event"]["id"]: event["event"]["name"] for event in self.events}
-
-        # Write to file
-        self.save_json_data(event_log, file_name=file_name)
-
     def _create_event_index(self, event: Dict[str, Union[Dict, List]]) -> None:
-        """ Create event index file for an event, if exists append missing markets
+        """ Add an event and its markets to the catalog, existing markets are updated in place
 
         Args:
             event (Dict[str: Dict]): Event object from Betfair API w/ markets
         """
-        logging.info(f"Creating event index for {event['event']['name']}")
-
-        res = {"event": event["event"]}
-        file_name = "eventIndex.json"
-        relative_file_path = os.path.join(f"{event['event']['id']}/", file_name)
-
-        if self.check_file_exists(f"/{event['event']['id']}/", file_name):
-            # Load file and append missing markets
-            with open(os.path.join(self.data_path, relative_file_path), "r") as file:
-                cur_event_index = json.load(file)
-
-            markets: List[Dict] = cur_event_index["markets"]
-            cur_market_ids: List[str] = [market["marketId"] for market in markets]
-
-            for market in event["markets"]:
-                if market["id"] not in cur_market_ids:
-                    markets.append(market)
-
-            res["markets"] = markets
-        else:
-            res["markets"] = event["markets"]
-
-        # Write to file
-        self.save_json_data(res, folder_name=event["event"]["id"], file_name=file_name)
+        logging.info(f"Adding {event['event']['name']} to the catalog")
+        self.catalog.add_event(event["event"], event["markets"])
 
     def check_file_exists(self, relative_path: str, file_name: str) -> bool:
         """Check if file exists in relative path from data folder
@@ -132,16 +109,13 @@ class DataLocation(AbstractDataStorage):
             data = json.load(f)
         return data
 
-    def load_events(self) -> List[Dict]:
-        """Returns all events
+    def load_events(self) -> Dict[str, str]:
+        """Returns all events in the catalog
 
         Returns:
-            List[Dict]: List of events
+            Dict[str, str]: Mapping of event ID to event name
         """
-        if len(self.events) > 0:
-            return self.events
-        else:
-            return self.load_json_data(file_name="eventLog.json")
+        return self.catalog.get_events()
 
     def save_json_data(self, data: Any, folder_name: str = None, file_name: str = "eventIndex.json") -> None:
         """Saves data to json file relative to the root directory.
@@ -160,7 +134,7 @@ class DataLocation(AbstractDataStorage):
             file.write(json.dumps(data, indent=4))
 
     def load_event(self, event: str) -> Dict:
-        """Loads event data from json file relative to the root directory.
+        """Loads event data and its markets from the catalog
 
         Args:
             event (str): Event ID
@@ -168,22 +142,297 @@ class DataLocation(AbstractDataStorage):
         Returns:
             Any: JSON data
         """
-        return self.load_json_data(folder_name=event)
+        return self.catalog.get_event(event)
+
+    def iter_market_records(self, event: str, market: str, start: int = None,
+                            end: int = None) -> Iterator[CaptureRecord]:
+        """Streams the records of a market capture across all of its segments, in write order.
+        Markets which have already been parsed are read from their JSON file.
+
+        With a window, segments outside of it are skipped using the catalog, inside a segment the
+        sidecar index is used to seek close to `start` (in a memory-mapped file for uncompressed
+        segments), so only the requested window is decoded. Records of captures written before
+        records were numbered have no sequence number.
+
+        Args:
+            event (str): Event ID
+            market (str): Market ID
+            start (int, optional): Start publish time in milliseconds (inclusive)
+            end (int, optional): End publish time in milliseconds (inclusive)
+
+        Yields:
+            CaptureRecord: Records published in the window
+        """
+        captures = self.catalog.get_capture_files(event_id=event, market_id=market,
+                                                  file_format="txt")
+        if not captures:
+            for record in self._iter_parsed_records(event, market):
+                after_start = start is None or record.publish_time >= start
+                if after_start and (end is None or record.publish_time <= end):
+                    yield record
+            return
+
+        decoder = self.get_definition_decoder(event, market)
+        for record in iter_records(self._iter_capture_lines(captures, start, end)):
+            if end is not None and record.publish_time > end:
+                break
+            if start is None or record.publish_time >= start:
+                yield record._replace(update=decoder.decode(record.update)) if decoder else record
+
+    def _iter_capture_lines(self, captures: List[Dict], start: Optional[int],
+                            end: Optional[int]) -> Iterator[bytes]:
+        """Yields the lines of the capture segments overlapping a publish time window, in segment
+        order"""
+        for capture in sorted(captures, key=lambda capture: segment_sequence(capture["path"])):
+            first_timestamp, last_timestamp = capture["first_timestamp"], capture["last_timestamp"]
+            if end is not None and first_timestamp is not None and first_timestamp > end:
+                continue
+            if start is not None and last_timestamp is not None and last_timestamp < start:
+                continue
+
+            file_path = os.path.join(self.data_path, capture["path"])
+            offset = 0
+            if start is not None:
+                offset = OffsetIndex(index_file_name(file_path)).seek_offset(start)
+            yield from self._iter_lines_from(file_path, offset)
+
+    def _iter_lines_from(self, file_path: str, offset: int) -> Iterator[bytes]:
+        """Yields the lines of a capture segment starting from a byte offset of its uncompressed
+        data"""
+        if is_compressed(file_path):
+            with open_segment(file_path) as file:
+                file.seek(offset)
+                yield from file
+        elif os.path.getsize(file_path) > 0:
+            with open(file_path, "rb") as file, mmap.mmap(file.fileno(), 0,
+                                                          access=mmap.ACCESS_READ) as data:
+                data.seek(offset)
+                yield from iter(data.readline, b"")
+
+    def _iter_parsed_records(self, event: str, market: str) -> Iterator[CaptureRecord]:
+        """Yields the records of a parsed market file, files parsed before records were numbered
+        hold a `{"mcm": {publish_time: update}}` mapping"""
+        market_data = self.load_json_data(folder_name=event, file_name=f"{market}.json")
+        if "records" in market_data:
+            for data in market_data["records"]:
+                yield record_from_dict(data)
+            return
+        for timestamp, update in market_data["mcm"].items():
+            yield CaptureRecord(None, int(timestamp), None, None, update)
+
+    def iter_market(self, event: str, market: str) -> Iterator[Tuple[int, Dict]]:
+        """Streams the packets of a market capture, see `iter_market_records`
+
+        Args:
+            event (str): Event ID
+            market (str): Market ID
+
+        Yields:
+            Tuple[int, Dict]: Publish time in milliseconds and market change message
+        """
+        for record in self.iter_market_records(event, market):
+            yield record.publish_time, record.update
+
+    def iter_markets(self, markets: List[Tuple[str, str]]) -> Iterator[Tuple[int, str, Dict]]:
+        """Streams the packets of several markets in publish time order, with a k-way merge of their
+        captures
+
+        Only one packet per market is decoded ahead of the merge, packets with the same publish time
+        keep the order of `markets`.
+
+        Args:
+            markets (List[Tuple[str, str]]): (event ID, market ID) of the markets
+
+        Yields:
+            Tuple[int, str, Dict]: Publish time in milliseconds, market ID and market change message
+        """
+        def tag(market: str,
+                packets: Iterator[Tuple[int, Dict]]) -> Iterator[Tuple[int, str, Dict]]:
+            for timestamp, packet in packets:
+                yield timestamp, market, packet
+
+        streams = [tag(market, self.iter_market(event, market)) for event, market in markets]
+        return heapq.merge(*streams, key=lambda item: item[0])
+
+    def get_event_markets(self, event: str) -> List[str]:
+        """Returns the IDs of the markets of an event which have been recorded, captured or
+        parsed"""
+        captured = {market for event_id, market in self.get_market_captures() if event_id == event}
+        return [market["marketId"] for market in self.load_event(event)["markets"]
+                if market["marketId"] in captured
+                or self.check_file_exists(event, f"{market['marketId']}.json")]
+
+    def iter_event(self, event: str) -> Iterator[Tuple[int, str, Dict]]:
+        """Streams the packets of all recorded markets of an event in publish time order, see
+        `iter_markets`"""
+        return self.iter_markets([(event, market) for market in self.get_event_markets(event)])
+
+    def iter_event_timeline(self, event: str, runner_fields: List[str] = None,
+                            chunk_rows: int = None) -> Iterator[Any]:
+        """Streams the as-of joined timeline of all recorded markets of an event
+
+        Every row is a packet of one of the markets, with the latest state (last traded price,
+        traded volume, best back/lay and in play flag) of every runner of every market carried
+        forward. See order_book.timeline.
+
+        Args:
+            event (str): Event ID
+            runner_fields (List[str], optional): Runner state columns, defaults to all of
+                RUNNER_FIELDS
+            chunk_rows (int, optional): Rows per chunk
+
+        Yields:
+            TimelineChunk: Consecutive rows of the timeline
+        """
+        # Imported here so numpy is only loaded when the timeline is used
+        from order_book.timeline import DEFAULT_CHUNK_ROWS, RUNNER_FIELDS, build_event_timeline
+        return build_event_timeline(self.iter_event(event), runner_fields or RUNNER_FIELDS,
+                                    chunk_rows or DEFAULT_CHUNK_ROWS)
+
+    def get_pyramid_path(self, event: str, market: str) -> str:
+        """Returns the path of the resolution pyramid of a market, see order_book.resample"""
+        return os.path.join(self.data_path, event, f"{market}.pyramid.npz")
+
+    def save_market_pyramid(self, event: str, market: str, pyramid: Dict) -> None:
+        """Saves the resolution pyramid of a market next to its capture"""
+        from order_book.resample import save_pyramid
+        save_pyramid(self.get_pyramid_path(event, market), pyramid)
+
+    def load_market_pyramid(self, event: str, market: str) -> Dict:
+        """Loads the resolution pyramid of a market, it is (re)built from the market data if it is
+        missing or older than the market's capture files
+
+        Args:
+            event (str): Event ID
+            market (str): Market ID
+
+        Returns:
+            Dict[int, Dict[str, Bars]]: Runner ID to resolution label to bars
+        """
+        # Imported here so numpy is only loaded when the pyramid is used
+        from order_book.resample import build_market_pyramid, load_pyramid
+
+        pyramid_path = self.get_pyramid_path(event, market)
+        captures = (self.get_capture_files("txt", event, market)
+                    + self.get_capture_files("json", event, market))
+        captures_mtime = max((os.path.getmtime(path) for path in captures if os.path.exists(path)),
+                             default=0)
+        if os.path.exists(pyramid_path) and os.path.getmtime(pyramid_path) >= captures_mtime:
+            return load_pyramid(pyramid_path)
+
+        logging.info(f"Building resolution pyramid for {market}")
+        pyramid = build_market_pyramid(self.iter_market(event, market))
+        self.save_market_pyramid(event, market, pyramid)
+        return pyramid
+
+    def get_definitions_path(self, event: str, market: str) -> str:
+        """Returns the path of the market definitions sidecar of a dictionary encoded market
+        capture"""
+        return os.path.join(self.data_path, event, definitions_file_name(market))
+
+    def get_definition_decoder(self, event: str, market: str) -> Optional[DefinitionDecoder]:
+        """Returns a decoder for the market definitions of a capture, None if the capture is not
+        encoded"""
+        defs_path = self.get_definitions_path(event, market)
+        return DefinitionDecoder(defs_path) if os.path.exists(defs_path) else None
+
+    def get_market_captures(self, file_format: str = "txt") -> Dict[Tuple[str, str], List[str]]:
+        """Returns the capture segments of every market, ordered by sequence
+
+        Args:
+            file_format (str, optional): File extension. Defaults to "txt".
+
+        Returns:
+            Dict[Tuple[str, str], List[str]]: Mapping of (event ID, market ID) to segment paths
+        """
+        market_captures = {}
+        for capture in self.catalog.get_capture_files(file_format=file_format):
+            key = (capture["event_id"], capture["market_id"])
+            market_captures.setdefault(key, []).append(os.path.join(self.data_path,
+                                                                    capture["path"]))
+        return {key: sort_segments(paths) for key, paths in market_captures.items()}
+
+    def get_market_event_id(self, market: str) -> str:
+        """Returns the event ID (folder) of a market
+
+        Args:
+            market (str): Market ID
+
+        Raises:
+            KeyError: If the market is unknown
+        """
+        if market not in self.market_event_mapping:
+            event_id = self.catalog.get_market_event_id(market)
+            if event_id is None:
+                raise KeyError(f"Market {market} not found in catalog")
+            self.market_event_mapping[market] = event_id
+        return self.market_event_mapping[market]
+
+    def get_capture_files(self, file_format: str = "txt", event: str = None,
+                          market: str = None) -> List[str]:
+        """Returns the absolute paths of capture files recorded in the catalog
+
+        Args:
+            file_format (str, optional): File extension. Defaults to "txt".
+            event (str, optional): Event ID
+            market (str, optional): Market ID
+
+        Returns:
+            List[str]: Capture file paths
+        """
+        captures = self.catalog.get_capture_files(event_id=event, market_id=market,
+                                                  file_format=file_format)
+        return sort_segments([os.path.join(self.data_path, capture["path"])
+                              for capture in captures])
 
-    def load_market(self, event: str, market: str) -> Dict:
-        """Loads market data from json file relative to the root directory.
+    def record_capture(self, event: str, market: str, file_name: str, byte_size: int,
+                       packet_count: int, first_timestamp: int = None,
+                       last_timestamp: int = None) -> None:
+        """Record data appended to a capture file in the catalog
+
+        Args:
+            event (str): Event ID
+            market (str): Market ID
+            file_name (str): Capture file name inside the event folder
+            byte_size (int): Number of bytes appended
+            packet_count (int): Number of packets appended
+            first_timestamp (int, optional): First publish time (ms) appended
+            last_timestamp (int, optional): Last publish time (ms) appended
+        """
+        self.catalog.record_capture(os.path.join(event, file_name), event, market, byte_size,
+                                    packet_count, first_timestamp, last_timestamp)
+
+    def relative_path(self, file_path: str) -> str:
+        return os.path.relpath(file_path, self.data_path)
+
+    def load_market(self, event: str, market: str) -> List[CaptureRecord]:
+        """Loads all records of a market, from its capture segments or its parsed file. Prefer
+        `iter_market_records`, which streams them.
 
         Args:
             event (str): Event ID
             market (str): Market ID
 
         Returns:
-            Any: JSON data
+            List[CaptureRecord]: Records in write order
         """
+        return list(self.iter_market_records(event, market))
+
+    def load_market_range(self, event: str, market: str, start: int,
+                          end: int) -> List[CaptureRecord]:
+        """Loads the records of a market published between two timestamps (inclusive), see
+        `iter_market_records`, which streams them.
+
+        Args:
+            event (str): Event ID
+            market (str): Market ID
+            start (int): Start publish time in milliseconds
+            end (int): End publish time in milliseconds
 
-        if not market.endswith('.json'):
-            market += '.json'
-        return self.load_json_data(folder_name=event, file_name=market)
+        Returns:
+            List[CaptureRecord]: Records in write order
+        """
+        return list(self.iter_market_records(event, market, start, end))
 
     def _create_folder(self, folder_name: str, relative_path: str = "") -> None:
         """Create folder in relative path from data folder
@@ -196,8 +445,3 @@ class DataLocation(AbstractDataStorage):
         logging.info(f"Creating folder at {folder_path}")
         if not os.path.exists(folder_path):
             os.makedirs(folder_path)
-
-    def get_files_in_folder(self, folder_name: str = "", file_extension="txt") -> List[str]:
-        folder_path = os.path.join(self.data_path, folder_name, f"**/*.{file_extension}")
-        print(folder_path)
-        return glob.glob(folder_path, recursive=True)
@@ -0,0 +1,180 @@
+import os
+import copy
+import json
+import hashlib
+from typing import Any, Dict, List, Optional
+
+# Key used in place of a market definition which is stored in the market's definitions sidecar file
+DEFINITION_REF = "$ref"
+
+
+def definition_id(definition: Dict) -> str:
+    """ Content hash of a market definition, independent of key order """
+    canonical = json.dumps(definition, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+
+def diff_definition(base: Dict, definition: Dict) -> Dict:
+    """ Structural diff of two market definitions, runners are compared by position
+
+    Args:
+        base (Dict): Previous market definition
+        definition (Dict): New market definition
+
+    Returns:
+        Dict: Diff which can be applied to `base` with `apply_definition_diff`
+    """
+    diff: Dict[str, Any] = {
+        "set": {key: value for key, value in definition.items()
+                if key != "runners" and (key not in base or base[key] != value)},
+        "unset": [key for key in base if key not in definition],
+    }
+
+    if base.get("runners") != definition.get("runners"):
+        base_runners = base.get("runners") or []
+        runners = definition.get("runners")
+        if runners is None:
+            diff["unset"].append("runners")
+        else:
+            diff["runners"] = {
+                "length": len(runners),
+                "set": {str(idx): runner for idx, runner in enumerate(runners)
+                        if idx >= len(base_runners) or base_runners[idx] != runner},
+            }
+    return diff
+
+
+def apply_definition_diff(base: Dict, diff: Dict) -> Dict:
+    """ Rebuild a market definition from its base definition and structural diff """
+    definition = {key: value for key, value in base.items() if key not in diff["unset"]}
+    definition.update(copy.deepcopy(diff["set"]))
+
+    if "runners" in diff:
+        runners = list(base.get("runners") or [])[:diff["runners"]["length"]]
+        runners += [None] * (diff["runners"]["length"] - len(runners))
+        for idx, runner in diff["runners"]["set"].items():
+            runners[int(idx)] = copy.deepcopy(runner)
+        definition["runners"] = runners
+    return definition
+
+
+class DefinitionEncoder:
+    """ Dictionary encodes the market definitions of a market capture
+
+    Every distinct market definition is stored once in the `{market_id}.defs` sidecar file, either
+    in full or as a structural diff of the previous definition, and the capture packets only keep a
+    reference to it.
+    """
+
+    def __init__(self, defs_path: str) -> None:
+        """ Initialise the encoder, definitions already in the sidecar file are reused
+
+        Args:
+            defs_path (str): Path to the definitions sidecar file
+        """
+        self.defs_path = defs_path
+        self._known = set()
+        self._last: Optional[Dict] = None
+        self._last_id: Optional[str] = None
+        self._pending: List[Dict] = []
+
+        decoder = DefinitionDecoder(defs_path)
+        for entry_id, definition in decoder.definitions.items():
+            self._known.add(entry_id)
+            self._last, self._last_id = definition, entry_id
+
+    def encode(self, update: Dict) -> Dict:
+        """ Replace the market definition of a market change message by a reference
+
+        Args:
+            update (Dict): Market change message, it is not modified
+
+        Returns:
+            Dict: Market change message to write to the capture
+        """
+        definition = update.get("marketDefinition")
+        if definition is None:
+            return update
+
+        entry_id = definition_id(definition)
+        if entry_id not in self._known:
+            entry = {"id": entry_id, "def": definition}
+            if self._last is not None:
+                diff = diff_definition(self._last, definition)
+                if len(json.dumps(diff)) < len(json.dumps(definition)):
+                    entry = {"id": entry_id, "base": self._last_id, "diff": diff}
+            self._pending.append(entry)
+            self._known.add(entry_id)
+
+        self._last, self._last_id = definition, entry_id
+        return dict(update, marketDefinition={DEFINITION_REF: entry_id})
+
+    def flush(self) -> None:
+        """ Append new definitions to the sidecar, must be called before the packets referencing
+        them are written """
+        if len(self._pending) == 0:
+            return
+
+        with open(self.defs_path, "a") as file:
+            file.writelines(json.dumps(entry) + "\n" for entry in self._pending)
+        self._pending = []
+
+
+class DefinitionDecoder:
+    """ Expands the market definition references of an encoded market capture """
+
+    def __init__(self, defs_path: str) -> None:
+        self.defs_path = defs_path
+        self.definitions: Dict[str, Dict] = {}
+        self._offset = 0
+        self._load()
+
+    def _load(self) -> None:
+        """ Read definitions appended to the sidecar file since the last load """
+        if not os.path.exists(self.defs_path):
+            return
+
+        with open(self.defs_path, "rb") as file:
+            file.seek(self._offset)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # Partially written entry, read it on the next load
+                    break
+                self._offset += len(line)
+                entry = json.loads(line)
+                if "def" in entry:
+                    self.definitions[entry["id"]] = entry["def"]
+                else:
+                    base = self.definitions[entry["base"]]
+                    self.definitions[entry["id"]] = apply_definition_diff(base, entry["diff"])
+
+    def decode(self, update: Dict) -> Dict:
+        """ Expand the market definition reference of a market change message (if any)
+
+        Every definition is expanded once per market, when the sidecar file is read. The message is
+        not modified, a shallow copy holding the expanded definition is returned. Packets
+        referencing the same definition share the definition object, it is read only: copy it before
+        modifying it.
+
+        Args:
+            update (Dict): Market change message read from the capture
+
+        Returns:
+            Dict: Market change message with its full market definition
+
+        Raises:
+            KeyError: If the referenced definition is missing from the sidecar file
+        """
+        definition = update.get("marketDefinition")
+        if definition is None or DEFINITION_REF not in definition:
+            return update
+
+        entry_id = definition[DEFINITION_REF]
+        if entry_id not in self.definitions:
+            # Definitions written after the decoder was created, e.g. while tailing a live capture
+            self._load()
+        return dict(update, marketDefinition=self.definitions[entry_id])
+
+
+def definitions_file_name(market_id: str) -> str:
+    return f"{market_id}.defs"
@@ -0,0 +1,90 @@
+from typing import Any, Dict, List, Optional
+
+# A gap between two packets longer than this is treated as missing data
+MISSING_DATA_GAP_MS = 10 * 60 * 1000
+
+# Upper bounds (ms) of the gap histogram buckets, the last bucket counts all longer gaps
+GAP_HISTOGRAM_BOUNDS_MS = [100, 1000, 10 * 1000, 60 * 1000, MISSING_DATA_GAP_MS]
+
+
+class MarketStats:
+    """Running statistics of a market capture, updated packet by packet
+
+    Maintained by the stream writer as packets are written and persisted in the catalog, so reports
+    never need to read the capture itself.
+    """
+
+    def __init__(self) -> None:
+        self.packet_count = 0
+        self.first_timestamp: Optional[int] = None
+        self.last_timestamp: Optional[int] = None
+        self.gap_total_ms = 0
+        self.max_gap_ms = 0
+        self.gap_histogram = [0] * (len(GAP_HISTOGRAM_BOUNDS_MS) + 1)
+        self.status: Optional[str] = None
+        self.runner_ids = set()
+        self.bytes_written = 0
+
+    @property
+    def is_closed(self) -> bool:
+        return self.status == "CLOSED"
+
+    @property
+    def contains_missing_data(self) -> bool:
+        return self.max_gap_ms > MISSING_DATA_GAP_MS
+
+    def update(self, timestamp: int, packet: Dict, byte_size: int = 0) -> None:
+        """ Update the statistics with a new packet
+
+        Args:
+            timestamp (int): Publish time in milliseconds
+            packet (Dict): Market change message (with an expanded market definition)
+            byte_size (int, optional): Number of bytes written for the packet
+        """
+        self.packet_count += 1
+        self.bytes_written += byte_size
+
+        if self.last_timestamp is not None:
+            gap = timestamp - self.last_timestamp
+            self.gap_total_ms += gap
+            self.max_gap_ms = max(self.max_gap_ms, gap)
+            bucket = 0
+            while bucket < len(GAP_HISTOGRAM_BOUNDS_MS) and gap > GAP_HISTOGRAM_BOUNDS_MS[bucket]:
+                bucket += 1
+            self.gap_histogram[bucket] += 1
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+
+        definition = packet.get("marketDefinition")
+        if definition is not None:
+            self.status = definition.get("status", self.status)
+            self.runner_ids.update(runner["id"] for runner in definition.get("runners", []))
+        self.runner_ids.update(runner["id"] for runner in packet.get("rc", []))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "packet_count": self.packet_count,
+            "first_timestamp": self.first_timestamp,
+            "last_timestamp": self.last_timestamp,
+            "gap_total_ms": self.gap_total_ms,
+            "max_gap_ms": self.max_gap_ms,
+            "gap_histogram": self.gap_histogram,
+            "status": self.status,
+            "runner_ids": sorted(self.runner_ids),
+            "bytes_written": self.bytes_written,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "MarketStats":
+        stats = cls()
+        for key, value in data.items():
+            setattr(stats, key, value)
+        stats.runner_ids = set(data.get("runner_ids", []))
+        return stats
+
+    @staticmethod
+    def histogram_labels() -> List[str]:
+        """ Labels of the gap histogram buckets, e.g. `<=100ms` """
+        labels = [f"<={bound}ms" for bound in GAP_HISTOGRAM_BOUNDS_MS]
+        return labels + [f">{GAP_HISTOGRAM_BOUNDS_MS[-1]}ms"]
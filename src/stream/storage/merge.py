@@ -0,0 +1,245 @@
+import os
+import json
+import heapq
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+from stream.storage.capture import CaptureRecord, encode_record
+from stream.storage.data_location import DataLocation
+from stream.storage.offset_index import OffsetIndexWriter
+from stream.storage.segments import index_file_name
+
+# Gap ranges listed per source and market in the report, all gaps are counted
+MAX_REPORTED_GAPS = 100
+
+_worker_sources: List[DataLocation] = []
+
+
+def _iter_source(source: int,
+                 records: Iterator[CaptureRecord]) -> Iterator[Tuple[int, int, str, CaptureRecord]]:
+    """ Tags the records of a copy with their source and canonical JSON, equal packets have equal
+    JSON """
+    for record in records:
+        payload = json.dumps(record.update, sort_keys=True, separators=(",", ":"))
+        yield record.publish_time, source, payload, record
+
+
+class _GapTracker:
+    """Tracks the runs of merged packets which are missing from one source, in constant memory"""
+
+    def __init__(self) -> None:
+        self.missing_packets = 0
+        self.gap_count = 0
+        self.gaps: List[Dict] = []
+        self._open: Optional[Dict] = None
+
+    def packet(self, timestamp: int, present: bool) -> None:
+        if present:
+            self._close()
+            return
+        self.missing_packets += 1
+        if self._open is None:
+            self._open = {"start": timestamp, "end": timestamp, "packets": 0}
+        self._open["end"] = timestamp
+        self._open["packets"] += 1
+
+    def _close(self) -> None:
+        if self._open is None:
+            return
+        self.gap_count += 1
+        if len(self.gaps) < MAX_REPORTED_GAPS:
+            self.gaps.append(self._open)
+        self._open = None
+
+    def to_dict(self) -> Dict:
+        self._close()
+        return {"missing_packets": self.missing_packets, "gap_count": self.gap_count,
+                "gaps": self.gaps}
+
+
+def merge_market_copies(sources: List[DataLocation], event: str, market: str, output_path: str,
+                        index_interval: int = 100) -> Dict:
+    """Merges the copies of a market recorded by several listeners into a single capture
+
+    The copies are streamed through a k-way merge by publish time. Packets with the same publish
+    time and content are written once (a packet repeated within one copy is kept as many times as
+    the copy with the most repeats has it), so a packet missing from one copy is filled in from the
+    others. Dictionary encoded definitions are expanded, the merged capture is a plain
+    `{market_id}.txt` with its offset index, written to a temporary file first.
+
+    Args:
+        sources (List[DataLocation]): Data locations of the listeners, copies missing the market are
+            skipped
+        event (str): Event ID
+        market (str): Market ID
+        output_path (str): Data folder of the merged capture, it is not recorded in its catalog
+        index_interval (int, optional): Number of packets between sidecar index entries. Defaults to
+            100.
+
+    Returns:
+        Dict: Merge report of the market: packets read per source, packets written, duplicates
+            dropped, first/last publish time, byte size and per source gaps closed by the other
+            copies
+    """
+    streams, source_ids = [], []
+    for source_id, source in enumerate(sources):
+        captured = source.get_capture_files("txt", event, market)
+        if captured or source.check_file_exists(event, f"{market}.json"):
+            streams.append(_iter_source(source_id, source.iter_market_records(event, market)))
+            source_ids.append(source_id)
+
+    folder = os.path.join(output_path, event)
+    os.makedirs(folder, exist_ok=True)
+    capture_path = os.path.join(folder, f"{market}.txt")
+    tmp_path = capture_path + ".merge"
+    offset_index = OffsetIndexWriter(tmp_path + ".idx", interval=index_interval)
+
+    read = {source_id: 0 for source_id in source_ids}
+    gaps = {source_id: _GapTracker() for source_id in source_ids}
+    written, duplicates, offset = 0, 0, 0
+    first_timestamp = last_timestamp = None
+
+    # Packets of the current publish time: sources having each written occurrence, occurrences read
+    # per source
+    current_timestamp, emitted, seen = None, {}, {}
+
+    def close_group() -> None:
+        for occurrences in emitted.values():
+            for sources_present in occurrences:
+                for source_id in source_ids:
+                    gaps[source_id].packet(current_timestamp, source_id in sources_present)
+
+    with open(tmp_path, "wb") as file:
+        merged = heapq.merge(*streams, key=lambda item: item[0])
+        for timestamp, source_id, payload, record in merged:
+            read[source_id] += 1
+            if timestamp != current_timestamp:
+                close_group()
+                current_timestamp, emitted, seen = timestamp, {}, {}
+
+            occurrence = seen.get((source_id, payload), 0)
+            seen[(source_id, payload)] = occurrence + 1
+            occurrences = emitted.setdefault(payload, [])
+            if occurrence < len(occurrences):
+                # Already written from another copy
+                duplicates += 1
+                occurrences[occurrence].add(source_id)
+                continue
+
+            occurrences.append({source_id})
+            # Records are renumbered, the receive time and clock are those of the copy written
+            line = encode_record(record._replace(sequence=written + 1)).encode()
+            offset_index.add(timestamp, offset)
+            file.write(line)
+            offset += len(line)
+            written += 1
+            first_timestamp = timestamp if first_timestamp is None else first_timestamp
+            last_timestamp = timestamp
+        close_group()
+    offset_index.flush()
+
+    os.replace(tmp_path, capture_path)
+    if os.path.exists(tmp_path + ".idx"):
+        os.replace(tmp_path + ".idx", index_file_name(capture_path))
+
+    return {
+        "event_id": event,
+        "market_id": market,
+        "packets_written": written,
+        "duplicates_dropped": duplicates,
+        "byte_size": offset,
+        "first_timestamp": first_timestamp,
+        "last_timestamp": last_timestamp,
+        "sources": {sources[source_id].data_path: {"packets_read": read[source_id],
+                                                   **gaps[source_id].to_dict()}
+                    for source_id in source_ids},
+    }
+
+
+def _init_merge_worker(source_paths: List[str]) -> None:
+    global _worker_sources
+    _worker_sources = [DataLocation(path, []) for path in source_paths]
+
+
+def _merge_market_task(task: Tuple[str, str, str, int]) -> Dict:
+    return merge_market_copies(_worker_sources, *task)
+
+
+def merge_recordings(source_paths: List[str], output: DataLocation, workers: int = None,
+                     index_interval: int = 100,
+                     report_file_name: str = "merge_report.json") -> Dict:
+    """Merges the recordings of several listeners of the same markets into one data location
+
+    Every market captured by at least one listener is merged with `merge_market_copies` in a process
+    pool. The events and markets are copied to the output catalog and the merged captures recorded
+    in it (replacing previous captures of the market in the output), the report is written to
+    `report_file_name` in the output folder.
+
+    Args:
+        source_paths (List[str]): Data folders of the listeners
+        output (DataLocation): Data location of the merged recordings, it must not be one of the
+            sources
+        workers (int, optional): Number of worker processes, defaults to the number of CPUs. 1 runs
+            in process.
+        index_interval (int, optional): Number of packets between sidecar index entries. Defaults to
+            100.
+        report_file_name (str, optional): Report file name in the output folder
+
+    Raises:
+        ValueError: If the output folder is one of the sources
+
+    Returns:
+        Dict: Merge report, totals and per market reports
+    """
+    if any(os.path.abspath(path) == os.path.abspath(output.data_path) for path in source_paths):
+        raise ValueError("The merge output must not be one of the source folders")
+
+    sources = [DataLocation(path, []) for path in source_paths]
+    markets = set()
+    for source in sources:
+        for event in source.load_events():
+            markets.update((event, market) for market in source.get_event_markets(event))
+            event_data = source.load_event(event)
+            output.catalog.add_event(event_data["event"], event_data["markets"])
+    markets = sorted(markets)
+
+    tasks = [(event, market, output.data_path, index_interval) for event, market in markets]
+    logging.info(f"Merging {len(tasks)} market(s) from {len(sources)} listener(s)")
+    if workers == 1 or len(tasks) <= 1:
+        _init_merge_worker(source_paths)
+        results = map(_merge_market_task, tasks)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(workers, initializer=_init_merge_worker,
+                                       initargs=(source_paths,))
+        results = executor.map(_merge_market_task, tasks)
+
+    market_reports = []
+    try:
+        for report in results:
+            event, market = report["event_id"], report["market_id"]
+            for capture in output.catalog.get_capture_files(market_id=market, file_format="txt"):
+                output.catalog.remove_capture(capture["path"])
+            output.record_capture(event, market, f"{market}.txt", report["byte_size"],
+                                  report["packets_written"], report["first_timestamp"],
+                                  report["last_timestamp"])
+            market_reports.append(report)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    merge_report = {
+        "sources": source_paths,
+        "markets": len(market_reports),
+        "packets_written": sum(report["packets_written"] for report in market_reports),
+        "duplicates_dropped": sum(report["duplicates_dropped"] for report in market_reports),
+        "gaps_closed": sum(source["gap_count"] for report in market_reports
+                           for source in report["sources"].values()),
+        "market_reports": market_reports,
+    }
+    with open(os.path.join(output.data_path, report_file_name), "w") as file:
+        json.dump(merge_report, file, indent=4)
+    logging.info(f"Merged {merge_report['packets_written']} packet(s), dropped "
+                 f"{merge_report['duplicates_dropped']} duplicate(s) and closed "
+                 f"{merge_report['gaps_closed']} gap(s)")
+    return merge_report
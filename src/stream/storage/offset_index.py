@@ -0,0 +1,84 @@
+import os
+import struct
+from array import array
+from bisect import bisect_right
+from typing import List, Tuple
+
+# Each index entry is (publish time in ms, byte offset of the line in the capture file)
+INDEX_ENTRY = struct.Struct("<qq")
+
+
+class OffsetIndexWriter:
+    """ Maintains the timestamp -> byte offset sidecar index of a capture file
+
+    An entry is added every `interval` packets, entries are buffered and appended to the index file
+    on `flush`, which must be called after the matching capture lines were written so the index
+    never points past the end of the file.
+    """
+
+    def __init__(self, index_path: str, interval: int = 100) -> None:
+        """ Initialise the index writer
+
+        Args:
+            index_path (str): Path of the sidecar index file
+            interval (int, optional): Number of packets between index entries. Defaults to 100.
+        """
+        self.index_path = index_path
+        self.interval = interval
+        self._pending: List[Tuple[int, int]] = []
+        # Always index the first packet written by this writer (e.g. after a restart)
+        self._packets_since_entry = interval
+
+    def add(self, timestamp: int, offset: int) -> None:
+        """ Register a packet written at the given byte offset """
+        if self._packets_since_entry >= self.interval:
+            self._pending.append((timestamp, offset))
+            self._packets_since_entry = 0
+        self._packets_since_entry += 1
+
+    def flush(self) -> None:
+        if len(self._pending) == 0:
+            return
+
+        with open(self.index_path, "ab") as file:
+            file.write(b"".join(INDEX_ENTRY.pack(timestamp, offset)
+                                for timestamp, offset in self._pending))
+        self._pending = []
+
+
+class OffsetIndex:
+    """ Read only view of a capture file's sidecar index """
+
+    def __init__(self, index_path: str) -> None:
+        self.timestamps = array("q")
+        self.offsets = array("q")
+
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as file:
+                data = file.read()
+            # Ignore a partially written trailing entry
+            data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+            for timestamp, offset in INDEX_ENTRY.iter_unpack(data):
+                self.timestamps.append(timestamp)
+                self.offsets.append(offset)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def seek_offset(self, timestamp: int) -> int:
+        """ Returns a byte offset from which all packets published at or after `timestamp` can be
+        read
+
+        Publish times are non-decreasing within a market capture, so the offset of the last entry
+        strictly before `timestamp` is a safe starting point.
+
+        Args:
+            timestamp (int): Publish time in milliseconds
+
+        Returns:
+            int: Byte offset in the capture file
+        """
+        idx = bisect_right(self.timestamps, timestamp - 1)
+        if idx == 0:
+            return 0
+        return self.offsets[idx - 1]
@@ -0,0 +1,140 @@
+import os
+import time
+import logging
+from typing import Dict, List
+from stream.storage.data_location import DataLocation
+from stream.storage.capture import decode_line
+from stream.storage.offset_index import OffsetIndexWriter
+from stream.storage.segments import (
+    COMPRESSION_EXTENSIONS,
+    SegmentPolicy,
+    compress_segment,
+    index_file_name,
+    is_compressed,
+    iter_segment_lines,
+    segment_file_name,
+    segment_sequence,
+    sort_segments,
+)
+
+
+def apply_retention(data_location: DataLocation, policy: SegmentPolicy, now: float = None) -> None:
+    """ Expire and compact the sealed capture segments of every market according to the policy
+
+    Only sealed segments are touched (compressed segments, or all but the last segment when
+    compression is disabled), so the job can run while the stream is writing.
+
+    Args:
+        data_location (DataLocation): Data location with the catalog of capture files
+        policy (SegmentPolicy): Retention and compaction policy
+        now (float, optional): Current epoch time in seconds. Defaults to time.time().
+    """
+    now_ms = int((now if now is not None else time.time()) * 1000)
+    market_segments: Dict[str, List[Dict]] = {}
+    for capture in data_location.catalog.get_capture_files(file_format="txt"):
+        market_segments.setdefault(capture["market_id"], []).append(capture)
+
+    for market_id, captures in market_segments.items():
+        captures = sorted(captures, key=lambda capture: segment_sequence(capture["path"]))
+        sealed = [capture for idx, capture in enumerate(captures)
+                  if is_compressed(capture["path"])
+                  or (policy.compression is None and idx < len(captures) - 1)]
+
+        if policy.retention_days is not None:
+            cutoff = now_ms - policy.retention_days * 24 * 60 * 60 * 1000
+            expired = [capture for capture in sealed
+                       if capture["last_timestamp"] is not None
+                       and capture["last_timestamp"] < cutoff]
+            for capture in expired:
+                _expire_segment(data_location, capture)
+            sealed = [capture for capture in sealed if capture not in expired]
+
+        if policy.compact_max_bytes is not None:
+            for run in _compaction_runs(sealed, policy.compact_max_bytes):
+                compact_segments(data_location, market_id, [capture["path"] for capture in run],
+                                 policy)
+
+
+def _expire_segment(data_location: DataLocation, capture: Dict) -> None:
+    segment_path = os.path.join(data_location.data_path, capture["path"])
+    logging.info(f"Expiring capture segment {segment_path}")
+    for path in (segment_path, index_file_name(segment_path)):
+        if os.path.exists(path):
+            os.remove(path)
+    data_location.catalog.remove_capture(capture["path"])
+
+
+def _compaction_runs(sealed: List[Dict], max_bytes: int) -> List[List[Dict]]:
+    """ Group consecutive sealed segments into runs of at most `max_bytes`, only runs of 2+ segments
+    are returned """
+    runs, current, current_size = [], [], 0
+    for capture in sealed:
+        if current and current_size + capture["byte_size"] > max_bytes:
+            runs.append(current)
+            current, current_size = [], 0
+        current.append(capture)
+        current_size += capture["byte_size"]
+    runs.append(current)
+    return [run for run in runs if len(run) > 1]
+
+
+def compact_segments(data_location: DataLocation, market_id: str, paths: List[str],
+                     policy: SegmentPolicy, index_interval: int = 100) -> str:
+    """ Merge sealed segments of a market into a single segment, replacing the first one
+
+    Args:
+        data_location (DataLocation): Data location with the catalog of capture files
+        market_id (str): Market ID
+        paths (List[str]): Relative paths of the segments to merge
+        policy (SegmentPolicy): Policy used to compress the merged segment
+        index_interval (int, optional): Number of packets between sidecar index entries. Defaults to
+            100.
+
+    Returns:
+        str: Relative path of the merged segment
+    """
+    segment_paths = sort_segments([os.path.join(data_location.data_path, path) for path in paths])
+    folder = os.path.dirname(segment_paths[0])
+    sequence = segment_sequence(segment_paths[0])
+    if sequence < 0:
+        # The capture written before segments were enabled comes first and keeps its name
+        merged_path = os.path.join(folder, f"{market_id}.txt")
+    else:
+        merged_path = os.path.join(folder, segment_file_name(market_id, sequence))
+    logging.info(f"Compacting {len(segment_paths)} segments into {merged_path}")
+
+    # Write the merged segment and its index next to the originals, then swap them in
+    tmp_path = merged_path + ".compact"
+    tmp_index_path = tmp_path + ".idx"
+    offset_index = OffsetIndexWriter(tmp_index_path, interval=index_interval)
+    offset = 0
+    with open(tmp_path, "wb") as file:
+        for line in iter_segment_lines(segment_paths):
+            timestamp, _ = decode_line(line)
+            offset_index.add(timestamp, offset)
+            file.write(line)
+            offset += len(line)
+    offset_index.flush()
+
+    # The catalog points to the merged segment before the originals are removed
+    if policy.compression is not None:
+        final_path = merged_path + COMPRESSION_EXTENSIONS[policy.compression]
+        compress_segment(tmp_path, policy.compression, new_path=final_path)
+    else:
+        final_path = merged_path
+        os.replace(tmp_path, merged_path)
+    new_path = data_location.relative_path(final_path)
+    data_location.catalog.replace_captures(paths, new_path, byte_size=os.path.getsize(final_path))
+    # The merged segment starts with the lines of the first one, so its old index stays valid until
+    # then
+    os.replace(tmp_index_path, index_file_name(merged_path))
+
+    for segment_path in segment_paths:
+        if segment_path != final_path and os.path.exists(segment_path):
+            os.remove(segment_path)
+        if segment_sequence(segment_path) != segment_sequence(merged_path):
+            index_path = index_file_name(segment_path)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+
+    return new_path
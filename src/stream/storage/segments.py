@@ -0,0 +1,191 @@
+import os
+import io
+import re
+import gzip
+import queue
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, IO, Iterator, List, Optional
+
+# Compression formats for sealed segments and the extension they add to the segment file name
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+
+@dataclass
+class SegmentPolicy:
+    """Rolling, compression and retention policy of segmented market captures
+
+    A market capture is split into `{market_id}.{sequence}.txt` segments, a segment is sealed once
+    it is larger than `max_bytes` or older than `max_age_sec`, sealed segments are compressed in the
+    background.
+    """
+    max_bytes: int = 256 * 1024 * 1024
+    max_age_sec: int = 60 * 60
+    compression: Optional[str] = "gzip"
+    retention_days: Optional[int] = None
+    compact_max_bytes: Optional[int] = None
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Optional["SegmentPolicy"]:
+        """ Create the policy from the `storage` section of the app config, None keeps a single file
+        per market
+
+        Args:
+            config (Dict): App config
+        """
+        storage = config.get("storage")
+        if not storage:
+            return None
+
+        compact_max_mb = storage.get("compact_max_mb")
+        policy = cls(
+            max_bytes=int(storage.get("segment_max_mb", 256) * 1024 * 1024),
+            max_age_sec=int(storage.get("segment_max_minutes", 60) * 60),
+            compression=storage.get("compression", "gzip"),
+            retention_days=storage.get("retention_days"),
+            compact_max_bytes=int(compact_max_mb * 1024 * 1024) if compact_max_mb else None,
+        )
+        if policy.compression is not None and policy.compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"Unsupported segment compression {policy.compression}")
+        if policy.compression == "zstd":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                raise ValueError("Segment compression zstd requires the zstandard package, "
+                                 "install it or use gzip")
+        return policy
+
+
+def segment_file_name(market_id: str, sequence: int) -> str:
+    return f"{market_id}.{sequence:05d}.txt"
+
+
+def segment_sequence(file_name: str) -> int:
+    """ Returns the sequence number of a segment file name, the legacy `{market_id}.txt` file comes
+    first (-1) """
+    match = re.search(r"\.(\d{5})\.txt(\.gz|\.zst)?$", os.path.basename(file_name))
+    return int(match.group(1)) if match else -1
+
+
+def index_file_name(segment_path: str) -> str:
+    """ Returns the sidecar index path of a (possibly compressed) segment """
+    for extension in COMPRESSION_EXTENSIONS.values():
+        if segment_path.endswith(extension):
+            segment_path = segment_path[:-len(extension)]
+    return segment_path.rsplit(".", 1)[0] + ".idx"
+
+
+def sort_segments(paths: List[str]) -> List[str]:
+    return sorted(paths, key=segment_sequence)
+
+
+def is_compressed(path: str) -> bool:
+    return any(path.endswith(extension) for extension in COMPRESSION_EXTENSIONS.values())
+
+
+def open_segment(path: str) -> IO[bytes]:
+    """ Open a segment for binary reading, transparently decompressing sealed segments """
+    if path.endswith(COMPRESSION_EXTENSIONS["gzip"]):
+        return gzip.open(path, "rb")
+    if path.endswith(COMPRESSION_EXTENSIONS["zstd"]):
+        import zstandard
+
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"),
+                                                                            closefd=True))
+    return open(path, "rb")
+
+
+def iter_segment_lines(paths: List[str]) -> Iterator[bytes]:
+    """ Stream the lines of the segments of a market capture in order
+
+    Args:
+        paths (List[str]): Segment paths, in any order
+
+    Yields:
+        bytes: Capture lines
+    """
+    for path in sort_segments(paths):
+        with open_segment(path) as file:
+            for line in file:
+                if line.strip():
+                    yield line
+
+
+def compress_segment(path: str, compression: str, new_path: str = None,
+                     on_compressed: Callable[[str, str], None] = None) -> str:
+    """ Compress a sealed segment, the uncompressed segment is removed once the compressed file is
+    complete and recorded
+
+    Args:
+        path (str): Path of the uncompressed segment
+        compression (str): Compression format (gzip, zstd)
+        new_path (str, optional): Path of the compressed segment, defaults to `path` with the
+            extension of the compression
+        on_compressed (Callable[[str, str], None], optional): Called with the old and new path
+            before the uncompressed segment is removed, e.g. to update the catalog. If it fails the
+            compressed file is removed and the uncompressed segment kept.
+
+    Returns:
+        str: Path of the compressed segment
+    """
+    new_path = new_path or path + COMPRESSION_EXTENSIONS[compression]
+    tmp_path = new_path + ".tmp"
+    with open(path, "rb") as source:
+        if compression == "zstd":
+            import zstandard
+
+            with open(tmp_path, "wb") as target:
+                zstandard.ZstdCompressor().copy_stream(source, target)
+        else:
+            with gzip.open(tmp_path, "wb") as target:
+                while chunk := source.read(1024 * 1024):
+                    target.write(chunk)
+
+    os.replace(tmp_path, new_path)
+    if on_compressed is not None:
+        try:
+            on_compressed(path, new_path)
+        except Exception:
+            os.remove(new_path)
+            raise
+    os.remove(path)
+    return new_path
+
+
+class SegmentCompressor(threading.Thread):
+    """ Background thread compressing sealed segments so the stream writer is never blocked """
+
+    def __init__(self, compression: str = "gzip") -> None:
+        threading.Thread.__init__(self, daemon=True, name=self.__class__.__name__)
+        self.compression = compression
+        self._queue: queue.Queue = queue.Queue()
+
+    def submit(self, path: str, callback: Callable[[str, str], None] = None) -> None:
+        """ Queue a sealed segment for compression
+
+        Args:
+            path (str): Path of the sealed segment
+            callback (Callable[[str, str], None], optional): Called with the old and new path once
+                compressed
+        """
+        self._queue.put((path, callback))
+
+    def run(self) -> None:
+        while True:
+            path, callback = self._queue.get()
+            if path is None:
+                break
+            try:
+                compress_segment(path, self.compression, on_compressed=callback)
+                logging.debug(f"Compressed segment {path}")
+            except Exception as e:
+                logging.error(f"Failed to compress segment {path} : {e}")
+            finally:
+                self._queue.task_done()
+
+    def stop(self) -> None:
+        """ Compress the remaining queued segments and stop the thread """
+        self._queue.put((None, None))
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,134 @@
+import os
+from typing import IO, Dict, List, Optional, Tuple
+from stream.storage.capture import decode_line
+from stream.storage.data_location import DataLocation
+from stream.storage.definition_codec import DefinitionDecoder
+from stream.storage.offset_index import OffsetIndex
+from stream.storage.segments import index_file_name, is_compressed, open_segment, segment_sequence
+
+
+class CaptureTailer:
+    """Follows a market capture while it is being recorded, returning only the packets written since
+    the last poll
+
+    The position is kept as the segment sequence and byte offset of the last complete line read, so
+    each poll only reads new data. Rolled segments are followed in order, and a segment compressed
+    after it was sealed is resumed at the same offset of its uncompressed data. The compressed
+    segment being read is kept open between polls so it is only decompressed once.
+    """
+
+    def __init__(self, data_location: DataLocation, event: str, market: str,
+                 start_timestamp: int = None) -> None:
+        """ Initialise the tailer
+
+        Args:
+            data_location (DataLocation): DataLocation instance
+            event (str): Event ID
+            market (str): Market ID
+            start_timestamp (int, optional): Skip packets published before this time (ms), uses the
+                sidecar index to start reading close to it. Defaults to the start of the capture.
+        """
+        self.data_location = data_location
+        self.event = event
+        self.market = market
+        self.start_timestamp = start_timestamp
+        self.sequence: Optional[int] = None
+        self.offset = 0
+        self.decoder = DefinitionDecoder(data_location.get_definitions_path(event, market))
+        # Open compressed segment positioned at `offset` and its path
+        self._sealed_file: Optional[IO[bytes]] = None
+        self._sealed_path: Optional[str] = None
+
+    def close(self) -> None:
+        """ Close the compressed segment kept open between polls """
+        if self._sealed_file is not None:
+            self._sealed_file.close()
+            self._sealed_file, self._sealed_path = None, None
+
+    def _start_position(self, captures: List[Dict]) -> None:
+        """ Position the tailer at the first segment containing packets at or after
+        `start_timestamp` """
+        for capture in captures:
+            if self.start_timestamp is None or capture["last_timestamp"] is None \
+                    or capture["last_timestamp"] >= self.start_timestamp:
+                file_path = os.path.join(self.data_location.data_path, capture["path"])
+                self.sequence = segment_sequence(capture["path"])
+                self.offset = 0 if self.start_timestamp is None else \
+                    OffsetIndex(index_file_name(file_path)).seek_offset(self.start_timestamp)
+                return
+
+    def _open(self, file_path: str) -> IO[bytes]:
+        """ Open a segment at the current offset, compressed segments are sealed so they stay open
+        until the tailer moves past them """
+        if file_path == self._sealed_path:
+            return self._sealed_file
+        self.close()
+        file = open_segment(file_path)
+        # Seeking in a compressed segment decompresses it up to the offset
+        file.seek(self.offset)
+        if is_compressed(file_path):
+            self._sealed_file, self._sealed_path = file, file_path
+        return file
+
+    def _read_lines(self, file_path: str, max_packets: Optional[int]) -> List[bytes]:
+        """ Read at most `max_packets` complete lines after the current offset, the offset is moved
+        past the returned lines """
+        file = self._open(file_path)
+        lines = []
+        try:
+            while max_packets is None or len(lines) < max_packets:
+                line = file.readline()
+                if not line.endswith(b"\n"):
+                    if line:
+                        # A partially written last line is read again on the next poll
+                        self.close()
+                    break
+                lines.append(line)
+                self.offset += len(line)
+        finally:
+            if file is not self._sealed_file:
+                file.close()
+        return lines
+
+    def poll(self, max_packets: int = None) -> List[Tuple[int, Dict]]:
+        """ Read the packets written since the last poll
+
+        Args:
+            max_packets (int, optional): Maximum number of packets to return, the rest is returned
+                by later polls
+
+        Returns:
+            List[Tuple[int, Dict]]: Publish time in milliseconds and market change message
+        """
+        catalog = self.data_location.catalog
+        captures = catalog.get_capture_files(event_id=self.event, market_id=self.market,
+                                             file_format="txt")
+        captures.sort(key=lambda capture: segment_sequence(capture["path"]))
+        if self.sequence is None:
+            self._start_position(captures)
+            if self.sequence is None:
+                return []
+
+        packets = []
+        for capture in captures:
+            sequence = segment_sequence(capture["path"])
+            if sequence < self.sequence:
+                continue
+            if sequence > self.sequence:
+                # The current segment was sealed, continue from the start of the next one
+                self.sequence, self.offset = sequence, 0
+
+            remaining = None if max_packets is None else max_packets - len(packets)
+            file_path = os.path.join(self.data_location.data_path, capture["path"])
+            try:
+                lines = self._read_lines(file_path, remaining)
+            except FileNotFoundError:
+                # The segment is being compressed, its new path is read on the next poll
+                break
+            for line in lines:
+                timestamp, packet = decode_line(line)
+                if self.start_timestamp is None or timestamp >= self.start_timestamp:
+                    packets.append((timestamp, self.decoder.decode(packet)))
+            if remaining is not None and len(lines) >= remaining:
+                break
+        return packets
@@ -2,12 +2,101 @@ import logging
 import queue
 import threading
 import random
+import time
 from tenacity import retry, wait_exponential
 from datetime import datetime
 from dataclasses import dataclass
+from typing import Dict, List, Optional
 import betfairlightweight
 from betfairlightweight import StreamListener
 from betfairlightweight import BetfairError
+from betfairlightweight.streaming.stream import BaseStream, MarketStream
+from stream.checkpoint import StreamPosition, subscription_key
+from stream.session import SessionManager
+from utils import profiling
+
+
+class CaptureMarketStream(MarketStream):
+    """Market stream stamping its market books with the receive time and clock of their message,
+    both are stored in the capture records
+
+    `on_process` mirrors `MarketStream.on_process` of betfairlightweight, unchanged from 2.17.0 to
+    2.24.0.
+    """
+
+    def on_process(self, caches: list, publish_time: Optional[int] = None) -> None:
+        if self.output_queue:
+            output = []
+            for cache in caches:
+                market_book = cache.create_resource(self.unique_id, snap=False,
+                                                    publish_time=publish_time)
+                market_book.receive_time = self._listener.receive_time
+                market_book.clk = self._clk
+                output.append(market_book)
+            self.output_queue.put(output)
+
+
+class CaptureStreamListener(StreamListener):
+    """Stream listener of the capture, measuring the time to the first packet of the stream
+
+    Market books are stamped with the time their message was received, in milliseconds, and its
+    clock.
+
+    With `checkpoint`, the clock of the stream is queued behind the market books of every change
+    message, with the `subscription` it was issued for. The stream handler checkpoints a clock once
+    the books queued before it are written, see stream.checkpoint.
+    """
+
+    def __init__(self, output_queue: queue.Queue = None, stream_name: str = None,
+                 checkpoint: bool = False, **kwargs):
+        super().__init__(output_queue=output_queue, **kwargs)
+        self.stream_name = stream_name
+        self.checkpoint = checkpoint
+        self.subscription: Optional[str] = None  # Set by the stream, see `subscription_key`
+        self.start_time: Optional[float] = None  # Set when the stream starts connecting
+        self.time_to_first_packet: Optional[float] = None
+        self.receive_time: Optional[int] = None
+        self._position = (None, None)
+        self._market_count = 0
+
+    def on_data(self, raw_data: str):
+        self.receive_time = int(time.time() * 1000)
+        return super().on_data(raw_data)
+
+    def _add_stream(self, unique_id: int, operation: str) -> BaseStream:
+        if operation == "marketSubscription":
+            return CaptureMarketStream(self, unique_id)
+        return super()._add_stream(unique_id, operation)
+
+    def _on_change_message(self, data: dict, unique_id: int) -> None:
+        super()._on_change_message(data, unique_id)
+        if self.time_to_first_packet is None and data.get("mc") and self.start_time is not None:
+            self.time_to_first_packet = time.monotonic() - self.start_time
+            logging.info(f"First packet of {self.stream_name} {self.time_to_first_packet:.2f}s "
+                         "after its start")
+        if not self.checkpoint:
+            return
+
+        position = (self.initial_clk, self.clk)
+        if position == self._position or self.output_queue is None:
+            return
+
+        self._position = position
+        market_ids = None
+        if len(self.stream._caches) != self._market_count:
+            market_ids = tuple(self.stream._caches)
+            self._market_count = len(market_ids)
+        self.output_queue.put(StreamPosition(self.stream_name, *position, market_ids=market_ids,
+                                             subscription=self.subscription))
+
+
+class TimedStreamListener(CaptureStreamListener):
+    """Stream listener timing the decoding of every stream message, used when profiling is
+    enabled"""
+
+    def on_data(self, raw_data: str):
+        with profiling.span("listener.on_data"):
+            return super().on_data(raw_data)
 
 
 class Streaming(threading.Thread):
@@ -19,33 +108,86 @@ class Streaming(threading.Thread):
             conflate_ms: int = None,
             streaming_unique_id: int = 1000,
             output_queue: queue.Queue = None,
+            stream_name: str = None,
+            resume: Dict = None,
+            checkpoint: bool = False,
+            priority: int = 0,
+            session: SessionManager = None,
     ):
+        """ Initialise the stream
+
+        Args:
+            client (betfairlightweight.APIClient): Logged in API client
+            market_filter (dict): Streaming market filter
+            market_data_filter (dict): Streaming market data filter
+            conflate_ms (int, optional): Conflation rate of the subscription
+            streaming_unique_id (int, optional): Unique ID of the stream
+            output_queue (queue.Queue, optional): Queue of the market books, a new queue if None
+            stream_name (str, optional): Stream name, identifies the stream in the checkpoint
+            resume (Dict, optional): Checkpointed `initial_clk`/`clk` to resume the
+                subscription from
+            checkpoint (bool, optional): Queue the clock of the stream behind the market books for
+                the checkpoint
+            priority (int, optional): Importance of the stream, the least important streams are
+                conflated first
+            session (SessionManager, optional): Shared session of the client, the stream logs in
+                itself if None
+        """
         threading.Thread.__init__(self, daemon=True, name=self.__class__.__name__)
         self.client = client
         self.market_filter = market_filter
         self.market_data_filter = market_data_filter
         self.conflate_ms = conflate_ms
         self.streaming_unique_id = streaming_unique_id
+        self.stream_name = stream_name
+        self.resume = resume
+        self.priority = priority
+        self.session = session
+        self._session_token = None  # Token of the last connection, validated when reconnecting
         self.stream = None
         if output_queue:
             self.output_queue = output_queue
         else:
             self.output_queue = queue.Queue()
-        self.listener = StreamListener(output_queue=self.output_queue)
+        listener_class = TimedStreamListener if profiling.is_enabled() else CaptureStreamListener
+        self.listener = listener_class(output_queue=self.output_queue, stream_name=stream_name,
+                                       checkpoint=checkpoint)
+        self.listener.subscription = self._subscription_key()
+
+    def _subscription_key(self) -> str:
+        """ Subscription of the stream at its current conflation, the checkpointed clocks are
+        only resumed with the same subscription """
+        return subscription_key(self.market_filter, self.market_data_filter, self.conflate_ms)
+
+    def _subscription_clk(self):
+        """ Clocks to subscribe with, the listener's after a reconnect, the checkpoint's on the
+        first attempt """
+        if self.listener.clk is None and self.resume is not None:
+            # A clock rejected by the exchange falls back to full images
+            resume, self.resume = self.resume, None
+            logging.info(f"Resuming {self.stream_name} from the checkpoint")
+            return resume.get("initial_clk"), resume.get("clk")
+        return self.listener.initial_clk, self.listener.clk
 
     @retry(wait=wait_exponential(multiplier=1, min=2, max=20))
     def run(self) -> None:
-        self.client.login()
+        if self.listener.start_time is None:
+            self.listener.start_time = time.monotonic()
+        if self.session is not None:
+            self._session_token = self.session.ensure_session(self._session_token)
+        else:
+            self.client.login()
         self.stream = self.client.streaming.create_stream(
             unique_id=self.streaming_unique_id, listener=self.listener
         )
+        initial_clk, clk = self._subscription_clk()
         try:
             self.streaming_unique_id = self.stream.subscribe_to_markets(
                 market_filter=self.market_filter,
                 market_data_filter=self.market_data_filter,
                 conflate_ms=self.conflate_ms,
-                initial_clk=self.listener.initial_clk,  # supplying these two values allows a reconnect
-                clk=self.listener.clk,
+                initial_clk=initial_clk,  # supplying these two values allows a reconnect
+                clk=clk,
             )
             self.stream.start()
         except BetfairError:
@@ -55,6 +197,37 @@ class Streaming(threading.Thread):
             logging.critical("Streaming stopped unexpectedly")
             raise
 
+    @property
+    def time_to_first_packet(self) -> Optional[float]:
+        """ Seconds from the start of the stream to its first market change, None until then """
+        return self.listener.time_to_first_packet
+
+    @property
+    def market_ids(self) -> List[str]:
+        """ Markets received by the stream so far """
+        if self.listener.stream is None:
+            return []
+        return list(self.listener.stream._caches)
+
+    def set_conflation(self, conflate_ms: Optional[int]) -> None:
+        """ Re-subscribe with another conflation, from the current clocks so no change is missed
+
+        The conflation is only stored if the stream is not subscribed yet, it applies to the next
+        subscription. The clocks checkpointed from then on are recorded with the new conflation, so
+        they are not resumed by a stream restarted with another one.
+        """
+        self.conflate_ms = conflate_ms
+        self.listener.subscription = self._subscription_key()
+        if self.stream is None or self.listener.clk is None:
+            return
+        self.streaming_unique_id = self.stream.subscribe_to_markets(
+            market_filter=self.market_filter,
+            market_data_filter=self.market_data_filter,
+            conflate_ms=conflate_ms,
+            initial_clk=self.listener.initial_clk,
+            clk=self.listener.clk,
+        )
+
     def stop(self) -> None:
         if self.stream:
             self.stream.stop()
@@ -66,6 +239,7 @@ class StreamConfig:
     stream_name: str
     market_filter: dict
     stream_market_filter: dict
+    priority: int = 0  # Streams with the lowest priority are conflated first under load
     is_running: bool = False
 
     @property
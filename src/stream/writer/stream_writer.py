@@ -1,11 +1,24 @@
 import time
 import os
-import json
-from typing import List, Dict, Type
+from typing import List, Dict, Optional, Tuple, Type
 import logging
 import queue
 from betfairlightweight.resources import MarketBook
+from stream.checkpoint import StreamCheckpoint, StreamPosition
 from stream.storage.data_location import DataLocation
+from stream.storage.capture import CaptureRecord, encode_record
+from stream.storage.offset_index import OffsetIndexWriter
+from stream.storage.definition_codec import DefinitionEncoder
+from stream.storage.market_stats import MarketStats
+from utils.profiling import profiled, span
+from stream.storage.segments import (
+    SegmentCompressor,
+    SegmentPolicy,
+    index_file_name,
+    is_compressed,
+    segment_file_name,
+    segment_sequence,
+)
 from abc import ABC, abstractmethod
 
 
@@ -36,21 +49,105 @@ class MarketBuffer(ABC):
     def write(self) -> None:
         pass
 
+    def position(self) -> Optional[Tuple[str, int]]:
+        """ File and byte offset written so far, recorded in the stream checkpoint """
+        return None
+
+
+class PipelineStage(ABC):
+    """ Abstract class for consumers of the live market books, run by the stream handler alongside
+    the writer """
+
+    @abstractmethod
+    def process(self, market_book: MarketBook) -> None:
+        """ Process a market book, must not block the capture """
+        pass
+
+    def close(self) -> None:
+        pass
+
 
 class MarketFileBuffer(MarketBuffer):
     """ Class for writing streamed data to a buffer and then writing to a file """
 
-    def __init__(self, market_id, data_location: DataLocation, max_size: int = 10) -> None:
+    def __init__(self, market_id, data_location: DataLocation, max_size: int = 10,
+                 index_interval: int = 100, segment_policy: SegmentPolicy = None,
+                 segment_compressor: SegmentCompressor = None,
+                 encode_definitions: bool = False) -> None:
         """ Initialise the MarketFileBuffer class
 
         Args:
             market_id (str): Market id
             data_location (DataLocation): Data location object, uses the default data path
             max_size (int, optional): Max size of buffer. Defaults to 10.
+            index_interval (int, optional): Number of packets between sidecar index entries.
+                Defaults to 100.
+            segment_policy (SegmentPolicy, optional): Roll the capture into segments, defaults to a
+                single file.
+            segment_compressor (SegmentCompressor, optional): Background compressor for sealed
+                segments.
+            encode_definitions (bool, optional): Store each distinct market definition once in a
+                sidecar file.
         """
         super().__init__(market_id, max_size)
         self.data_location = data_location
-        self.folder = data_location.market_event_mapping[market_id]
+        self.folder = data_location.get_market_event_id(market_id)
+        self.index_interval = index_interval
+        self.segment_policy = segment_policy
+        self.segment_compressor = segment_compressor
+        self.sequence = None
+        stats = data_location.catalog.get_market_stats(market_id)
+        self.stats = MarketStats.from_dict(stats) if stats else MarketStats()
+        self.definition_encoder = None
+        if encode_definitions:
+            defs_path = data_location.get_definitions_path(self.folder, market_id)
+            self.definition_encoder = DefinitionEncoder(defs_path)
+
+        if segment_policy is None:
+            self._open_file(f"{market_id}.txt")
+        else:
+            # Seal the segments left open by a previous run and start a new segment
+            segments = data_location.get_capture_files("txt", event=self.folder, market=market_id)
+            for segment_path in segments:
+                if segment_sequence(segment_path) >= 0 and not is_compressed(segment_path):
+                    self._seal(segment_path)
+            self.sequence = max([segment_sequence(segment_path) for segment_path in segments],
+                                default=-1) + 1
+            self._open_file(segment_file_name(market_id, self.sequence))
+
+    def _open_file(self, file_name: str) -> None:
+        self.file_name = file_name
+        self.file_path = os.path.join(self.data_location.data_path, self.folder, file_name)
+        self.offset = os.path.getsize(self.file_path) if os.path.exists(self.file_path) else 0
+        self.segment_start = time.time()
+        self.offset_index = OffsetIndexWriter(index_file_name(self.file_path),
+                                              interval=self.index_interval)
+
+    def _should_roll(self) -> bool:
+        """ Check if the current segment is full or too old according to the segment policy """
+        if self.segment_policy is None or self.offset == 0:
+            return False
+        return (self.offset >= self.segment_policy.max_bytes
+                or time.time() - self.segment_start >= self.segment_policy.max_age_sec)
+
+    def _roll(self) -> None:
+        logging.debug(f"Rolling capture segment {self.file_name}")
+        self._seal(self.file_path)
+        self.sequence += 1
+        self._open_file(segment_file_name(self.market_id, self.sequence))
+
+    def _seal(self, segment_path: str) -> None:
+        """ Hand a segment which will not be written to anymore to the background compressor """
+        if self.segment_policy.compression is None or self.segment_compressor is None:
+            return
+        self.segment_compressor.submit(segment_path, self._on_segment_compressed)
+
+    def _on_segment_compressed(self, segment_path: str, compressed_path: str) -> None:
+        self.data_location.catalog.replace_captures(
+            [self.data_location.relative_path(segment_path)],
+            self.data_location.relative_path(compressed_path),
+            byte_size=os.path.getsize(compressed_path)
+        )
 
     def push(self, item: MarketBook) -> None:
         self.time_start = time.time()
@@ -61,16 +158,54 @@ class MarketFileBuffer(MarketBuffer):
             logging.debug(f"Writing buffer for market {item.market_id} as buffer is full")
             self.write()
 
+    def position(self) -> Optional[Tuple[str, int]]:
+        return self.data_location.relative_path(self.file_path), self.offset
+
+    @profiled("writer.write")
     def write(self) -> None:
         if len(self) == 0:
             return
 
-        filename = f"{self.market_id}.txt"
-        with open(os.path.join(self.data_location.data_path, self.folder, filename), "a") as file:
-            for item in self.buffer:
-                data = {str(int(item.publish_time.timestamp() * 1000)): item.streaming_update}
-                file.write(json.dumps(data) + '\n')
-
+        if self._should_roll():
+            self._roll()
+
+        timestamps = [item.publish_time_epoch for item in self.buffer]
+        updates = [item.streaming_update for item in self.buffer]
+        if self.definition_encoder is not None:
+            updates = [self.definition_encoder.encode(update) for update in updates]
+            # Definitions must be on disk before the packets referencing them
+            self.definition_encoder.flush()
+        # Records are numbered after the packets already written for the market, including by
+        # previous runs
+        first_sequence = self.stats.packet_count + 1
+        items = zip(timestamps, updates, self.buffer)
+        lines = [
+            encode_record(CaptureRecord(sequence, timestamp, getattr(item, "receive_time", None),
+                                        getattr(item, "clk", None), update)).encode()
+            for sequence, (timestamp, update, item) in enumerate(items, start=first_sequence)
+        ]
+        with open(self.file_path, "ab") as file:
+            file.writelines(lines)
+
+        byte_size = 0
+        for timestamp, line, item in zip(timestamps, lines, self.buffer):
+            self.offset_index.add(timestamp, self.offset + byte_size)
+            self.stats.update(timestamp, item.streaming_update, len(line))
+            byte_size += len(line)
+        self.offset += byte_size
+        self.offset_index.flush()
+
+        # One commit per write for the capture totals and the statistics
+        with self.data_location.catalog.transaction():
+            self.data_location.record_capture(
+                self.folder, self.market_id, self.file_name,
+                byte_size=byte_size,
+                packet_count=len(lines),
+                first_timestamp=min(timestamps),
+                last_timestamp=max(timestamps),
+            )
+            self.data_location.catalog.save_market_stats(self.folder, self.market_id,
+                                                         self.stats.to_dict())
         self.buffer = []
 
 
@@ -107,11 +242,22 @@ class MarketBufferFactory:
 class MarketStreamHandler:
     """ Class for handling market stream data """
 
-    def __init__(self, stream_type: str, max_sleep_time: int = 2, max_time_elapsed: int = 10) -> None:
+    def __init__(self, stream_type: str, max_sleep_time: int = 2, max_time_elapsed: int = 10,
+                 stages: List[PipelineStage] = None, checkpoint: StreamCheckpoint = None) -> None:
         self.write_buffers: Dict[str: MarketBuffer] = {}
+        self.stages = stages or []
+        self._stage_spans = [f"stage.{stage.__class__.__name__}" for stage in self.stages]
         self.stream_type = stream_type
         self.max_sleep_time = max_sleep_time
         self.max_time_elapsed = max_time_elapsed
+        self.checkpoint = checkpoint
+        # Sequence number of the next market book, and of the oldest book not written yet of each
+        # market
+        self._sequence = 0
+        self._unwritten: Dict[str, int] = {}
+        self._last_stale_check = time.time()
+        # Age of the last market book processed, zero while the queue is empty
+        self.lag_seconds = 0.0
         self.buffer_factory = MarketBufferFactory()
         self.buffer_factory.register("local", MarketFileBuffer)
         # TODO: Add database buffer
@@ -120,6 +266,39 @@ class MarketStreamHandler:
         """ Write all data remaining in buffers """
         for _, write_buffer in self.write_buffers.items():
             write_buffer.write()
+        self._unwritten.clear()
+        self._update_checkpoint(force=True)
+
+    def _write_stale_buffers(self) -> None:
+        for market_id, write_buffer in self.write_buffers.items():
+            # Write data if buffer has been not been updated for max_time_elapsed
+            if write_buffer.time_elapsed > self.max_time_elapsed and len(write_buffer) > 0:
+                logging.debug(f"Writing buffer for market {write_buffer.market_id} as "
+                              "max_time_elapsed exceeded")
+                write_buffer.write()
+                self._unwritten.pop(market_id, None)
+        self._last_stale_check = time.time()
+        self._update_checkpoint()
+
+    def _update_checkpoint(self, force: bool = False) -> None:
+        """ Checkpoint the stream clocks queued before the oldest market book not written yet """
+        if self.checkpoint is None:
+            return
+        writers = {market_id: write_buffer.position()
+                   for market_id, write_buffer in self.write_buffers.items()
+                   if write_buffer.position() is not None}
+        self.checkpoint.update(min(self._unwritten.values(), default=self._sequence), writers,
+                               force=force)
+
+    def _push(self, write_buffer: MarketBuffer, market_book: MarketBook) -> None:
+        write_buffer.push(market_book)
+        if len(write_buffer) == 0:
+            # The push filled the buffer, which was written
+            self._unwritten.pop(market_book.market_id, None)
+            self._update_checkpoint()
+        elif len(write_buffer) == 1:
+            self._unwritten[market_book.market_id] = self._sequence
+        self._sequence += 1
 
     def process_packets(self, output_queue, max_buffer_size=10, **kwargs):
         """ Process packets from output queue and write to buffer 
@@ -129,37 +308,52 @@ class MarketStreamHandler:
         """
         while True:
             try:
-                new_market_books: List[MarketBook] = output_queue.get()
+                new_market_books: List[MarketBook] = output_queue.get(timeout=self.max_sleep_time)
+                if isinstance(new_market_books, StreamPosition):
+                    # Clock of a stream, queued behind the market books of its change message
+                    self.checkpoint.add_position(self._sequence, new_market_books)
+                    new_market_books = []
                 logging.debug(f"Received new market books[{len(new_market_books)}]")
-
-                for market_book in new_market_books:
-                    market_id = market_book.market_id
-                    if market_id in self.write_buffers.keys():
-                        self.write_buffers[market_id].push(market_book)
-                    else:
-                        _buffer: Type[MarketBuffer] = self.buffer_factory.get(
-                            self.stream_type,
-                            market_id=market_id,
-                            max_size=max_buffer_size,
-                            **kwargs
-                        )
-
-                        self.write_buffers[market_id] = _buffer
-                        self.write_buffers[market_id].push(market_book)
+                if new_market_books:
+                    self.lag_seconds = time.time() - new_market_books[-1].publish_time_epoch / 1000
+
+                with span("stream_handler.batch"):
+                    for market_book in new_market_books:
+                        for stage, stage_span in zip(self.stages, self._stage_spans):
+                            try:
+                                with span(stage_span):
+                                    stage.process(market_book)
+                            except Exception as e:
+                                # A failing consumer must not stop the capture
+                                stage_name = stage.__class__.__name__
+                                logging.error(f"Error in pipeline stage {stage_name} : {e}")
+
+                        market_id = market_book.market_id
+                        if market_id in self.write_buffers.keys():
+                            self._push(self.write_buffers[market_id], market_book)
+                        else:
+                            _buffer: Type[MarketBuffer] = self.buffer_factory.get(
+                                self.stream_type,
+                                market_id=market_id,
+                                max_size=max_buffer_size,
+                                **kwargs
+                            )
+
+                            self.write_buffers[market_id] = _buffer
+                            self._push(self.write_buffers[market_id], market_book)
 
             except queue.Empty:
-                for _, write_buffer in self.write_buffers.items():
-                    # Write data if buffer has been not been updated for max_time_elapsed
-                    if write_buffer.time_elapsed > self.max_time_elapsed:
-                        logging.debug(
-                            f"Writing buffer for market {write_buffer.market_id} as max_time_elapsed exceeded")
-                        write_buffer.write()
-                time.sleep(self.max_sleep_time)
+                self.lag_seconds = 0.0
 
             except Exception as e:
                 logging.error(f"Error in market stream handler : {e}")
                 raise
 
+            # Checked on every iteration, so quiet markets are written even while busy markets keep
+            # the queue full
+            if time.time() - self._last_stale_check >= self.max_sleep_time:
+                self._write_stale_buffers()
+
 
 def generate_folder(path: str) -> None:
     """ Generate folder if it doesn't exist """
@@ -1,7 +1,8 @@
 import argparse
 from collections import namedtuple
 
-CliArgs = namedtuple("CliArgs", ["parse", "report", "force"])
+CliArgs = namedtuple("CliArgs", ["parse", "report", "force", "maintain", "features", "merge",
+                                 "profile", "asyncio", "workers"])
 
 
 def handle_cli_args() -> CliArgs:
@@ -10,6 +11,24 @@ def handle_cli_args() -> CliArgs:
     parser.add_argument('--parse', '-p', action='store_true', help='Flag to run the parser')
     parser.add_argument('--report', '-r', action='store_true', help='Flag to run the report')
     parser.add_argument('--force', '-f', action='store_true', help='Force run the stream scheduler')
+    parser.add_argument('--maintain', '-m', action='store_true',
+                        help='Run the retention/compaction job on capture segments')
+    parser.add_argument('--features', '-d', action='store_true',
+                        help='Build the fixed interval feature dataset (Parquet) of the captured '
+                             'markets')
+    parser.add_argument('--merge', nargs='+', default=None, metavar='DATA_DIR',
+                        help='Merge the recordings of several listeners into the configured data '
+                             'folder')
+    parser.add_argument('--profile', nargs='?', const='spans', default=None,
+                        choices=['spans', 'cprofile', 'memory'],
+                        help='Time the hot paths of the run and log a summary per stage on exit, '
+                             'optionally with cProfile or tracemalloc allocations')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='Run the stream capture on a single asyncio event loop instead of a '
+                             'thread per stream')
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help='Number of worker processes for the report and features (defaults to '
+                             'the number of CPUs)')
     args = parser.parse_args()
 
     return CliArgs(**{k: v for k, v in args._get_kwargs()})
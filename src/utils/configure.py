@@ -1,12 +1,11 @@
-from typing import Any, Dict
-from enum import Enum
+from typing import Any, Dict, TYPE_CHECKING
 from datetime import datetime
 import os
 import yaml
-import betfairlightweight
 import logging.config
-import dacite
-from stream.streaming import StreamConfig
+
+if TYPE_CHECKING:
+    import betfairlightweight
 
 
 class ConfigLoader:
@@ -35,12 +34,9 @@ class ConfigLoader:
         return config
 
 
-def load_config():
+def load_config() -> Dict[str, Any]:
+    """ Load the app config and configure logging, without touching the Betfair API """
     conf_path = os.environ.get("CONF_PATH")
-    certs_path = os.environ.get("CERTS_PATH")
-    username = os.environ.get("USERNAME")
-    password = os.environ.get("PASSWORD")
-    app_key = os.environ.get("APP_KEY")
 
     config_loader = ConfigLoader(conf_path)
     config = config_loader.load()
@@ -48,9 +44,19 @@ def load_config():
     log_config = config_loader.load("logging")
     logging.config.dictConfig(log_config)
 
-    trading = betfairlightweight.APIClient(username, password, app_key=app_key, certs=certs_path)
+    return config
 
-    return trading, config
+
+def create_api_client() -> "betfairlightweight.APIClient":
+    """ Create the Betfair API client, only needed when streaming """
+    import betfairlightweight
+
+    certs_path = os.environ.get("CERTS_PATH")
+    username = os.environ.get("USERNAME")
+    password = os.environ.get("PASSWORD")
+    app_key = os.environ.get("APP_KEY")
+
+    return betfairlightweight.APIClient(username, password, app_key=app_key, certs=certs_path)
 
 
 def get_market_filter_config(config):
@@ -64,6 +70,10 @@ def get_market_filter_config(config):
 
 
 def get_streams(config):
+    import betfairlightweight
+    import dacite
+    from stream.streaming import StreamConfig
+
     streams = config['streams']
     for stream in streams:
         stream_market_filter = stream['market_filter'].copy()
@@ -0,0 +1,220 @@
+import os
+import glob
+import logging
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from order_book.bars import parse_interval
+from stream.storage.data_location import DataLocation
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pyarrow as pa
+
+_worker_data_location: Optional[DataLocation] = None
+
+
+@dataclass
+class FeatureConfig:
+    """Options of the feature dataset builder"""
+    output_dir: str = "features"  # Relative to the data folder
+    interval: str = "1s"
+    depth: int = 3
+    return_lags: List[int] = field(default_factory=lambda: [1, 5, 30])
+    max_time_to_off: Optional[str] = None  # e.g. "30m", only keep rows this long before the off
+    row_group_rows: int = 500_000
+    file_rows: int = 10_000_000
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "FeatureConfig":
+        """ Create the options from the `features` section of the app config, defaults if there is
+        none
+
+        Args:
+            config (Dict): App config
+
+        Raises:
+            ValueError: If an interval is invalid
+        """
+        features = config.get("features") or {}
+        feature_config = cls(**{key: value for key, value in features.items()
+                                if key in cls.__dataclass_fields__})
+        parse_interval(feature_config.interval)
+        if feature_config.max_time_to_off is not None:
+            parse_interval(feature_config.max_time_to_off)
+        return feature_config
+
+
+class ParquetPartWriter:
+    """Writes tables to numbered Parquet files with row groups of a fixed number of rows
+
+    Rows are buffered until a row group is full, so memory stays bounded by `row_group_rows`
+    whatever the number of tables written. A file is renamed to its final name once it is complete.
+    """
+
+    def __init__(self, output_dir: str, schema: "pa.Schema", row_group_rows: int,
+                 file_rows: int) -> None:
+        self.output_dir = output_dir
+        self.schema = schema
+        self.row_group_rows = row_group_rows
+        self.file_rows = file_rows
+        self.file_count = 0
+        self.row_count = 0
+        self._buffer: List["pa.Table"] = []
+        self._buffer_rows = 0
+        self._writer = None
+        self._file_path = None
+        self._file_rows = 0
+
+    def write(self, table: "pa.Table") -> None:
+        self._buffer.append(table)
+        self._buffer_rows += table.num_rows
+        if self._buffer_rows >= self.row_group_rows:
+            self._flush(self.row_group_rows)
+
+    def _flush(self, min_rows: int) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.concat_tables(self._buffer)
+        offset = 0
+        while table.num_rows - offset >= max(min_rows, 1):
+            if self._writer is None:
+                self._file_path = os.path.join(self.output_dir,
+                                               f"part-{self.file_count:05d}.parquet")
+                self._writer = pq.ParquetWriter(self._file_path + ".tmp", self.schema,
+                                                compression="zstd")
+            rows = min(self.row_group_rows, self.file_rows - self._file_rows,
+                       table.num_rows - offset)
+            self._writer.write_table(table.slice(offset, rows), row_group_size=rows)
+            offset += rows
+            self._file_rows += rows
+            self.row_count += rows
+            if self._file_rows >= self.file_rows:
+                self._close_file()
+
+        remainder = table.slice(offset)
+        if remainder.num_rows:
+            self._buffer, self._buffer_rows = [remainder], remainder.num_rows
+        else:
+            self._buffer, self._buffer_rows = [], 0
+
+    def _close_file(self) -> None:
+        self._writer.close()
+        os.replace(self._file_path + ".tmp", self._file_path)
+        self._writer, self._file_rows = None, 0
+        self.file_count += 1
+
+    def close(self) -> None:
+        if self._buffer:
+            self._flush(0)
+        if self._writer is not None:
+            self._close_file()
+
+
+def feature_schema(config: FeatureConfig) -> "pa.Schema":
+    """ Parquet schema of the feature dataset, see order_book.features.feature_columns """
+    import pyarrow as pa
+    from order_book.features import feature_columns
+
+    types = {"time": pa.timestamp("ms", tz="UTC"), "selection_id": pa.int64(),
+             "in_play": pa.bool_()}
+    return pa.schema([("market_id", pa.string())] + [
+        (column, types.get(column, pa.float64()))
+        for column in feature_columns(config.depth, config.return_lags)
+    ])
+
+
+def _init_feature_worker(data_path: str) -> None:
+    global _worker_data_location
+    _worker_data_location = DataLocation(data_path, [])
+
+
+def _market_features_task(
+        task: Tuple[str, str, FeatureConfig]) -> Tuple[str, Dict[str, "np.ndarray"]]:
+    """ Computes the feature rows of a market in a worker process """
+    from order_book.features import build_market_features
+
+    event_id, market_id, config = task
+    max_time_to_off_ms = parse_interval(config.max_time_to_off) if config.max_time_to_off else None
+    columns = build_market_features(_worker_data_location.iter_market(event_id, market_id),
+                                    parse_interval(config.interval), config.depth,
+                                    config.return_lags, max_time_to_off_ms)
+    return market_id, columns
+
+
+def _imap_bounded(executor: Executor, function: Callable, tasks: Iterable,
+                  max_pending: int) -> Iterator[Any]:
+    """ Ordered `map` over an executor which only submits `max_pending` tasks ahead of the
+    consumer """
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(function, task))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def build_feature_dataset(data_location: DataLocation, config: FeatureConfig,
+                          markets: List[Tuple[str, str]] = None, workers: int = None) -> str:
+    """Builds the fixed interval feature dataset of recorded markets as Parquet files
+
+    Markets are replayed and featurised in a process pool, see
+    order_book.features.build_market_features. Only a few markets per worker are in flight at any
+    time and rows are written in row groups as they arrive, so memory does not grow with the number
+    of markets. Existing part files in the output folder are replaced.
+
+    Args:
+        data_location (DataLocation): DataLocation instance
+        config (FeatureConfig): Dataset options
+        markets (List[Tuple[str, str]], optional): (event ID, market ID) of the markets, every
+            captured market if None
+        workers (int, optional): Number of worker processes, defaults to the number of CPUs. 1 runs
+            in process.
+
+    Returns:
+        str: Output folder
+    """
+    import pyarrow as pa
+
+    if markets is None:
+        markets = sorted(data_location.get_market_captures())
+    output_dir = os.path.join(data_location.data_path, config.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(output_dir, "part-*.parquet")):
+        os.remove(path)
+
+    schema = feature_schema(config)
+    writer = ParquetPartWriter(output_dir, schema, config.row_group_rows, config.file_rows)
+    tasks = [(event_id, market_id, config) for event_id, market_id in markets]
+    logging.info(f"Building features of {len(tasks)} market(s) every {config.interval}")
+
+    if workers == 1 or len(tasks) <= 1:
+        _init_feature_worker(data_location.data_path)
+        results = map(_market_features_task, tasks)
+        executor = None
+    else:
+        workers = workers or os.cpu_count() or 1
+        executor = ProcessPoolExecutor(workers, initializer=_init_feature_worker,
+                                       initargs=(data_location.data_path,))
+        results = _imap_bounded(executor, _market_features_task, tasks, 2 * workers)
+
+    try:
+        for market_id, columns in results:
+            row_count = len(columns["time"])
+            if row_count == 0:
+                continue
+            arrays = [pa.repeat(pa.scalar(market_id, type=pa.string()), row_count)]
+            arrays += [pa.array(columns[column.name], type=column.type)
+                       for column in list(schema)[1:]]
+            writer.write(pa.Table.from_arrays(arrays, schema=schema))
+        writer.close()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    logging.info(f"Wrote {writer.row_count} feature row(s) to {writer.file_count} file(s) in "
+                 f"{output_dir}")
+    return output_dir
@@ -1,15 +1,13 @@
-import betfairlightweight
-from betfairlightweight.filters import (
-    streaming_market_filter,
-    streaming_market_data_filter,
-)
 import logging
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, TYPE_CHECKING
 from utils.configure import get_market_filter_config
 
+if TYPE_CHECKING:
+    import betfairlightweight
 
-def get_events(trading: betfairlightweight.APIClient, event_filter: dict) -> List[Dict]:
+
+def get_events(trading: "betfairlightweight.APIClient", event_filter: dict) -> List[Dict]:
     """Get list of events and markets from Betfair API
 
     Args:
@@ -49,6 +47,8 @@ def get_events(trading: betfairlightweight.APIClient, event_filter: dict) -> Lis
 
 
 def get_stream_market_filter(config):
+    from betfairlightweight.filters import streaming_market_filter
+
     event_ids, event_type_ids, market_types, country_codes = get_market_filter_config(config)
 
     return streaming_market_filter(
@@ -60,6 +60,8 @@ def get_stream_market_filter(config):
 
 
 def get_market_filter(config):
+    import betfairlightweight
+
     event_ids, event_type_ids, market_types, country_codes = get_market_filter_config(config)
     market_filter = betfairlightweight.filters.market_filter(
         event_type_ids=event_type_ids,
@@ -76,5 +78,7 @@ def convert_timestamp_to_datetime(timestamp: str) -> datetime:
 
 
 def get_stream_market_data_filter(config):
+    from betfairlightweight.filters import streaming_market_data_filter
+
     data_fields = config['market_data_filter']
     return streaming_market_data_filter(fields=data_fields)
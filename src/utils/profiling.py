@@ -0,0 +1,169 @@
+import io
+import time
+import atexit
+import logging
+import threading
+from contextlib import nullcontext
+from dataclasses import dataclass
+from functools import wraps
+from typing import Callable, ContextManager, Dict, Optional
+
+# Profiling modes of the --profile flag: timed spans only, spans and cProfile of the main thread,
+# spans with the memory allocated in each span and the top allocation sites (tracemalloc)
+PROFILE_MODES = ("spans", "cprofile", "memory")
+
+_enabled = False
+_memory = False
+_profiler = None
+_lock = threading.Lock()
+_NULL_SPAN = nullcontext()
+
+
+@dataclass
+class SpanStats:
+    """Totals of a profiled stage"""
+    count: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    allocated_bytes: int = 0  # Net memory allocated in the spans, only with tracemalloc
+
+    def add(self, seconds: float, allocated_bytes: int) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.allocated_bytes += allocated_bytes
+
+
+_stats: Dict[str, SpanStats] = {}
+
+
+def _record(name: str, seconds: float, allocated_bytes: int) -> None:
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = SpanStats()
+        stats.add(seconds, allocated_bytes)
+
+
+class _Span:
+    __slots__ = ("name", "start", "memory")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> "_Span":
+        if _memory:
+            import tracemalloc
+            self.memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        seconds = time.perf_counter() - self.start
+        allocated_bytes = 0
+        if _memory:
+            import tracemalloc
+            allocated_bytes = tracemalloc.get_traced_memory()[0] - self.memory
+        _record(self.name, seconds, allocated_bytes)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable(mode: str = "spans") -> None:
+    """ Enable the profiling hooks for the rest of the run, the summary is logged when the process
+    exits
+
+    The hooks of functions decorated with `profiled` are installed when their module is imported, so
+    profiling must be enabled before the instrumented modules are imported (main imports them inside
+    the run_* functions).
+
+    Args:
+        mode (str, optional): One of PROFILE_MODES. Defaults to "spans".
+
+    Raises:
+        ValueError: If the mode is unknown
+    """
+    global _enabled, _memory, _profiler
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Invalid profile mode {mode}")
+
+    _enabled = True
+    if mode == "memory":
+        import tracemalloc
+        tracemalloc.start()
+        _memory = True
+    elif mode == "cprofile":
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    atexit.register(log_summary)
+    logging.info(f"Profiling enabled ({mode})")
+
+
+def span(name: str) -> ContextManager:
+    """ Time a block of code as the stage `name`, a shared no-op context manager when profiling is
+    disabled """
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def profiled(name: str) -> Callable[[Callable], Callable]:
+    """ Decorator timing every call of a function as the stage `name`
+
+    When profiling is disabled the function is returned unchanged, so the hook costs nothing.
+    """
+    def decorator(function: Callable) -> Callable:
+        if not _enabled:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary(top: int = 25) -> str:
+    """ Text summary of the time and memory allocated per stage, and of cProfile/tracemalloc if
+    enabled
+
+    Args:
+        top (int, optional): Number of functions/allocation sites listed. Defaults to 25.
+    """
+    with _lock:
+        stats = sorted(_stats.items(), key=lambda item: item[1].seconds, reverse=True)
+
+    lines = [f"{'stage':<36}{'calls':>10}{'total s':>11}{'mean ms':>10}{'max ms':>10}"
+             + (f"{'alloc MB':>11}" if _memory else "")]
+    for name, stage in stats:
+        mean_ms = 1000 * stage.seconds / stage.count
+        line = f"{name:<36}{stage.count:>10}{stage.seconds:>11.3f}{mean_ms:>10.3f}" \
+            f"{1000 * stage.max_seconds:>10.3f}"
+        lines.append(line + (f"{stage.allocated_bytes / 1e6:>11.2f}" if _memory else ""))
+
+    if _profiler is not None:
+        import pstats
+        _profiler.disable()
+        output = io.StringIO()
+        pstats.Stats(_profiler, stream=output).sort_stats("cumulative").print_stats(top)
+        lines += ["", "cProfile (main thread, cumulative time)", output.getvalue()]
+
+    if _memory:
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        lines += ["", f"tracemalloc: current {current / 1e6:.2f}MB, peak {peak / 1e6:.2f}MB, "
+                  "top allocation sites"]
+        for statistic in tracemalloc.take_snapshot().statistics("lineno")[:top]:
+            lines.append(f"    {statistic}")
+    return "\n".join(lines)
+
+
+def log_summary(file_path: Optional[str] = None) -> None:
+    """ Log the profiling summary, and write it to `file_path` if given """
+    text = summary()
+    logging.info(f"Profile summary\n{text}")
+    if file_path is not None:
+        with open(file_path, "w") as file:
+            file.write(text + "\n")
@@ -0,0 +1,130 @@
+from array import array
+from typing import Dict, List, Optional, Any
+import numpy as np
+
+# Gaps within this window of a suspension/resumption are reported with the suspension
+SUSPENSION_WINDOW_MS = 60 * 1000
+GAP_PERCENTILES = [50, 90, 99]
+
+
+class MarketColumnsBuilder:
+    """Collects the columns needed for the data quality analytics while streaming the packets of a
+    market"""
+
+    def __init__(self) -> None:
+        self.timestamps = array("q")
+        self.update_runner_ids = array("q")
+        self.clks: List[Optional[str]] = []
+        self.status_changes: List[tuple] = []
+        self._status = None
+
+    def add(self, timestamp: int, packet: Dict, clk: str = None) -> None:
+        """ Add a packet
+
+        Args:
+            timestamp (int): Publish time in milliseconds
+            packet (Dict): Market change message
+            clk (str, optional): Stream clk of the packet, if recorded
+        """
+        self.timestamps.append(timestamp)
+        self.clks.append(clk)
+        for runner in packet.get("rc", []):
+            self.update_runner_ids.append(runner["id"])
+
+        definition = packet.get("marketDefinition")
+        if definition is not None and definition.get("status") != self._status:
+            self._status = definition.get("status")
+            self.status_changes.append((timestamp, self._status))
+
+
+def _percentiles(values: np.ndarray) -> Dict[str, Optional[float]]:
+    if len(values) == 0:
+        return {f"p{percentile}": None for percentile in GAP_PERCENTILES}
+    return {f"p{percentile}": float(value)
+            for percentile, value in zip(GAP_PERCENTILES, np.percentile(values, GAP_PERCENTILES))}
+
+
+def _suspensions(status_changes: List[tuple], last_timestamp: int) -> List[tuple]:
+    """ Returns the (start, end) of every suspension, an open suspension ends at the last packet """
+    suspensions, start = [], None
+    for timestamp, status in status_changes:
+        if status == "SUSPENDED" and start is None:
+            start = timestamp
+        elif status != "SUSPENDED" and start is not None:
+            suspensions.append((start, timestamp))
+            start = None
+    if start is not None:
+        suspensions.append((start, last_timestamp))
+    return suspensions
+
+
+def compute_market_quality(columns: MarketColumnsBuilder) -> Dict[str, Any]:
+    """Computes the data quality distributions of a market
+
+    Args:
+        columns (MarketColumnsBuilder): Columns of the market packets
+
+    Returns:
+        Dict[str, Any]: Gap percentiles, packets per second over time, gaps around suspensions,
+            runner update counts and publish time/clk anomalies
+    """
+    timestamps = np.frombuffer(columns.timestamps, dtype=np.int64)
+    if len(timestamps) == 0:
+        return {}
+
+    gaps = np.diff(timestamps)
+    positive_gaps = gaps[gaps > 0]
+
+    # Packets per second, overall and per minute
+    seconds = (timestamps - timestamps[0]) // 1000
+    seconds = seconds[seconds >= 0]
+    packets_per_second = np.bincount(seconds)
+    packets_per_minute = np.bincount(seconds // 60)
+
+    # Largest gap within the window around the start and end of each suspension
+    gap_end_times = timestamps[1:]
+    suspensions = []
+    for start, end in _suspensions(columns.status_changes, int(timestamps[-1])):
+        window = {}
+        for label, time in (("suspend", start), ("resume", end)):
+            bounds = [time - SUSPENSION_WINDOW_MS, time + SUSPENSION_WINDOW_MS]
+            lower, upper = np.searchsorted(gap_end_times, bounds)
+            max_gap = int(gaps[lower:upper].max()) if upper > lower else None
+            window[f"max_gap_around_{label}_ms"] = max_gap
+        suspensions.append({"start": start, "end": end, "duration_ms": end - start, **window})
+
+    # Updates per runner
+    runner_ids, update_counts = np.unique(np.frombuffer(columns.update_runner_ids, dtype=np.int64),
+                                          return_counts=True)
+
+    # Publish time regressions/duplicates and clk anomalies (only available for captures recording
+    # the clk)
+    anomalies = {
+        "publish_time_regressions": int(np.count_nonzero(gaps < 0)),
+        "duplicate_publish_times": int(np.count_nonzero(gaps == 0)),
+        "repeated_clk": None,
+        "clk_unchanged_time_advanced": None,
+    }
+    if all(clk is not None for clk in columns.clks):
+        clks = np.array(columns.clks, dtype=object)
+        repeated = clks[1:] == clks[:-1]
+        anomalies["repeated_clk"] = int(np.count_nonzero(repeated))
+        anomalies["clk_unchanged_time_advanced"] = int(np.count_nonzero(repeated & (gaps > 0)))
+
+    return {
+        "gap_ms": {
+            **_percentiles(positive_gaps),
+            "max": int(gaps.max()) if len(gaps) else None,
+            "mean": float(positive_gaps.mean()) if len(positive_gaps) else None,
+        },
+        "packets_per_second": {
+            "mean": float(packets_per_second.mean()),
+            **_percentiles(packets_per_second),
+            "max": int(packets_per_second.max()),
+            "per_minute": (packets_per_minute / 60).round(3).tolist(),
+        },
+        "suspensions": suspensions,
+        "runner_update_counts": {str(runner_id): int(count)
+                                 for runner_id, count in zip(runner_ids, update_counts)},
+        "anomalies": anomalies,
+    }
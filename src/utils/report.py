@@ -1,91 +1,142 @@
 from utils.helper import convert_timestamp_to_datetime
-from typing import Dict, List
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
 from stream.storage.data_location import DataLocation
+from stream.storage.market_stats import MarketStats
+from utils.profiling import profiled
+import contextlib
+import json
 import math
+import os
 import logging
 
+if TYPE_CHECKING:
+    from utils.quality import MarketColumnsBuilder
 
-def generate_market_report(event_id: str, market_info: dict, data_location: DataLocation) -> dict:
-    """Generates a report for a single market
+
+def compute_market_stats(event_id: str, market_id: str, data_location: DataLocation,
+                         columns: "MarketColumnsBuilder" = None) -> Optional[MarketStats]:
+    """Computes the statistics of a market from its data, for markets recorded before the writer
+    kept statistics
 
     Args:
         event_id (str): Event ID
-        market_info (dict): Event data
-        data_location (DataLoader): DataLoader instance
+        market_id (str): Market ID
+        data_location (DataLocation): DataLocation instance
+        columns (MarketColumnsBuilder, optional): Also collects the quality analytics columns in the
+            same pass
 
     Returns:
-        dict: Market report
+        MarketStats: Market statistics, None if the market data is missing
     """
-    market_id = market_info['marketId']
-    logging.debug(f"Generating market report for {market_id}")
-    market_data = {}
-    # Load market data
+    stats = MarketStats()
     try:
-        market_data = data_location.load_market(event_id, market_id)['mcm']
+        for record in data_location.iter_market_records(event_id, market_id):
+            stats.update(record.publish_time, record.update)
+            if columns is not None:
+                columns.add(record.publish_time, record.update, record.clk)
     except FileNotFoundError:
         logging.error(f"Market data not found for {market_id}")
+        return None
     except KeyError:
         logging.error(f"Market data found but missing market change message {market_id}")
+        return None
+
+    return stats
+
+
+def build_market_report(market_info: dict, stats: Optional[MarketStats]) -> dict:
+    """Builds the report of a single market from its statistics
+
+    Args:
+        market_info (dict): Market catalogue
+        stats (MarketStats, optional): Market statistics, None if the market data is missing
+
+    Returns:
+        dict: Market report
+    """
+    report = {
+        "market_id": market_info['marketId'],
+        "record_start": None,
+        "record_end": None,
+        "record_length_sec": None,
+        "contains_market_closure": False,
+        "contains_missing_data": False,
+        "timestamp_count": 0,
+        "timestamp_avg_diff": None,
+        "max_timestamp_diff": None,
+        "timestamp_diff_histogram": {},
+        "bytes_written": 0,
+        "num_runners": len(market_info['runners']),
+        "num_runners_recorded": 0,
+    }
+    if stats is None or stats.packet_count == 0:
+        return report
 
-    # market_start_time = market_info['description']['marketTime'] TODO: Fix this
-    # market_start_time = parser.isoparse(market_start_time).isoformat() TODO: Fix this
-
-    timestamp_count = 0
-    timestamp_diff_total = 0
-    last_timestamp = None
-    is_market_closed = False
-    is_market_data_missing = False
-
-    timestamps = list(market_data)
-    for timestamp in timestamps:
-        timestamp_count += 1
-        timestamp = int(timestamp)
-
-        if last_timestamp is not None:
-            timestamp_diff = timestamp - last_timestamp
-            timestamp_diff_total += timestamp_diff
-            # Check if there is a gap of more than 10 minutes
-            if timestamp_diff > 10 * 60 * 60:
-                is_market_data_missing = True
-        last_timestamp = timestamp
-
-    last_timestamp = str(last_timestamp)
-    # Check if market is closed
-    if "marketDefinition" in market_data[last_timestamp]:
-        if market_data[last_timestamp]["marketDefinition"]["status"] == "CLOSED":
-            is_market_closed = True
-
-    record_start = convert_timestamp_to_datetime(timestamps[0])
-    record_end = convert_timestamp_to_datetime(timestamps[-1])
-    record_length_sec = (record_end - record_start).total_seconds()
-
-    return ({
-        "market_id": market_id,
-        # "market_name": market_info['name'], TODO: Fix this
-        # "market_start_time": market_start_time, TODO: Fix this
+    record_start = convert_timestamp_to_datetime(stats.first_timestamp)
+    record_end = convert_timestamp_to_datetime(stats.last_timestamp)
+
+    report.update({
         "record_start": record_start.isoformat(),
         "record_end": record_end.isoformat(),
-        "record_length_sec": record_length_sec,
-        "contains_market_closure": is_market_closed,
-        "contains_missing_data": is_market_data_missing,
-        "timestamp_count": timestamp_count,
-        "timestamp_avg_diff": math.ceil(timestamp_diff_total / timestamp_count),
-        "num_runners": len(market_info['runners']),
+        "record_length_sec": (record_end - record_start).total_seconds(),
+        "contains_market_closure": stats.is_closed,
+        "contains_missing_data": stats.contains_missing_data,
+        "timestamp_count": stats.packet_count,
+        "timestamp_avg_diff": math.ceil(stats.gap_total_ms / stats.packet_count),
+        "max_timestamp_diff": stats.max_gap_ms,
+        "timestamp_diff_histogram": dict(zip(MarketStats.histogram_labels(), stats.gap_histogram)),
+        "bytes_written": stats.bytes_written,
+        "num_runners_recorded": len(stats.runner_ids),
     })
+    return report
+
+
+def generate_market_report(event_id: str, market_info: dict, data_location: DataLocation,
+                           stats: MarketStats = None) -> dict:
+    """Generates a report for a single market from the statistics kept in the catalog
+
+    Args:
+        event_id (str): Event ID
+        market_info (dict): Event data
+        data_location (DataLoader): DataLoader instance
+        stats (MarketStats, optional): Market statistics, loaded from the catalog if not provided
+
+    Returns:
+        dict: Market report
+    """
+    market_id = market_info['marketId']
+    logging.debug(f"Generating market report for {market_id}")
+
+    if stats is None:
+        stats_data = data_location.catalog.get_market_stats(market_id)
+        if stats_data is not None:
+            stats = MarketStats.from_dict(stats_data)
+        else:
+            # Backfill the catalog so the next report is a metadata read
+            stats = compute_market_stats(event_id, market_id, data_location)
+            if stats is not None and stats.packet_count > 0:
+                data_location.catalog.save_market_stats(event_id, market_id, stats.to_dict())
+
+    return build_market_report(market_info, stats)
 
 
 def generate_event_report(event_id: str, data_location: DataLocation) -> dict:
     """Generates a report for a single event"""
     logging.info(f"Generating event report for {event_id}")
-    # Load event data
+    # Load event data and the statistics of all its markets in one read
     event_data = data_location.load_event(event_id)
+    event_stats = data_location.catalog.get_event_market_stats(event_id)
     markets = list(event_data['markets'])
 
     market_report = []
 
     for market in markets:
         event_id = event_data["event"]["id"]
-        market_report.append(generate_market_report(event_id, market, data_location))
+        stats = event_stats.get(market['marketId'])
+        market_report.append(generate_market_report(
+            event_id, market, data_location, MarketStats.from_dict(stats) if stats else None
+        ))
 
     event_report = {
         'event_id': event_id,
@@ -96,12 +147,148 @@ def generate_event_report(event_id: str, data_location: DataLocation) -> dict:
     return event_report
 
 
-def generate_all_events_report(data_location: DataLocation) -> List[Dict]:
+# Bump when the market report format changes to invalidate cached reports
+REPORT_VERSION = 4
+
+# Data location of the report worker processes, see _init_report_worker
+_worker_data_location: Optional[DataLocation] = None
+
+
+def _market_cache_key(market_id: str, data_location: DataLocation, stats: Optional[Dict]) -> str:
+    """Cache key of a market report: the size/mtime of its capture files and the packet count of its
+    statistics"""
+    files = []
+    for capture in data_location.catalog.get_capture_files(market_id=market_id):
+        try:
+            file_stat = os.stat(os.path.join(data_location.data_path, capture["path"]))
+        except FileNotFoundError:
+            continue
+        files.append([capture["path"], file_stat.st_size, file_stat.st_mtime_ns])
+    return json.dumps([REPORT_VERSION, files, stats["packet_count"] if stats else None])
+
+
+def _init_report_worker(data_path: str) -> None:
+    global _worker_data_location
+    _worker_data_location = DataLocation(data_path, [])
+
+
+@profiled("report.market")
+def _market_report_task(task: Tuple[str, dict, Optional[Dict]]) -> Tuple[dict, Optional[Dict]]:
+    """Generates a market report in a worker process, the catalog is only written by the parent
+    process
+
+    The market data is read once for the data quality analytics, and for the statistics of markets
+    recorded before the writer kept them. The quality of a market still being captured covers the
+    data captured so far and is flagged as `partial`, its cached report is regenerated when the
+    capture grows.
+
+    Returns:
+        Tuple[dict, Optional[Dict]]: Market report, statistics computed from the market data (if not
+            in the catalog)
+    """
+    event_id, market_info, stats_data = task
+    stats = MarketStats.from_dict(stats_data) if stats_data is not None else None
+
+    # Imported here so numpy is only loaded by the processes reading market data
+    from utils.quality import MarketColumnsBuilder, compute_market_quality
+
+    columns = MarketColumnsBuilder()
+    computed_stats = compute_market_stats(event_id, market_info['marketId'], _worker_data_location,
+                                          columns)
+
+    computed = None
+    if stats is None:
+        stats = computed_stats
+        if stats is not None and stats.packet_count > 0:
+            computed = stats.to_dict()
+
+    report = build_market_report(market_info, stats)
+    quality = compute_market_quality(columns)
+    if quality:
+        quality["partial"] = stats is None or not stats.is_closed
+    report["quality"] = quality
+    return report, computed
+
+
+def iter_events_report(data_location: DataLocation, workers: int = None) -> Iterator[Dict]:
+    """Generates the report of every event, one event at a time
+
+    Market reports are cached in the catalog and only regenerated when the market's capture files
+    change, the missing reports are generated in a process pool.
+
+    Args:
+        data_location (DataLocation): DataLocation instance
+        workers (int, optional): Number of worker processes, defaults to the number of CPUs. 1 runs
+            in process.
+
+    Yields:
+        Dict: Event report
+    """
+    events, tasks = [], []
+    for event_id in data_location.load_events():
+        event_data = data_location.load_event(event_id)
+        event_stats = data_location.catalog.get_event_market_stats(event_id)
+        markets = []
+        for market in event_data['markets']:
+            stats = event_stats.get(market['marketId'])
+            cache_key = _market_cache_key(market['marketId'], data_location, stats)
+            report = data_location.catalog.get_cached_report(market['marketId'], cache_key)
+            if report is None:
+                tasks.append((event_id, market, stats))
+            markets.append((market, cache_key, report))
+        events.append((event_data['event'], markets))
+
+    logging.info(f"Generating {len(tasks)} market report(s), "
+                 f"{sum(len(m) for _, m in events) - len(tasks)} cached")
+    with contextlib.ExitStack() as stack:
+        if workers == 1 or len(tasks) <= 1:
+            _init_report_worker(data_location.data_path)
+            results = map(_market_report_task, tasks)
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(
+                workers, initializer=_init_report_worker, initargs=(data_location.data_path,)
+            ))
+            results = executor.map(_market_report_task, tasks, chunksize=max(1, len(tasks) // 64))
+
+        for event, markets in events:
+            market_reports = []
+            for market, cache_key, report in markets:
+                if report is None:
+                    report, computed_stats = next(results)
+                    if computed_stats is not None:
+                        data_location.catalog.save_market_stats(event['id'], market['marketId'],
+                                                                computed_stats)
+                    data_location.catalog.save_cached_report(market['marketId'], cache_key, report)
+                market_reports.append(report)
+
+            yield {
+                'event_id': event['id'],
+                'event_name': event['name'],
+                'markets': market_reports
+            }
+
+
+def generate_all_events_report(data_location: DataLocation, workers: int = None) -> List[Dict]:
     """Generates a report for all events"""
-    events = data_location.load_json_data(file_name='eventLog.json')
-    report = []
+    return list(iter_events_report(data_location, workers))
 
-    for event_id in events:
-        report.append(generate_event_report(event_id, data_location))
 
-    return report
+@profiled("report.write")
+def write_all_events_report(data_location: DataLocation, file_name: str = "report.json",
+                            workers: int = None) -> None:
+    """Writes the report of all events as a JSON array, streamed one event at a time
+
+    Args:
+        data_location (DataLocation): DataLocation instance
+        file_name (str, optional): File name in the data folder. Defaults to "report.json".
+        workers (int, optional): Number of worker processes, defaults to the number of CPUs
+    """
+    file_path = os.path.join(data_location.data_path, file_name)
+    tmp_file_path = file_path + ".tmp"
+    with open(tmp_file_path, "w") as file:
+        file.write("[")
+        for idx, event_report in enumerate(iter_events_report(data_location, workers)):
+            file.write(",\n" if idx > 0 else "\n")
+            file.write(json.dumps(event_report, indent=4))
+        file.write("\n]\n")
+    os.replace(tmp_file_path, file_path)
@@ -0,0 +1,48 @@
+import os
+import sys
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+# The app modules are imported from src, as when running `python src/main.py`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from stream.storage.data_location import DataLocation  # noqa: E402
+
+EVENT = {"id": "32000001", "name": "Arsenal v Chelsea", "openDate": "2023-02-14T19:00:00.000Z"}
+MARKETS = [
+    {"marketId": "1.200000001", "marketName": "Match Odds",
+     "marketStartTime": "2023-02-14T19:00:00.000Z",
+     "description": {"marketType": "MATCH_ODDS"},
+     "runners": [{"selectionId": 1096, "runnerName": "Arsenal"},
+                 {"selectionId": 58805, "runnerName": "The Draw"}]},
+    {"marketId": "1.200000002", "marketName": "Over/Under 2.5 Goals",
+     "marketStartTime": "2023-02-14T19:00:00.000Z",
+     "description": {"marketType": "OVER_UNDER_25"},
+     "runners": [{"selectionId": 47972, "runnerName": "Under 2.5 Goals"}]},
+]
+
+
+@pytest.fixture
+def data_location(tmp_path):
+    """ Data location holding one event with two markets """
+    data_location = DataLocation(str(tmp_path / "data"), [{"event": EVENT, "markets": MARKETS}])
+    data_location.create()
+    yield data_location
+    data_location.catalog.close()
+
+
+@pytest.fixture
+def market_book():
+    """ Factory of the market books queued by the streams, with the attributes read by the
+    writer and the pipeline stages """
+    def make(market_id, publish_time, update=None, **kwargs):
+        return SimpleNamespace(
+            market_id=market_id,
+            publish_time=datetime.fromtimestamp(publish_time / 1000, timezone.utc),
+            publish_time_epoch=publish_time,
+            streaming_update=update if update is not None else {"id": market_id},
+            **kwargs,
+        )
+    return make
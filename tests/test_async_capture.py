@@ -0,0 +1,131 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from stream.async_capture import (AsyncCapture, AsyncCaptureConfig, AsyncMarketStream,
+                                  StreamProtocolError)
+from stream.replay_server import ReplayServer
+from stream.session import SessionManager
+from stream.storage.data_location import DataLocation
+from stream.streaming import StreamConfig
+from stream.writer.stream_writer import MarketFileBuffer
+
+EVENT = "32000001"
+MARKETS = ["1.200000001", "1.200000002"]
+
+
+@pytest.fixture
+def source(data_location, market_book):
+    """ Data location with 3 recorded packets per market, interleaved in publish time """
+    for offset, market_id in enumerate(MARKETS):
+        buffer = MarketFileBuffer(market_id, data_location, max_size=100)
+        for idx in range(3):
+            publish_time = 1000 + idx * 100 + offset * 10
+            buffer.push(market_book(market_id, publish_time, {
+                "id": market_id, "rc": [{"id": 1096, "ltp": 2.0 + idx / 10}]}))
+        buffer.write()
+    return data_location
+
+
+async def send(writer, message):
+    writer.write(json.dumps(message).encode() + b"\r\n")
+    await writer.drain()
+
+
+async def receive(reader, count):
+    return [json.loads(await reader.readline()) for _ in range(count)]
+
+
+def test_from_config():
+    assert AsyncCaptureConfig.from_config({}) == AsyncCaptureConfig()
+    config = AsyncCaptureConfig.from_config({"async_capture": {"port": 8443, "ssl": False,
+                                                               "unknown": 1}})
+    assert (config.port, config.ssl) == (8443, False)
+
+
+def test_replay_server_protocol(source):
+    async def replay():
+        server = ReplayServer(source, [(EVENT, market_id) for market_id in MARKETS])
+        await server.start()
+        reader, writer = await asyncio.open_connection(server.host, server.port)
+        try:
+            (connection,) = await receive(reader, 1)
+            await send(writer, {"op": "authentication", "id": 1, "session": "any"})
+            await send(writer, {"op": "marketSubscription", "id": 2,
+                                "marketFilter": {"marketIds": [MARKETS[1]]}})
+            subscribed = await receive(reader, 5)
+            # A subscription with clocks resumes after the packet of `clk`
+            await send(writer, {"op": "marketSubscription", "id": 3, "marketFilter": {},
+                                "initialClk": "0", "clk": "4"})
+            resumed = await receive(reader, 3)
+        finally:
+            writer.close()
+            await server.stop()
+        return connection, subscribed, resumed
+
+    connection, subscribed, resumed = asyncio.run(replay())
+    assert connection == {"op": "connection", "connectionId": "replay-1"}
+    assert [message["statusCode"] for message in subscribed[:2]] == ["SUCCESS"] * 2
+    changes = subscribed[2:]
+    assert [(message["clk"], message["pt"]) for message in changes] == \
+        [("1", 1010), ("2", 1110), ("3", 1210)]
+    assert changes[0]["ct"] == "SUB_IMAGE" and "ct" not in changes[1]
+    assert [change["id"] for message in changes for change in message["mc"]] == [MARKETS[1]] * 3
+
+    assert resumed[0]["statusCode"] == "SUCCESS"
+    assert [(message["clk"], message["pt"]) for message in resumed[1:]] == \
+        [("5", 1200), ("6", 1210)]
+    assert resumed[1]["ct"] == "RESUB_DELTA"
+
+
+@pytest.fixture
+def output(tmp_path):
+    """ Empty data location of the capture, with the event in its catalog """
+    output = DataLocation(str(tmp_path / "output"), [])
+    output.catalog.add_event({"id": EVENT}, [{"marketId": market_id} for market_id in MARKETS])
+    os.makedirs(os.path.join(output.data_path, EVENT))
+    yield output
+    output.catalog.close()
+
+
+def test_capture_of_the_replay(source, output):
+    streams = [StreamConfig(datetime.now(), "football", {"eventIds": [EVENT]},
+                            {"eventIds": [EVENT]})]
+
+    async def capture():
+        server = ReplayServer(source)
+        await server.start()
+        client = SimpleNamespace(session_expired=False, session_token="replay",
+                                 app_key="replay", keep_alive=lambda: None)
+        config = AsyncCaptureConfig(host=server.host, port=server.port, ssl=False, buffer_size=2)
+        async_capture = AsyncCapture(config, streams, {"fields": ["EX_ALL_OFFERS"]}, output,
+                                     SessionManager(client))
+        task = asyncio.create_task(async_capture.run())
+        while async_capture.metrics["changes"] < 6:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await server.stop()
+        return async_capture
+
+    async_capture = asyncio.run(capture())
+    (stream,) = async_capture.streams
+    assert (stream.initial_clk, stream.clk, stream.change_count) == ("0", "6", 6)
+    # The buffered changes are written when the capture stops
+    for market_id in MARKETS:
+        assert list(output.iter_market(EVENT, market_id)) == \
+            list(source.iter_market(EVENT, market_id))
+    record = next(output.iter_market_records(EVENT, MARKETS[0]))
+    assert record.clk == "1" and record.receive_time is not None
+
+
+def test_failure_status_closes_the_connection():
+    AsyncMarketStream._check_status({"op": "status", "statusCode": "SUCCESS"})
+    with pytest.raises(StreamProtocolError, match="INVALID_SESSION_INFORMATION"):
+        AsyncMarketStream._check_status({"op": "status", "statusCode": "FAILURE",
+                                         "errorCode": "INVALID_SESSION_INFORMATION"})
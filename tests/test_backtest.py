@@ -0,0 +1,144 @@
+import pytest
+
+from backtest.broker import BACK, LAY, SimulatedBroker
+from backtest.engine import Backtest
+from backtest.strategy import Strategy
+from order_book.runner_order_book import RunnerOrderBook
+
+MARKET, RUNNER = "1.200000001", 1096
+
+
+def book(atb=(), atl=()):
+    runner_book = RunnerOrderBook(RUNNER)
+    runner_book.apply(0, {"id": RUNNER, "atb": [list(level) for level in atb],
+                          "atl": [list(level) for level in atl]})
+    return {MARKET: {RUNNER: runner_book}}
+
+
+def test_runner_change_is_applied_like_a_packet():
+    changes = [{"id": RUNNER, "ltp": 2.0, "tv": 10, "atb": [[1.99, 5]], "trd": [[2.0, 10]]},
+               {"id": RUNNER, "atb": [[1.99, 0], [1.98, 3]], "atl": [[2.02, 4]]},
+               {"id": RUNNER, "ltp": 2.02, "tv": 14, "trd": [[2.02, 4]]}]
+    applied, updated = RunnerOrderBook(RUNNER), RunnerOrderBook(RUNNER)
+    for timestamp, change in enumerate(changes):
+        applied.apply(timestamp, change)
+        updated.update(timestamp, {"rc": [{"id": 7}, change]})
+        assert vars(applied) == vars(updated)
+    assert applied.atb_book == {1.98: 3} and applied.delta_tv == 4
+
+
+def test_orders_match_the_book_once():
+    broker = SimulatedBroker(latency_ms=100)
+    books = book(atb=[(2.0, 10), (2.2, 4)])
+    first = broker.place_order(0, MARKET, RUNNER, BACK, 2.0, 6)
+    second = broker.place_order(0, MARKET, RUNNER, BACK, 2.0, 10)
+    assert not broker.has_pending(50) and broker.activate(50, books) == []
+
+    assert broker.activate(100, books) == [first, second]
+    assert first.fills == [(100, 2.2, 4), (100, 2.0, 2)]
+    assert first.status == "EXECUTION_COMPLETE"
+    # Only the volume left by the first order is available to the second one
+    assert second.fills == [(100, 2.0, 8)]
+    assert (second.status, second.size_remaining) == ("EXECUTABLE", 2)
+
+
+def test_book_volume_is_shared_until_the_level_changes():
+    broker = SimulatedBroker()
+    books = book(atl=[(3.0, 5)])
+    first = broker.place_order(0, MARKET, RUNNER, LAY, 3.0, 4)
+    second = broker.place_order(0, MARKET, RUNNER, LAY, 3.0, 4)
+    broker.activate(0, books)
+    assert (first.size_matched, second.size_matched) == (4, 1)
+    assert second.status == "EXECUTABLE"
+
+    books[MARKET][RUNNER].apply(10, {"id": RUNNER, "atl": [[3.0, 6]]})
+    third = broker.place_order(10, MARKET, RUNNER, LAY, 3.0, 10)
+    broker.activate(10, books)
+    assert third.size_matched == 6
+
+
+def test_queue_position():
+    broker = SimulatedBroker()
+    # The back order rests on the lay side behind 10 already queued at its price
+    order = broker.place_order(0, MARKET, RUNNER, BACK, 2.0, 5)
+    broker.activate(0, book(atb=[(1.9, 10)], atl=[(2.0, 10)]))
+    assert order.status == "EXECUTABLE" and order.queue_ahead == 10
+
+    assert broker.on_prints(MARKET, [(10, RUNNER, 2.0, 8)]) == []
+    assert order.queue_ahead == 2
+    assert broker.on_prints(MARKET, [(20, RUNNER, 2.0, 4)]) == [order]
+    assert order.fills == [(20, 2.0, 2)]
+    broker.on_prints(MARKET, [(30, RUNNER, 2.0, 10)])
+    assert order.fills[-1] == (30, 2.0, 3) and order.status == "EXECUTION_COMPLETE"
+
+
+def test_through_prints_fill_up_to_their_size():
+    broker = SimulatedBroker()
+    orders = [broker.place_order(0, MARKET, RUNNER, BACK, price, 5) for price in (2.1, 2.0)]
+    lay = broker.place_order(0, MARKET, RUNNER, LAY, 2.4, 5)
+    broker.activate(0, book())
+
+    broker.on_prints(MARKET, [(10, RUNNER, 2.2, 7)])
+    # The best priced back order is matched first, the lay order is on the other side
+    assert [order.size_matched for order in orders] == [2, 5]
+    assert lay.size_matched == 5
+    assert orders[1].fills == [(10, 2.0, 5)]
+    broker.on_prints(MARKET, [(20, RUNNER, 1.8, 1)])
+    assert orders[0].size_matched == 2
+
+
+def test_cancelled_orders_are_not_matched():
+    broker = SimulatedBroker(latency_ms=100)
+    pending = broker.place_order(0, MARKET, RUNNER, BACK, 2.0, 5)
+    broker.cancel_order(pending.order_id)
+    assert broker.activate(100, book(atb=[(2.0, 10)])) == []
+    assert pending.status == "CANCELLED" and pending.size_matched == 0
+
+    resting = broker.place_order(100, MARKET, RUNNER, BACK, 3.0, 5)
+    broker.activate(200, book(atb=[(2.0, 10)]))
+    broker.on_prints(MARKET, [(250, RUNNER, 3.2, 2)])
+    broker.cancel_order(resting.order_id)
+    assert broker.on_prints(MARKET, [(300, RUNNER, 3.2, 10)]) == []
+    assert (resting.status, resting.size_matched) == ("CANCELLED", 2)
+
+    with pytest.raises(ValueError):
+        broker.place_order(0, MARKET, RUNNER, "SELL", 2.0, 5)
+    with pytest.raises(ValueError):
+        broker.place_order(0, MARKET, RUNNER, BACK, 2.0, 0)
+
+
+class BackOnce(Strategy):
+    def __init__(self, **params):
+        super().__init__(**params)
+        self.fills = []
+
+    def on_market_book(self, backtest, books):
+        if backtest.now == 1000:
+            backtest.place_order(books.market_id, RUNNER, BACK, self.params["price"], 10)
+
+    def on_fill(self, backtest, order):
+        self.fills.append((backtest.now, order.size_matched))
+
+    def on_finish(self, backtest):
+        return {"fills": self.fills}
+
+
+def test_backtest_replays_the_packets():
+    runners = [{"id": RUNNER, "status": "ACTIVE"}, {"id": 58805, "status": "ACTIVE"}]
+    packets = [
+        (1000, MARKET, {"id": MARKET, "img": True, "marketDefinition": {"runners": runners},
+                        "rc": [{"id": RUNNER, "atb": [[2.0, 4]], "atl": [[2.1, 20]],
+                                "trd": [[2.0, 100]]}]}),
+        (1050, MARKET, {"id": MARKET, "rc": [{"id": RUNNER, "trd": [[2.2, 3]]}]}),
+        (1200, MARKET, {"id": MARKET, "rc": [{"id": RUNNER, "trd": [[2.2, 8]]}]}),
+        (1300, MARKET, {"id": MARKET, "marketDefinition": {"status": "CLOSED", "runners": [
+            {"id": RUNNER, "status": "WINNER"}, {"id": 58805, "status": "LOSER"}]}}),
+    ]
+
+    result = Backtest(BackOnce(price=2.0), latency_ms=100).run(packets)
+
+    # The order reaches the exchange at 1200: 4 from the book, then 5 of the print through it
+    assert result["fills"] == [(1200, 4), (1200, 9)]
+    assert (result["packets"], result["orders"], result["size_matched"]) == (4, 1, 9)
+    assert result["profit"] == pytest.approx(9 * (2.0 - 1))
+    assert result["params"] == {"price": 2.0}
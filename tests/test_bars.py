@@ -0,0 +1,65 @@
+import pytest
+
+from order_book.bars import BarBuilder, build_market_bars, parse_interval
+from stream.bar_stage import BarConfig, BarStage, load_market_bars
+
+EVENT, MARKET, RUNNER = "32000001", "1.200000001", 1096
+
+
+def runner_change(img=False, **change):
+    packet = {"id": MARKET, "rc": [dict(id=RUNNER, **change)]}
+    return dict(packet, img=True) if img else packet
+
+
+def test_parse_interval():
+    assert [parse_interval(interval) for interval in ["1s", "10s", "1m", "2h"]] == \
+        [1000, 10000, 60000, 7200000]
+    with pytest.raises(ValueError):
+        parse_interval("1d")
+
+
+def test_image_volume_is_not_a_trade():
+    packets = [
+        (1000, runner_change(img=True, ltp=2.0, trd=[[2.0, 3000], [2.1, 2000]])),
+        (1500, runner_change(ltp=2.0, trd=[[2.0, 3010]])),
+    ]
+    (bar,) = build_market_bars(MARKET, packets, ["1s"])
+
+    assert (bar.volume, bar.vwap, bar.updates) == (10, 2.0, 2)
+
+
+def test_bars_of_every_interval():
+    builder = BarBuilder(["1s", "10s"])
+    assert builder.update(MARKET, 1000, runner_change(img=True, ltp=2.0, trd=[[2.0, 100]],
+                                                      atb=[[1.98, 5]], atl=[[2.02, 5]])) == []
+    builder.update(MARKET, 1200, runner_change(ltp=2.2, trd=[[2.2, 10]]))
+    builder.update(MARKET, 1400, runner_change(ltp=1.9, trd=[[1.9, 30]]))
+
+    (second,) = builder.update(MARKET, 2100, runner_change(ltp=2.0, trd=[[2.0, 110]]))
+    assert (second.interval, second.start) == ("1s", 1000)
+    assert (second.open, second.high, second.low, second.close) == (2.0, 2.2, 1.9, 1.9)
+    assert second.volume == 40 and second.vwap == pytest.approx((2.2 * 10 + 1.9 * 30) / 40)
+    assert (second.best_back, second.best_lay, second.updates) == (1.98, 2.02, 3)
+
+    completed = builder.flush(MARKET)
+    assert [(bar.interval, bar.start, bar.volume) for bar in completed] == \
+        [("1s", 2000, 10), ("10s", 0, 50)]
+    assert builder.flush() == []
+
+
+def test_total_volume_without_the_traded_ladder():
+    packets = [(1000, runner_change(img=True, ltp=2.0, tv=500)),
+               (1100, runner_change(ltp=2.5, tv=520))]
+    (bar,) = build_market_bars(MARKET, packets, ["1s"])
+    assert (bar.volume, bar.vwap) == (20, 2.5)
+
+
+def test_bar_stage_stores_the_bars(data_location, market_book):
+    stage = BarStage(BarConfig(intervals=["1s"], publish=False), data_location)
+    stage.process(market_book(MARKET, 1000, runner_change(ltp=2.0, trd=[[2.0, 10]])))
+    stage.process(market_book(MARKET, 2000, runner_change(ltp=2.1, trd=[[2.1, 5]])))
+    stage.close()
+
+    bars = load_market_bars(data_location, EVENT, MARKET, "1s")
+    assert [(bar["start"], bar["volume"]) for bar in bars] == [(1000, 10), (2000, 5)]
+    assert load_market_bars(data_location, EVENT, "1.999", "1s") == []
@@ -0,0 +1,55 @@
+import json
+import os
+
+from stream.storage.capture import (CaptureRecord, decode_line, decode_record, encode_record,
+                                    iter_records)
+from stream.writer.stream_writer import MarketFileBuffer
+
+EVENT, MARKET = "32000001", "1.200000001"
+
+
+def test_record_round_trip():
+    record = CaptureRecord(3, 1000, 1005, "clk3", {"id": MARKET, "rc": [{"id": 1096, "ltp": 2.0}]})
+    line = encode_record(record)
+    assert line.endswith("\n") and line.count("\n") == 1
+    assert json.loads(line) == {"seq": 3, "pt": 1000, "rt": 1005, "clk": "clk3",
+                                "mc": record.update}
+    assert decode_record(line) == record
+    assert decode_line(line) == (1000, record.update)
+
+
+def test_legacy_lines_are_not_numbered():
+    line = json.dumps({"1000": {"id": MARKET}}) + "\n"
+    assert decode_record(line) == CaptureRecord(None, 1000, None, None, {"id": MARKET})
+    assert decode_line(line) == (1000, {"id": MARKET})
+    # Numbered records without receive time and clock
+    numbered = decode_record('{"seq": 1, "pt": 1000, "mc": {}}')
+    assert numbered == CaptureRecord(1, 1000, None, None, {})
+    assert [record.sequence for record in iter_records([line, "\n", line.strip()])] == [None, None]
+
+
+def test_packets_sharing_a_publish_time_are_kept(data_location, market_book):
+    buffer = MarketFileBuffer(MARKET, data_location, max_size=100)
+    for idx, publish_time in enumerate([1000, 1000, 1010]):
+        buffer.push(market_book(MARKET, publish_time, {"id": MARKET, "rc": [{"id": idx}]},
+                                receive_time=publish_time + 5, clk=f"clk{idx}"))
+    buffer.write()
+    # Records are numbered after the packets of previous runs
+    buffer = MarketFileBuffer(MARKET, data_location, max_size=100)
+    buffer.push(market_book(MARKET, 1010, {"id": MARKET, "rc": [{"id": 3}]}))
+    buffer.write()
+
+    records = list(data_location.iter_market_records(EVENT, MARKET))
+    assert [(record.sequence, record.publish_time, record.clk) for record in records] == \
+        [(1, 1000, "clk0"), (2, 1000, "clk1"), (3, 1010, "clk2"), (4, 1010, None)]
+    assert [record.update["rc"][0]["id"] for record in records] == [0, 1, 2, 3]
+    assert records[0].receive_time == 1005
+
+
+def test_legacy_parsed_market_file(data_location):
+    file_path = os.path.join(data_location.data_path, EVENT, f"{MARKET}.json")
+    with open(file_path, "w") as file:
+        json.dump({"mcm": {"1000": {"id": MARKET}, "1010": {"id": MARKET, "rc": []}}}, file)
+
+    records = list(data_location.iter_market_records(EVENT, MARKET, start=1005))
+    assert records == [CaptureRecord(None, 1010, None, None, {"id": MARKET, "rc": []})]
@@ -0,0 +1,143 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from stream.storage.catalog import Catalog
+
+EVENT = {"id": "32000001", "name": "Arsenal v Chelsea", "openDate": "2023-02-14T19:00:00.000Z"}
+MARKETS = [
+    {"marketId": "1.200000002", "marketName": "Over/Under 2.5 Goals",
+     "marketStartTime": "2023-02-14T20:00:00.000Z",
+     "description": {"marketType": "OVER_UNDER_25"},
+     "runners": [{"selectionId": 47972, "runnerName": "Under 2.5 Goals"},
+                 {"selectionId": 47973, "runnerName": "Over 2.5 Goals"}]},
+    {"marketId": "1.200000001", "marketName": "Match Odds",
+     "marketStartTime": "2023-02-14T19:00:00.000Z",
+     "description": {"marketType": "MATCH_ODDS"},
+     "runners": [{"selectionId": 1096, "runnerName": "Arsenal"},
+                 {"selectionId": 58805, "runnerName": "The Draw"}]},
+]
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(os.path.join(tmp_path, "catalog.db"))
+    yield catalog
+    catalog.close()
+
+
+def test_event_round_trip(catalog):
+    catalog.add_event(EVENT, MARKETS)
+
+    assert not catalog.is_empty()
+    assert catalog.get_events() == {EVENT["id"]: EVENT["name"]}
+    event = catalog.get_event(EVENT["id"])
+    assert event["event"] == EVENT
+    # Markets are ordered by start time
+    assert event["markets"] == [MARKETS[1], MARKETS[0]]
+    assert catalog.get_markets(selection_id=47973) == [MARKETS[0]]
+    assert catalog.get_markets(date=datetime(2023, 2, 14)) == [MARKETS[1], MARKETS[0]]
+    assert catalog.get_markets(date=datetime(2023, 2, 15)) == []
+    assert catalog.get_market_event_id("1.200000001") == EVENT["id"]
+
+    with pytest.raises(KeyError):
+        catalog.get_event("32000002")
+
+
+def test_add_event_updates_in_place(catalog):
+    catalog.add_event(EVENT, MARKETS)
+    renamed = dict(MARKETS[0], marketName="Over/Under 2.5")
+    catalog.add_event(dict(EVENT, name="Arsenal v Chelsea (Live)"), [renamed])
+
+    assert catalog.get_events() == {EVENT["id"]: "Arsenal v Chelsea (Live)"}
+    assert catalog.get_markets(event_id=EVENT["id"]) == [MARKETS[1], renamed]
+
+
+def test_record_capture_accumulates(catalog):
+    path = os.path.join(EVENT["id"], "1.200000001.txt")
+    catalog.record_capture(path, EVENT["id"], "1.200000001", 100, 2, 1000, 2000)
+    catalog.record_capture(path, EVENT["id"], "1.200000001", 50, 1, 3000, 3000)
+    catalog.record_capture(path, EVENT["id"], "1.200000001", 0, 0, None, None)
+
+    assert catalog.get_capture_files(market_id="1.200000001") == [{
+        "path": path, "event_id": EVENT["id"], "market_id": "1.200000001", "file_format": "txt",
+        "byte_size": 150, "packet_count": 3, "first_timestamp": 1000, "last_timestamp": 3000,
+    }]
+    assert catalog.get_capture_files(file_format="json") == []
+
+
+def test_replace_captures_combines_statistics(catalog):
+    segments = [os.path.join(EVENT["id"], f"1.200000001.{sequence:05d}.txt")
+                for sequence in range(2)]
+    catalog.record_capture(segments[0], EVENT["id"], "1.200000001", 100, 2, 1000, 2000)
+    catalog.record_capture(segments[1], EVENT["id"], "1.200000001", 100, 3, 2500, 4000)
+    compressed = segments[0] + ".zst"
+    catalog.replace_captures([segments[0]], compressed, 40)
+    parsed = os.path.join(EVENT["id"], "1.200000001.json")
+    catalog.replace_captures([compressed, segments[1]], parsed, 500)
+
+    assert catalog.get_capture_files() == [{
+        "path": parsed, "event_id": EVENT["id"], "market_id": "1.200000001", "file_format": "json",
+        "byte_size": 500, "packet_count": 5, "first_timestamp": 1000, "last_timestamp": 4000,
+    }]
+
+
+def test_catalog_persists_across_connections(tmp_path):
+    db_path = os.path.join(tmp_path, "catalog.db")
+    catalog = Catalog(db_path)
+    with catalog.transaction():
+        catalog.add_event(EVENT, MARKETS)
+        catalog.record_capture("32000001/1.200000001.txt", EVENT["id"], "1.200000001", 10, 1, 5, 5)
+        catalog.save_market_stats(EVENT["id"], "1.200000001", {"packet_count": 1})
+    catalog.save_cached_report("1.200000001", "key", {"marketId": "1.200000001"})
+    catalog.close()
+
+    reopened = Catalog(db_path)
+    assert reopened.get_event(EVENT["id"])["markets"] == [MARKETS[1], MARKETS[0]]
+    assert reopened.get_capture_files()[0]["byte_size"] == 10
+    assert reopened.get_market_stats("1.200000001") == {"packet_count": 1}
+    assert reopened.get_event_market_stats(EVENT["id"]) == {"1.200000001": {"packet_count": 1}}
+    assert reopened.get_cached_report("1.200000001", "key") == {"marketId": "1.200000001"}
+    assert reopened.get_cached_report("1.200000001", "other key") is None
+    assert reopened._fetch_one("PRAGMA journal_mode")[0] == "wal"
+    reopened.close()
+
+
+def test_failed_transaction_is_rolled_back(catalog):
+    with pytest.raises(ValueError):
+        with catalog.transaction():
+            catalog.add_event(EVENT, MARKETS)
+            catalog.record_capture("32000001/1.200000001.txt", EVENT["id"], "1.200000001", 10, 1,
+                                   5, 5)
+            raise ValueError("write failed")
+
+    assert catalog.is_empty()
+    assert catalog.get_capture_files() == []
+
+
+def test_import_legacy(tmp_path):
+    with open(os.path.join(tmp_path, "eventLog.json"), "w") as file:
+        json.dump({EVENT["id"]: EVENT["name"], "32000002": "Missing folder"}, file)
+    os.makedirs(os.path.join(tmp_path, EVENT["id"]))
+    with open(os.path.join(tmp_path, EVENT["id"], "eventIndex.json"), "w") as file:
+        json.dump({"event": EVENT, "markets": MARKETS}, file)
+    # Capture written before the records were numbered, with a partially written last line
+    with open(os.path.join(tmp_path, EVENT["id"], "1.200000001.txt"), "w") as file:
+        file.write('{"1000": {"id": "1.200000001"}}\n{"3000": {"id": "1.200000001"}}\n'
+                   '{"2000": {"id": "1.200000001"}}\n{"4000": {"id"')
+    with open(os.path.join(tmp_path, EVENT["id"], "1.200000002.json"), "w") as file:
+        json.dump({"mcm": {"5000": {"id": "1.200000002"}, "6000": {"id": "1.200000002"}}}, file)
+
+    catalog = Catalog(os.path.join(tmp_path, "catalog.db"))
+    catalog.import_legacy(str(tmp_path))
+
+    assert catalog.get_events() == {EVENT["id"]: EVENT["name"], "32000002": "Missing folder"}
+    assert catalog.get_event(EVENT["id"])["markets"] == [MARKETS[1], MARKETS[0]]
+    captures = {capture["market_id"]: capture for capture in catalog.get_capture_files()}
+    assert [(captures[market_id]["packet_count"], captures[market_id]["first_timestamp"],
+             captures[market_id]["last_timestamp"]) for market_id in sorted(captures)] == \
+        [(3, 1000, 3000), (2, 5000, 6000)]
+    assert captures["1.200000002"]["file_format"] == "json"
+    catalog.close()
@@ -0,0 +1,124 @@
+import json
+import os
+
+import pytest
+
+from stream.checkpoint import (CheckpointConfig, StreamCheckpoint, StreamPosition,
+                               subscription_key)
+
+SUBSCRIPTION = subscription_key({"market_type_codes": ["MATCH_ODDS"]}, ["EX_BEST_OFFERS"], None)
+CAPTURE = os.path.join("32000001", "1.200000001.txt")
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    os.makedirs(os.path.join(tmp_path, "32000001"))
+    with open(os.path.join(tmp_path, CAPTURE), "wb") as file:
+        file.write(b"x" * 100)
+    return str(tmp_path)
+
+
+def checkpoint_stream(data_path):
+    """ Checkpoints two positions of a stream, the second one is not flushed """
+    checkpoint = StreamCheckpoint(data_path, CheckpointConfig(min_interval_sec=0))
+    checkpoint.start_stream("football", SUBSCRIPTION)
+    checkpoint.add_position(1, StreamPosition("football", "init", "clk1",
+                                              market_ids=("1.200000001",)))
+    checkpoint.add_position(3, StreamPosition("football", "init", "clk2"))
+    checkpoint.update(2, {"1.200000001": (CAPTURE, 100)})
+    return checkpoint
+
+
+def test_from_config():
+    assert CheckpointConfig.from_config({}) is None
+    assert CheckpointConfig.from_config({"checkpoint": {"enabled": False}}) is None
+    assert CheckpointConfig.from_config({"checkpoint": {"min_interval_sec": 5}}) == \
+        CheckpointConfig(min_interval_sec=5)
+
+
+def test_only_flushed_positions_are_checkpointed(data_path):
+    checkpoint = checkpoint_stream(data_path)
+
+    with open(checkpoint.file_path) as file:
+        saved = json.load(file)
+    assert saved["streams"]["football"]["clk"] == "clk1"
+    assert saved["streams"]["football"]["market_ids"] == ["1.200000001"]
+    assert saved["writers"] == {"1.200000001": {"path": CAPTURE, "offset": 100}}
+
+    checkpoint.update(3, {})
+    with open(checkpoint.file_path) as file:
+        assert json.load(file)["streams"]["football"]["clk"] == "clk2"
+
+
+def test_writes_are_rate_limited(data_path):
+    checkpoint = StreamCheckpoint(data_path, CheckpointConfig(min_interval_sec=3600))
+    checkpoint.start_stream("football", SUBSCRIPTION)
+    checkpoint.add_position(1, StreamPosition("football", "init", "clk1"))
+    checkpoint.update(1, {})
+    checkpoint.add_position(2, StreamPosition("football", "init", "clk2"))
+    checkpoint.update(2, {})
+    with open(checkpoint.file_path) as file:
+        assert json.load(file)["streams"]["football"]["clk"] == "clk1"
+
+    checkpoint.update(2, {}, force=True)
+    with open(checkpoint.file_path) as file:
+        assert json.load(file)["streams"]["football"]["clk"] == "clk2"
+
+
+def test_resume_position(data_path):
+    checkpoint_stream(data_path)
+
+    resumed = StreamCheckpoint(data_path, CheckpointConfig())
+    position = resumed.resume_position("football", SUBSCRIPTION)
+    assert (position["initial_clk"], position["clk"]) == ("init", "clk1")
+    assert position["market_ids"] == ["1.200000001"]
+    assert resumed.resume_position("tennis", SUBSCRIPTION) is None
+    other_subscription = subscription_key({"market_type_codes": ["OVER_UNDER_25"]},
+                                          ["EX_BEST_OFFERS"], None)
+    assert resumed.resume_position("football", other_subscription) is None
+
+
+def test_no_resume_from_truncated_capture(data_path):
+    checkpoint_stream(data_path)
+    with open(os.path.join(data_path, CAPTURE), "r+b") as file:
+        file.truncate(50)
+
+    resumed = StreamCheckpoint(data_path, CheckpointConfig())
+    assert resumed.resume_position("football", SUBSCRIPTION) is None
+
+
+def test_resume_from_compressed_capture(data_path):
+    checkpoint_stream(data_path)
+    os.rename(os.path.join(data_path, CAPTURE), os.path.join(data_path, CAPTURE + ".zst"))
+
+    resumed = StreamCheckpoint(data_path, CheckpointConfig())
+    assert resumed.resume_position("football", SUBSCRIPTION) is not None
+
+
+def test_changed_subscription_clears_the_stream(data_path):
+    checkpoint = checkpoint_stream(data_path)
+    other_subscription = subscription_key({}, ["EX_BEST_OFFERS"], 500)
+    checkpoint.start_stream("football", other_subscription)
+    assert checkpoint.streams["football"] == {"subscription": other_subscription}
+    assert checkpoint.resume_position("football", other_subscription) is None
+
+
+def test_unreadable_checkpoint_is_ignored(data_path):
+    with open(os.path.join(data_path, "checkpoint.json"), "w") as file:
+        file.write("{")
+    checkpoint = StreamCheckpoint(data_path, CheckpointConfig())
+    assert checkpoint.streams == {}
+    assert checkpoint.resume_position("football", SUBSCRIPTION) is None
+
+
+def test_clocks_of_another_conflation_are_not_resumed(data_path):
+    checkpoint = checkpoint_stream(data_path)
+    conflated = subscription_key({"market_type_codes": ["MATCH_ODDS"]}, ["EX_BEST_OFFERS"], 500)
+    checkpoint.add_position(4, StreamPosition("football", "init", "clk3",
+                                              subscription=conflated))
+    checkpoint.update(4, {})
+
+    resumed = StreamCheckpoint(data_path, CheckpointConfig())
+    assert resumed.streams["football"]["subscription"] == conflated
+    assert resumed.resume_position("football", SUBSCRIPTION) is None
+    assert resumed.resume_position("football", conflated)["clk"] == "clk3"
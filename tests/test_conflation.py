@@ -0,0 +1,125 @@
+import os
+import queue
+from types import SimpleNamespace
+
+import pytest
+
+from stream import conflation
+from stream.conflation import ConflationConfig, ConflationController
+from stream.storage.catalog import Catalog
+
+
+class FakeStream:
+    """ Running stream recording its conflation changes """
+
+    def __init__(self, stream_name, priority, market_ids):
+        self.stream_name = stream_name
+        self.priority = priority
+        self.market_ids = market_ids
+        self.conflate_ms = None
+
+    def set_conflation(self, conflate_ms):
+        self.conflate_ms = conflate_ms
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(os.path.join(tmp_path, "catalog.db"))
+    yield catalog
+    catalog.close()
+
+
+@pytest.fixture
+def controller(catalog, monkeypatch):
+    """ Controller of three streams, the clock of the windows advances by 1000 ms per call """
+    clock = iter(range(1000, 100000, 1000))
+    monkeypatch.setattr(conflation, "_now_ms", lambda: next(clock))
+    streams = [FakeStream("football", 0, ["1.1"]), FakeStream("tennis", -1, ["1.2"]),
+               FakeStream("racing", 1, ["1.3"])]
+    scheduler = SimpleNamespace(output_queue=queue.Queue(), active_streams=streams)
+    lag = {"seconds": 0.0}
+    config = ConflationConfig(adaptive=True, degraded_conflate_ms=500, high_queue_depth=3,
+                              low_queue_depth=1, hold_sec=0)
+    controller = ConflationController(config, scheduler, lambda: lag["seconds"], catalog)
+    controller.lag = lag
+    return controller
+
+
+def set_queue_depth(controller, depth):
+    output_queue = controller.scheduler.output_queue
+    while not output_queue.empty():
+        output_queue.get()
+    for _ in range(depth):
+        output_queue.put([])
+
+
+def test_from_config():
+    assert ConflationConfig.from_config({}) == ConflationConfig()
+    config = ConflationConfig.from_config({"conflation": {"adaptive": True, "hold_sec": 5,
+                                                          "unknown": 1}})
+    assert config.adaptive and config.hold_sec == 5
+    with pytest.raises(ValueError):
+        ConflationConfig.from_config({"conflation": {"degraded_conflate_ms": 200000}})
+    with pytest.raises(ValueError):
+        ConflationConfig.from_config({"conflation": {"low_lag_sec": 10, "high_lag_sec": 5}})
+
+
+def test_lowest_priority_streams_are_degraded_first(controller, catalog):
+    football, tennis, racing = controller.scheduler.active_streams
+    set_queue_depth(controller, 3)
+    controller.check()
+    assert controller.degraded == [tennis] and tennis.conflate_ms == 500
+    controller.check()
+    assert controller.degraded == [tennis, football]
+    # Streams above `max_priority` are never degraded
+    controller.check()
+    assert controller.degraded == [tennis, football] and racing.conflate_ms is None
+
+    # Neither degraded nor restored between the thresholds
+    set_queue_depth(controller, 2)
+    controller.check()
+    assert len(controller.degraded) == 2
+
+    set_queue_depth(controller, 0)
+    controller.check()
+    assert controller.degraded == [tennis] and football.conflate_ms is None
+    controller.check()
+    assert controller.degraded == [] and tennis.conflate_ms is None
+
+    windows = catalog.get_conflation_windows("1.2")
+    assert [(window["stream_name"], window["conflate_ms"], window["start_time"],
+             window["end_time"]) for window in windows] == [("tennis", 500, 2000, 5000)]
+
+
+def test_lag_degrades_and_restores(controller):
+    controller.lag["seconds"] = 6.0
+    controller.check()
+    assert [stream.stream_name for stream in controller.degraded] == ["tennis"]
+    controller.lag["seconds"] = 2.0
+    controller.check()
+    assert len(controller.degraded) == 1
+    controller.lag["seconds"] = 0.5
+    controller.check()
+    assert controller.degraded == []
+
+
+def test_changes_are_held(controller):
+    controller.config.hold_sec = 3600
+    set_queue_depth(controller, 3)
+    controller.check()
+    controller.check()
+    assert len(controller.degraded) == 1
+
+
+def test_new_markets_of_degraded_streams_are_recorded(controller, catalog):
+    tennis = controller.scheduler.active_streams[1]
+    set_queue_depth(controller, 3)
+    controller.check()
+    tennis.market_ids = ["1.2", "1.4"]
+    set_queue_depth(controller, 2)
+    controller.check()
+    assert catalog.get_conflation_windows("1.4")[0]["start_time"] == 3000
+
+    controller.stop()
+    assert all(catalog.get_conflation_windows(market_id)[0]["end_time"] == 4000
+               for market_id in ("1.2", "1.4"))
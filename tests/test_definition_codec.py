@@ -0,0 +1,115 @@
+import copy
+import json
+import os
+
+import pytest
+
+from stream.storage.definition_codec import (DEFINITION_REF, DefinitionDecoder, DefinitionEncoder,
+                                             apply_definition_diff, definition_id,
+                                             diff_definition)
+
+
+def runner(selection_id, status="ACTIVE", **kwargs):
+    return {"id": selection_id, "status": status, "sortPriority": selection_id, **kwargs}
+
+
+BASE = {
+    "status": "OPEN",
+    "inPlay": False,
+    "betDelay": 0,
+    "marketTime": "2023-02-14T20:00:00.000Z",
+    "regulators": ["MR_INT"],
+    "runners": [runner(1), runner(2), runner(3)],
+}
+
+DEFINITIONS = {
+    "unchanged": BASE,
+    "changed key": dict(BASE, inPlay=True, betDelay=5),
+    "added key": dict(BASE, suspendTime="2023-02-14T20:00:00.000Z"),
+    "removed key": {key: value for key, value in BASE.items() if key != "regulators"},
+    "changed runner": dict(BASE, runners=[runner(1), runner(2, "REMOVED", adjustmentFactor=12.5),
+                                          runner(3)]),
+    "added runner": dict(BASE, runners=BASE["runners"] + [runner(4)]),
+    "truncated runners": dict(BASE, runners=BASE["runners"][:1]),
+    "reordered runners": dict(BASE, runners=list(reversed(BASE["runners"]))),
+    "empty runners": dict(BASE, runners=[]),
+    "removed runners": {key: value for key, value in BASE.items() if key != "runners"},
+}
+
+
+@pytest.mark.parametrize("name", DEFINITIONS)
+def test_diff_is_lossless(name):
+    definition = DEFINITIONS[name]
+    base = copy.deepcopy(BASE)
+
+    diff = diff_definition(base, definition)
+    # Diffs are stored as JSON
+    rebuilt = apply_definition_diff(base, json.loads(json.dumps(diff)))
+
+    assert rebuilt == definition
+    assert base == BASE
+
+
+@pytest.mark.parametrize("name", DEFINITIONS)
+def test_diff_from_missing_runners_is_lossless(name):
+    base = DEFINITIONS["removed runners"]
+    definition = DEFINITIONS[name]
+    assert apply_definition_diff(base, diff_definition(base, definition)) == definition
+
+
+def test_diff_only_holds_changes():
+    changed = DEFINITIONS["changed runner"]["runners"][1]
+    diff = diff_definition(BASE, DEFINITIONS["changed runner"])
+    assert diff == {"set": {}, "unset": [], "runners": {"length": 3, "set": {"1": changed}}}
+    assert diff_definition(BASE, BASE) == {"set": {}, "unset": []}
+
+
+def test_rebuilt_definition_does_not_share_the_diff():
+    diff = diff_definition(BASE, DEFINITIONS["changed runner"])
+    rebuilt = apply_definition_diff(BASE, diff)
+    rebuilt["runners"][1]["status"] = "WINNER"
+    assert diff["runners"]["set"]["1"]["status"] == "REMOVED"
+
+
+def test_encoder_decoder_round_trip(tmp_path):
+    defs_path = os.path.join(tmp_path, "1.200000001.defs")
+    updates = [{"id": "1.200000001", "marketDefinition": definition}
+               for definition in DEFINITIONS.values()]
+    updates.insert(1, {"id": "1.200000001", "rc": [{"id": 1, "ltp": 2.0}]})
+    updates.append({"id": "1.200000001", "marketDefinition": BASE})
+
+    encoder = DefinitionEncoder(defs_path)
+    encoded = [json.loads(json.dumps(encoder.encode(update))) for update in updates]
+    encoder.flush()
+
+    assert encoded[0]["marketDefinition"] == {DEFINITION_REF: definition_id(BASE)}
+    assert encoded[1] == updates[1]
+    with open(defs_path) as file:
+        entries = [json.loads(line) for line in file]
+    # Every distinct definition is stored once, some of them as diffs
+    assert len(entries) == len({definition_id(definition) for definition in DEFINITIONS.values()})
+    assert any("diff" in entry for entry in entries)
+
+    decoder = DefinitionDecoder(defs_path)
+    assert [decoder.decode(update) for update in encoded] == updates
+
+
+def test_decoder_reads_definitions_appended_later(tmp_path):
+    defs_path = os.path.join(tmp_path, "1.200000001.defs")
+    encoder = DefinitionEncoder(defs_path)
+    first = encoder.encode({"id": "1.200000001", "marketDefinition": BASE})
+    encoder.flush()
+    decoder = DefinitionDecoder(defs_path)
+    assert decoder.decode(first)["marketDefinition"] == BASE
+
+    # A restarted encoder reuses the definitions of the sidecar file
+    encoder = DefinitionEncoder(defs_path)
+    assert encoder.encode({"id": "1.200000001", "marketDefinition": BASE}) == first
+    assert encoder._pending == []
+    definition = DEFINITIONS["changed key"]
+    second = encoder.encode({"id": "1.200000001", "marketDefinition": definition})
+    encoder.flush()
+    assert decoder.decode(second)["marketDefinition"] == definition
+
+    with pytest.raises(KeyError):
+        decoder.decode({"marketDefinition": {DEFINITION_REF: "0" * 16}})
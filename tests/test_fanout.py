@@ -0,0 +1,104 @@
+import json
+import socket
+
+import pytest
+
+from stream.fanout import FanOutConfig, FanOutServer, _Subscriber, subscribe
+
+MARKETS = ["1.200000001", "1.200000002"]
+
+
+def runner_change(market_id, ltp):
+    return {"id": market_id, "rc": [{"id": 1096, "ltp": ltp, "atb": [[ltp, 10]]}]}
+
+
+def definition(market_id, status):
+    return {"id": market_id, "marketDefinition": {"status": status}}
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = FanOutServer(FanOutConfig(socket_path=str(tmp_path / "fanout.sock"), max_pending=3))
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def subscriber(server):
+    """ Subscriber to all markets on one end of a socket pair, its messages are serialized by hand
+    instead of the server thread """
+    connection, other = socket.socketpair()
+    subscriber = _Subscriber(connection)
+    subscriber.market_ids = None
+    server.subscribers[connection.fileno()] = subscriber
+    yield subscriber
+    connection.close()
+    other.close()
+
+
+def serialized(server, subscriber):
+    server._serialize(subscriber)
+    messages = [json.loads(line) for line in bytes(subscriber.out).splitlines()]
+    subscriber.out.clear()
+    return messages
+
+
+def test_deltas_are_queued_in_order(server, subscriber, market_book):
+    server.process(market_book(MARKETS[0], 1000, runner_change(MARKETS[0], 2.0)))
+    server.process(market_book(MARKETS[1], 1100, runner_change(MARKETS[1], 3.0)))
+
+    messages = serialized(server, subscriber)
+    assert [(message["type"], message["market_id"], message["pt"]) for message in messages] == \
+        [("delta", MARKETS[0], 1000), ("delta", MARKETS[1], 1100)]
+    assert messages[0]["rc"] == runner_change(MARKETS[0], 2.0)["rc"]
+
+
+def test_slow_subscribers_get_snapshots_and_keep_bars(server, subscriber, market_book):
+    server.broadcast(MARKETS[0], {"type": "bar", "market_id": MARKETS[0], "time": 0})
+    for publish_time in range(1000, 5000, 1000):
+        server.process(market_book(MARKETS[0], publish_time,
+                                   runner_change(MARKETS[0], publish_time / 1000)))
+    assert subscriber.conflations == 1 and MARKETS[0] in subscriber.stale
+    # Bars of a stale market are still queued, its deltas are part of the snapshot
+    server.broadcast(MARKETS[0], {"type": "bar", "market_id": MARKETS[0], "time": 1000})
+    server.process(market_book(MARKETS[0], 5000, runner_change(MARKETS[0], 5.0)))
+
+    messages = serialized(server, subscriber)
+    assert [message["type"] for message in messages] == ["snapshot", "bar", "bar"]
+    assert [message["time"] for message in messages[1:]] == [0, 1000]
+    snapshot = messages[0]
+    assert snapshot["pt"] == 5000 and snapshot["runners"]["1096"]["ltp"] == 5.0
+    assert subscriber.pending_count == 0 and not subscriber.stale
+
+
+def test_closed_markets_are_dropped(server, subscriber, market_book):
+    server.process(market_book(MARKETS[0], 1000, definition(MARKETS[0], "OPEN")))
+    server.process(market_book(MARKETS[1], 1000, definition(MARKETS[1], "OPEN")))
+    serialized(server, subscriber)
+    subscriber.stale.add(MARKETS[0])
+
+    server.process(market_book(MARKETS[0], 2000, definition(MARKETS[0], "CLOSED")))
+    assert list(server.books) == [MARKETS[1]]
+
+    messages = serialized(server, subscriber)
+    # The stale subscriber gets the final snapshot of the closed market
+    closed = [message for message in messages if message["market_id"] == MARKETS[0]]
+    assert [message["type"] for message in closed] == ["snapshot"]
+    assert closed[0]["marketDefinition"]["status"] == "CLOSED"
+
+
+def test_subscribe_starts_with_a_snapshot(server, market_book):
+    server.process(market_book(MARKETS[0], 1000, runner_change(MARKETS[0], 2.0)))
+    server.process(market_book(MARKETS[1], 1000, runner_change(MARKETS[1], 3.0)))
+    server.start()
+
+    messages = subscribe(server.config.socket_path, [MARKETS[0]])
+    snapshot = next(messages)
+    assert (snapshot["type"], snapshot["market_id"]) == ("snapshot", MARKETS[0])
+    assert snapshot["runners"]["1096"]["atb"] == [[2.0, 10]]
+
+    server.process(market_book(MARKETS[1], 2000, runner_change(MARKETS[1], 3.1)))
+    server.process(market_book(MARKETS[0], 2000, runner_change(MARKETS[0], 2.1)))
+    delta = next(messages)
+    assert (delta["type"], delta["market_id"], delta["pt"]) == ("delta", MARKETS[0], 2000)
+    messages.close()
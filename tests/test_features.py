@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from order_book.features import build_market_features, feature_columns
+
+MARKET, RUNNER = "1.200000001", 1096
+MARKET_TIME = "1970-01-01T00:00:10.000Z"
+
+
+def runner_change(img=False, **change):
+    packet = {"id": MARKET, "rc": [dict(id=RUNNER, **change)]}
+    return dict(packet, img=True) if img else packet
+
+
+def definition(in_play):
+    return {"id": MARKET, "marketDefinition": {"inPlay": in_play, "marketTime": MARKET_TIME}}
+
+
+PACKETS = [
+    (500, definition(False)),
+    (1000, runner_change(img=True, ltp=2.0, tv=5000, trd=[[2.0, 3000], [2.1, 2000]],
+                         atb=[[1.97, 1], [1.98, 2], [1.99, 3]], atl=[[2.02, 4], [2.04, 5]])),
+    (1500, runner_change(ltp=2.1, tv=5010, trd=[[2.1, 2010]])),
+    (3200, runner_change(ltp=2.2, tv=5030, trd=[[2.2, 20]], atb=[[1.99, 0]])),
+    (3500, definition(True)),
+]
+
+
+def test_feature_rows():
+    features = build_market_features(PACKETS, interval_ms=1000, depth=2, return_lags=(1, 2))
+
+    assert list(features) == feature_columns(2, (1, 2))
+    assert features["time"].tolist() == [1000, 2000, 3000]
+    assert features["selection_id"].tolist() == [RUNNER] * 3
+    # The volume of the image was traded before the capture started
+    assert features["traded_volume"].tolist() == [10, 0, 20]
+    assert features["total_volume"].tolist() == [5010, 5010, 5030]
+    # The book of the last bucket is carried forward, best price first
+    assert features["back_price_1"].tolist() == [1.99, 1.99, 1.98]
+    assert features["back_size_2"].tolist() == [2, 2, 1]
+    assert features["lay_price_2"].tolist() == [2.04] * 3
+    assert features["ltp"].tolist() == [2.1, 2.1, 2.2]
+    assert np.isnan(features["ltp_return_1"][0])
+    assert features["ltp_return_2"][2] == pytest.approx(np.log(2.2 / 2.1))
+    assert features["traded_volume_1"][1:].tolist() == [0, 20]
+    # Market state as of the end of each interval
+    assert features["in_play"].tolist() == [False, False, True]
+    assert features["time_to_off"].tolist() == [9, 8, 7]
+
+
+def test_rows_before_the_off():
+    features = build_market_features(PACKETS, interval_ms=1000, max_time_to_off_ms=7500)
+    assert features["time"].tolist() == [2000, 3000]
+
+
+def test_market_without_runner_changes():
+    features = build_market_features([(500, definition(False))], depth=1, return_lags=(1,))
+    assert list(features) == feature_columns(1, (1,))
+    assert all(len(column) == 0 for column in features.values())
+    assert features["in_play"].dtype == bool
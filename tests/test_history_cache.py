@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pytest
+
+from order_book.history_cache import HistoryCache, HistoryCacheConfig
+from order_book.order_book_history import MarketOrderBookHistory
+from stream.writer.stream_writer import MarketFileBuffer
+
+EVENT, MARKET = "32000001", "1.200000001"
+RUNNERS = [1096, 58805]
+
+
+def write_packets(data_location, market_book, publish_times):
+    buffer = MarketFileBuffer(MARKET, data_location, max_size=100)
+    for publish_time in publish_times:
+        buffer.push(market_book(MARKET, publish_time, {"id": MARKET, "rc": [
+            {"id": 1096, "ltp": publish_time / 1000, "tv": publish_time,
+             "atb": [[1.9, 10], [2.0, publish_time / 100]], "atl": [[2.1, 5]]}]}))
+    buffer.write()
+
+
+@pytest.fixture
+def history_cache(data_location, market_book):
+    write_packets(data_location, market_book, [1000, 2000, 3000])
+    return HistoryCache(data_location, HistoryCacheConfig(depth=1))
+
+
+def test_from_config():
+    assert HistoryCacheConfig.from_config({}) == HistoryCacheConfig()
+    assert HistoryCacheConfig.from_config({"history_cache": {"max_mb": 5}}).max_mb == 5
+
+
+def test_cached_history_matches_the_replay(history_cache, data_location):
+    history = history_cache.get(EVENT, MARKET, RUNNERS)
+    assert (history_cache.hits, history_cache.misses) == (0, 1)
+    assert history_cache.get(EVENT, MARKET, RUNNERS).runner_ids == RUNNERS
+    assert (history_cache.hits, history_cache.misses) == (1, 1)
+
+    replayed = MarketOrderBookHistory(RUNNERS)
+    for publish_time, update in data_location.iter_market(EVENT, MARKET):
+        replayed.update(publish_time, update)
+    runner, expected = history.get_runner_history(1096), replayed.get_runner_order_book(1096)
+    assert isinstance(runner.ltp, np.memmap) and len(history) == 3
+    np.testing.assert_array_equal(runner.timestamps, expected.timestamps)
+    np.testing.assert_array_equal(runner.ltp, expected.ltp_history)
+    np.testing.assert_array_equal(runner.delta_tv, expected.delta_tv_history)
+    # Only the best level is kept with a depth of 1
+    assert runner.atb_price.tolist() == [[2.0]] * 3
+    assert runner.atb_volume[:, 0].tolist() == [10, 20, 30]
+    assert runner.atl_price.tolist() == [[2.1]] * 3
+    assert len(history.get_runner_history(58805).ltp) == 3
+
+
+def test_window_and_max_records(history_cache):
+    window = history_cache.get(EVENT, MARKET, RUNNERS, start=1500, end=3000)
+    assert window.get_runner_history(1096).timestamps.tolist() == [2000, 3000]
+    limited = history_cache.get(EVENT, MARKET, RUNNERS, max_records=1)
+    assert len(limited) == 1
+    empty = history_cache.get(EVENT, MARKET, RUNNERS, start=5000)
+    assert len(empty.get_runner_history(1096)) == 0
+    assert len(history_cache.entries()) == 3
+
+
+def test_grown_capture_replaces_its_entries(history_cache, data_location, market_book):
+    history_cache.get(EVENT, MARKET, RUNNERS)
+    history_cache.get(EVENT, MARKET, RUNNERS, start=1500, end=3000)
+    key = history_cache.cache_key(EVENT, MARKET, RUNNERS)
+
+    write_packets(data_location, market_book, [4000])
+    grown = history_cache.get(EVENT, MARKET, RUNNERS)
+    assert len(grown) == 4 and history_cache.misses == 3
+    (entry_path, _, _), = history_cache.entries()
+    assert os.path.basename(entry_path) == history_cache.cache_key(EVENT, MARKET, RUNNERS) != key
+
+
+def test_least_recently_used_entries_are_evicted(history_cache):
+    history_cache.get(EVENT, MARKET, RUNNERS, max_records=1)
+    history_cache.get(EVENT, MARKET, RUNNERS, max_records=2)
+    entry_size = max(byte_size for _, byte_size, _ in history_cache.entries())
+    history_cache.config.max_mb = 2.5 * entry_size / 1024 / 1024
+    oldest, newest = [entry_path for entry_path, _, _ in history_cache.entries()]
+    os.utime(oldest, (0, 0))
+
+    history_cache.get(EVENT, MARKET, RUNNERS)
+    entries = [entry_path for entry_path, _, _ in history_cache.entries()]
+    assert oldest not in entries and newest in entries and len(entries) == 2
+
+
+def test_damaged_entry_is_replayed(history_cache):
+    history_cache.get(EVENT, MARKET, RUNNERS)
+    (entry_path, _, _), = history_cache.entries()
+    os.remove(os.path.join(entry_path, "ltp.npy"))
+
+    assert len(history_cache.get(EVENT, MARKET, RUNNERS)) == 3
+    assert history_cache.misses == 2
@@ -0,0 +1,100 @@
+import os
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import main
+import utils.configure
+from stream.storage.capture import iter_capture_file
+from stream.storage.data_location import DataLocation
+from stream.writer.stream_writer import MarketStreamHandler
+
+EVENT = {"id": "32000001", "name": "Arsenal v Chelsea", "openDate": "2023-02-14T19:00:00.000Z"}
+MARKET = {"marketId": "1.200000001", "marketName": "Match Odds",
+          "marketStartTime": "2023-02-14T20:00:00.000Z",
+          "description": {"marketType": "MATCH_ODDS"},
+          "runners": [{"selectionId": 1096, "runnerName": "Arsenal"}]}
+
+
+class StubBetting:
+    def list_events(self, filter, lightweight):
+        return [{"event": EVENT}]
+
+    def list_market_catalogue(self, filter, **kwargs):
+        return [MARKET] if filter["eventIds"] == [EVENT["id"]] else []
+
+
+class StubClient:
+    """ API client which never reaches Betfair """
+
+    def __init__(self):
+        self.betting = StubBetting()
+        self.session_token = "token"
+        self.session_expired = False
+        self.logins = 0
+        self.logged_out = False
+
+    def login(self):
+        self.logins += 1
+
+    def keep_alive(self):
+        pass
+
+    def logout(self):
+        self.logged_out = True
+
+
+class ScriptedQueue:
+    """ Output queue of the scheduler, stops the stream like Ctrl+C once its packets are read """
+
+    def __init__(self, items):
+        self.items = list(items)
+
+    def get(self, timeout=None):
+        if not self.items:
+            raise KeyboardInterrupt
+        return self.items.pop(0)
+
+
+def market_book(publish_time):
+    return SimpleNamespace(
+        market_id=MARKET["marketId"],
+        publish_time=datetime.fromtimestamp(publish_time / 1000, timezone.utc),
+        publish_time_epoch=publish_time,
+        streaming_update={"id": MARKET["marketId"], "rc": [{"id": 1096, "ltp": 2.0}]},
+    )
+
+
+def test_run_stream(tmp_path, monkeypatch):
+    client = StubClient()
+    monkeypatch.setattr(utils.configure, "create_api_client", lambda: client)
+    process_packets = MarketStreamHandler.process_packets
+    publish_times = [1676401200000, 1676401200100, 1676401200200]
+
+    def process_scripted_packets(handler, output_queue, **kwargs):
+        assert handler.checkpoint is not None
+        books = ScriptedQueue([[market_book(publish_time)] for publish_time in publish_times])
+        process_packets(handler, books, **kwargs)
+
+    monkeypatch.setattr(MarketStreamHandler, "process_packets", process_scripted_packets)
+    data_dir = str(tmp_path / "data")
+    config = {
+        "paths": {"data_dir": data_dir},
+        # Never started by the scheduler
+        "streams": [{"start_time": "01/01/99 00:00:00", "stream_name": "Arsenal v Chelsea",
+                     "market_filter": {"event_ids": [EVENT["id"]],
+                                       "market_type_codes": ["MATCH_ODDS"]}}],
+        "market_data_filter": ["EX_BEST_OFFERS", "EX_MARKET_DEF"],
+        "checkpoint": {"enabled": True},
+    }
+
+    main.run_stream(config, force_run_flag=True)
+
+    assert client.logins == 1
+    assert client.logged_out
+    data_location = DataLocation(data_dir, [])
+    assert data_location.load_events() == {EVENT["id"]: EVENT["name"]}
+    capture_path = os.path.join(data_dir, EVENT["id"], f"{MARKET['marketId']}.txt")
+    records = list(iter_capture_file(capture_path))
+    assert [record.publish_time for record in records] == publish_times
+    capture = data_location.catalog.get_capture_files(market_id=MARKET["marketId"])[0]
+    assert capture["packet_count"] == 3
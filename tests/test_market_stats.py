@@ -0,0 +1,87 @@
+from stream.storage.market_stats import MISSING_DATA_GAP_MS, MarketStats
+from stream.writer.stream_writer import MarketFileBuffer
+from utils.report import compute_market_stats, generate_market_report
+
+EVENT, MARKET = "32000001", "1.200000001"
+OPEN = {"status": "OPEN", "runners": [{"id": 1096}, {"id": 58805}]}
+PACKETS = [
+    (1000, {"id": MARKET, "marketDefinition": OPEN}),
+    (1050, {"id": MARKET, "rc": [{"id": 1096, "ltp": 2.0}]}),
+    (1550, {"id": MARKET, "rc": [{"id": 7, "ltp": 3.0}]}),
+    (1550, {"id": MARKET, "rc": [{"id": 1096, "ltp": 2.1}]}),
+    (1550 + MISSING_DATA_GAP_MS + 1,
+     {"id": MARKET, "marketDefinition": {"status": "CLOSED", "runners": []}}),
+]
+
+
+def test_running_statistics():
+    stats = MarketStats()
+    for publish_time, packet in PACKETS:
+        stats.update(publish_time, packet, byte_size=10)
+
+    assert stats.packet_count == 5
+    assert (stats.first_timestamp, stats.last_timestamp) == (1000, PACKETS[-1][0])
+    assert stats.gap_total_ms == PACKETS[-1][0] - 1000
+    assert stats.max_gap_ms == MISSING_DATA_GAP_MS + 1
+    # Gaps of 50, 500, 0 and over 10 minutes
+    assert stats.gap_histogram == [2, 1, 0, 0, 0, 1]
+    assert stats.runner_ids == {1096, 58805, 7}
+    assert stats.bytes_written == 50
+    assert stats.is_closed and stats.contains_missing_data
+    assert len(MarketStats.histogram_labels()) == len(stats.gap_histogram)
+
+    restored = MarketStats.from_dict(stats.to_dict())
+    assert restored.to_dict() == stats.to_dict()
+    assert restored.runner_ids == {1096, 58805, 7}
+
+
+def test_writer_keeps_statistics_across_restarts(data_location, market_book):
+    buffer = MarketFileBuffer(MARKET, data_location, max_size=100)
+    for publish_time, packet in PACKETS[:3]:
+        buffer.push(market_book(MARKET, publish_time, packet))
+    buffer.write()
+    # A restarted writer continues from the statistics of the catalog
+    buffer = MarketFileBuffer(MARKET, data_location, max_size=100)
+    for publish_time, packet in PACKETS[3:]:
+        buffer.push(market_book(MARKET, publish_time, packet))
+    buffer.write()
+
+    saved = data_location.catalog.get_market_stats(MARKET)
+    computed = compute_market_stats(EVENT, MARKET, data_location)
+    capture = data_location.catalog.get_capture_files(market_id=MARKET)[0]
+    assert saved["bytes_written"] == capture["byte_size"]
+    # Statistics computed from the capture only lack the byte count
+    assert dict(saved, bytes_written=0) == computed.to_dict()
+
+
+def test_market_report_from_the_catalog(data_location, market_book):
+    market_info = data_location.load_event(EVENT)["markets"][0]
+    assert generate_market_report(EVENT, market_info, data_location)["timestamp_count"] == 0
+
+    buffer = MarketFileBuffer(MARKET, data_location, max_size=100)
+    for publish_time, packet in PACKETS:
+        buffer.push(market_book(MARKET, publish_time, packet))
+    buffer.write()
+
+    report = generate_market_report(EVENT, market_info, data_location)
+    assert report["timestamp_count"] == 5
+    assert report["record_length_sec"] == (PACKETS[-1][0] - 1000) / 1000
+    assert report["contains_market_closure"] and report["contains_missing_data"]
+    assert report["max_timestamp_diff"] == MISSING_DATA_GAP_MS + 1
+    assert report["timestamp_diff_histogram"]["<=100ms"] == 2
+    assert (report["num_runners"], report["num_runners_recorded"]) == (2, 3)
+
+
+def test_market_report_backfills_the_statistics(data_location, market_book):
+    buffer = MarketFileBuffer(MARKET, data_location, max_size=100)
+    for publish_time, packet in PACKETS:
+        buffer.push(market_book(MARKET, publish_time, packet))
+    buffer.write()
+    # Captured before the writer kept statistics
+    data_location.catalog._connection.execute("DELETE FROM market_stats")
+
+    market_info = data_location.load_event(EVENT)["markets"][0]
+    report = generate_market_report(EVENT, market_info, data_location)
+
+    assert report["timestamp_count"] == 5
+    assert data_location.catalog.get_market_stats(MARKET)["packet_count"] == 5
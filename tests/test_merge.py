@@ -0,0 +1,85 @@
+import os
+
+from stream.storage.capture import CaptureRecord, encode_record, iter_capture_file
+from stream.storage.data_location import DataLocation
+from stream.storage.merge import merge_market_copies
+from stream.storage.offset_index import OffsetIndex
+from stream.storage.segments import index_file_name
+
+EVENT, MARKET = "32000001", "1.200000001"
+
+
+def make_copy(path, updates):
+    """ Data location holding one capture of the market, `updates` are (publish time, update) """
+    data_location = DataLocation(str(path), [])
+    os.makedirs(os.path.join(data_location.data_path, EVENT))
+    records = [CaptureRecord(sequence, publish_time, publish_time + 5, f"clk{sequence}", update)
+               for sequence, (publish_time, update) in enumerate(updates, start=1)]
+    lines = [encode_record(record) for record in records]
+    with open(os.path.join(data_location.data_path, EVENT, f"{MARKET}.txt"), "w") as file:
+        file.writelines(lines)
+    data_location.record_capture(EVENT, MARKET, f"{MARKET}.txt", len("".join(lines)), len(records),
+                                 updates[0][0], updates[-1][0])
+    return data_location
+
+
+def packet(idx):
+    return {"id": MARKET, "rc": [{"id": 1, "ltp": 2.0 + idx / 100}]}
+
+
+PACKETS = [(1000 + 10 * idx, packet(idx)) for idx in range(10)]
+
+
+def test_merge_drops_duplicates_and_fills_gaps(tmp_path):
+    # The first copy misses packets 3 and 4, the second misses packet 8
+    first = make_copy(tmp_path / "first", [item for idx, item in enumerate(PACKETS)
+                                           if idx not in (3, 4)])
+    second = make_copy(tmp_path / "second", [item for idx, item in enumerate(PACKETS)
+                                             if idx != 8])
+    output = str(tmp_path / "merged")
+
+    report = merge_market_copies([first, second], EVENT, MARKET, output, index_interval=4)
+
+    merged = list(iter_capture_file(os.path.join(output, EVENT, f"{MARKET}.txt")))
+    assert [(record.publish_time, record.update) for record in merged] == PACKETS
+    assert [record.sequence for record in merged] == list(range(1, 11))
+    assert report["packets_written"] == 10
+    assert report["duplicates_dropped"] == 7
+    assert (report["first_timestamp"], report["last_timestamp"]) == (1000, 1090)
+    assert report["byte_size"] == os.path.getsize(os.path.join(output, EVENT, f"{MARKET}.txt"))
+    assert report["sources"] == {
+        first.data_path: {"packets_read": 8, "missing_packets": 2, "gap_count": 1,
+                          "gaps": [{"start": 1030, "end": 1040, "packets": 2}]},
+        second.data_path: {"packets_read": 9, "missing_packets": 1, "gap_count": 1,
+                           "gaps": [{"start": 1080, "end": 1080, "packets": 1}]},
+    }
+
+    index = OffsetIndex(index_file_name(os.path.join(output, EVENT, f"{MARKET}.txt")))
+    assert list(index.timestamps) == [1000, 1040, 1080]
+    assert not os.path.exists(os.path.join(output, EVENT, f"{MARKET}.txt.merge"))
+
+
+def test_merge_keeps_packets_repeated_within_a_copy(tmp_path):
+    repeated = PACKETS[:2] + [PACKETS[1]] + PACKETS[2:]
+    first = make_copy(tmp_path / "first", PACKETS)
+    second = make_copy(tmp_path / "second", repeated)
+
+    report = merge_market_copies([first, second], EVENT, MARKET, str(tmp_path / "merged"))
+
+    merged = list(iter_capture_file(str(tmp_path / "merged" / EVENT / f"{MARKET}.txt")))
+    assert [(record.publish_time, record.update) for record in merged] == repeated
+    assert report["duplicates_dropped"] == 10
+    assert report["sources"][first.data_path]["missing_packets"] == 1
+    assert report["sources"][second.data_path]["missing_packets"] == 0
+
+
+def test_merge_skips_copies_missing_the_market(tmp_path):
+    first = make_copy(tmp_path / "first", PACKETS)
+    empty = DataLocation(str(tmp_path / "empty"), [])
+
+    report = merge_market_copies([empty, first], EVENT, MARKET, str(tmp_path / "merged"))
+
+    assert list(report["sources"]) == [first.data_path]
+    assert report["packets_written"] == 10
+    assert report["duplicates_dropped"] == 0
+    assert report["sources"][first.data_path]["gaps"] == []
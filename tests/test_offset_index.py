@@ -0,0 +1,78 @@
+import os
+
+from stream.storage.offset_index import INDEX_ENTRY, OffsetIndex, OffsetIndexWriter
+
+
+def write_capture(tmp_path, timestamps, interval):
+    """ Writes one line per publish time to a capture file and indexes it """
+    capture_path = os.path.join(tmp_path, "1.200000001.txt")
+    index_path = capture_path + ".idx"
+    writer = OffsetIndexWriter(index_path, interval=interval)
+    with open(capture_path, "wb") as file:
+        for timestamp in timestamps:
+            writer.add(timestamp, file.tell())
+            file.write(f"{timestamp}\n".encode())
+    writer.flush()
+    return capture_path, index_path
+
+
+def read_from(capture_path, offset):
+    with open(capture_path, "rb") as file:
+        file.seek(offset)
+        return [int(line) for line in file]
+
+
+def test_writer_indexes_every_interval(tmp_path):
+    timestamps = list(range(1000, 1250, 10))
+    capture_path, index_path = write_capture(tmp_path, timestamps, interval=10)
+
+    index = OffsetIndex(index_path)
+    assert len(index) == 3
+    assert list(index.timestamps) == [1000, 1100, 1200]
+    for timestamp, offset in zip(index.timestamps, index.offsets):
+        assert read_from(capture_path, offset)[0] == timestamp
+
+
+def test_writer_indexes_first_packet_after_restart(tmp_path):
+    index_path = os.path.join(tmp_path, "1.200000001.txt.idx")
+    writer = OffsetIndexWriter(index_path, interval=10)
+    for offset, timestamp in enumerate(range(1000, 1005)):
+        writer.add(timestamp, offset)
+    writer.flush()
+    # Nothing pending, nothing appended
+    writer.flush()
+
+    writer = OffsetIndexWriter(index_path, interval=10)
+    writer.add(2000, 50)
+    assert len(OffsetIndex(index_path)) == 1
+    writer.flush()
+
+    index = OffsetIndex(index_path)
+    assert list(index.timestamps) == [1000, 2000]
+    assert list(index.offsets) == [0, 50]
+
+
+def test_seek_offset_reads_all_packets_from_timestamp(tmp_path):
+    # Repeated publish times across an index entry
+    timestamps = sorted([1000 + 10 * (idx // 3) for idx in range(60)])
+    capture_path, index_path = write_capture(tmp_path, timestamps, interval=4)
+    index = OffsetIndex(index_path)
+
+    for start in [0, 1000, 1005, 1010, 1100, 1190, 1200]:
+        lines = read_from(capture_path, index.seek_offset(start))
+        expected = [timestamp for timestamp in timestamps if timestamp >= start]
+        assert [timestamp for timestamp in lines if timestamp >= start] == expected
+    assert index.seek_offset(1000) == 0
+    assert index.seek_offset(10 ** 15) == index.offsets[-1]
+
+
+def test_missing_or_truncated_index(tmp_path):
+    index_path = os.path.join(tmp_path, "1.200000001.txt.idx")
+    assert len(OffsetIndex(index_path)) == 0
+    assert OffsetIndex(index_path).seek_offset(1000) == 0
+
+    with open(index_path, "wb") as file:
+        file.write(INDEX_ENTRY.pack(1000, 0) + INDEX_ENTRY.pack(2000, 64)[:5])
+    index = OffsetIndex(index_path)
+    assert list(index.timestamps) == [1000]
+    assert index.seek_offset(5000) == 0
@@ -0,0 +1,75 @@
+import atexit
+import tracemalloc
+
+import pytest
+
+from utils import profiling
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    """ Profiling module with its global state restored after the test """
+    monkeypatch.setattr(profiling, "_enabled", False)
+    monkeypatch.setattr(profiling, "_memory", False)
+    monkeypatch.setattr(profiling, "_profiler", None)
+    monkeypatch.setattr(profiling, "_stats", {})
+    monkeypatch.setattr(atexit, "register", lambda function: None)
+    yield profiling
+    if profiling._profiler is not None:
+        profiling._profiler.disable()
+    if profiling._memory:
+        tracemalloc.stop()
+
+
+def add(a, b):
+    return a + b
+
+
+def test_hooks_cost_nothing_when_disabled(profiler):
+    assert profiler.profiled("add")(add) is add
+    assert profiler.span("block") is profiler.span("other")
+    with profiler.span("block"):
+        pass
+    assert profiler._stats == {}
+
+
+def test_spans(profiler, tmp_path):
+    profiler.enable()
+    timed_add = profiler.profiled("add")(add)
+    assert timed_add is not add and timed_add.__name__ == "add"
+    assert [timed_add(1, 2) for _ in range(3)] == [3] * 3
+    with profiler.span("block"):
+        pass
+
+    assert profiler._stats["add"].count == 3
+    assert profiler._stats["block"].count == 1
+    assert profiler._stats["add"].max_seconds <= profiler._stats["add"].seconds
+
+    file_path = tmp_path / "profile.txt"
+    profiler.log_summary(str(file_path))
+    lines = file_path.read_text().splitlines()
+    assert lines[0].split() == ["stage", "calls", "total", "s", "mean", "ms", "max", "ms"]
+    assert {line.split()[0]: int(line.split()[1]) for line in lines[1:]} == {"add": 3, "block": 1}
+
+
+def test_memory_mode(profiler):
+    profiler.enable("memory")
+    with profiler.span("allocate"):
+        data = [bytearray(1024) for _ in range(1000)]
+
+    assert profiler._stats["allocate"].allocated_bytes >= 1024 * 1000
+    text = profiler.summary(top=3)
+    assert "alloc MB" in text and "tracemalloc" in text
+    del data
+
+
+def test_cprofile_mode(profiler):
+    profiler.enable("cprofile")
+    profiler.profiled("add")(add)(1, 2)
+    assert "cProfile (main thread, cumulative time)" in profiler.summary()
+
+
+def test_invalid_mode(profiler):
+    with pytest.raises(ValueError):
+        profiler.enable("wall")
+    assert not profiler.is_enabled()
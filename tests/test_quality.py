@@ -0,0 +1,76 @@
+import pytest
+
+from stream.writer.stream_writer import MarketFileBuffer
+from utils.quality import SUSPENSION_WINDOW_MS, MarketColumnsBuilder, compute_market_quality
+from utils.report import generate_all_events_report
+
+MARKET = "1.200000001"
+
+
+def definition(status):
+    return {"id": MARKET, "marketDefinition": {"status": status}}
+
+
+def runner_change(*runner_ids):
+    return {"id": MARKET, "rc": [{"id": runner_id, "ltp": 2.0} for runner_id in runner_ids]}
+
+
+def test_quality_analytics():
+    columns = MarketColumnsBuilder()
+    packets = [
+        (0, definition("OPEN"), "1"),
+        (100, runner_change(1, 2), "2"),
+        (100, runner_change(1), "3"),
+        (1100, definition("SUSPENDED"), "3"),
+        (90, runner_change(2), "4"),
+        (1100 + SUSPENSION_WINDOW_MS * 2, definition("OPEN"), "5"),
+        (1200 + SUSPENSION_WINDOW_MS * 2, runner_change(1), "5"),
+    ]
+    for timestamp, packet, clk in packets:
+        columns.add(timestamp, packet, clk)
+
+    quality = compute_market_quality(columns)
+
+    assert quality["gap_ms"]["max"] == SUSPENSION_WINDOW_MS * 2 + 1010
+    # Positive gaps of 100, 1000, 121010 and 100 ms
+    assert quality["gap_ms"]["p50"] == pytest.approx(550)
+    assert quality["runner_update_counts"] == {"1": 3, "2": 2}
+    suspension, = quality["suspensions"]
+    assert (suspension["start"], suspension["end"]) == (1100, 1100 + SUSPENSION_WINDOW_MS * 2)
+    assert suspension["max_gap_around_suspend_ms"] == 1000
+    assert suspension["max_gap_around_resume_ms"] == SUSPENSION_WINDOW_MS * 2 + 1010
+    assert quality["anomalies"] == {
+        "publish_time_regressions": 1,
+        "duplicate_publish_times": 1,
+        "repeated_clk": 2,
+        "clk_unchanged_time_advanced": 2,
+    }
+    assert quality["packets_per_second"]["max"] == 4
+
+
+def test_clk_anomalies_need_the_clk():
+    columns = MarketColumnsBuilder()
+    columns.add(0, runner_change(1))
+    columns.add(100, runner_change(1), "1")
+    anomalies = compute_market_quality(columns)["anomalies"]
+    assert anomalies["repeated_clk"] is None and anomalies["clk_unchanged_time_advanced"] is None
+    assert compute_market_quality(MarketColumnsBuilder()) == {}
+
+
+def test_live_markets_have_partial_quality(data_location, market_book):
+    buffer = MarketFileBuffer(MARKET, data_location, max_size=100)
+    for timestamp, packet in [(1000, definition("OPEN")), (1200, runner_change(1)),
+                              (1500, runner_change(1))]:
+        buffer.push(market_book(MARKET, timestamp, packet))
+    buffer.write()
+
+    report = generate_all_events_report(data_location, workers=1)[0]["markets"][0]
+    assert report["quality"]["partial"]
+    assert report["quality"]["gap_ms"]["max"] == 300
+    assert report["quality"]["runner_update_counts"] == {"1": 2}
+
+    buffer.push(market_book(MARKET, 2000, definition("CLOSED")))
+    buffer.write()
+    report = generate_all_events_report(data_location, workers=1)[0]["markets"][0]
+    assert not report["quality"]["partial"]
+    assert report["quality"]["gap_ms"]["max"] == 500
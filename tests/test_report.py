@@ -0,0 +1,79 @@
+import json
+import os
+
+import pytest
+
+from stream.writer.stream_writer import MarketFileBuffer
+from utils import report as report_module
+from utils.report import generate_all_events_report, write_all_events_report
+
+EVENT = "32000001"
+MARKETS = ["1.200000001", "1.200000002"]
+
+
+def capture(data_location, market_book, market_id, publish_times, status="OPEN"):
+    buffer = MarketFileBuffer(market_id, data_location, max_size=100)
+    for publish_time in publish_times:
+        definition = {"status": status, "runners": [{"id": 1096}]}
+        buffer.push(market_book(market_id, publish_time,
+                                {"id": market_id, "marketDefinition": definition}))
+    buffer.write()
+
+
+@pytest.fixture
+def captured(data_location, market_book):
+    capture(data_location, market_book, MARKETS[0], [1000, 2000, 3000], status="CLOSED")
+    capture(data_location, market_book, MARKETS[1], [1000, 1500])
+    return data_location
+
+
+@pytest.fixture
+def report_tasks(monkeypatch):
+    """ Markets reported by the in-process report worker """
+    reported = []
+    market_report_task = report_module._market_report_task
+
+    def count_task(task):
+        reported.append(task[1]["marketId"])
+        return market_report_task(task)
+
+    monkeypatch.setattr(report_module, "_market_report_task", count_task)
+    return reported
+
+
+def test_report_of_every_market(captured):
+    (event_report,) = generate_all_events_report(captured, workers=1)
+
+    assert (event_report["event_id"], event_report["event_name"]) == (EVENT, "Arsenal v Chelsea")
+    reports = {report["market_id"]: report for report in event_report["markets"]}
+    assert [reports[market_id]["timestamp_count"] for market_id in MARKETS] == [3, 2]
+    assert reports[MARKETS[0]]["contains_market_closure"]
+    assert not reports[MARKETS[1]]["contains_market_closure"]
+
+
+def test_process_pool_gives_the_same_report(captured):
+    in_process = generate_all_events_report(captured, workers=1)
+    captured.catalog._connection.execute("DELETE FROM report_cache")
+
+    assert generate_all_events_report(captured, workers=2) == in_process
+
+
+def test_reports_are_cached_until_the_capture_changes(captured, market_book, report_tasks):
+    first = generate_all_events_report(captured, workers=1)
+    assert sorted(report_tasks) == MARKETS
+
+    assert generate_all_events_report(captured, workers=1) == first
+    assert sorted(report_tasks) == MARKETS
+
+    capture(captured, market_book, MARKETS[1], [4000])
+    (event_report,) = generate_all_events_report(captured, workers=1)
+    assert sorted(report_tasks) == MARKETS + [MARKETS[1]]
+    assert [report["timestamp_count"] for report in event_report["markets"]] == [3, 3]
+
+
+def test_write_all_events_report(captured):
+    write_all_events_report(captured, workers=1)
+
+    with open(os.path.join(captured.data_path, "report.json")) as file:
+        assert json.load(file) == generate_all_events_report(captured, workers=1)
+    assert not os.path.exists(os.path.join(captured.data_path, "report.json.tmp"))
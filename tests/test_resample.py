@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from order_book.resample import (RESOLUTIONS_MS, build_market_pyramid, build_runner_bars,
+                                 choose_resolution, downsample_bars, load_pyramid, lttb,
+                                 save_pyramid)
+
+MARKET, RUNNER = "1.200000001", 1096
+
+
+def runner_change(**change):
+    return {"id": MARKET, "rc": [dict(id=RUNNER, **change)]}
+
+
+PACKETS = [
+    # The image carries the volume traded before the capture started
+    (1000, dict(runner_change(ltp=2.0, tv=5000, trd=[[2.0, 3000], [2.1, 2000]],
+                              atb=[[1.99, 10]], atl=[[2.02, 20]]), img=True)),
+    (1500, runner_change(ltp=2.1, tv=5010, trd=[[2.0, 3010]])),
+    (2200, runner_change(ltp=1.9, tv=5040, trd=[[1.9, 30]])),
+    (2400, runner_change(ltp=2.2, tv=5045, trd=[[2.2, 5]])),
+    (12000, runner_change(ltp=2.0, tv=5045, atb=[[1.99, 0], [1.98, 5]])),
+]
+
+
+def test_image_volume_is_not_a_trade():
+    bars = build_runner_bars(PACKETS, 1000)[RUNNER]
+
+    assert bars.time.tolist() == [1000, 2000, 12000]
+    assert bars.volume.tolist() == [10, 35, 0]
+    assert bars.total_volume.tolist() == [5010, 5045, 5045]
+    assert bars.open.tolist() == [2.0, 1.9, 2.0]
+    assert (bars.high.tolist(), bars.low.tolist()) == ([2.1, 2.2, 2.0], [2.0, 1.9, 2.0])
+    assert bars.close.tolist() == [2.1, 2.2, 2.0]
+    assert bars.atb_price[-1, 0] == 1.98 and np.isnan(bars.atb_price[-1, 1])
+    assert bars.atl_price.shape == (3, 10)
+
+
+def test_total_volume_without_the_traded_ladder():
+    packets = [(1000, dict(runner_change(ltp=2.0, tv=5000), img=True)),
+               (1200, runner_change(ltp=2.0, tv=5010)),
+               (2100, runner_change(ltp=2.0, tv=5030))]
+    assert build_runner_bars(packets, 1000)[RUNNER].volume.tolist() == [10, 20]
+
+
+def test_downsample_bars():
+    bars = build_runner_bars(PACKETS, 1000)[RUNNER]
+    coarse = downsample_bars(bars, 10 * 1000)
+
+    assert coarse.time.tolist() == [0, 10000]
+    assert coarse.volume.tolist() == [45, 0]
+    assert (coarse.open.tolist(), coarse.close.tolist()) == ([2.0, 2.0], [2.2, 2.0])
+    assert (coarse.high.tolist(), coarse.low.tolist()) == ([2.2, 2.0], [1.9, 2.0])
+    assert coarse.total_volume.tolist() == [5045, 5045]
+    assert len(coarse.window(5000, 20000)) == 1
+
+
+def test_pyramid_round_trip(tmp_path):
+    pyramid = build_market_pyramid(PACKETS)
+    assert list(pyramid[RUNNER]) == list(RESOLUTIONS_MS)
+
+    path = str(tmp_path / "pyramid.npz")
+    save_pyramid(path, pyramid)
+    loaded = load_pyramid(path)
+
+    for label, bars in pyramid[RUNNER].items():
+        for name, column in vars(bars).items():
+            np.testing.assert_array_equal(getattr(loaded[RUNNER][label], name), column)
+
+
+def test_choose_resolution():
+    assert choose_resolution(60 * 1000, 100) == "1s"
+    assert choose_resolution(60 * 60 * 1000, 1000) == "10s"
+    assert choose_resolution(24 * 60 * 60 * 1000, 1000) == "1m"
+
+
+def test_lttb_keeps_the_extremes():
+    x = np.arange(100)
+    y = np.zeros(100)
+    y[30], y[70] = 10, -10
+
+    indices = lttb(x, y, 4)
+    assert indices.tolist() == [0, 30, 70, 99]
+    assert lttb(x, y, 200).tolist() == list(range(100))
+
+
+@pytest.mark.filterwarnings("error")
+def test_lttb_never_selects_nan_points():
+    x = np.arange(10)
+    y = np.array([0, np.nan, np.nan, 1, np.nan, np.nan, np.nan, np.nan, 2, 0], dtype=float)
+
+    # Buckets [1, 3), [3, 6) and [6, 9), only the first one has no finite point
+    assert lttb(x, y, 5).tolist() == [0, 1, 3, 8, 9]
+    assert lttb(x, np.full(10, np.nan), 5).tolist() == [0, 1, 3, 6, 9]
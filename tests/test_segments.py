@@ -0,0 +1,140 @@
+import gzip
+import os
+
+import pytest
+
+from stream.storage.retention import apply_retention, compact_segments
+from stream.storage.segments import (SegmentCompressor, SegmentPolicy, index_file_name,
+                                     segment_sequence, sort_segments)
+from stream.writer.stream_writer import MarketFileBuffer
+
+EVENT, MARKET = "32000001", "1.200000001"
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def write_segments(data_location, market_book, policy, batches, compressor=None, start=0):
+    """ Writes each batch of publish times with one buffer write, rolling a segment per write """
+    buffer = MarketFileBuffer(MARKET, data_location, max_size=100, segment_policy=policy,
+                              segment_compressor=compressor, index_interval=2)
+    publish_time = start
+    for batch_size in batches:
+        for _ in range(batch_size):
+            buffer.push(market_book(MARKET, publish_time, {"id": MARKET, "pt": publish_time}))
+            publish_time += 1000
+        buffer.write()
+    return buffer
+
+
+def publish_times(data_location, start=None):
+    return [record.publish_time
+            for record in data_location.iter_market_records(EVENT, MARKET, start=start)]
+
+
+def test_segment_names():
+    assert segment_sequence("32000001/1.200000001.00012.txt") == 12
+    assert segment_sequence("32000001/1.200000001.00012.txt.zst") == 12
+    assert segment_sequence("32000001/1.200000001.txt") == -1
+    assert index_file_name("1.200000001.00012.txt.gz") == "1.200000001.00012.idx"
+    assert sort_segments(["1.2.00001.txt.gz", "1.2.00000.txt.gz", "1.2.txt", "1.2.00002.txt"]) == \
+        ["1.2.txt", "1.2.00000.txt.gz", "1.2.00001.txt.gz", "1.2.00002.txt"]
+
+
+def test_policy_from_config():
+    assert SegmentPolicy.from_config({}) is None
+    policy = SegmentPolicy.from_config({"storage": {"segment_max_mb": 1, "compact_max_mb": 2,
+                                                    "compression": None}})
+    assert (policy.max_bytes, policy.compact_max_bytes, policy.compression) == \
+        (1024 * 1024, 2 * 1024 * 1024, None)
+    with pytest.raises(ValueError):
+        SegmentPolicy.from_config({"storage": {"compression": "lz4"}})
+
+
+def test_writer_rolls_segments(data_location, market_book):
+    policy = SegmentPolicy(max_bytes=1, compression=None)
+    write_segments(data_location, market_book, policy, [3, 2, 4])
+
+    segments = data_location.get_capture_files("txt", EVENT, MARKET)
+    assert [segment_sequence(path) for path in segments] == [0, 1, 2]
+    assert publish_times(data_location) == [idx * 1000 for idx in range(9)]
+    records = data_location.load_market(EVENT, MARKET)
+    assert [record.sequence for record in records] == list(range(1, 10))
+
+    # A restarted writer continues in a new segment and keeps numbering the records
+    write_segments(data_location, market_book, policy, [1], start=9000)
+    segments = data_location.get_capture_files("txt", EVENT, MARKET)
+    assert [segment_sequence(path) for path in segments] == [0, 1, 2, 3]
+    assert data_location.load_market(EVENT, MARKET)[-1].sequence == 10
+
+
+def test_sealed_segments_are_compressed(data_location, market_book):
+    policy = SegmentPolicy(max_bytes=1, compression="gzip")
+    compressor = SegmentCompressor("gzip")
+    compressor.start()
+    write_segments(data_location, market_book, policy, [3, 3, 3], compressor)
+    compressor.stop()
+
+    segments = data_location.get_capture_files("txt", EVENT, MARKET)
+    assert [os.path.basename(path) for path in segments] == \
+        [f"{MARKET}.00000.txt.gz", f"{MARKET}.00001.txt.gz", f"{MARKET}.00002.txt"]
+    assert not os.path.exists(segments[0][:-len(".gz")])
+    with gzip.open(segments[0]) as file:
+        assert len(file.readlines()) == 3
+    captures = data_location.catalog.get_capture_files(market_id=MARKET)
+    assert captures[0]["byte_size"] == os.path.getsize(segments[0])
+    assert [capture["packet_count"] for capture in captures] == [3, 3, 3]
+
+    assert publish_times(data_location) == [idx * 1000 for idx in range(9)]
+    # Windows seek into the compressed segments with their index
+    assert publish_times(data_location, start=4000) == [idx * 1000 for idx in range(4, 9)]
+
+
+def test_retention_expires_sealed_segments(data_location, market_book):
+    policy = SegmentPolicy(max_bytes=1, compression=None, retention_days=1)
+    write_segments(data_location, market_book, policy, [2, 2, 2])
+
+    # The open segment is kept whatever its age
+    apply_retention(data_location, policy, now=(5000 + 2 * DAY_MS) / 1000)
+    segments = data_location.get_capture_files("txt", EVENT, MARKET)
+    assert [segment_sequence(path) for path in segments] == [2]
+    assert not os.path.exists(index_file_name(os.path.join(data_location.data_path, EVENT,
+                                                           f"{MARKET}.00000.txt")))
+    assert publish_times(data_location) == [4000, 5000]
+
+    # Segments younger than the retention are kept
+    write_segments(data_location, market_book, policy, [1, 1], start=6000)
+    apply_retention(data_location, policy, now=(7000 + DAY_MS / 2) / 1000)
+    assert publish_times(data_location) == [4000, 5000, 6000, 7000]
+
+
+def test_compaction_merges_sealed_segments(data_location, market_book):
+    policy = SegmentPolicy(max_bytes=1, compression=None, compact_max_bytes=10 * 1024)
+    write_segments(data_location, market_book, policy, [3, 2, 4, 1])
+
+    apply_retention(data_location, policy)
+
+    segments = data_location.get_capture_files("txt", EVENT, MARKET)
+    assert [segment_sequence(path) for path in segments] == [0, 3]
+    assert not os.path.exists(os.path.join(data_location.data_path, EVENT, f"{MARKET}.00001.txt"))
+    captures = data_location.catalog.get_capture_files(market_id=MARKET)
+    assert [capture["packet_count"] for capture in captures] == [9, 1]
+    assert captures[0]["byte_size"] == os.path.getsize(segments[0])
+    assert publish_times(data_location) == [idx * 1000 for idx in range(10)]
+    assert publish_times(data_location, start=5000) == [idx * 1000 for idx in range(5, 10)]
+
+
+def test_compaction_keeps_the_legacy_capture_name(data_location, market_book):
+    # Capture written as a single file before segments were enabled
+    write_segments(data_location, market_book, None, [2])
+    policy = SegmentPolicy(max_bytes=1, compression="gzip")
+    write_segments(data_location, market_book, policy, [2], start=2000)
+
+    new_path = compact_segments(data_location, MARKET,
+                                [os.path.join(EVENT, f"{MARKET}.txt"),
+                                 os.path.join(EVENT, f"{MARKET}.00000.txt")], policy)
+
+    assert new_path == os.path.join(EVENT, f"{MARKET}.txt.gz")
+    assert [capture["path"] for capture in data_location.catalog.get_capture_files()] == [new_path]
+    assert os.path.exists(os.path.join(data_location.data_path, EVENT, f"{MARKET}.idx"))
+    assert not os.path.exists(os.path.join(data_location.data_path, EVENT, f"{MARKET}.00000.idx"))
+    assert publish_times(data_location) == [0, 1000, 2000, 3000]
+    assert publish_times(data_location, start=3000) == [3000]
@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+from betfairlightweight import BetfairError
+
+from stream import session as session_module
+from stream.session import SessionManager
+
+
+class FakeClient:
+    """ API client counting its requests, `login` issues a new token """
+
+    def __init__(self):
+        self.session_token = None
+        self.logins = 0
+        self.keep_alives = 0
+        self.keep_alive_fails = False
+
+    @property
+    def session_expired(self):
+        return self.session_token is None
+
+    def login(self):
+        time.sleep(0.01)
+        self.logins += 1
+        self.session_token = f"token{self.logins}"
+
+    def keep_alive(self):
+        self.keep_alives += 1
+        if self.keep_alive_fails:
+            raise BetfairError("INVALID_SESSION_INFORMATION")
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+def test_streams_starting_together_share_one_login(client):
+    manager = SessionManager(client)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(manager.ensure_session()))
+               for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == ["token1"] * 20
+    assert client.logins == manager.login_count == 1
+
+
+def test_stale_token_is_validated(client, monkeypatch):
+    manager = SessionManager(client)
+    manager.login()
+    # Validated recently, reconnecting streams reuse the token as is
+    assert manager.ensure_session("token1") == "token1"
+    assert client.keep_alives == 0
+
+    monkeypatch.setattr(session_module, "VALIDATION_INTERVAL_SEC", -1)
+    assert manager.ensure_session("token1") == "token1"
+    assert client.keep_alives == 1
+    # A token already replaced by another stream is not validated again
+    assert manager.ensure_session("token0") == "token1"
+    assert client.keep_alives == 1
+
+    client.keep_alive_fails = True
+    assert manager.ensure_session("token1") == "token2"
+    assert client.logins == 2
+
+
+def test_keep_alive_thread(client):
+    manager = SessionManager(client, keep_alive_interval_sec=0.01)
+    manager.login()
+    manager.start()
+    time.sleep(0.1)
+    manager.stop()
+    manager.join(1)
+    assert not manager.is_alive() and client.keep_alives > 0
@@ -0,0 +1,74 @@
+import uuid
+
+import pytest
+
+from stream import shared_books
+from stream.shared_books import SharedBookConfig, SharedBookReader, SharedBookWriter
+
+MARKETS = ["1.200000001", "1.200000002"]
+
+
+def runner_change(market_id, *runner_ids, img=False):
+    changes = [{"id": runner_id, "ltp": 2.0, "tv": 100.0 * runner_id,
+                "atb": [[1.98, 5], [1.99, 10]], "atl": [[2.02, 20], [2.04, 30]]}
+               for runner_id in runner_ids]
+    return dict({"id": market_id, "rc": changes}, **({"img": True} if img else {}))
+
+
+def closed(market_id):
+    return {"id": market_id, "marketDefinition": {"status": "CLOSED"}}
+
+
+@pytest.fixture
+def writer():
+    writer = SharedBookWriter(SharedBookConfig(name=f"test-books-{uuid.uuid4().hex[:8]}",
+                                               max_slots=2, depth=3))
+    yield writer
+    writer.close()
+
+
+@pytest.fixture
+def reader(writer, monkeypatch):
+    # The region is tracked by the writer, which runs in the same process in these tests
+    monkeypatch.setattr(shared_books, "_untrack", lambda shm: None)
+    reader = SharedBookReader(writer.config.name)
+    yield reader
+    reader.close()
+
+
+def test_reader_gets_the_published_books(writer, reader, market_book):
+    assert reader.read(MARKETS[0], 1) is None
+
+    writer.process(market_book(MARKETS[0], 1000, runner_change(MARKETS[0], 1, 2, img=True)))
+    writer.process(market_book(MARKETS[0], 1100, {"id": MARKETS[0],
+                                                  "rc": [{"id": 2, "atb": [[1.99, 0]]}]}))
+
+    assert sorted(reader.runners()) == [(MARKETS[0], 1), (MARKETS[0], 2)]
+    book = reader.read(MARKETS[0], 1)
+    assert (book.publish_time, book.ltp, book.tv) == (1000, 2.0, 100.0)
+    assert book.atb == [[1.99, 10], [1.98, 5]]
+    assert book.atl == [[2.02, 20], [2.04, 30]]
+    book = reader.read(MARKETS[0], 2)
+    assert book.publish_time == 1100 and book.atb == [[1.98, 5]]
+
+
+def test_slots_of_closed_markets_are_reused(writer, reader, market_book):
+    writer.process(market_book(MARKETS[0], 1000, runner_change(MARKETS[0], 1, 2, img=True)))
+    assert reader.read(MARKETS[0], 1).publish_time == 1000
+    assert reader.read(MARKETS[0], 2).publish_time == 1000
+
+    # Every slot is taken by the open market
+    writer.process(market_book(MARKETS[1], 1000, runner_change(MARKETS[1], 3, img=True)))
+    assert reader.read(MARKETS[1], 3) is None
+
+    writer.process(market_book(MARKETS[0], 2000, closed(MARKETS[0])))
+    assert sorted(writer.free_slots) == [0, 1] and MARKETS[0] not in writer.books
+
+    writer.process(market_book(MARKETS[1], 3000, runner_change(MARKETS[1], 3, 4)))
+    assert sorted(writer.slots.values()) == [0, 1]
+    # The reader still has the slots of the closed market in its lookup
+    assert reader.read(MARKETS[0], 1) is None
+    assert reader.read(MARKETS[0], 2) is None
+    assert reader.read(MARKETS[1], 3).tv == 300.0
+    assert reader.read(MARKETS[1], 4).publish_time == 3000
+    assert sorted(reader.runners()) == [(MARKETS[1], 3), (MARKETS[1], 4)]
@@ -0,0 +1,99 @@
+import json
+import queue
+import time
+
+import pytest
+
+from stream.checkpoint import StreamPosition, subscription_key
+from stream.streaming import Streaming
+
+MARKET_ID = "1.200000001"
+MARKET_FILTER = {"market_type_codes": ["MATCH_ODDS"]}
+MARKET_DATA_FILTER = {"fields": ["EX_BEST_OFFERS"]}
+MARKET_DEFINITION = {
+    "status": "OPEN", "inPlay": False, "bettingType": "ODDS", "marketType": "MATCH_ODDS",
+    "eventId": "32000001", "eventTypeId": "1", "countryCode": "GB", "timezone": "GMT",
+    "marketTime": "2023-02-14T19:00:00.000Z", "openDate": "2023-02-14T19:00:00.000Z",
+    "suspendTime": "2023-02-14T19:00:00.000Z", "version": 1, "complete": True,
+    "bspMarket": False, "bspReconciled": False, "turnInPlayEnabled": True,
+    "persistenceEnabled": True, "crossMatching": True, "runnersVoidable": False,
+    "discountAllowed": True, "marketBaseRate": 5, "numberOfWinners": 1,
+    "numberOfActiveRunners": 1, "betDelay": 0, "regulators": ["MR_INT"],
+    "priceLadderDefinition": {"type": "CLASSIC"},
+    "runners": [{"id": 1096, "status": "ACTIVE", "sortPriority": 1}],
+}
+
+
+class FakeStream:
+    """ Subscribed betfairlightweight stream, recording the re-subscriptions """
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def subscribe_to_markets(self, **kwargs):
+        self.subscriptions.append(kwargs)
+        return len(self.subscriptions)
+
+
+def change_message(clk, publish_time, image=False):
+    market_change = {"id": MARKET_ID, "rc": [{"id": 1096, "atb": [[2.0, publish_time / 100]]}]}
+    if image:
+        market_change.update(img=True, marketDefinition=MARKET_DEFINITION)
+    message = {"op": "mcm", "id": 1, "clk": clk, "pt": publish_time, "mc": [market_change]}
+    if image:
+        message.update(initialClk="init", ct="SUB_IMAGE")
+    return json.dumps(message)
+
+
+@pytest.fixture
+def streaming():
+    """ Checkpointed stream with its listener registered, messages are fed to the listener """
+    streaming = Streaming(None, MARKET_FILTER, MARKET_DATA_FILTER, output_queue=queue.Queue(),
+                          stream_name="football", checkpoint=True)
+    streaming.listener.register_stream(1, "marketSubscription")
+    return streaming
+
+
+def queued(streaming):
+    items = []
+    while not streaming.output_queue.empty():
+        items.append(streaming.output_queue.get())
+    return items
+
+
+def test_market_books_are_stamped_with_their_message(streaming, monkeypatch):
+    monkeypatch.setattr(time, "time", lambda: 1676401200.5)
+    streaming.listener.on_data(change_message("clk1", 1000, image=True))
+    streaming.listener.on_data(change_message("clk2", 1100))
+    books = [item[0] for item in queued(streaming) if isinstance(item, list)]
+    assert [(book.receive_time, book.clk) for book in books] == [(1676401200500, "clk1"),
+                                                                 (1676401200500, "clk2")]
+    assert books[1].runners[0].ex.available_to_back[0].size == 11
+
+
+def test_positions_follow_the_market_books(streaming):
+    streaming.listener.on_data(change_message("clk1", 1000, image=True))
+    (market_book,), position = queued(streaming)
+    assert market_book.market_id == MARKET_ID
+    assert position == StreamPosition(
+        "football", "init", "clk1", market_ids=(MARKET_ID,),
+        subscription=subscription_key(MARKET_FILTER, MARKET_DATA_FILTER, None))
+
+    # The markets are only sent when they change
+    streaming.listener.on_data(change_message("clk2", 1100))
+    assert queued(streaming)[-1].market_ids is None
+
+
+def test_positions_are_checkpointed_with_the_current_conflation(streaming):
+    streaming.listener.on_data(change_message("clk1", 1000, image=True))
+    queued(streaming)
+    streaming.stream = FakeStream()
+    streaming.set_conflation(500)
+    assert streaming.stream.subscriptions == [{
+        "market_filter": MARKET_FILTER, "market_data_filter": MARKET_DATA_FILTER,
+        "conflate_ms": 500, "initial_clk": "init", "clk": "clk1"}]
+
+    streaming.listener.on_data(change_message("clk2", 1500))
+    position = queued(streaming)[-1]
+    assert position.clk == "clk2"
+    assert position.subscription == subscription_key(MARKET_FILTER, MARKET_DATA_FILTER, 500)
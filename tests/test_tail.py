@@ -0,0 +1,87 @@
+import os
+
+from stream.storage import tail
+from stream.storage.segments import SegmentCompressor, SegmentPolicy
+from stream.storage.tail import CaptureTailer
+from stream.writer.stream_writer import MarketFileBuffer
+
+EVENT, MARKET = "32000001", "1.200000001"
+
+
+def capture(data_location, market_book, publish_times, policy=None, compressor=None):
+    buffer = MarketFileBuffer(MARKET, data_location, max_size=100, segment_policy=policy,
+                              segment_compressor=compressor, index_interval=2)
+    for publish_time in publish_times:
+        buffer.push(market_book(MARKET, publish_time, {"id": MARKET, "pt": publish_time}))
+    buffer.write()
+
+
+def poll_times(tailer, max_packets=None):
+    return [timestamp for timestamp, _ in tailer.poll(max_packets)]
+
+
+def test_poll_returns_new_packets(data_location, market_book):
+    tailer = CaptureTailer(data_location, EVENT, MARKET)
+    assert tailer.poll() == []
+
+    capture(data_location, market_book, [1000, 2000, 3000])
+    assert poll_times(tailer, max_packets=2) == [1000, 2000]
+    assert poll_times(tailer) == [3000]
+    assert poll_times(tailer) == []
+
+    capture(data_location, market_book, [4000])
+    assert poll_times(tailer) == [4000]
+
+
+def test_partial_lines_are_read_once_complete(data_location, market_book):
+    capture(data_location, market_book, [1000])
+    tailer = CaptureTailer(data_location, EVENT, MARKET)
+    assert poll_times(tailer) == [1000]
+
+    path = os.path.join(data_location.data_path, EVENT, f"{MARKET}.txt")
+    with open(path, "rb") as file:
+        line = file.read()
+    with open(path, "ab") as file:
+        file.write(line[:10])
+    assert poll_times(tailer) == []
+    with open(path, "ab") as file:
+        file.write(line[10:])
+    assert poll_times(tailer) == [1000]
+
+
+def test_start_timestamp_skips_older_packets(data_location, market_book):
+    capture(data_location, market_book, [idx * 1000 for idx in range(6)])
+    tailer = CaptureTailer(data_location, EVENT, MARKET, start_timestamp=3500)
+    assert poll_times(tailer) == [4000, 5000]
+
+
+def test_compressed_segments_are_decompressed_once(data_location, market_book, monkeypatch):
+    opened = []
+    open_segment = tail.open_segment
+
+    def count_open(path):
+        opened.append(os.path.basename(path))
+        return open_segment(path)
+
+    monkeypatch.setattr(tail, "open_segment", count_open)
+    policy = SegmentPolicy(max_bytes=1, compression="gzip")
+    compressor = SegmentCompressor("gzip")
+    compressor.start()
+    for batch in range(3):
+        capture(data_location, market_book, [batch * 3000 + idx * 1000 for idx in range(3)],
+                policy, compressor)
+    compressor.stop()
+
+    tailer = CaptureTailer(data_location, EVENT, MARKET)
+    polled = []
+    while True:
+        times = poll_times(tailer, max_packets=2)
+        if not times:
+            break
+        polled += times
+    tailer.close()
+
+    assert polled == [idx * 1000 for idx in range(9)]
+    # Three restarted writers, each sealing its segment when the next one starts
+    assert opened.count(f"{MARKET}.00000.txt.gz") == 1
+    assert opened.count(f"{MARKET}.00001.txt.gz") == 1
@@ -0,0 +1,116 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from order_book.market_order_books import MarketOrderBooks
+from order_book.timeline import (EventTimeline, build_event_timeline, market_column,
+                                 runner_column)
+from stream.writer.stream_writer import MarketFileBuffer
+
+EVENT = "32000001"
+MARKETS = ["1.200000001", "1.200000002"]
+
+
+def random_packets(count, seed=3):
+    """ Merged packets of two markets with runners appearing over time and full images """
+    generator = random.Random(seed)
+    packets = []
+    for idx in range(count):
+        market_id = generator.choice(MARKETS)
+        packet = {"id": market_id, "rc": []}
+        if generator.random() < 0.05:
+            packet["img"] = True
+        if generator.random() < 0.1:
+            packet["marketDefinition"] = {"inPlay": generator.random() < 0.5}
+        for runner_id in generator.sample(range(1, 6), generator.randint(0, 2)):
+            change = {"id": runner_id, "ltp": generator.choice([2.0, 2.5, 3.0]),
+                      "tv": float(idx)}
+            for side in ("atb", "atl"):
+                change[side] = [[generator.choice([1.5, 2.0, 2.5, 3.0]),
+                                 generator.choice([0, 0, 5, 10])]
+                                for _ in range(generator.randint(0, 2))]
+            packet["rc"].append(change)
+        packets.append((1000 + idx * 10, market_id, packet))
+    return packets
+
+
+def reference_rows(packets):
+    """ State of every runner after each packet, from the full books """
+    books = {market_id: MarketOrderBooks(market_id) for market_id in MARKETS}
+    in_play = {}
+    rows = []
+    for publish_time, market_id, packet in packets:
+        books[market_id].update(publish_time, packet)
+        if "marketDefinition" in packet:
+            in_play[market_id] = 1.0 if packet["marketDefinition"]["inPlay"] else 0.0
+        row = {market_column(market_id, "in_play"): value for market_id, value in in_play.items()}
+        for book_market_id, market_books in books.items():
+            for selection_id, book in market_books.runners.items():
+                backs = [price for price, volume in book.atb_book.items() if volume > 0]
+                lays = [price for price, volume in book.atl_book.items() if volume > 0]
+                back = max(backs) if backs else None
+                lay = min(lays) if lays else None
+                state = {"ltp": book.ltp or np.nan, "tv": book.tv,
+                         "back": np.nan if back is None else back,
+                         "back_size": np.nan if back is None else book.atb_book[back],
+                         "lay": np.nan if lay is None else lay,
+                         "lay_size": np.nan if lay is None else book.atl_book[lay]}
+                row.update({runner_column(book_market_id, selection_id, field): value
+                            for field, value in state.items()})
+        rows.append(row)
+    return rows
+
+
+def test_chunks_match_the_full_books():
+    packets = random_packets(400)
+    chunks = list(build_event_timeline(packets, chunk_rows=64))
+    assert [len(chunk) for chunk in chunks] == [64] * 6 + [16]
+
+    expected = reference_rows(packets)
+    row = 0
+    for chunk in chunks:
+        for idx in range(len(chunk)):
+            assert chunk.time[idx] == packets[row][0] and chunk.market_id[idx] == packets[row][1]
+            actual = dict(zip(chunk.columns, chunk.values[idx]))
+            # Runners removed by an image are NaN, never seen columns are missing
+            actual = {column: value for column, value in actual.items()
+                      if column in expected[row] or not np.isnan(value)}
+            assert actual.keys() == expected[row].keys()
+            for column, value in expected[row].items():
+                assert actual[column] == pytest.approx(value, nan_ok=True), (row, column)
+            row += 1
+
+
+def test_last_change_of_a_packet_wins():
+    timeline = EventTimeline(runner_fields=["back"], chunk_rows=10)
+    timeline.update(1000, MARKETS[0], {"id": MARKETS[0], "rc": [
+        {"id": 1, "atb": [[2.0, 5]]}, {"id": 1, "atb": [[2.2, 5]]}]})
+    timeline.update(1100, MARKETS[0], {"id": MARKETS[0], "rc": [{"id": 1, "atb": [[2.2, 0]]}]})
+
+    chunk = timeline.flush()
+    assert chunk.column(runner_column(MARKETS[0], 1, "back")).tolist() == [2.2, 2.0]
+    frame = chunk.to_frame()
+    assert list(frame.columns) == ["market_id", runner_column(MARKETS[0], 1, "back")]
+    assert frame.index[0] == pd.Timestamp(1000, unit="ms", tz="UTC")
+
+    with pytest.raises(ValueError):
+        EventTimeline(runner_fields=["ltp", "vwap"])
+
+
+def test_event_timeline_of_the_captures(data_location, market_book):
+    for market_id, publish_times in zip(MARKETS, [[1000, 3000], [2000]]):
+        buffer = MarketFileBuffer(market_id, data_location, max_size=100)
+        for publish_time in publish_times:
+            buffer.push(market_book(market_id, publish_time, {
+                "id": market_id, "rc": [{"id": 1096, "ltp": publish_time / 1000}]}))
+        buffer.write()
+
+    (chunk,) = data_location.iter_event_timeline(EVENT, ["ltp"])
+    assert chunk.time.tolist() == [1000, 2000, 3000]
+    assert chunk.market_id.tolist() == [MARKETS[0], MARKETS[1], MARKETS[0]]
+    np.testing.assert_array_equal(chunk.column(runner_column(MARKETS[0], 1096, "ltp")),
+                                  [1.0, 1.0, 3.0])
+    np.testing.assert_array_equal(chunk.column(runner_column(MARKETS[1], 1096, "ltp")),
+                                  [np.nan, 2.0, 2.0])
@@ -0,0 +1,74 @@
+import random
+
+import numpy as np
+
+from order_book.trade_tape import TradeTapeBuilder, extract_trade_tape, traded_deltas
+
+MARKET = "1.200000001"
+
+
+def packet(*changes, img=False):
+    update = {"id": MARKET, "rc": [{"id": runner_id, "trd": trd} for runner_id, trd in changes]}
+    return dict(update, img=True) if img else update
+
+
+PACKETS = [
+    (1000, packet((1, [[2.0, 100], [2.1, 50]]), (2, [[3.0, 10]]), img=True)),
+    (1100, packet((1, [[2.0, 110]]))),
+    (1200, packet((1, [[2.2, 5]]), (2, [[3.0, 12], [3.1, 1]]))),
+    # Corrections lower the cumulative volume without a print
+    (1300, packet((1, [[2.0, 105]]))),
+    (1400, packet((1, [[2.0, 106]]))),
+    # A new image after a reconnect only prints what traded since the last update
+    (1500, packet((1, [[2.0, 106], [2.1, 55], [2.3, 70]]), img=True)),
+]
+
+
+def test_traded_deltas():
+    book = {2.0: 100.0}
+    assert traded_deltas(book, [[2.0, 110], [2.1, 5]]) == [(2.0, 10), (2.1, 5)]
+    assert traded_deltas(book, [[2.0, 110], [2.1, 5]], image=True) == [(2.0, 10)]
+    assert traded_deltas(book, [[2.0, 90]]) == []
+    assert book == {2.0: 100.0}
+
+
+def test_incremental_tape():
+    builder = TradeTapeBuilder()
+    prints = [trade for publish_time, update in PACKETS
+              for trade in builder.update(publish_time, update)]
+
+    assert prints == [(1100, 1, 2.0, 10), (1200, 1, 2.2, 5), (1200, 2, 3.0, 2),
+                      (1200, 2, 3.1, 1), (1400, 1, 2.0, 1), (1500, 1, 2.1, 5)]
+    columns = builder.tape.to_columns()
+    assert columns["size"].tolist() == [trade[3] for trade in prints]
+    assert TradeTapeBuilder(keep_tape=False).tape is None
+
+
+def assert_same_tape(packets):
+    builder = TradeTapeBuilder()
+    for publish_time, update in packets:
+        builder.update(publish_time, update)
+    expected = builder.tape.to_columns()
+    tape = extract_trade_tape(packets)
+    for column in expected:
+        np.testing.assert_array_equal(tape[column], expected[column])
+
+
+def test_vectorized_tape_matches_the_incremental_tape():
+    assert_same_tape(PACKETS)
+    assert len(extract_trade_tape([])["timestamp"]) == 0
+
+    generator = random.Random(7)
+    volumes = {}
+    packets = []
+    for idx in range(500):
+        changes = []
+        for runner_id in generator.sample([1, 2, 3], generator.randint(1, 3)):
+            levels = []
+            for price in generator.sample([1.5, 1.6, 1.7, 1.8], generator.randint(1, 2)):
+                key = (runner_id, price)
+                volumes[key] = max(volumes.get(key, 0) + generator.randint(-2, 20), 0)
+                levels.append([price, volumes[key]])
+            changes.append((runner_id, levels))
+        packets.append((1000 + idx * 100, packet(*changes, img=generator.random() < 0.05)))
+    assert_same_tape(packets)